@@ -1,18 +1,39 @@
-import requests
+import asyncio
 import subprocess
 import signal
 import os
+from contextlib import asynccontextmanager
+
+import httpx
 import uvicorn
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
 import time
 import threading
 
-from health_check.connections_counter import read_counter, initialize_counter_file
 from health_check.common import get_streamlit_url
-
-app = FastAPI()
+from qa_agent.metrics import render
+from qa_agent.job_runner import JobStore
+from qa_agent.run_registry import run_registry
 
 STREAMLIT_URL = get_streamlit_url()
+# probes within this many seconds share one check of Streamlit
+READYZ_TTL = 5.0
+job_store = JobStore()
+# one pooled client with strict timeouts, a hanging Streamlit fails the probe instead of piling probes up
+streamlit_client = httpx.AsyncClient(timeout=httpx.Timeout(2.0, connect=1.0),
+                                     limits=httpx.Limits(max_connections=2, max_keepalive_connections=1))
+_readiness = {"checked_at": 0.0, "result": None}
+_readiness_lock = asyncio.Lock()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await streamlit_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get('/livez')
@@ -20,10 +41,9 @@ def get_livez():
     return {'status': 'ok'}
 
 
-@app.get('/readyz')
-def get_readyz():
+async def check_streamlit() -> dict:
     try:
-        r = requests.get(STREAMLIT_URL)
+        r = await streamlit_client.get(STREAMLIT_URL)
         if r.status_code == 200:
             return {"status": True}
         else:
@@ -32,16 +52,49 @@ def get_readyz():
         return {"status": False, "error": str(e)}
 
 
+@app.get('/readyz')
+async def get_readyz():
+    """
+    Streamlit health, cached for READYZ_TTL seconds. Concurrent probes wait for the one check in flight.
+    """
+    async with _readiness_lock:
+        if _readiness["result"] is None or time.monotonic() - _readiness["checked_at"] > READYZ_TTL:
+            _readiness["result"] = await check_streamlit()
+            _readiness["checked_at"] = time.monotonic()
+        return _readiness["result"]
+
+
 @app.get("/openConnections")
 def open_connections():
     """
-    API endpoint to retrieve the global count of open connections.
+    API endpoint to retrieve the global count of open connections: open page requests, running generation runs
+    (jobs, batch sheets) and queued jobs. A request is unregistered once its job is submitted, the job keeps the
+    count up until it ends, so a drain on this count does not shut down running generations.
     """
-    count = read_counter()
+    count = len(run_registry.active()) + job_store.counts()["queued"]
     print(f"Current open connections: {count}")
     return {"open_connections": count}
 
 
+@app.get("/activeRuns")
+def active_runs():
+    """
+    Open requests and generation runs (jobs, batch sheets) with their start time and scenario progress.
+    """
+    runs = run_registry.active()
+    return {"active_runs": len([run for run in runs if run["kind"] != "request"]), "runs": runs}
+
+
+@app.get("/metrics")
+def get_metrics():
+    """
+    Prometheus scrape endpoint: the counters and histograms recorded by the app and job worker processes,
+    plus the queued and running generation jobs.
+    """
+    gauges = {("qa_runs", (("state", state),)): count for state, count in job_store.counts().items()}
+    return PlainTextResponse(render(gauges=gauges), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/shutdown")
 def shutdown():
     try:
@@ -76,6 +129,5 @@ def shutdown():
         raise HTTPException(status_code=500, detail=f"Failed to shutdown Streamlit: {str(e)}")
 
 
-if _name_ == "_main_":
-    initialize_counter_file()
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=8000)
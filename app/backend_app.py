@@ -1,6 +1,7 @@
 import streamlit as st
 
 from qa_agent.graph_steps2 import QAGraph
+from qa_agent.message_window import archive_run
 
 from pprint import pprint
 import json
@@ -10,6 +11,7 @@ from openai import OpenAI
 import threading
 
 import time
+import uuid
 
 st.set_page_config(layout="wide")
 
@@ -386,7 +388,9 @@ def downloaders():
 
 
 #---------------------------------------- Stage Handling  -----------------------------------------------------
-thread_config = {"configurable": {"thread_id": 1}}
+def new_thread_config() -> dict:
+    # a checkpoint thread per request, concurrent sessions never share checkpoints
+    return {"configurable": {"thread_id": str(uuid.uuid4())}}
 
 def get_required_values(data, required_keys):
     """Recursively searches for required keys in a nested dictionary and returns their values.
@@ -500,9 +504,10 @@ def get_progress_data(node_state:dict,global_state:dict):
 
 def run_qa_graph(inputs):
     graph_with_memory = st.session_state['graph_with_memory']
+    thread_config = new_thread_config()
     print("Running stage 1 graph id ~~~~~~~~~~~~~~~~~~: ",graph_with_memory)
     
-    with st.status("Generating Test Cases .. ") as status:
+    with archive_run(thread_config['configurable']['thread_id']), st.status("Generating Test Cases .. ") as status:
         #status.update(label="Processing Files.. ",expanded=True)
         # update staus as per first test type
         id,test_type = inputs.get('current_test_type')
@@ -517,7 +522,6 @@ def run_qa_graph(inputs):
             print("()"*100)
             #st.session_state['test_list_data'] = output
             #placeholder.json(st.session_state['test_list_data'])
-            time.sleep(1)
             # Update Progress
             
             label,json_data = get_progress_data(output,global_state)
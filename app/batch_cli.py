@@ -0,0 +1,226 @@
+"""
+Headless test case generation for a directory of approved scenario sheets.
+
+Every *.xlsx / *.csv sheet in the directory (columns scenarioDescription, expectedResults) is run through
+QAGraph.astream_scenarios. Documents in a sub directory named like the sheet (orders.xlsx -> orders/) are
+attached to that sheet only, other documents next to the sheets are attached to every sheet. YAML files are
+treated as OpenAPI specs and converted to JSON.
+
+Test cases are appended to <output>/test_cases.jsonl as every scenario finishes. With --format parquet every
+finished scenario is also added as a row group to <output>/<sheet>.parquet, which becomes readable once its sheet
+finishes (JSONL is the output to follow during a run). Pass the --run-id of an interrupted run to
+continue it, finished scenarios are read back from their checkpoints.
+Run from the app directory:  python -m batch_cli scenarios/ --output out/ --files 2 --workers 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from common.utils import load_app_config
+
+load_app_config()
+from qa_agent.tc_graph import QAGraph, max_scenario_workers
+from qa_agent.checkpoint_store import checkpoint_store, checkpoint_store_path, run_config
+from qa_agent.document_store import file_search_attachments
+from qa_agent.upload_pipeline import UploadPipeline, is_yaml
+from qa_agent.result_accumulator import ParquetRowGroupWriter, parquet_available
+from qa_agent.run_registry import run_registry
+
+if parquet_available:
+    import pyarrow
+
+sheet_extensions = (".xlsx", ".csv")
+attachment_extensions = (".pdf", ".docx", ".doc", ".txt", ".md", ".json", ".yaml", ".yml", ".html")
+
+
+def read_scenarios(path: str) -> list:
+    df = pd.read_csv(path) if path.lower().endswith(".csv") else pd.read_excel(path)
+    return [(idx + 1, (row['scenarioDescription'], row['expectedResults'])) for idx, row in df.iterrows()]
+
+
+def attachment_files(directory: str) -> list[str]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.lower().endswith(attachment_extensions) and os.path.isfile(os.path.join(directory, name)))
+
+
+def find_sheets(directory: str) -> list[tuple[str, list[str]]]:
+    """
+    (sheet path, attachment paths) of every scenario sheet in directory.
+    """
+    shared = attachment_files(directory)
+    sheets = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.lower().endswith(sheet_extensions) and not name.startswith("~$") and os.path.isfile(path):
+            stem = os.path.splitext(name)[0]
+            sheets.append((path, shared + attachment_files(os.path.join(directory, stem))))
+    return sheets
+
+
+class BatchWriter:
+    """
+    Appends finished scenarios to the JSONL output, scenarios written by an earlier attempt of the run are skipped.
+    """
+
+    def __init__(self, output: str):
+        self.path = os.path.join(output, "test_cases.jsonl")
+        self.written = set()
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    row = json.loads(line)
+                    self.written.add((row['sheet'], row['scenario_id']))
+
+    def write(self, sheet: str, scenario_id, scenario, test_cases: list) -> bool:
+        with self._lock:
+            if (sheet, scenario_id) in self.written:
+                return False
+            with open(self.path, "a", encoding="utf-8") as f:
+                for test_case in test_cases:
+                    row = {'sheet': sheet, 'scenario_id': scenario_id, 'scenario': scenario, **test_case}
+                    f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+            self.written.add((sheet, scenario_id))
+            return True
+
+
+class BatchStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sheets = 0
+        self.scenarios = 0
+        self.test_cases = 0
+        self.errors = 0
+        self.tokens = 0
+        self.cost = 0.0
+
+    def add_usage(self, tc_graph: QAGraph):
+        usage = tc_graph.usage_tracker.summary()
+        self.tokens += usage['assistant']['total_tokens'] + usage['reflection']['total_tokens']
+        self.cost += usage['total_cost']
+
+    def summary(self) -> str:
+        elapsed = time.perf_counter() - self.started
+        return (f"{self.sheets} sheets, {self.scenarios} scenarios ({self.errors} failed), {self.test_cases} test cases "
+                f"in {elapsed:.0f}s: {self.scenarios / elapsed * 60:.1f} scenarios/min, "
+                f"{self.tokens / elapsed:.0f} tokens/s, {self.tokens} tokens, cost ${self.cost:.2f}")
+
+
+async def run_sheet(path: str, attachments: list[str], args, writer: BatchWriter, stats: BatchStats):
+    sheet = os.path.basename(path)
+    scenario_list = read_scenarios(path)
+    if not scenario_list:
+        print(f"{sheet}: no scenarios")
+        return
+    sheet_started = time.perf_counter()
+    uploads = UploadPipeline()
+    file_ids = []
+    tc_graph = QAGraph(args.checkpoint_path)
+    parquet = None
+    if args.format == "parquet":
+        # row groups come in the order the scenarios finish, scenario_id orders them
+        parquet = ParquetRowGroupWriter(os.path.join(args.output, os.path.splitext(sheet)[0] + ".parquet"),
+                                        {'scenario_id': pyarrow.int64(), 'scenario': pyarrow.string()})
+    try:
+        for attachment in attachments:
+            with open(attachment, "rb") as f:
+                content = f.read()
+            if is_yaml(attachment):
+                uploads.submit_openapi_spec(os.path.basename(attachment), content)
+            else:
+                uploads.submit(os.path.basename(attachment), content)
+        file_ids = await asyncio.to_thread(uploads.file_ids)
+
+        inputs = {'scenario_list': scenario_list, 'current_scenario': scenario_list[0], 'tech_stack': args.tech_stack}
+        if file_ids:
+            inputs['attachments'] = file_search_attachments(file_ids)
+        run_id = f"{args.run_id}-{os.path.splitext(sheet)[0]}"
+        config = run_config(run_id, {"recursion_limit": 10000})
+
+        async with tc_graph:
+            graph = await tc_graph.aget_sqlite_graph()
+            with run_registry.tracked("batch", run_id=run_id, scenarios_total=len(scenario_list)):
+                async for result in tc_graph.astream_scenarios(graph, inputs, config, args.workers):
+                    stats.scenarios += 1
+                    if result['error'] is not None:
+                        stats.errors += 1
+                        print(f"{sheet} scenario {result['scenario_id']} failed: {result['error']}")
+                        continue
+                    test_cases = result['test_details_list']
+                    stats.test_cases += len(test_cases)
+                    run_registry.scenario_finished(run_id, len(test_cases))
+                    writer.write(sheet, result['scenario_id'], result['scenario'][0], test_cases)
+                    if parquet is not None:
+                        parquet.append({'scenario_id': result['scenario_id'], 'scenario': result['scenario'][0]},
+                                       test_cases)
+                    print(f"{sheet} scenario {result['scenario_id']}/{len(scenario_list)}: {len(test_cases)} "
+                          f"test cases in {result['elapsed']:.0f}s")
+        if parquet is not None:
+            parquet.close()
+    finally:
+        if parquet is not None:
+            parquet.abort()
+        uploads.close()
+        await asyncio.to_thread(uploads.store.release, file_ids)
+        stats.sheets += 1
+        stats.add_usage(tc_graph)
+    print(f"{sheet}: {len(scenario_list)} scenarios in {time.perf_counter() - sheet_started:.0f}s, "
+          f"cost ${tc_graph.usage_tracker.total_cost():.2f}. Total: {stats.summary()}")
+
+
+async def run(args):
+    sheets = find_sheets(args.directory)
+    if not sheets:
+        print(f"No scenario sheets ({', '.join(sheet_extensions)}) found in {args.directory}")
+        return
+    os.makedirs(args.output, exist_ok=True)
+    print(f"Run {args.run_id}: {len(sheets)} sheets, {args.files} at a time, {args.workers} scenario workers each")
+    writer = BatchWriter(args.output)
+    stats = BatchStats()
+    semaphore = asyncio.Semaphore(args.files)
+
+    async def run_limited(path, attachments):
+        async with semaphore:
+            try:
+                await run_sheet(path, attachments, args, writer, stats)
+            except Exception as e:
+                print(f"{os.path.basename(path)} failed: {e}")
+
+    try:
+        await asyncio.gather(*[run_limited(path, attachments) for path, attachments in sheets])
+    finally:
+        await checkpoint_store.aclose()
+    print(f"Finished run {args.run_id}: {stats.summary()}")
+    print(f"Test cases written to {writer.path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", help="directory with the scenario sheets and their documents")
+    parser.add_argument("--output", default="batch_output", help="directory for the results")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl",
+                        help="parquet also writes a .parquet file per sheet, JSONL is always written")
+    parser.add_argument("--files", type=int, default=2, help="sheets processed at the same time")
+    parser.add_argument("--workers", type=int, default=4,
+                        help=f"scenarios of a sheet processed at the same time (at most {max_scenario_workers})")
+    parser.add_argument("--tech-stack", choices=["Back End", "Front End"], default="Back End")
+    parser.add_argument("--run-id", default=f"batch-{datetime.now():%Y%m%d-%H%M%S}",
+                        help="pass the id of an interrupted run to continue it")
+    parser.add_argument("--checkpoint-path", default=checkpoint_store_path)
+    args = parser.parse_args()
+    if args.format == "parquet" and not parquet_available:
+        parser.error("--format parquet needs pyarrow")
+    args.files = max(1, args.files)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
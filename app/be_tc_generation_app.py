@@ -2,7 +2,11 @@ import streamlit as st
 from common.utils import load_app_config
 
 load_app_config()
-from qa_agent.tc_graph import QAGraph
+from qa_agent.document_store import document_store, file_search_attachments
+from qa_agent.result_accumulator import ResultAccumulator, export_formats
+from qa_agent.job_runner import job_runner, JobRejected, active_states, partial_state, describe_timing, \
+    JOB_POLL_INTERVAL
+from qa_agent.tracing import tracer
 
 from pprint import pprint
 import json
@@ -156,16 +160,14 @@ if 'skip_schema' not in st.session_state:
 if 'test_list_data' not in st.session_state:
     st.session_state.test_list_data = []
 
+if 'results' not in st.session_state:
+    st.session_state.results = ResultAccumulator()
+
 # Graph state
 
 if 'session_id' not in st.session_state:
     st.session_state['session_id'] = str(uuid.uuid4())
 
-if 'tc_graph_with_memory' not in st.session_state:
-    checkpoint_path = str(st.session_state['session_id']) + "_tc.sqlite"
-    lc_graph_with_memory = QAGraph(checkpoint_path)  # .get_sqlite_graph()
-    st.session_state['tc_graph_with_memory'] = lc_graph_with_memory
-
 if 'invoke_graph_button_clicked' not in st.session_state:
     st.session_state['invoke_graph_button_clicked'] = False
 # ----------------------------- Authentication code --------------------------------
@@ -289,38 +291,26 @@ def td_inputs():
 
 @st.fragment()
 def downloaders():
-    # initialize dataframe
-    df = pd.DataFrame()
-    print("Test List Data: ", st.session_state['test_list_data'])
-    for scenario in st.session_state['test_list_data']:
-        print("scenario: ", scenario)
-        # for test_details in scenario[1]:
-        print("test_details: ", scenario[1])
-        # Assign 'internal_class' 
-        temp_df = pd.DataFrame(scenario[1])
-        temp_df['scenario'] = scenario[0]
-
-        # append tests to a DataFrame
-        df = pd.concat([df, temp_df], ignore_index=True)
-        # Add the 'Result' column with labels
-    result_labels = ['Adopt', 'New Addition', 'Not Used(Basic)', 'Not Used(Irrelevant)', 'Not Used(Other)']
-    df['Result'] = result_labels * (len(df) // len(result_labels)) + result_labels[:len(df) % len(result_labels)]
-
-    # Create a BytesIO buffer to hold the XLS data
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Sheet1')
-        # writer.save()
-
-    # Prepare the buffer for download
-    xls_data = output.getvalue()
+    # results are accumulated as scenarios finish, the export is only rebuilt after new results arrived
+    results = st.session_state['results']
     st.download_button(
         label=f'Download test scenarios',
-        data=xls_data,  # json.dumps(test_list[1],indent=4),
+        data=results.export_bytes("xlsx"),
         file_name=f'test_scenarios.xlsx',
         mime="application/vnd.ms-excel",
         key=f"download_scenarios"
     )
+    for fmt in results.formats():
+        if fmt == "xlsx":
+            continue
+        file_name, mime = export_formats[fmt]
+        st.download_button(
+            label=f'Download test scenarios as {fmt.upper()}',
+            data=results.export_bytes(fmt),
+            file_name=file_name,
+            mime=mime,
+            key=f"download_scenarios_{fmt}"
+        )
 
 
 # ---------------------------------------- Stage Handling  -----------------------------------------------------
@@ -330,191 +320,90 @@ def sanitize_filename(filename):
     return re.sub(r'[<>:"/\\|?*]', '_', filename)
 
 
-thread_config = {
-    "recursion_limit": 10000,
-    "configurable": {
-        "thread_id": 1
-    }
-}
-
-
-def get_required_values(data, required_keys):
-    """Recursively searches for required keys in a nested dictionary and returns their values.
-
-    Args:
-        data: The dictionary to search within.
-        required_keys: List of keys to search for.
-
-    Returns:
-        A dictionary of found keys and their corresponding values.
+def attachable_job():
     """
-    found_values = {}
-
-    def recursive_search(d):
-        """Helper function to search for keys in a nested dictionary."""
-        if not isinstance(d, dict):
-            return False
-
-        for key in required_keys:
-            if key in d:
-                found_values[key] = d[key]
-            else:
-                for sub_key in d:
-                    if isinstance(d[sub_key], dict):
-                        recursive_search(d[sub_key])
-
-    recursive_search(data)
-    return found_values
-
-
-def get_progress_data(node_state: dict, global_state: dict):
-    print("start progress report")
-    stage_key = next(iter(node_state))
-    label = "Processing ..."
-    json_data = {}
-    id, current_scenario = global_state.values.get('current_scenario')
-    test_id, test_name = global_state.values.get('current_test', (0, ""))
-    scenario_list = global_state.values.get('scenario_list')
-    next_scenario = next((item for item in scenario_list if item[0] == (id + 1)), None)
-    next_scenario = next_scenario[1] if next_scenario else ""
-    # is_finished = global_state.values.get('is_finished_stage2',False)
-    # if is_finished:
-    #     return "complete",json_data
-    print("inited progress report")
-    if stage_key == 'assist_stage1':
-        print("assist1")
-        # print(graph_state_data.keys())
-
-        is_scenario_list_processed = node_state[stage_key].get('is_scenario_list_processed', False)
-        if is_scenario_list_processed:
-            label = f"Finished generating test cases ..."
-        else:
-            id, current_scenario = node_state[stage_key].get('current_scenario', (0, ""))
-            label = f'Verifying test scnarios for "{current_scenario[0]}"...'
-    elif stage_key == 'reflect_stage1':
-        print("reflect1")
-        stage1_results = get_required_values(node_state, ['is_finished_stage1'])
-        stage1_finished = stage1_results.get('is_finished_stage1', False)
-        is_scenario_list_processed = global_state.values.get('is_scenario_list_processed')
-
-        if is_scenario_list_processed:
-            label = f"Finished generating test cases for all the scenarios, please download !!!"
-        elif stage1_finished:
-            label = f"Identified following test cases, now generating {next_scenario} test cases ..."
-            print("~~~~~~~~~~~~~~~~~~~~~Stage 1 completed successfully")
-            # json_data = global_state.values.get('test_list')
-            # st.session_state['test_list_data'].append((current_scenario[0], json_data))
-
-            # # Download File
-            # st.download_button(     
-            #     label=f'Download Test File {current_scenario[0]}',
-            #     data=json.dumps(json_data,indent=4),
-            #     file_name="Test1.JSON",
-            #     mime="application/json",
-            #     key=f"download_TC_{current_scenario[0]}" 
-            # )
-        else:
-            print("~~~~~~~~~~~~~~~~~~~~~Stage 1 failed")
-            json_data = {'Error': f'Failed verifying test scenarios for {current_scenario[0]}, retrying!!'}
-
-    elif stage_key == 'assist_stage2':
-        print("assist2")
-        print("Node State: ", node_state[stage_key])
-        is_test_list_processed = node_state[stage_key].get('is_test_list_processed', False)
-        if is_test_list_processed:
-            label = f"Finished generating test case details ..."
-        else:
-            id, test_name = node_state[stage_key].get('current_test', (0, ""))
-            label = f'Verifying test case details for "{test_name}"...'
-        print("end assist2")
-    elif stage_key == 'reflect_stage2':
-        print("reflect2")
-        stage2_results = get_required_values(node_state, ['is_finished_stage2'])
-        stage2_finished = stage2_results.get('is_finished_stage2')
-        test_details_finished = global_state.values.get('is_test_list_processed')
-
-        if test_details_finished:
-            label = f"Finished generating test details ..."
-            # test_details_list
-            json_data = global_state.values.get('test_details_list')
-            st.session_state['test_list_data'].append((current_scenario[0], json_data))
-            # overwrite the test_list_data with the latest data here as we already appen in grpah state
-            # st.session_state['test_list_data'] = (current_scenario[0], json_data)
-            print("#$#$Test List Data: ", json_data)
-
-            # Dump json_data to a disk file
-            if JSON_DUMPS:
-                file_name = sanitize_filename(f'{current_scenario[0]}.JSON')
-                with open(file_name, "w") as f:
-                    json.dump(json_data, f, indent=4)
-
-            # Download File
-            st.download_button(
-                label=f"Download Test Case File {current_scenario[0]}",
-                data=json.dumps(json_data, indent=4),
-                file_name="Test2.JSON",
-                mime="application/json",
-                key=f"download_detailed_{current_scenario[0]}"
-            )
-        elif stage2_finished:
-            label = f"Generating test case details finished for {test_name} !!"
-            print("~~~~~~~~~~~~~~~~~~~~~Stage 2 completed successfully")
-            # json_data = global_state.values.get('test_list')    
-            # st.session_state['test_list_data'].append((test_name, json_data))
-            # print("#$#$Test List Data: ",json_data)
-            # # Download File
-            # st.download_button(
-            #     label=f"Download Test Case File {test_name['Title']}",
-            #     data=json.dumps(json_data,indent=4),
-            #     file_name="Test2.JSON",
-            #     mime="application/json",
-            #     key=f"download_detailed_{test_name['Title']}"
-            # )
-        else:
-            print("~~~~~~~~~~~~~~~~~~~~~Stage 2 failed")
-            label = f"Generating test case details failed for {test_name} !!, retrying..."
-        print("end progress report")
-    return label, json_data
-
-
-async def run_qa_graph(inputs):
-    tc_graph = st.session_state['tc_graph_with_memory']
-    print("Running stage 1 graph id ~~~~~~~~~~~~~~~~~~: ", tc_graph)
-
-    async with tc_graph:
-        graph_with_memory = await tc_graph.aget_sqlite_graph()
-        # graph_with_memory = tc_graph.get_sqlite_graph()
-
-        with st.status("Generating Test Cases .. ") as status:
-            # update staus as per first test type
-            id, current_scenario = inputs.get('current_scenario')
-            status.update(label=f"Processing {current_scenario} Cases", expanded=True)
-            placeholder = st.empty()
+    Job to (re)attach to: the one in the page URL, else the latest unfinished job of the user.
+    """
+    job_id = st.query_params.get('job') or st.session_state.get('job_id')
+    if job_id is None and 'user_info' in st.session_state:
+        active_jobs = job_runner.store.active(st.session_state['user_info'].get('email'))
+        job_id = active_jobs[0] if active_jobs else None
+    if job_id is None or st.session_state.get('loaded_job') == job_id:
+        return None
+    return job_id
 
-            async for output in graph_with_memory.astream(inputs, thread_config):
-                global_state = await graph_with_memory.aget_state(thread_config)
-                if LOG_LEVEL == "DEBUG":
-                    print("\nMemory --- Memoey\n")
-                    print("()" * 100)
-                    print("Node State: ", output)
-                    print("Global State", global_state)
-                    print("()" * 100)
-                # st.session_state['test_list_data'] = output
-                # placeholder.json(st.session_state['test_list_data'])
-                time.sleep(1)
-                # Update Progress
 
-                label, json_data = get_progress_data(output, global_state)
-                # expand if we have JSON data
-                do_expand = json_data != {}
+def follow_job(job_id):
+    """
+    Follow a generation job: job_progress refreshes its progress every JOB_POLL_INTERVAL seconds without holding
+    the script thread, and loads the results when it ends. The job itself runs in a worker process, so a reload
+    or rerun of the page only detaches from it.
+    """
+    st.session_state['job_id'] = job_id
+    st.query_params['job'] = job_id
+    if st.session_state.get('followed_job') != job_id:
+        st.session_state['followed_job'] = job_id
+        st.session_state['job_last_event'] = 0
+        st.session_state['job_errors'] = []
+    job_progress(job_id)
+
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def job_progress(job_id):
+    job = job_runner.store.get(job_id)
+    if job is None:
+        # nothing to follow, do not try again on every rerun
+        finish_job(job_id, f"Unknown generation job {job_id}", "error")
+        return
+    events = job_runner.store.events(job_id, after=st.session_state['job_last_event'])
+    if events:
+        with tracer.span("ui_update", run_id=job_id, events=len(events)):
+            for event in events:
+                st.session_state['job_last_event'] = event['id']
+                print(f"job: {job_id} {event['label']}")
+                if event['kind'] in ('NodeError', 'ScenarioFailed'):
+                    st.session_state['job_errors'].append(event['label'])
+    if job['status'] in active_states:
+        label = job['label']
+        if job['status'] == 'queued':
+            label = f"Waiting for a free worker, {job_runner.store.position(job_id)} jobs ahead .."
+        with st.status(label, expanded=True):
+            if job['status'] == 'running':
+                # wall time against the summed scenario times, the speedup of the parallel scenario workers
+                st.write(describe_timing(job_runner.store.timing(job_id), len(job['inputs']['scenario_list'])))
+            for error in st.session_state['job_errors']:
+                st.json({'Error': error})
+        return
+
+    if job['status'] == 'failed':
+        finish_job(job_id, f"Generating test cases failed: {job['error']}", "error")
+        return
+    st.session_state['test_list_data'] = []
+    st.session_state['results'].clear()
+    for scenario, test_cases in job_runner.store.results(job_id):
+        st.session_state['test_list_data'].append((scenario, test_cases))
+        st.session_state['results'].append(scenario, test_cases)
+    timing = describe_timing(job_runner.store.timing(job_id), len(job['inputs']['scenario_list']))
+    print(f"job: {job_id} {timing}")
+    if job['status'] == partial_state:
+        finish_job(job_id, f"{job['error']}. {timing}, cost ${job['cost']:.2f}, please download !!!", "error")
+        return
+    finish_job(job_id, f"{timing}, cost ${job['cost']:.2f}, please download !!!", "complete")
+
+
+def finish_job(job_id, label, state):
+    """
+    Stop following job_id and rerun the whole page, which shows the outcome and the loaded results.
+    """
+    st.session_state['loaded_job'] = job_id
+    st.session_state['job_outcome'] = (job_id, label, state)
+    st.rerun()
 
-                if label == "complete":
-                    status.update(label="Processing Completed", expanded=do_expand, state="complete")
-                else:
-                    status.update(label=label, expanded=do_expand)
-                placeholder.json(json_data)
 
-        # -------------------------------------------------------------------------------------------------------------
+def job_outcome():
+    outcome = st.session_state.get('job_outcome')
+    if outcome is not None and outcome[0] == st.session_state.get('job_id'):
+        st.status(outcome[1], state=outcome[2], expanded=outcome[2] == "error")
 
 
 # ---------------------------------------- UI   -----------------------------------------------------
@@ -525,14 +414,11 @@ def process_button():
             placeholder = st.empty()
             placeholder.write('Processing files...')
 
+            uploaded_file_ids = []
+            job_id = None
             try:
-                # Create file and attachment (Uploads the user provided file to OpenAI)        
-                client = OpenAI()
-                file_attachments = []
-                td_file = None
-                frd_file = None
-                schema_file = None
-                figma_file = None
+                # Upload the user provided files to OpenAI, documents uploaded before are reused
+                documents = []
                 scenario_list = []
 
                 # read scenario document
@@ -549,42 +435,21 @@ def process_button():
                 # Add schema_file if uploaded
                 if st.session_state.schema_doc is not None:
                     schema_doc = st.session_state.schema_doc
-                    schema_file = client.files.create(
-                        file=schema_doc, purpose="assistants"
-                    )
-
-                    file_attachments.append({
-                        "file_id": schema_file.id,
-                        "tools": [{"type": "file_search"}]
-                    })
+                    documents.append((schema_doc.name, schema_doc.getvalue()))
 
                 # Add tech_design_file if uploaded
                 if st.session_state.tech_design is not None:
                     tech_design_doc = st.session_state.tech_design
-                    td_file = client.files.create(
-                        file=tech_design_doc, purpose="assistants"
-                    )
-
-                    # add td and frd files to attachments if present
-                    file_attachments.append(
-                        {
-                            "file_id": td_file.id,
-                            "tools": [{"type": "file_search"}]
-                        }
-                    )
+                    documents.append((tech_design_doc.name, tech_design_doc.getvalue()))
 
                 # Add frd_document_file if uploaded
                 if st.session_state.frd_document is not None:
                     frd_doc = st.session_state.frd_document
+                    documents.append((frd_doc.name, frd_doc.getvalue()))
 
-                    frd_file = client.files.create(
-                        file=frd_doc, purpose="assistants"
-                    )
-
-                    file_attachments.append({
-                        "file_id": frd_file.id,
-                        "tools": [{"type": "file_search"}]
-                    })
+                # all documents are uploaded in parallel
+                uploaded_file_ids = document_store.acquire_many(documents)
+                file_attachments = file_search_attachments(uploaded_file_ids)
 
                 attachment_input = {"attachments": file_attachments}
                 st.session_state['uploaded_td_file'] = attachment_input
@@ -602,24 +467,30 @@ def process_button():
                 # thread.start()
                 # time.sleep(5)
                 placeholder.write('Generating Test cases ...')
-                # run_qa_graph(inputs)
-                asyncio.run(run_qa_graph(inputs))
+                # the run goes to a worker process, the page only follows it and can re-attach after a reload
+                job_id = job_runner.submit(inputs, owner=st.session_state['user_info'].get('email'))
+                # the job releases the uploaded files once it is done
+                uploaded_file_ids = []
 
+            except JobRejected as e:
+                placeholder.write(str(e))
             except Exception as e:
                 print("Error: ", e)
                 traceback.print_exc()
                 placeholder.write('Error processing files...')
 
             finally:
-                # cleanup files
-                if schema_file:
-                    client.files.delete(schema_file.id)
-                if td_file:
-                    client.files.delete(td_file.id)
-                if frd_file:
-                    client.files.delete(frd_file.id)
-                if figma_file:
-                    client.files.delete(figma_file.id)
+                # release the uploaded files, they stay available for the next run
+                document_store.release(uploaded_file_ids)
+            if job_id is not None:
+                # followed below, like a job the page re-attaches to
+                st.session_state['job_id'] = job_id
+                st.query_params['job'] = job_id
+    job_id = attachable_job()
+    if job_id is not None:
+        follow_job(job_id)
+    else:
+        job_outcome()
 
 
 # Function to create a bordered container with a given title and content
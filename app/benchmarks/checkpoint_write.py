@@ -0,0 +1,73 @@
+"""
+Micro-benchmark: checkpoint write latency versus state size.
+
+Compares the per-run AsyncSqliteSaver.from_conn_string checkpointer QAGraph used to open with the shared
+checkpoint store (WAL, synchronous=NORMAL, run registry). Every write stores a message_history of the given
+number of messages, like a graph step does.
+Run from the app directory:  python -m benchmarks.checkpoint_write --writes 200 --messages 1 20 100 400
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from langchain.schema import AIMessage, HumanMessage
+from langgraph.checkpoint.base import empty_checkpoint
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+from qa_agent.checkpoint_store import CheckpointStore
+
+
+def make_state(message_count: int, message_chars: int) -> dict:
+    messages = [(HumanMessage if i % 2 == 0 else AIMessage)(content="x" * message_chars) for i in range(message_count)]
+    return {"message_history": messages, "test_list": [(i + 1, {"Title": f"test {i + 1}"}) for i in range(20)]}
+
+
+async def time_writes(saver, state: dict, writes: int, thread_id: str) -> list[float]:
+    config = {"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}}
+    samples = []
+    for _ in range(writes):
+        checkpoint = empty_checkpoint()
+        checkpoint["channel_values"] = state
+        started = time.perf_counter()
+        config = await saver.aput(config, checkpoint, {"source": "loop", "step": 0, "writes": {}}, {})
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def summarize(label, samples):
+    samples_ms = sorted(sample * 1000 for sample in samples)
+    p95 = samples_ms[int(len(samples_ms) * 0.95) - 1]
+    print(f"{label:<34} mean {statistics.mean(samples_ms):8.3f} ms   "
+          f"median {statistics.median(samples_ms):8.3f} ms   p95 {p95:8.3f} ms")
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        store = CheckpointStore()
+        store_saver = await store.saver(os.path.join(directory, "store.sqlite"))
+        async with AsyncSqliteSaver.from_conn_string(os.path.join(directory, "per_run.sqlite")) as per_run_saver:
+            for message_count in args.messages:
+                state = make_state(message_count, args.message_chars)
+                state_kb = len(per_run_saver.serde.dumps_typed(state)[1]) / 1024
+                print(f"\n{message_count} messages, ~{state_kb:.0f} KB state, {args.writes} writes")
+                summarize("per-run AsyncSqliteSaver", await time_writes(per_run_saver, state, args.writes,
+                                                                       f"per-run-{message_count}"))
+                summarize("checkpoint store", await time_writes(store_saver, state, args.writes,
+                                                               f"store-{message_count}"))
+        await store.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writes", type=int, default=200)
+    parser.add_argument("--messages", type=int, nargs="+", default=[1, 20, 100, 400],
+                        help="message_history lengths to benchmark")
+    parser.add_argument("--message-chars", type=int, default=2000, help="characters per message")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
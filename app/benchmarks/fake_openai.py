@@ -0,0 +1,422 @@
+"""
+Offline stand-in for the parts of the OpenAI API the graphs use: files, Assistants threads / messages / runs
+and chat completions with tool calls.
+
+Runs are answered by polling or, for stream=True, as server-sent events with the answer split into deltas.
+Assistant answers are shaped after the prompt (scenario test lists, test case details, single and batch test
+type classification), reflection calls answer the first tool of the request. Latencies are drawn from a lognormal
+distribution, a share of requests is answered with 429 and a share of assistant answers carries malformed JSON.
+Point the OpenAI clients at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1, GET /_fake/stats returns the
+request counters.
+Run from the app directory:  python -m benchmarks.fake_openai --port 8765 --run-latency 2 --rate-limit-rate 0.02
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import random
+import re
+import socket
+import threading
+import time
+import urllib.request
+import uuid
+from collections import Counter
+from dataclasses import dataclass, asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+@dataclass
+class FakeConfig:
+    # median seconds until a run completes / a chat completion returns, lognormal with the given sigma
+    run_latency: float = 1.0
+    chat_latency: float = 0.3
+    latency_sigma: float = 0.5
+    # share of requests answered with 429 and of assistant answers with truncated JSON
+    rate_limit_rate: float = 0.0
+    malformed_rate: float = 0.0
+    # share of reflections which ask for a revision
+    revision_rate: float = 0.0
+    tests_per_scenario: int = 5
+    poll_after_ms: int = 100
+    retry_after_ms: int = 200
+    seed: int = 0
+
+
+# streamed runs: share of the run latency before the first delta, deltas per answer
+FIRST_DELTA_SHARE = 0.3
+STREAM_CHUNKS = 20
+
+
+def _id(prefix: str) -> str:
+    return f"{prefix}_{uuid.uuid4().hex[:24]}"
+
+
+def _words(count: int) -> str:
+    return " ".join(random.choice(("verify", "request", "response", "export", "flow", "mapping", "error", "field"))
+                    for _ in range(count))
+
+
+class FakeOpenAIState:
+    def __init__(self, config: FakeConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.threads = {}
+        self.runs = {}
+        self.files = {}
+        self.stats = Counter()
+
+    def latency(self, median: float) -> float:
+        if median <= 0:
+            return 0.0
+        with self.lock:
+            return self.random.lognormvariate(math.log(median), self.config.latency_sigma)
+
+    def chance(self, rate: float) -> bool:
+        with self.lock:
+            return self.random.random() < rate
+
+    def answer(self, prompt: str) -> dict:
+        batch = [int(index) for index in re.findall(r"## Test Case (\d+):", prompt)]
+        if batch:
+            return {"test_types": [{"index": index, "Test_Type": "Component", "Reason": _words(12)} for index in batch]}
+        if "componant level" in prompt or "Component level or End-to-End" in prompt:
+            return {"Test_Type": "Component", "Reason": _words(12)}
+        if "Generate comprehensive test case details" in prompt or "Generate UI test case details" in prompt:
+            return {"test_list": [{"Test_Steps": _words(40), "Request_Body": {"name": "x"}, "Response": {"status": 200},
+                                   "Expected_Result": _words(15)}]}
+        return {"test_list": [{"Title": f"{_words(6)} {i + 1}", "Type": "Functional", "Pre_Conditions": _words(20)}
+                              for i in range(self.config.tests_per_scenario)]}
+
+    def assistant_output(self, prompt: str) -> str:
+        output = json.dumps(self.answer(prompt))
+        if self.chance(self.config.malformed_rate):
+            self.stats["malformed"] += 1
+            return output[:len(output) // 2]
+        return output
+
+
+def _usage(prompt: str, completion: str) -> dict:
+    prompt_tokens, completion_tokens = len(prompt) // 4 + 1, len(completion) // 4 + 1
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+def _message(thread_id: str, role: str, text: str, run_id: str = None) -> dict:
+    return {"id": _id("msg"), "object": "thread.message", "created_at": int(time.time()), "thread_id": thread_id,
+            "role": role, "content": [{"type": "text", "text": {"value": text, "annotations": []}}],
+            "assistant_id": None, "run_id": run_id, "attachments": [], "metadata": {}, "status": "completed"}
+
+
+def _message_text(message: dict) -> str:
+    content = message.get("content", "")
+    if isinstance(content, str):
+        return content
+    return "".join(part.get("text", "") if isinstance(part.get("text"), str) else part.get("text", {}).get("value", "")
+                   for part in content if isinstance(part, dict))
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    state: FakeOpenAIState = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        self.send_header("x-ratelimit-remaining-requests", "10000")
+        self.send_header("x-ratelimit-limit-requests", "10000")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self) -> dict:
+        length = int(self.headers.get("content-length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        if self.headers.get("content-type", "").startswith("multipart/form-data"):
+            filename = re.search(rb'filename="([^"]*)"', raw)
+            return {"filename": filename.group(1).decode() if filename else "upload", "bytes": len(raw)}
+        return json.loads(raw) if raw else {}
+
+    def _route(self, method: str):
+        state = self.state
+        path = self.path.split("?", 1)[0]
+        if path == "/_fake/stats":
+            return self._send(200, {"stats": dict(state.stats), "config": asdict(state.config)})
+        path = path[len("/v1"):] if path.startswith("/v1") else path
+        body = self._body() if method == "POST" else {}
+        route = re.sub(r"/(thread|run|msg|file)[-_][A-Za-z0-9]+", r"/{\1}", path)
+        state.stats[f"{method} {route}"] += 1
+        if method == "POST" and state.chance(state.config.rate_limit_rate):
+            state.stats["rate_limited"] += 1
+            return self._send(429, {"error": {"message": "Rate limit reached for requests", "type": "requests",
+                                              "code": "rate_limit_exceeded"}},
+                              {"retry-after-ms": str(state.config.retry_after_ms)})
+        parts = [part for part in path.split("/") if part]
+        handler = getattr(self, "_" + "_".join([method.lower()] + [p if not re.match(r"(thread|run|msg|file)[-_]", p)
+                                                                     else "id" for p in parts]), None)
+        if handler is None:
+            return self._send(404, {"error": {"message": f"fake_openai does not implement {method} {path}"}})
+        return handler(parts, body)
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_DELETE(self):
+        self._route("DELETE")
+
+    # files
+    def _post_files(self, parts, body):
+        file = {"id": _id("file"), "object": "file", "bytes": body.get("bytes", 0), "created_at": int(time.time()),
+                "filename": body.get("filename", "upload"), "purpose": "assistants", "status": "processed"}
+        self.state.files[file["id"]] = file
+        self._send(200, file)
+
+    def _get_files_id(self, parts, body):
+        file = self.state.files.get(parts[1])
+        if file is None:
+            return self._send(404, {"error": {"message": "No such File object", "type": "invalid_request_error"}})
+        self._send(200, file)
+
+    def _delete_files_id(self, parts, body):
+        self.state.files.pop(parts[1], None)
+        self._send(200, {"id": parts[1], "object": "file", "deleted": True})
+
+    # threads and messages
+    def _new_thread(self, messages: list) -> dict:
+        thread = {"id": _id("thread"), "object": "thread", "created_at": int(time.time()), "metadata": {},
+                  "tool_resources": {}}
+        self.state.threads[thread["id"]] = [_message(thread["id"], m.get("role", "user"), _message_text(m))
+                                            for m in messages]
+        return thread
+
+    def _post_threads(self, parts, body):
+        self._send(200, self._new_thread(body.get("messages") or []))
+
+    def _get_threads_id(self, parts, body):
+        self._send(200, {"id": parts[1], "object": "thread", "created_at": int(time.time()), "metadata": {},
+                         "tool_resources": {}})
+
+    def _post_threads_id_messages(self, parts, body):
+        message = _message(parts[1], body.get("role", "user"), _message_text(body))
+        self.state.threads.setdefault(parts[1], []).append(message)
+        self._send(200, message)
+
+    def _get_threads_id_messages(self, parts, body):
+        messages = list(reversed(self.state.threads.get(parts[1], [])))
+        if "order=asc" in self.path:
+            messages.reverse()
+        self._send(200, {"object": "list", "data": messages, "first_id": messages[0]["id"] if messages else None,
+                         "last_id": messages[-1]["id"] if messages else None, "has_more": False})
+
+    # runs
+    def _new_run(self, thread_id: str, body: dict) -> dict:
+        state = self.state
+        messages = state.threads.get(thread_id, [])
+        prompt = _message_text(messages[-1]) if messages else ""
+        run = {"id": _id("run"), "object": "thread.run", "created_at": int(time.time()), "thread_id": thread_id,
+               "assistant_id": body.get("assistant_id"), "status": "queued", "model": body.get("model") or "gpt-4o",
+               "instructions": "", "tools": [], "metadata": {}, "usage": None, "required_action": None,
+               "last_error": None, "_prompt": prompt, "_done_at": time.time() + state.latency(state.config.run_latency)}
+        state.runs[run["id"]] = run
+        state.stats["runs"] += 1
+        return run
+
+    def _complete_run(self, run: dict, output: str) -> dict:
+        message = _message(run["thread_id"], "assistant", output, run["id"])
+        self.state.threads.setdefault(run["thread_id"], []).append(message)
+        run.update(status="completed", completed_at=int(time.time()), usage=_usage(run["_prompt"], output))
+        return message
+
+    def _run_view(self, run: dict) -> dict:
+        if run["status"] != "completed" and time.time() >= run["_done_at"]:
+            self._complete_run(run, self.state.assistant_output(run["_prompt"]))
+        elif run["status"] == "queued":
+            run["status"] = "in_progress"
+        return {key: value for key, value in run.items() if not key.startswith("_")}
+
+    def _stream_run(self, run: dict):
+        """
+        Server-sent run events: the first delta after FIRST_DELTA_SHARE of the run latency, the rest of the answer
+        in STREAM_CHUNKS deltas spread over the remaining time.
+        """
+        self.state.stats["streamed_runs"] += 1
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def send(event: str, data):
+            self.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        send("thread.run.created", self._run_view(run))
+        output = self.state.assistant_output(run["_prompt"])
+        message_id = _id("msg")
+        send("thread.message.created", {**_message(run["thread_id"], "assistant", "", run["id"]), "id": message_id,
+                                        "status": "in_progress"})
+        duration = max(0.0, run["_done_at"] - time.time())
+        time.sleep(duration * FIRST_DELTA_SHARE)
+        size = max(1, math.ceil(len(output) / STREAM_CHUNKS))
+        for start in range(0, len(output), size):
+            send("thread.message.delta", {"id": message_id, "object": "thread.message.delta", "delta": {"content": [
+                {"index": 0, "type": "text", "text": {"value": output[start:start + size], "annotations": []}}]}})
+            time.sleep(duration * (1 - FIRST_DELTA_SHARE) / STREAM_CHUNKS)
+        message = self._complete_run(run, output)
+        send("thread.message.completed", {**message, "id": message_id})
+        send("thread.run.completed", self._run_view(run))
+        self.wfile.write(b"event: done\ndata: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _poll_headers(self) -> dict:
+        return {"openai-poll-after-ms": str(self.state.config.poll_after_ms)}
+
+    def _post_threads_id_runs(self, parts, body):
+        if body.get("additional_messages"):
+            for message in body["additional_messages"]:
+                self.state.threads.setdefault(parts[1], []).append(
+                    _message(parts[1], message.get("role", "user"), _message_text(message)))
+        run = self._new_run(parts[1], body)
+        if body.get("stream"):
+            return self._stream_run(run)
+        self._send(200, self._run_view(run), self._poll_headers())
+
+    def _post_threads_runs(self, parts, body):
+        thread = self._new_thread((body.get("thread") or {}).get("messages") or [])
+        run = self._new_run(thread["id"], body)
+        if body.get("stream"):
+            return self._stream_run(run)
+        self._send(200, self._run_view(run), self._poll_headers())
+
+    def _get_threads_id_runs_id(self, parts, body):
+        run = self.state.runs.get(parts[3])
+        if run is None:
+            return self._send(404, {"error": {"message": "No run found", "type": "invalid_request_error"}})
+        self._send(200, self._run_view(run), self._poll_headers())
+
+    # chat completions
+    def _post_chat_completions(self, parts, body):
+        state = self.state
+        time.sleep(state.latency(state.config.chat_latency))
+        state.stats["chat_completions"] += 1
+        prompt = "".join(_message_text(m) for m in body.get("messages", []))
+        tools = body.get("tools") or []
+        if tools:
+            function = tools[0]["function"]
+            arguments = {name: _words(8) if spec.get("type") == "string" else True
+                         for name, spec in function.get("parameters", {}).get("properties", {}).items()}
+            if "Finished" in arguments:
+                arguments["Finished"] = not state.chance(state.config.revision_rate)
+            completion = json.dumps(arguments)
+            message = {"role": "assistant", "content": None, "tool_calls": [
+                {"id": _id("call"), "type": "function", "function": {"name": function["name"], "arguments": completion}}]}
+            finish_reason = "tool_calls"
+        else:
+            completion = state.assistant_output(prompt)
+            message, finish_reason = {"role": "assistant", "content": completion}, "stop"
+        self._send(200, {"id": _id("chatcmpl"), "object": "chat.completion", "created": int(time.time()),
+                         "model": body.get("model", "gpt-4o"),
+                         "choices": [{"index": 0, "message": message, "finish_reason": finish_reason, "logprobs": None}],
+                         "usage": _usage(prompt, completion)})
+
+
+def serve(config: FakeConfig, port: int, ready=None):
+    handler = type("Handler", (FakeOpenAIHandler,), {"state": FakeOpenAIState(config)})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    if ready is not None:
+        ready.set()
+    server.serve_forever()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FakeOpenAIServer:
+    """
+    fake_openai in a separate process, so its work does not show up in the timings and memory of the caller.
+    """
+
+    def __init__(self, config: FakeConfig = None, port: int = None):
+        self.config = config or FakeConfig()
+        self.port = port or free_port()
+        self.process = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        context = multiprocessing.get_context("spawn")
+        ready = context.Event()
+        self.process = context.Process(target=serve, args=(self.config, self.port, ready), daemon=True)
+        self.process.start()
+        if not ready.wait(30):
+            raise RuntimeError("fake_openai did not start")
+        return self
+
+    def stats(self) -> dict:
+        with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/_fake/stats") as response:
+            return json.loads(response.read())["stats"]
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+def add_fake_arguments(parser: argparse.ArgumentParser):
+    defaults = FakeConfig()
+    parser.add_argument("--run-latency", type=float, default=defaults.run_latency,
+                        help="median seconds until an assistant run completes")
+    parser.add_argument("--chat-latency", type=float, default=defaults.chat_latency,
+                        help="median seconds of a chat completion")
+    parser.add_argument("--latency-sigma", type=float, default=defaults.latency_sigma,
+                        help="sigma of the lognormal latency distribution")
+    parser.add_argument("--rate-limit-rate", type=float, default=defaults.rate_limit_rate,
+                        help="share of requests answered with 429")
+    parser.add_argument("--malformed-rate", type=float, default=defaults.malformed_rate,
+                        help="share of assistant answers with malformed JSON")
+    parser.add_argument("--revision-rate", type=float, default=defaults.revision_rate,
+                        help="share of reflections asking for a revision")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def fake_config(args, **overrides) -> FakeConfig:
+    return FakeConfig(run_latency=args.run_latency, chat_latency=args.chat_latency, latency_sigma=args.latency_sigma,
+                      rate_limit_rate=args.rate_limit_rate, malformed_rate=args.malformed_rate,
+                      revision_rate=args.revision_rate, seed=args.seed, **overrides)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--tests-per-scenario", type=int, default=FakeConfig.tests_per_scenario)
+    add_fake_arguments(parser)
+    args = parser.parse_args()
+    print(f"fake_openai listening on http://127.0.0.1:{args.port}/v1")
+    serve(fake_config(args, tests_per_scenario=args.tests_per_scenario), args.port)
+
+
+if __name__ == "__main__":
+    main()
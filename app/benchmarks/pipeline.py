@@ -0,0 +1,286 @@
+"""
+End-to-end benchmark: the real QAGraph graphs (tc_graph with its sub_tc_graph) against the offline OpenAI
+stand-in in benchmarks.fake_openai, for small, medium and large scenario sheets.
+
+Reports wall time, per node latency, checkpoint write overhead, LLM call count and peak memory per sheet size.
+--save writes the results with the git revision to a JSON file, --compare prints the change against such a file.
+The response cache is disabled unless --cache is passed, checkpoints go to a temporary database.
+Run from the app directory:  python -m benchmarks.pipeline --sizes small medium --workers 4 --save pipeline.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import resource
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from benchmarks.fake_openai import FakeOpenAIServer, add_fake_arguments, fake_config, free_port
+
+# scenarios per sheet, test cases per scenario
+sheet_sizes = {"small": (2, 3), "medium": (8, 5), "large": (24, 8)}
+call_counters = ("runs", "chat_completions", "rate_limited", "malformed")
+
+
+class NodeTimer(BaseCallbackHandler):
+    """
+    Latency of every graph node (of the parent graph and the subgraphs), from the node's own chain callbacks.
+    """
+    run_inline = True
+
+    def __init__(self):
+        self.started = {}
+        self.samples = defaultdict(list)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        # nested runnables of a node carry the same metadata, only the node itself is named after it
+        if node is not None and kwargs.get("name") == node:
+            self.started[run_id] = (node, time.perf_counter())
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def _finish(self, run_id):
+        started = self.started.pop(run_id, None)
+        if started is not None:
+            node, start = started
+            self.samples[node].append(time.perf_counter() - start)
+
+
+def time_checkpoint_writes(saver) -> list[float]:
+    """
+    Record the latency of every checkpoint write of saver, the shared saver is wrapped once and its samples
+    cleared for every sheet.
+    """
+    samples = getattr(saver, "_benchmark_samples", None)
+    if samples is not None:
+        samples.clear()
+        return samples
+    samples = saver._benchmark_samples = []
+    for name in ("aput", "aput_writes"):
+        method = getattr(saver, name)
+
+        async def timed(*args, _method=method, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await _method(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - started)
+
+        setattr(saver, name, timed)
+    return samples
+
+
+def make_sheet(scenario_count: int) -> list:
+    return [(i + 1, (f"Scenario {i + 1}: user updates order {i + 1} through the orders API",
+                     f"Order {i + 1} is updated and the change is returned")) for i in range(scenario_count)]
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def node_summary(samples: list[float]) -> dict:
+    samples_ms = sorted(sample * 1000 for sample in samples)
+    return {"count": len(samples_ms), "mean_ms": statistics.mean(samples_ms),
+            "p95_ms": samples_ms[math.ceil(len(samples_ms) * 0.95) - 1], "total_ms": sum(samples_ms)}
+
+
+async def run_sheet(size: str, args, checkpoint_path: str, server: FakeOpenAIServer) -> dict:
+    from qa_agent.tc_graph import QAGraph
+    from qa_agent.model_routing import routing_policy
+    from qa_agent.progress import PartialResult, ProgressChannel, ScenarioFinished, TestCaseDone, with_progress
+
+    scenario_count, _ = sheet_sizes[size]
+    scenario_list = make_sheet(scenario_count)
+    inputs = {'scenario_list': scenario_list, 'current_scenario': scenario_list[0], 'tech_stack': args.tech_stack}
+    timer = NodeTimer()
+    config = {"recursion_limit": 10000, "callbacks": [timer],
+              "configurable": {"thread_id": f"benchmark-{size}-{uuid.uuid4().hex[:8]}"}}
+    tc_graph = QAGraph(checkpoint_path)
+    calls_before = server.stats()
+    routing_policy.reset_stats()
+    test_cases = 0
+    # seconds until the first test case showed up in the progress events, and until the first one was done
+    first_draft = first_done = None
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    async with tc_graph:
+        graph = await tc_graph.aget_sqlite_graph()
+        checkpoint_samples = time_checkpoint_writes(tc_graph.checkpointer)
+        channel = ProgressChannel()
+        progress_config = with_progress(config, channel)
+        if args.workers > 1:
+            async def collect():
+                return [result async for result in tc_graph.astream_scenarios(graph, inputs, progress_config,
+                                                                              args.workers)]
+            run = collect()
+        else:
+            run = graph.ainvoke(inputs, progress_config)
+        async for event in channel.stream(run):
+            if isinstance(event, PartialResult) and first_draft is None:
+                first_draft = time.perf_counter() - started
+            elif isinstance(event, TestCaseDone) and first_done is None:
+                first_done = time.perf_counter() - started
+            elif isinstance(event, ScenarioFinished) and args.workers == 1:
+                # test_details_list only holds the last scenario at the end of the run, count them as they finish
+                test_cases += len(event.test_cases or [])
+        if args.workers > 1:
+            for result in channel.result:
+                if result['error'] is not None:
+                    print(f"{size}: scenario {result['scenario_id']} failed: {result['error']}")
+                test_cases += len(result['test_details_list'] or [])
+    wall_time = time.perf_counter() - started
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    calls_after = server.stats()
+    calls = {name: calls_after.get(name, 0) - calls_before.get(name, 0) for name in call_counters}
+    usage = tc_graph.usage_tracker.summary()
+    return {
+        "scenarios": scenario_count,
+        "test_cases": test_cases,
+        "wall_time_s": wall_time,
+        "scenarios_per_min": scenario_count / wall_time * 60,
+        "first_draft_s": first_draft,
+        "first_test_case_s": first_done,
+        "llm_calls": calls["runs"] + calls["chat_completions"],
+        "calls": calls,
+        "total_tokens": usage['assistant']['total_tokens'] + usage['reflection']['total_tokens'],
+        "reflections_saved": usage['reflections_saved'],
+        "checkpoint_writes": len(checkpoint_samples),
+        "checkpoint_time_s": sum(checkpoint_samples),
+        "checkpoint_share": sum(checkpoint_samples) / wall_time,
+        "peak_memory_mb": peak_memory / 1024 / 1024,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "nodes": {node: node_summary(samples) for node, samples in sorted(timer.samples.items())},
+        "stages": routing_policy.summary(),
+        "speculation": tc_graph.speculative_runs.summary() if tc_graph.pipeline_stage2 else None,
+    }
+
+
+def print_result(size: str, result: dict):
+    calls = result["calls"]
+    print(f"\n{size}: {result['scenarios']} scenarios, {result['test_cases']} test cases in "
+          f"{result['wall_time_s']:.1f}s ({result['scenarios_per_min']:.1f} scenarios/min)")
+    if result.get("first_test_case_s") is not None:
+        first_draft = result.get("first_draft_s")
+        print(f"  first test case drafted after {first_draft:.1f}s, " if first_draft is not None else "  ", end="")
+        print(f"first test case done after {result['first_test_case_s']:.1f}s")
+    print(f"  LLM calls {result['llm_calls']} ({calls['runs']} runs, {calls['chat_completions']} chat completions, "
+          f"{calls['rate_limited']} 429s, {calls['malformed']} malformed), {result['total_tokens']} tokens, "
+          f"{result.get('reflections_saved', 0)} reflections decided locally")
+    print(f"  checkpoint writes {result['checkpoint_writes']}, {result['checkpoint_time_s'] * 1000:.0f} ms "
+          f"({result['checkpoint_share']:.1%} of wall time)")
+    print(f"  peak traced memory {result['peak_memory_mb']:.1f} MB, max RSS {result['max_rss_mb']:.0f} MB")
+    speculation = result.get("speculation")
+    if speculation:
+        print(f"  speculative stage 2 runs {speculation['started']}, used {speculation['used']}, discarded "
+              f"{speculation['discarded']}, failed {speculation['failed']}, {speculation['hidden_seconds']:.1f}s "
+              f"hidden behind reflection, {speculation['waited_seconds']:.1f}s waited for")
+    for stage, summary in result.get("stages", {}).items():
+        print(f"  stage {stage:<30} {summary['calls']:5d} calls   mean {summary['mean_seconds'] * 1000:9.1f} ms   "
+              f"escalated {summary['escalation_rate']:6.1%}   cost ${summary['cost']:.4f}")
+    for node, summary in result["nodes"].items():
+        print(f"  {node:<36} {summary['count']:5d} calls   mean {summary['mean_ms']:9.1f} ms   "
+              f"p95 {summary['p95_ms']:9.1f} ms   total {summary['total_ms'] / 1000:7.1f} s")
+
+
+compared_metrics = ("wall_time_s", "first_test_case_s", "llm_calls", "checkpoint_time_s", "checkpoint_writes",
+                    "peak_memory_mb")
+
+
+def print_comparison(results: dict, baseline: dict):
+    print(f"\nCompared to {baseline.get('git_revision', 'unknown')} ({baseline.get('created_at', '')}):")
+    for size, result in results.items():
+        base = baseline.get("results", {}).get(size)
+        if base is None:
+            print(f"  {size}: not in baseline")
+            continue
+        for metric in compared_metrics:
+            before, after = base.get(metric), result.get(metric)
+            if before is None or after is None:
+                continue
+            change = f"{(after - before) / before:+.1%}" if before else "n/a"
+            print(f"  {size:<7} {metric:<20} {before:12.2f} -> {after:12.2f}  {change}")
+
+
+async def run(args, server: FakeOpenAIServer) -> dict:
+    from qa_agent.checkpoint_store import checkpoint_store
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoint_path = os.path.join(directory, "checkpoints.sqlite")
+        try:
+            for size in args.sizes:
+                # one fake per size, on the same port the clients were created for
+                server.config = fake_config(args, tests_per_scenario=sheet_sizes[size][1])
+                server.start()
+                try:
+                    results[size] = await run_sheet(size, args, checkpoint_path, server)
+                finally:
+                    server.stop()
+                print_result(size, results[size])
+        finally:
+            await checkpoint_store.aclose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", choices=list(sheet_sizes), default=["small", "medium"])
+    parser.add_argument("--workers", type=int, default=1,
+                        help="1 runs the scenarios sequentially in one graph run, more uses astream_scenarios")
+    parser.add_argument("--tech-stack", choices=["Back End", "Front End"], default="Back End")
+    parser.add_argument("--cache", action="store_true", help="keep the response cache enabled")
+    parser.add_argument("--pipeline-stage2", action="store_true",
+                        help="generate the next test case's details while the current one is reflected on")
+    parser.add_argument("--stage2-concurrency", type=int, default=0,
+                        help="expand the test cases of a scenario concurrently (map-reduce stage 2), 0 is sequential")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier --save to compare against")
+    add_fake_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(port=free_port())
+    # the OpenAI clients of the graphs read these when qa_agent is imported, run_sheet imports it afterwards
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+    os.environ["OPENAI_API_KEY"] = "sk-fake"
+    if not args.cache:
+        os.environ["QA_RESPONSE_CACHE"] = "0"
+    if args.pipeline_stage2:
+        os.environ["QA_PIPELINE_STAGE2"] = "1"
+    if args.stage2_concurrency:
+        os.environ["QA_STAGE2_CONCURRENCY"] = str(args.stage2_concurrency)
+
+    results = asyncio.run(run(args, server))
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print_comparison(results, json.load(f))
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"created_at": datetime.now().isoformat(timespec="seconds"), "git_revision": git_revision(),
+                       "args": vars(args), "results": results}, f, indent=2)
+        print(f"\nResults saved to {args.save}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Micro-benchmark: cost of compiling SubQAGraph versus invoking the compiled graph.
+
+Assistant and reflection nodes are replaced by canned answers so only graph overhead is measured.
+Run from the app directory:  python -m benchmarks.subgraph_compile --runs 50 --tests 10
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from langchain.schema import AIMessage, HumanMessage
+from langgraph.checkpoint.memory import MemorySaver
+
+from qa_agent.sub_tc_graph import SubQAGraph
+from qa_agent.tc_graph import QAGraph
+
+
+class CannedSubQAGraph(SubQAGraph):
+    """SubQAGraph answering every classification and reflection without calling OpenAI."""
+
+    async def _sub_assist_stage1_node(self, state):
+        idx = state['current_test_index'] - 1
+        test_list = state['test_list'][:]
+        index, test_details = test_list[idx]
+        test_list[idx] = (index, {**test_details, 'test_type': 'Component', 'Reason': 'canned'})
+        answer = {'Test_Type': 'Component', 'Reason': 'canned'}
+        return {"message_history": [HumanMessage(content="classify"), AIMessage(content=json.dumps(answer))],
+                "test_list": test_list}
+
+    async def _sub_qa_reflection_stage1_node(self, state):
+        next_test_index = state['current_test_index'] + 1
+        return {"message_history": [AIMessage(content="Finished processing the test case.")], "revisions": 0,
+                "is_finished": True, "current_test_index": next_test_index,
+                "is_test_list_processed": next_test_index > len(state['test_list'])}
+
+
+def summarize(label, samples):
+    samples_ms = [sample * 1000 for sample in samples]
+    print(f"{label:<28} mean {statistics.mean(samples_ms):9.3f} ms   "
+          f"median {statistics.median(samples_ms):9.3f} ms   max {max(samples_ms):9.3f} ms")
+
+
+def time_calls(fn, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+async def time_invokes(graph, test_count, runs):
+    test_list = [(i + 1, {'Title': f'test {i + 1}', 'Pre_Conditions': 'none'}) for i in range(test_count)]
+    samples = []
+    for run in range(runs):
+        started = time.perf_counter()
+        await graph.ainvoke({"test_list": test_list, "current_test_index": 1},
+                            {"configurable": {"thread_id": f"bench-{run}"}})
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--tests", type=int, default=10, help="test cases per subgraph invocation")
+    args = parser.parse_args()
+
+    checkpointer = MemorySaver()
+    compile_samples = time_calls(lambda: CannedSubQAGraph().prepare_graph().compile(checkpointer=checkpointer),
+                                 args.runs)
+
+    qa_graph = QAGraph("benchmark.sqlite")
+    qa_graph.checkpointer = checkpointer
+    qa_graph._get_subgraph()
+    cached_samples = time_calls(qa_graph._get_subgraph, args.runs)
+
+    compiled = CannedSubQAGraph().prepare_graph().compile(checkpointer=checkpointer)
+    invoke_samples = asyncio.run(time_invokes(compiled, args.tests, args.runs))
+
+    print(f"SubQAGraph, {args.runs} runs, {args.tests} test cases per invocation")
+    summarize("compile", compile_samples)
+    summarize("cached lookup", cached_samples)
+    summarize(f"invoke ({args.tests} tests)", invoke_samples)
+    print(f"compile / invoke ratio: {statistics.mean(compile_samples) / statistics.mean(invoke_samples):.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,10 +4,16 @@ import streamlit as st
 
 from clean_scenarios.remove_duplicates import process_test_scenarios
 from common.utils import load_app_config
-from health_check.connections_counter import increment_counter, decrement_counter
 
 load_app_config()
-from qa_agent.tc_graph import QAGraph
+from qa_agent.tc_graph import max_scenario_workers
+from qa_agent.document_store import document_store, file_search_attachments
+from qa_agent.upload_pipeline import UploadPipeline
+from qa_agent.result_accumulator import ResultAccumulator, export_formats
+from qa_agent.job_runner import job_runner, JobRejected, active_states, partial_state, describe_timing, \
+    JOB_POLL_INTERVAL
+from qa_agent.tracing import tracer
+from qa_agent.run_registry import run_registry
 
 from pprint import pprint
 import json
@@ -181,6 +187,9 @@ if 'skip_other_documents' not in st.session_state:
 if 'test_list_data' not in st.session_state:
     st.session_state.test_list_data = []
 
+if 'results' not in st.session_state:
+    st.session_state.results = ResultAccumulator()
+
 if 'tc_tech_stack' not in st.session_state:
     st.session_state.tc_tech_stack = 'Back End'
 
@@ -190,16 +199,14 @@ if 'tc_figma_document' not in st.session_state:
 if 'tc_skip_figma' not in st.session_state:
     st.session_state.tc_skip_figma = False
 
+if 'tc_scenario_workers' not in st.session_state:
+    st.session_state.tc_scenario_workers = 1
+
 # Graph state
 
 if 'session_id' not in st.session_state:
     st.session_state['session_id'] = str(uuid.uuid4())
 
-if 'tc_graph_with_memory' not in st.session_state:
-    checkpoint_path = str(st.session_state['session_id']) + "_tc.sqlite"
-    lc_graph_with_memory = QAGraph(checkpoint_path)  # .get_sqlite_graph()
-    st.session_state['tc_graph_with_memory'] = lc_graph_with_memory
-
 if 'invoke_graph_button_clicked' not in st.session_state:
     st.session_state['invoke_graph_button_clicked'] = False
 # ----------------------------- Authentication code --------------------------------
@@ -229,6 +236,17 @@ def tech_stack_inputs():
     )
 
 
+def scenario_workers_inputs():
+    # Number of scenarios processed concurrently, 1 keeps the sequential flow
+    st.number_input(
+        "Scenarios to process in parallel:",
+        min_value=1,
+        max_value=max_scenario_workers,
+        step=1,
+        key='tc_scenario_workers',
+    )
+
+
 def scnario_inputs():
     # Upload Scenario Document
     if st.session_state.scenario_doc is None:
@@ -435,50 +453,26 @@ def other_document_inputs():
 
 @st.fragment()
 def downloaders():
-    # initialize dataframe
-    df = pd.DataFrame()
-    # print(
-    #     f"app: {st.session_state.app} id: {st.session_state.session_id} Test List Data:  {st.session_state['test_list_data']}")
-
-    for scenario in st.session_state['test_list_data']:
-        # print(f"app: {st.session_state.app} id: {st.session_state.session_id} scenario: {scenario}")
-        # for test_details in scenario[1]:
-        # print(f"app: {st.session_state.app} id: {st.session_state.session_id} test_details:  {scenario[1]}")
-        # Assign 'internal_class' 
-        temp_df = pd.DataFrame(scenario[1])
-        temp_df['scenario'] = scenario[0]
-
-        # append tests to a DataFrame
-        df = pd.concat([df, temp_df], ignore_index=True)
-        # Add the 'Result' column with labels
-    result_labels = ['Adopt', 'New Addition', 'Not Used(Basic)', 'Not Used(Irrelevant)', 'Not Used(Other)']
-    df['Result'] = result_labels * (len(df) // len(result_labels)) + result_labels[:len(df) % len(result_labels)]
-
-    df_unique = pd.DataFrame()
-    # Remove duplicate test_scenarios
-    if "unique_test_cases" in st.session_state and not st.session_state["unique_test_cases"].empty:
-        df_unique = st.session_state["unique_test_cases"]
-        df_unique['Result'] = result_labels * (len(df_unique) // len(result_labels)) + result_labels[
-                                                                                       :len(df_unique) % len(
-                                                                                           result_labels)]
-
-    # Create a BytesIO buffer to hold the XLS data
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Sheet1')
-        if "unique_test_cases" in st.session_state and not st.session_state["unique_test_cases"].empty:
-            df_unique.to_excel(writer, index=False, sheet_name='unique_cases')
-        # writer.save()
-
-    # Prepare the buffer for download
-    xls_data = output.getvalue()
+    # results are accumulated as scenarios finish, the export is only rebuilt after new results arrived
+    results = st.session_state['results']
     st.download_button(
         label=f'Download test cases',
-        data=xls_data,  # json.dumps(test_list[1],indent=4),
+        data=results.export_bytes("xlsx"),
         file_name=f'test_scenarios.xlsx',
         mime="application/vnd.ms-excel",
         key=f"download_scenarios"
     )
+    for fmt in results.formats():
+        if fmt == "xlsx":
+            continue
+        file_name, mime = export_formats[fmt]
+        st.download_button(
+            label=f'Download test cases as {fmt.upper()}',
+            data=results.export_bytes(fmt),
+            file_name=file_name,
+            mime=mime,
+            key=f"download_scenarios_{fmt}"
+        )
 
 
 # ---------------------------------------- Stage Handling  -----------------------------------------------------
@@ -488,232 +482,118 @@ def sanitize_filename(filename):
     return re.sub(r'[<>:"/\\|?*]', '_', filename)
 
 
-thread_config = {
-    "recursion_limit": 10000,
-    "configurable": {
-        "thread_id": 1
-    }
-}
-
-
-def get_required_values(data, required_keys):
-    """Recursively searches for required keys in a nested dictionary and returns their values.
-
-    Args:
-        data: The dictionary to search within.
-        required_keys: List of keys to search for.
-
-    Returns:
-        A dictionary of found keys and their corresponding values.
+def attachable_job():
     """
-    found_values = {}
-
-    def recursive_search(d):
-        """Helper function to search for keys in a nested dictionary."""
-        if not isinstance(d, dict):
-            return False
-
-        for key in required_keys:
-            if key in d:
-                found_values[key] = d[key]
-            else:
-                for sub_key in d:
-                    if isinstance(d[sub_key], dict):
-                        recursive_search(d[sub_key])
-
-    recursive_search(data)
-    return found_values
-
-
-def get_progress_data(node_state: dict, global_state: dict):
-    print(
-        f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} start progress report")
-    stage_key = next(iter(node_state))
-    label = "Processing ..."
-    json_data = {}
-    id, current_scenario = global_state.values.get('current_scenario')
-    current_test = global_state.values.get('current_test', (0, ""))
-    if current_test is None:
-        test_id, test_name = 0, ""
-    else:
-        test_id, test_name = current_test
-    scenario_list = global_state.values.get('scenario_list')
-    next_scenario = next((item for item in scenario_list if item[0] == (id + 1)), None)
-    next_scenario = next_scenario[1] if next_scenario else ""
-    # is_finished = global_state.values.get('is_finished_stage2',False)
-    # if is_finished:
-    #     return "complete",json_data
-    print(
-        f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} inited progress report")
-    if stage_key == 'assist_stage1':
-        print(
-            f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} assist1")
-        # print(graph_state_data.keys())
-
-        is_scenario_list_processed = node_state[stage_key].get('is_scenario_list_processed', False)
-        if is_scenario_list_processed:
-            label = f"Finished generating test cases ..."
-        else:
-            id, current_scenario = node_state[stage_key].get('current_scenario', (0, ""))
-            label = f'Verifying test scnarios for "{current_scenario[0]}"...'
-    elif stage_key == 'reflect_stage1':
-        print(
-            f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} reflect1")
-        stage1_results = get_required_values(node_state, ['is_finished_stage1'])
-        stage1_finished = stage1_results.get('is_finished_stage1', False)
-        is_scenario_list_processed = global_state.values.get('is_scenario_list_processed')
-
-        if is_scenario_list_processed:
-            label = f"Finished generating test cases for all the scenarios, please download !!!"
-        elif stage1_finished:
-            label = f"Identified following test cases, now generating {next_scenario} test cases ..."
-            print(
-                f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} ~~~~~~~~~~~~~~~~~~~~~Stage 1 completed successfully")
-            # json_data = global_state.values.get('test_list')
-            # st.session_state['test_list_data'].append((current_scenario[0], json_data))
-
-            # # Download File
-            # st.download_button(     
-            #     label=f'Download Test File {current_scenario[0]}',
-            #     data=json.dumps(json_data,indent=4),
-            #     file_name="Test1.JSON",
-            #     mime="application/json",
-            #     key=f"download_TC_{current_scenario[0]}" 
-            # )
-        else:
-            print(
-                f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} ~~~~~~~~~~~~~~~~~~~~~Stage 1 failed")
-            json_data = {'Error': f'Failed verifying test scenarios for {current_scenario[0]}, retrying!!'}
+    Job to (re)attach to: the one in the page URL, else the latest unfinished job of the user.
+    """
+    job_id = st.query_params.get('job') or st.session_state.get('job_id')
+    if job_id is None and 'user_info' in st.session_state:
+        active_jobs = job_runner.store.active(st.session_state['user_info'].get('email'))
+        job_id = active_jobs[0] if active_jobs else None
+    if job_id is None or st.session_state.get('loaded_job') == job_id:
+        return None
+    return job_id
 
-    elif stage_key == 'assist_stage2':
-        print(
-            f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} assist2")
-        print(
-            f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} Node State:  {node_state[stage_key]}")
-        is_test_list_processed = node_state[stage_key].get('is_test_list_processed', False)
-        if is_test_list_processed:
-            label = f"Finished generating test case details ..."
-        else:
-            id, test_name = node_state[stage_key].get('current_test', (0, ""))
-            label = f'Verifying test case details for "{test_name}"...'
-        print(
-            f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} end assist2")
-    elif stage_key == 'reflect_stage2':
-        print(
-            f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} reflect2")
-        stage2_results = get_required_values(node_state, ['is_finished_stage2'])
-        stage2_finished = stage2_results.get('is_finished_stage2')
-        test_details_finished = global_state.values.get('is_test_list_processed')
-
-        if test_details_finished:
-            label = f"Finished generating test details ..."
-            # test_details_list
-            json_data = global_state.values.get('test_details_list')
-            st.session_state['test_list_data'].append((current_scenario[0], json_data))
-            # overwrite the test_list_data with the latest data here as we already appen in grpah state
-            # st.session_state['test_list_data'] = (current_scenario[0], json_data)
-            print(f"app: {st.session_state.app} id: {st.session_state.session_id} #$#$Test List Data: ", json_data)
-
-            # Dump json_data to a disk file
-            if JSON_DUMPS:
-                file_name = sanitize_filename(f'{current_scenario[0]}.JSON')
-                with open(file_name, "w") as f:
-                    json.dump(json_data, f, indent=4)
-
-            # Download File
-            st.download_button(
-                label=f"Download Test Case File {current_scenario[0]}",
-                data=json.dumps(json_data, indent=4),
-                file_name="Test2.JSON",
-                mime="application/json",
-                key=f"download_detailed_{current_scenario[0]}"
-            )
-        elif stage2_finished:
-            label = f"Generating test case details finished for {test_name} !!"
-            print(
-                f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} ~~~~~~~~~~~~~~~~~~~~~Stage 2 completed successfully")
-            # json_data = global_state.values.get('test_list')    
-            # st.session_state['test_list_data'].append((test_name, json_data))
-            # print("#$#$Test List Data: ",json_data)
-            # # Download File
-            # st.download_button(
-            #     label=f"Download Test Case File {test_name['Title']}",
-            #     data=json.dumps(json_data,indent=4),
-            #     file_name="Test2.JSON",
-            #     mime="application/json",
-            #     key=f"download_detailed_{test_name['Title']}"
-            # )
-        else:
-            print(
-                f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} ~~~~~~~~~~~~~~~~~~~~~Stage 2 failed")
-            label = f"Generating test case details failed for {test_name} !!, retrying..."
-        print(
-            f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} end progress report")
-    return label, json_data
 
+def follow_job(job_id):
+    """
+    Follow a generation job: job_progress refreshes its progress every JOB_POLL_INTERVAL seconds without holding
+    the script thread, and loads the results when it ends. The job itself runs in a worker process, so a reload
+    or rerun of the page only detaches from it.
+    """
+    st.session_state['job_id'] = job_id
+    st.query_params['job'] = job_id
+    if st.session_state.get('followed_job') != job_id:
+        st.session_state['followed_job'] = job_id
+        st.session_state['job_last_event'] = 0
+        st.session_state['job_errors'] = []
+    job_progress(job_id)
+
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def job_progress(job_id):
+    job = job_runner.store.get(job_id)
+    if job is None:
+        # nothing to follow, do not try again on every rerun
+        finish_job(job_id, f"Unknown generation job {job_id}", "error")
+        return
+    events = job_runner.store.events(job_id, after=st.session_state['job_last_event'])
+    if events:
+        with tracer.span("ui_update", run_id=job_id, events=len(events)):
+            for event in events:
+                st.session_state['job_last_event'] = event['id']
+                print(
+                    f"app: {st.session_state.app} id: {st.session_state.session_id} job: {job_id} {event['label']}")
+                if event['kind'] in ('NodeError', 'ScenarioFailed'):
+                    st.session_state['job_errors'].append(event['label'])
+    if job['status'] in active_states:
+        label = job['label']
+        if job['status'] == 'queued':
+            label = f"Waiting for a free worker, {job_runner.store.position(job_id)} jobs ahead .."
+        with st.status(label, expanded=True):
+            if job['status'] == 'running':
+                # wall time against the summed scenario times, the speedup of the parallel scenario workers
+                st.write(describe_timing(job_runner.store.timing(job_id), len(job['inputs']['scenario_list'])))
+            for error in st.session_state['job_errors']:
+                st.json({'Error': error})
+        return
+
+    if job['status'] == 'failed':
+        finish_job(job_id, f"Generating test cases failed: {job['error']}", "error")
+        return
+    st.session_state['test_list_data'] = []
+    st.session_state['results'].clear()
+    for scenario, test_cases in job_runner.store.results(job_id):
+        st.session_state['test_list_data'].append((scenario, test_cases))
+        st.session_state['results'].append(scenario, test_cases)
+    st.session_state['deduplicate_job'] = job_id
+    timing = describe_timing(job_runner.store.timing(job_id), len(job['inputs']['scenario_list']))
+    print(f"job: {job_id} {timing}")
+    if job['status'] == partial_state:
+        finish_job(job_id, f"{job['error']}. {timing}, cost ${job['cost']:.2f}, please download !!!", "error")
+        return
+    finish_job(job_id, f"{timing}, cost ${job['cost']:.2f}, please download !!!", "complete")
+
+
+def finish_job(job_id, label, state):
+    """
+    Stop following job_id and rerun the whole page, which shows the outcome and the loaded results.
+    """
+    st.session_state['loaded_job'] = job_id
+    st.session_state['job_outcome'] = (job_id, label, state)
+    st.rerun()
 
-async def run_qa_graph(inputs):
-    tc_graph = st.session_state['tc_graph_with_memory']
-    print(
-        f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} Running stage 1 graph id ~~~~~~~~~~~~~~~~~~: ",
-        tc_graph)
 
-    async with tc_graph:
-        graph_with_memory = await tc_graph.aget_sqlite_graph()
-        # graph_with_memory = tc_graph.get_sqlite_graph()
+def job_outcome():
+    outcome = st.session_state.get('job_outcome')
+    if outcome is not None and outcome[0] == st.session_state.get('job_id'):
+        st.status(outcome[1], state=outcome[2], expanded=outcome[2] == "error")
 
-        with st.status("Generating Test Cases .. ") as status:
-            # update staus as per first test type
-            id, current_scenario = inputs.get('current_scenario')
-            status.update(label=f"Processing {current_scenario} Cases", expanded=True)
-            placeholder = st.empty()
 
-            async for output in graph_with_memory.astream(inputs, thread_config):
-                global_state = await graph_with_memory.aget_state(thread_config)
-                if LOG_LEVEL == "DEBUG":
-                    print(
-                        f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} \nMemory --- Memoey\n")
-                    print("()" * 100)
-                    print(
-                        f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} Node State: {output}")
-                    print(
-                        f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} Global State: {global_state}")
-                    print("()" * 100)
-                # st.session_state['test_list_data'] = output
-                # placeholder.json(st.session_state['test_list_data'])
-                time.sleep(1)
-                # Update Progress
-
-                label, json_data = get_progress_data(output, global_state)
-                # expand if we have JSON data
-                do_expand = json_data != {}
-
-                if label == "complete":
-                    status.update(label="Processing Completed", expanded=do_expand, state="complete")
-                else:
-                    status.update(label=label, expanded=do_expand)
-                placeholder.json(json_data)
-    # -------------------------------------------------------------------------------------------------------------
+def deduplicate_test_cases():
+    # a page which re-attached to a job after a reload never clicked Process, log the job id instead
+    request_id = st.session_state.get('request_id', st.session_state.get('job_id'))
     with st.status("Deduplicating  Test Cases .. ") as status:
         status.update(label="Removing the Duplicate Cases Started", expanded=False)
         print(
-            f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} logName=postProcessHit Post-processing Started!")
+            f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {request_id} logName=postProcessHit Post-processing Started!")
 
         if 'test_list_data' in st.session_state and len(st.session_state['test_list_data']) != 0:
             try:
                 unique_test_cases = process_test_scenarios(st.session_state['test_list_data'], app_type="case",
                                                            status=status)
                 st.session_state['unique_test_cases'] = unique_test_cases
+                st.session_state['results'].set_unique_cases(unique_test_cases)
             except Exception as e:
                 st.error(f"Error while removing test cases: {str(e)}")
                 st.error(traceback.print_exc())
                 print(
-                    f"app: {st.session_state.app} id: {st.session_state.session_id}  rid: {st.session_state.request_id} logName=postProcessError error: {traceback.print_exc()}")
+                    f"app: {st.session_state.app} id: {st.session_state.session_id}  rid: {request_id} logName=postProcessError error: {traceback.print_exc()}")
                 st.session_state['unique_test_cases'] = pd.DataFrame()  # Assign empty dataframe on failure
         else:
             st.warning("No test cases available to process.")
             print(
-                f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} logName=postProcessSuccess No test cases available to process.!")
+                f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {request_id} logName=postProcessSuccess No test cases available to process.!")
 
         # Download unique test cases
         status.update(label="Finished Removing Duplicate Cases", expanded=False)
@@ -724,109 +604,59 @@ def process_button():
     # Process Button
     if (((st.session_state.tech_design or st.session_state.frd_document) and st.session_state.scenario_doc)):
         if st.button('Process'):
-            increment_counter()
             placeholder = st.empty()
             placeholder.write('Processing files...')
             st.session_state['request_id'] = str(uuid.uuid4())
+            run_registry.register(st.session_state.request_id, "request", st.session_state['user_info'].get('email'))
             print(
                 f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} logName=requestHit Processing files....")
 
+            uploaded_file_ids = []
+            job_id = None
+            uploads = UploadPipeline()
             try:
-                # Create file and attachment (Uploads the user provided file to OpenAI)        
-                client = OpenAI()
-                file_attachments = []
-                td_file = None
-                frd_file = None
-                schema_file = None
-                openapi_spec_file = None
-                figma_file = None
+                # Upload the user provided files to OpenAI on worker threads, documents uploaded before are reused
                 scenario_list = []
 
-                # read scenario document
-                if st.session_state.scenario_doc is not None:
-                    scenario_doc = st.session_state.scenario_doc
-                    # Read the uploaded file
-                    df = pd.read_excel(scenario_doc)
-
-                    # Extract the columns as a list of tuples
-                    # scenario_list = list(zip(df['scenarioDescription'], df['expectedResults']))
-                    scenario_list = [(idx + 1, (row['scenarioDescription'], row['expectedResults']))
-                                     for idx, row in df.iterrows()]
-
                 # Add schema_file if uploaded
                 if st.session_state.schema_doc is not None:
                     schema_doc = st.session_state.schema_doc
-                    schema_file = client.files.create(
-                        file=schema_doc, purpose="assistants"
-                    )
-
-                    file_attachments.append({
-                        "file_id": schema_file.id,
-                        "tools": [{"type": "file_search"}]
-                    })
-                # Add openapi_spec_file if uploaded
+                    uploads.submit(schema_doc.name, schema_doc.getvalue())
+                # Add openapi_spec_file if uploaded, YAML specs are converted to JSON by the pipeline
                 if st.session_state.openapi_spec is not None:
                     openapi_spec_doc = st.session_state.openapi_spec
-                    filename = openapi_spec_doc.name.lower()
-                    if filename.endswith(".yml") or filename.endswith(".yaml"):
-                        # Read YAML content and convert to JSON
-                        yaml_content = yaml.safe_load(openapi_spec_doc.read())
-                        json_bytes = json.dumps(yaml_content, indent=2).encode('utf-8')
-
-                        # Create an in-memory file-like object for the JSON content
-                        json_file = io.BytesIO(json_bytes)
-                        json_file.name = filename.rsplit(".", 1)[0] + ".json"  # e.g., openapi.yaml → openapi.json
-
-                        openapi_spec_file = client.files.create(file=json_file, purpose="assistants")
-                    else:
-                        # Upload non-YAML file directly
-                        openapi_spec_file = client.files.create(file=openapi_spec_doc, purpose="assistants")
-
-                    file_attachments.append({
-                        "file_id": openapi_spec_file.id,
-                        "tools": [{"type": "file_search"}]
-                    })
-
-                uploaded_file_ids = []  # To keep track of files for deletion# Add figma_file if uploaded
+                    uploads.submit_openapi_spec(openapi_spec_doc.name, openapi_spec_doc.getvalue())
+
                 if st.session_state.get("other_documents") is not None:
                     for doc in st.session_state.other_documents:
-                        uploaded_file = client.files.create(
-                            file=doc,
-                            purpose="assistants"
-                        )
-                        file_attachments.append({
-                            "file_id": uploaded_file.id,
-                            "tools": [{"type": "file_search"}]
-                        })
-                        uploaded_file_ids.append(uploaded_file.id)
+                        uploads.submit(doc.name, doc.getvalue())
 
                 # Add tech_design_file if uploaded
                 if st.session_state.tech_design is not None:
                     tech_design_doc = st.session_state.tech_design
-                    td_file = client.files.create(
-                        file=tech_design_doc, purpose="assistants"
-                    )
-
-                    # add td and frd files to attachments if present
-                    file_attachments.append(
-                        {
-                            "file_id": td_file.id,
-                            "tools": [{"type": "file_search"}]
-                        }
-                    )
+                    uploads.submit(tech_design_doc.name, tech_design_doc.getvalue())
 
                 # Add frd_document_file if uploaded
                 if st.session_state.frd_document is not None:
                     frd_doc = st.session_state.frd_document
+                    uploads.submit(frd_doc.name, frd_doc.getvalue())
+
+                # read scenario document while the documents are uploading
+                if st.session_state.scenario_doc is not None:
+                    scenario_doc = st.session_state.scenario_doc
+                    # Read the uploaded file
+                    df = pd.read_excel(scenario_doc)
 
-                    frd_file = client.files.create(
-                        file=frd_doc, purpose="assistants"
-                    )
+                    # Extract the columns as a list of tuples
+                    # scenario_list = list(zip(df['scenarioDescription'], df['expectedResults']))
+                    scenario_list = [(idx + 1, (row['scenarioDescription'], row['expectedResults']))
+                                     for idx, row in df.iterrows()]
 
-                    file_attachments.append({
-                        "file_id": frd_file.id,
-                        "tools": [{"type": "file_search"}]
-                    })
+                # the graph needs every attachment in its inputs, so wait for all of them
+                for finished, total in uploads.progress():
+                    placeholder.write(f'Uploading documents ({finished}/{total})...')
+                uploaded_file_ids = uploads.file_ids()
+                file_attachments = file_search_attachments(uploaded_file_ids)
 
                 attachment_input = {"attachments": file_attachments}
                 st.session_state['uploaded_td_file'] = attachment_input
@@ -846,18 +676,15 @@ def process_button():
                 # thread.start()
                 # time.sleep(5)
                 placeholder.write('Generating Test cases ...')
-                # run_qa_graph(inputs)
-                # asyncio.run(run_qa_graph(inputs))
-                try:
-                    loop = asyncio.get_event_loop()
-                except RuntimeError:  # No event loop in this thread
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-
-                loop.run_until_complete(run_qa_graph(inputs))  # Run async function
-
+                # the run goes to a worker process, the page only follows it and can re-attach after a reload
+                job_id = job_runner.submit(inputs, owner=st.session_state['user_info'].get('email'),
+                                           workers=st.session_state.tc_scenario_workers)
+                # the job releases the uploaded files once it is done
+                uploaded_file_ids = []
                 print(
-                    f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} logName=successHit Process completed successfully!")
+                    f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} logName=successHit Submitted job {job_id}")
+            except JobRejected as e:
+                placeholder.write(str(e))
             except Exception as e:
                 print(
                     f"app: {st.session_state.app} id: {st.session_state.session_id} rid: {st.session_state.request_id} logName=failureHit Error:  {e} time: {datetime.now(timezone('Asia/Kolkata'))}")
@@ -865,24 +692,21 @@ def process_button():
                 placeholder.write('Error processing files...')
 
             finally:
-                decrement_counter()
-                # cleanup files
-                if schema_file:
-                    client.files.delete(schema_file.id)
-                if openapi_spec_file:
-                    client.files.delete(openapi_spec_file.id)
-                if td_file:
-                    client.files.delete(td_file.id)
-                if frd_file:
-                    client.files.delete(frd_file.id)
-                if figma_file:
-                    client.files.delete(figma_file.id)
-                if uploaded_file_ids:
-                    for file_id in uploaded_file_ids:
-                        try:
-                            client.files.delete(file_id)
-                        except Exception as e:
-                            print(f"Error deleting file {file_id}: {e}")
+                run_registry.unregister(st.session_state.request_id)
+                uploads.close()
+                # release the uploaded files, they stay available for the next run
+                document_store.release(uploaded_file_ids)
+            if job_id is not None:
+                # followed below, like a job the page re-attaches to
+                st.session_state['job_id'] = job_id
+                st.query_params['job'] = job_id
+    job_id = attachable_job()
+    if job_id is not None:
+        follow_job(job_id)
+    else:
+        job_outcome()
+        if st.session_state.pop('deduplicate_job', None) is not None:
+            deduplicate_test_cases()
 
 
 # Function to create a bordered container with a given title and content
@@ -895,6 +719,7 @@ def bordered_container(title, content_function):
 # place inputs in the left column
 with left_inputs:
     bordered_container("Select Tech Stack", tech_stack_inputs)
+    bordered_container("Parallel Processing", scenario_workers_inputs)
     bordered_container("Upload approved Test scenarios", scnario_inputs)
     if st.session_state.tc_tech_stack == 'Back End':
         bordered_container("Upload Schema Document", schema_inputs)
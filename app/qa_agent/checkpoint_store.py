@@ -0,0 +1,175 @@
+import asyncio
+import os
+import time
+
+import aiosqlite
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+from .tracing import tracer
+from .metrics import metrics
+
+checkpoint_store_path = os.getenv("QA_CHECKPOINT_PATH", "qa_checkpoints.sqlite")
+# runs not written to for this long are removed with all their checkpoints
+DEFAULT_RUN_RETENTION = 7 * 24 * 3600
+EXPIRE_INTERVAL = 600
+busy_timeout_ms = 5000
+
+
+def run_config(run_id: str, config: dict = None) -> dict:
+    """
+    config (recursion_limit etc.) pointed at the checkpoint thread of run_id.
+    """
+    config = config or {}
+    return {**config, 'configurable': {**config.get('configurable', {}), 'thread_id': str(run_id)}}
+
+
+def _trace_run_id(config: dict) -> str:
+    configurable = config["configurable"]
+    return str(configurable.get("run_id", configurable["thread_id"]))
+
+
+class RunTrackingSaver(AsyncSqliteSaver):
+    """
+    AsyncSqliteSaver which also records when every run (root checkpoint thread) was last written, for retention.
+    """
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        with tracer.span("checkpoint_write", run_id=_trace_run_id(config), channels=len(new_versions),
+                         namespace=config["configurable"].get("checkpoint_ns", "")):
+            started = time.perf_counter()
+            next_config = await super().aput(config, checkpoint, metadata, new_versions)
+            if not config["configurable"].get("checkpoint_ns"):
+                now = time.time()
+                async with self.lock:
+                    await self.conn.execute(
+                        "INSERT INTO checkpoint_runs (thread_id, created_at, updated_at) VALUES (?, ?, ?) "
+                        "ON CONFLICT(thread_id) DO UPDATE SET updated_at = excluded.updated_at",
+                        (str(config["configurable"]["thread_id"]), now, now),
+                    )
+                    await self.conn.commit()
+            metrics.observe("qa_checkpoint_write_seconds", time.perf_counter() - started, kind="checkpoint")
+            return next_config
+
+    async def aput_writes(self, config, writes, task_id, task_path: str = ""):
+        with tracer.span("checkpoint_writes", run_id=_trace_run_id(config), writes=len(writes)):
+            started = time.perf_counter()
+            await super().aput_writes(config, writes, task_id, task_path)
+            metrics.observe("qa_checkpoint_write_seconds", time.perf_counter() - started, kind="writes")
+
+
+class CheckpointStore:
+    """
+    Long lived checkpoint databases shared by every graph of the process.
+
+    One WAL mode connection is kept per (database, event loop), checkpoints outlive the run so a run can be
+    continued from its latest checkpoint by thread id. prune() keeps only the latest checkpoint of a run and
+    expire() removes runs untouched for longer than the retention.
+    """
+
+    def __init__(self, retention: float = DEFAULT_RUN_RETENTION):
+        self.retention = retention
+        self._savers = {}
+        self._last_expire = 0.0
+
+    async def _open(self, path: str) -> RunTrackingSaver:
+        conn = aiosqlite.connect(path)
+        # a leftover connection of an abandoned loop must not keep the process alive at exit
+        conn.daemon = True
+        await conn
+        # WAL lets readers (state polling, resume) run next to the writer and skips the fsync per commit
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        await conn.execute(f"PRAGMA busy_timeout={busy_timeout_ms}")
+        saver = RunTrackingSaver(conn)
+        await saver.setup()
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoint_runs (thread_id TEXT PRIMARY KEY, created_at REAL, updated_at REAL)"
+        )
+        await conn.commit()
+        return saver
+
+    async def _close_stale(self):
+        # Streamlit runs every request on a new event loop, connections of finished loops are closed from this one
+        for key in [key for key in self._savers if key[1].is_closed()]:
+            task = self._savers.pop(key)
+            if task.done() and task.exception() is None:
+                await task.result().conn.close()
+
+    async def saver(self, path: str = checkpoint_store_path) -> RunTrackingSaver:
+        """
+        Checkpointer for path, shared by all graphs running on the current event loop.
+        """
+        await self._close_stale()
+        key = (os.path.abspath(path), asyncio.get_running_loop())
+        task = self._savers.get(key)
+        if task is None or (task.done() and task.exception() is not None):
+            task = self._savers[key] = asyncio.ensure_future(self._open(path))
+        return await task
+
+    async def aclose(self):
+        """
+        Close the connections opened on the current event loop, e.g. before a batch job exits.
+        """
+        loop = asyncio.get_running_loop()
+        for key in [key for key in self._savers if key[1] is loop]:
+            task = self._savers.pop(key)
+            if task.done() and task.exception() is None:
+                await task.result().conn.close()
+
+    async def prune(self, thread_id: str, path: str = checkpoint_store_path, finished: bool = False):
+        """
+        Delete all but the latest checkpoint of thread_id (per namespace) together with their pending writes.
+        For finished runs the subgraph namespaces are dropped as well, only the final root checkpoint remains.
+        """
+        saver = await self.saver(path)
+        thread_id = str(thread_id)
+        keep = "SELECT MAX(checkpoint_id) FROM checkpoints WHERE thread_id = ? GROUP BY checkpoint_ns"
+        if finished:
+            keep = "SELECT MAX(checkpoint_id) FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ''"
+        async with saver.lock:
+            for table in ("writes", "checkpoints"):
+                await saver.conn.execute(
+                    f"DELETE FROM {table} WHERE thread_id = ? AND checkpoint_id NOT IN ({keep})", (thread_id, thread_id)
+                )
+            await saver.conn.commit()
+
+    async def delete(self, thread_id: str, path: str = checkpoint_store_path):
+        saver = await self.saver(path)
+        await saver.adelete_thread(str(thread_id))
+        async with saver.lock:
+            await saver.conn.execute("DELETE FROM checkpoint_runs WHERE thread_id = ?", (str(thread_id),))
+            await saver.conn.commit()
+
+    async def expire(self, path: str = checkpoint_store_path, force: bool = False) -> int:
+        """
+        Remove runs not written to within the retention, at most once per EXPIRE_INTERVAL unless forced.
+        """
+        now = time.time()
+        if not force and now - self._last_expire < EXPIRE_INTERVAL:
+            return 0
+        self._last_expire = now
+        saver = await self.saver(path)
+        async with saver.conn.execute(
+                "SELECT thread_id FROM checkpoint_runs WHERE updated_at < ?", (now - self.retention,)) as cursor:
+            expired = [row[0] async for row in cursor]
+        # scenario workers write to '<run>-scenario-<n>' threads, they expire with their own registry entry
+        for thread_id in expired:
+            await self.delete(thread_id, path)
+        if expired:
+            print(f"Checkpoint store removed {len(expired)} expired runs")
+        return len(expired)
+
+    async def runs(self, path: str = checkpoint_store_path, prefix: str = None) -> list[tuple[str, float]]:
+        """
+        (thread_id, updated_at) of the stored runs, most recent first.
+        """
+        saver = await self.saver(path)
+        sql, params = "SELECT thread_id, updated_at FROM checkpoint_runs", ()
+        if prefix is not None:
+            sql, params = sql + " WHERE thread_id LIKE ?", (prefix + "%",)
+        async with saver.conn.execute(sql + " ORDER BY updated_at DESC", params) as cursor:
+            return [(row[0], row[1]) async for row in cursor]
+
+
+# shared store, one connection per database and event loop for the whole process
+checkpoint_store = CheckpointStore()
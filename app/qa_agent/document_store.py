@@ -0,0 +1,193 @@
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from openai import NotFoundError, OpenAI
+
+from .rate_limiter import rate_limiter
+from .response_cache import response_cache
+
+document_store_path = os.getenv("QA_DOCUMENT_STORE_PATH", "qa_document_store.sqlite")
+# unreferenced files are deleted from OpenAI once unused for this long
+DEFAULT_DOCUMENT_TTL = 24 * 3600
+# references older than this are treated as leaked by a crashed session
+DEFAULT_LEASE_TTL = 12 * 3600
+GC_INTERVAL = 600
+max_upload_workers = 6
+
+
+def file_search_attachments(file_ids: list[str]) -> list[dict]:
+    return [{"file_id": file_id, "tools": [{"type": "file_search"}]} for file_id in file_ids]
+
+
+class DocumentStore:
+    """
+    Registry of documents uploaded to OpenAI, keyed by sha256 of their bytes.
+
+    acquire() reuses the OpenAI file of identical bytes uploaded earlier (by any session) and only
+    uploads unseen documents. Every acquire holds a reference until release(); files without
+    references are deleted from OpenAI by collect_garbage() after the TTL.
+    """
+
+    def __init__(self, path: str = document_store_path, ttl: float = DEFAULT_DOCUMENT_TTL,
+                 lease_ttl: float = DEFAULT_LEASE_TTL, client: OpenAI = None):
+        self.path = path
+        self.ttl = ttl
+        self.lease_ttl = lease_ttl
+        self._client = client
+        self._conn = None
+        self._lock = threading.Lock()
+        self._hash_locks = defaultdict(threading.Lock)
+        self._last_gc = 0.0
+        self.uploaded = 0
+        self.reused = 0
+
+    @property
+    def client(self) -> OpenAI:
+        if self._client is None:
+            self._client = OpenAI(http_client=rate_limiter.http_client())
+        return self._client
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents (sha256 TEXT PRIMARY KEY, file_id TEXT, filename TEXT, "
+                "size INTEGER, refcount INTEGER, created_at REAL, last_used_at REAL)"
+            )
+        return self._conn
+
+    def _execute(self, sql: str, params=()):
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def _transaction(self, statements):
+        """
+        Run statements(conn) in one write transaction, which other processes of the store cannot interleave.
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def _reference(self, sha256: str):
+        """
+        Take a reference on the registered file of sha256, None when there is none or it is being deleted.
+        """
+        def statements(conn):
+            row = conn.execute("SELECT file_id FROM documents WHERE sha256 = ? AND refcount >= 0",
+                               (sha256,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE documents SET refcount = refcount + 1, last_used_at = ? WHERE sha256 = ?",
+                             (time.time(), sha256))
+            return row[0] if row else None
+
+        return self._transaction(statements)
+
+    def _file_exists(self, file_id: str) -> bool:
+        try:
+            self.client.files.retrieve(file_id)
+            return True
+        except NotFoundError:
+            return False
+
+    def acquire(self, filename: str, content: bytes) -> str:
+        """
+        OpenAI file id for the document, uploading it only when these bytes are not known yet.
+        """
+        sha256 = hashlib.sha256(content).hexdigest()
+        with self._hash_locks[sha256]:
+            # the reference is taken before the file is checked, collect_garbage skips referenced rows
+            file_id = self._reference(sha256)
+            if file_id is not None and self._file_exists(file_id):
+                self.reused += 1
+                print(f"Reusing uploaded document {filename} ({file_id})")
+            else:
+                # a fresh file object per attempt, httpx streams it in chunks instead of copying the bytes
+                file = rate_limiter.call(
+                    lambda: self.client.files.create(file=(filename, io.BytesIO(content)), purpose="assistants")
+                )
+                file_id = file.id
+                now = time.time()
+                self._execute(
+                    "INSERT OR REPLACE INTO documents (sha256, file_id, filename, size, refcount, created_at, last_used_at) "
+                    "VALUES (?, ?, ?, ?, 1, ?, ?)",
+                    (sha256, file_id, filename, len(content), now, now),
+                )
+                self.uploaded += 1
+                print(f"Uploaded document {filename} ({file_id})")
+        response_cache.register_file(file_id, sha256=sha256)
+        return file_id
+
+    def acquire_many(self, documents: list[tuple[str, bytes]]) -> list[str]:
+        """
+        Acquire (filename, bytes) documents in parallel, file ids are returned in the same order.
+        """
+        if not documents:
+            return []
+        with ThreadPoolExecutor(max_workers=min(max_upload_workers, len(documents))) as executor:
+            return list(executor.map(lambda document: self.acquire(*document), documents))
+
+    def release(self, file_ids: list[str]):
+        """
+        Drop the references taken by acquire, the files stay available for reuse until the TTL expires.
+        """
+        now = time.time()
+        for file_id in file_ids:
+            self._execute(
+                "UPDATE documents SET refcount = refcount - 1, last_used_at = ? WHERE file_id = ? AND refcount > 0",
+                (now, file_id),
+            )
+        if now - self._last_gc > GC_INTERVAL:
+            self.collect_garbage()
+
+    def collect_garbage(self):
+        """
+        Delete files unused for longer than the TTL from OpenAI and from the registry.
+
+        Referenced files are never deleted. References older than the lease TTL are treated as leaked and
+        dropped, the file is then deleted once it stays unused for another TTL.
+        """
+        now = time.time()
+        self._last_gc = now
+
+        def claim(conn):
+            conn.execute("UPDATE documents SET refcount = 0, last_used_at = ? WHERE refcount > 0 AND last_used_at < ?",
+                         (now, now - self.lease_ttl))
+            rows = conn.execute("SELECT sha256, file_id FROM documents WHERE refcount = 0 AND last_used_at < ?",
+                                (now - self.ttl,)).fetchall()
+            # -1 marks the rows being deleted, acquire uploads the document again instead of reusing them
+            conn.executemany("UPDATE documents SET refcount = -1 WHERE sha256 = ?", [(row[0],) for row in rows])
+            return rows
+
+        rows = self._transaction(claim)
+        for sha256, file_id in rows:
+            try:
+                self.client.files.delete(file_id)
+            except NotFoundError:
+                pass
+            except Exception as e:
+                print(f"Error deleting file {file_id}: {e}")
+                # tried again by the next collection
+                self._execute("UPDATE documents SET refcount = 0 WHERE sha256 = ? AND file_id = ? AND refcount < 0",
+                              (sha256, file_id))
+                continue
+            self._execute("DELETE FROM documents WHERE sha256 = ? AND file_id = ?", (sha256, file_id))
+        if rows:
+            print(f"Document store removed {len(rows)} unused files")
+
+
+# shared store used by the test case generation apps
+document_store = DocumentStore()
@@ -5,6 +5,8 @@ from langchain_openai import ChatOpenAI
 from langchain.callbacks import get_openai_callback
 
 from qa_agent.agent import OpenAIAssistantExecuters
+from qa_agent.rate_limiter import rate_limiter
+from qa_agent.usage_tracker import UsageTracker
 
 import json
 import requests
@@ -20,7 +22,7 @@ import asyncio
 
 qa_reflection_model = "gpt-4-turbo"
 
-llm = ChatOpenAI(temperature = 0.0,model_name=qa_reflection_model)
+llm = ChatOpenAI(temperature = 0.0,model_name=qa_reflection_model,http_client=rate_limiter.http_client())
 
 class Reflection(BaseModel):
     """Reflection and Followup"""
@@ -88,19 +90,9 @@ from openai import OpenAI
 from pprint import pprint
 
 converse_mode = True
-stage1_thread_id = None
-stage2_thread_id = None
-stage3_thread_id = None
 max_revisions = 3
 usage_limit = 5.0
 
-# storage for connector metadata with levels resources, endpoints and endpoint content
-test_metadata = {}
-
-# define method to add testcase content to test metadata
-def add_testcase_content(test_type:str,test_case_details:list[dict]):
-    test_metadata.setdefault(test_type, []).extend(test_case_details)
-
 
 
 
@@ -125,130 +117,24 @@ class AutoconState(TypedDict):
     stage3_revisions: int
     is_finished_stage3: bool
 
-class UsageStatistics(TypedDict):
-    completion_tokens: int
-    prompt_tokens: int
-    total_tokens: int
-    model_cost: float
-    completion_cost: float
-    prompt_cost: float
-    total_cost: float
-
 
 class QAGraph():
 
     def __init__(self):
-       pass
+        self.usage_tracker = UsageTracker()
+        # connector metadata with levels resources, endpoints and endpoint content, per graph instance
+        self.test_metadata = {}
 
-    def _get_run_data(self,thread_id: str, run_id: str):
-        """
-        Retrieve OpenAI run data using thread_id and run_id.
-        """
-        client = OpenAI()
-        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
-        return run
+    def add_testcase_content(self, test_type: str, test_case_details: list[dict]):
+        self.test_metadata.setdefault(test_type, []).extend(test_case_details)
 
     def _check_limits(self) -> bool:
         """
         Check if the usage limits have been exceeded.
         """
-        usage = self.cumulative_usage.get('total_cost', 0.0)
+        usage = self.usage_tracker.assistant['total_cost']
         return usage > usage_limit
 
-    def _get_model_cost(self,model_name):
-        model_costs = {
-            'gpt-4o': 0.0050,
-            'gpt-4-turbo-2024-04-09': 0.01 ,
-            'gpt-4-turbo': 0.01 ,
-            'gpt-4-turbo-preview': 0.01 ,
-            'gpt-4-0125-preview': 0.01 ,
-            'gpt-4-1106-preview': 0.01,
-            'gpt-4-0613': 0.03 ,
-            'gpt-4-32k-0613': 0.03 ,
-            'gpt-3.5-turbo-0125':0.0005,
-            'gpt-3.5-turbo':0.0005,
-            'gpt-3.5-turbo-1106':0.0010,
-            'gpt-3.5-turbo-16k-0613':0.0030,
-            'gpt-3.5-turbo-0613':0.0015,
-
-        }
-        return model_costs.get(model_name, 0.0)
-
-    # Define method to calculate usage statistics
-    def _calculate_usage(self,out) -> Optional[UsageStatistics]:
-        if (out['agent_output']['thread_id'] and out['agent_output']['run_id']):
-
-            thread_id = out['agent_output']['thread_id']
-            run_id = out['agent_output']['run_id']
-
-            run_data = self._get_run_data(thread_id, run_id)
-            run_completion_tokens = run_data.usage.completion_tokens
-            run_prompt_tokens = run_data.usage.prompt_tokens
-            run_total_tokens = run_data.usage.total_tokens
-            model_cost = self._get_model_cost(run_data.model)
-            completion_cost = (run_completion_tokens/1000) * model_cost
-            prompt_cost = (run_prompt_tokens/1000) * model_cost
-            total_cost = (run_total_tokens/1000) * model_cost
-
-            print(f"Current usage: Completion tokens: {run_completion_tokens}, Prompt tokens: {run_prompt_tokens}, Total tokens: {run_total_tokens}, Model cost: {model_cost}, Completion cost: {completion_cost}, Prompt cost: {prompt_cost}, Total cost: {total_cost}")
-
-            return UsageStatistics(
-                    completion_tokens=run_completion_tokens,
-                    prompt_tokens=run_prompt_tokens,
-                    total_tokens=run_total_tokens,
-                    model_cost=model_cost,
-                    completion_cost=completion_cost,
-                    prompt_cost=prompt_cost,
-                    total_cost=total_cost
-                )
-        else:
-            raise ValueError("Missing thread_id or run_id in output data")
-
-        
-    # Define method to caluculate cumulative usage statistics
-    def _calculate_cumulative_usage(self,out, usage) -> Optional[UsageStatistics]:
-        # calculate cumulative usage statistics using calculate_usage method
-        usage_stats = self._calculate_usage(out)
-        if usage_stats:
-            usage['completion_tokens'] += usage_stats['completion_tokens']
-            usage['prompt_tokens'] += usage_stats['prompt_tokens']
-            usage['total_tokens'] += usage_stats['total_tokens']
-            usage['completion_cost'] += usage_stats['completion_cost']
-            usage['prompt_cost'] += usage_stats['prompt_cost']
-            usage['total_cost'] += usage_stats['total_cost']
-            print(f"Cumulative Usage: Completion tokens: {usage['completion_tokens']}, Prompt tokens: {usage['prompt_tokens']}, Total tokens: {usage['total_tokens']}, Model cost: {usage['model_cost']}, Completion cost: {usage['completion_cost']}, Prompt cost: {usage['prompt_cost']}, Total cost: {usage['total_cost']}")
-        return usage
-
-    # Define method to calculate cumulative usage statistics for reflection
-    def _calculate_cumulative_usage_reflection(self,cb, usage) -> Optional[UsageStatistics]:
-        
-        if cb:
-            usage['completion_tokens'] += cb.completion_tokens
-            usage['prompt_tokens'] += cb.prompt_tokens
-            usage['total_tokens'] += cb.total_tokens
-            usage['total_cost'] += cb.total_cost
-            print(f"Cumulative Usage Reflection: Completion tokens: {usage['completion_tokens']}, Prompt tokens: {usage['prompt_tokens']}, Total tokens: {usage['total_tokens']}, Total cost: {usage['total_cost']}")
-        return usage
-
-    # Cumulative usage statistics for Genrerator
-    cumulative_usage = {
-        'completion_tokens': 0,
-        'prompt_tokens': 0,
-        'total_tokens': 0,
-        'model_cost': 0.0,
-        'completion_cost': 0.0,
-        'prompt_cost': 0.0,
-        'total_cost': 0.0
-    }
-
-    # Cumulative usage statistics for reflection 
-    cumulative_usage_reflection = {
-        'completion_tokens': 0,
-        'prompt_tokens': 0,
-        'total_tokens': 0,
-        'total_cost': 0.0
-    }
-
     def _sim_assist_stage1_node(self,state: AutoconState):
         print("assist state:",type(state),state)
         content = 'Based on the information extracted from the documentation provided, here is the complete list of Salesforce B2B and D2C Commerce Resources formatted as requested:\n\n```json\n{\n  "resources": [\n    "Commerce Extension Mapping",\n    "Commerce Extension Mappings",\n    "Commerce Extension Provider",\n    "Commerce Extension Providers",\n    "Commerce Extensions",\n    "Commerce Import Category Job Create",\n    "Commerce Import Category Job Manage",\n    "Commerce Import Product Job Create",\n    "Commerce Import Product Job Manage",\n    "Commerce Product Import Resource",\n    "Commerce Webstore Account Addresses",\n    "Commerce Webstore Account Address",\n    "Commerce Webstore Application Context",\n    "Commerce Webstore Calculate Taxes",\n    "Commerce Webstore Carts",\n    "Commerce Webstore Cart",\n    "Commerce Webstore Cart Add to Wishlist",\n    "Commerce Webstore Cart Arrange Items",\n    "Commerce Webstore Cart Clone",\n    "Commerce Webstore Cart Make Primary",\n    "Commerce Webstore Cart Preserve",\n    "Commerce Webstore Cart Coupons",\n    "Commerce Webstore Cart Coupon",\n    "Commerce Webstore Cart Delivery Group",\n    "Commerce Webstore Cart Delivery Groups",\n    "Commerce Webstore Cart Inventory Reservations (Pilot)",\n    "Commerce Webstore Cart Messages Set Visibility",\n    "Commerce Webstore Cart Promotions",\n    "Commerce Webstore Cart Items",\n    "Commerce Webstore Cart Items Batch",\n    "Commerce Webstore Cart Item",\n    "Commerce Webstore Cart Items Promotions",\n    "Commerce Webstore Cart Product",\n    "Commerce Webstore Cart Products",\n    "Commerce Webstore Checkout",\n    "Commerce Webstore Checkout Payments",\n    "Commerce Webstore Checkout Orders",\n    "Commerce Webstore Checkouts",\n    "Commerce Webstore Externally Managed Accounts",\n    "Commerce Webstore Order Summaries",\n    "Commerce Webstore Order Summary",\n    "Commerce Webstore Order Summary Adjustments",\n    "Commerce Webstore Order Summary Lookup (Developer Preview)",\n    "Commerce Webstore Order Delivery Groups",\n    "Commerce Webstore Order Items",\n    "Commerce Webstore Order Items Adjustments",\n    "Commerce Webstore Order Summaries Add Order to Cart",\n    "Commerce Webstore Order Summaries Adjustment Aggregates",\n    "Commerce Webstore Order Shipments",\n    "Commerce Webstore Shipment Items",\n    "Commerce Webstore Payments Token"\n  ]\n}\n```\n\nThis list represents the Salesforce B2B and D2C Commerce Resources mentioned in the provided document【9†source】. Note that any URI formatting was omitted as per your request.'
@@ -268,7 +154,8 @@ class QAGraph():
         # if state['resources']:
         #     print("resources already cached")
         #     return {"message_history":[HumanMessage(content="Resources already cached")],"resources": state['resources'],"stage2_revisions":0}
-        global stage1_thread_id
+        # assistant thread is carried in state so that concurrent runs never share it
+        stage1_thread_id = state.get('stage1_thread_id')
         
         current_test_type = state['current_test_type']
 
@@ -402,8 +289,6 @@ class QAGraph():
         print('-'*100)    
         print(json_data)
         print('-'*100)
-
-        time.sleep(3)    
         
         # response = requests.post(
         #             "http://localhost:8000/connector/query/invoke",
@@ -411,7 +296,7 @@ class QAGraph():
         # )
         
         assist = OpenAIAssistantExecuters()
-        out = asyncio.run(assist.get_query_chain(json_data['input']))
+        out = asyncio.run(rate_limiter.acall(assist.get_query_chain, json_data['input']))
         
         print('+'*100)
         print(out)
@@ -430,23 +315,21 @@ class QAGraph():
                 test_list = out['query']['test_list']
 
         # Log usage
-        self.cumulative_usage = self._calculate_cumulative_usage(out, self.cumulative_usage)
+        self.usage_tracker.record(out, "assist_stage1")
 
 
         # else:
         #     print(response.text)
         #     out_message = AIMessage(content="Sorry, I Failed to retrieve requested information.")
 
-        return {"message_history":[query_message,out_message],"test_list": test_list,"current_test_type":current_test_type}
+        return {"message_history":[query_message,out_message],"test_list": test_list,"current_test_type":current_test_type,"stage1_thread_id":stage1_thread_id}
 
     # assistant for stage2, identify endpoints from resources
     def _assist_stage2_node(self,state: AutoconState):
         print("assist stage2:",type(state),state)
         print(type(state),state)
-        global stage2_thread_id
-        global stage1_thread_id
         #stich with stage1
-        stage2_thread_id = stage1_thread_id
+        stage2_thread_id = state.get('stage1_thread_id')
 
 
         #query = state['input']
@@ -486,11 +369,9 @@ class QAGraph():
         print('-'*100)    
         print(json_data)
         print('-'*100)
-
-        time.sleep(1)    
         
         assist = OpenAIAssistantExecuters()
-        out = asyncio.run(assist.get_query_chain(json_data['input']))
+        out = asyncio.run(rate_limiter.acall(assist.get_query_chain, json_data['input']))
         
         detailed_test_list = None
         
@@ -504,7 +385,7 @@ class QAGraph():
                 out_message = AIMessage(content="Failed to process output as proper JSON, Received following output response\n" + out['agent_output']['output'])
 
         # Log usage
-        self.cumulative_usage = self._calculate_cumulative_usage(out, self.cumulative_usage)
+        self.usage_tracker.record(out, "assist_stage2")
                 
         # else:
         #     print(response.text)
@@ -532,9 +413,8 @@ class QAGraph():
         print('+'*100)    
         print(json_data)
         print('+'*100)
-
-        time.sleep(3)    
         
+        rate_limiter.acquire()
         response = requests.post(
                     "http://localhost:8000/connector/query/invoke",
                     json = json_data
@@ -565,10 +445,10 @@ class QAGraph():
         messages = messages[-2:]
 
         with get_openai_callback() as cb:
-            res = qa_reflect_stage1.invoke({"messages": messages})
+            res = rate_limiter.call(qa_reflect_stage1.invoke, {"messages": messages})
 
         # Log usage
-        self.cumulative_usage_reflection = self._calculate_cumulative_usage_reflection(cb, self.cumulative_usage_reflection)
+        self.usage_tracker.record_reflection(cb, "qa_reflection_stage1")
         
         # We treat the output of this as human feedback for the generator
         parser = JsonOutputToolsParser(return_id=True)
@@ -619,10 +499,10 @@ class QAGraph():
         messages = messages[-2:]
 
         with get_openai_callback() as cb:
-            res = qa_reflect_stage1.invoke({"messages": messages})
+            res = rate_limiter.call(qa_reflect_stage1.invoke, {"messages": messages})
 
         # Log usage
-        self.cumulative_usage_reflection = self._calculate_cumulative_usage_reflection(cb, self.cumulative_usage_reflection)
+        self.usage_tracker.record_reflection(cb, "qa_reflection_stage2")
 
         # We treat the output of this as human feedback for the generator
         parser = JsonOutputToolsParser(return_id=True)
@@ -652,7 +532,7 @@ class QAGraph():
             with open(f'{test_type}.json', 'w', encoding="utf-8") as f:
                 json.dump(state['detailed_test_list'], f,ensure_ascii=False, indent=4)
             
-            add_testcase_content(state['current_test_type'][1],state['detailed_test_list'])
+            self.add_testcase_content(state['current_test_type'][1],state['detailed_test_list'])
             is_test_list_processed = True
             
         else:
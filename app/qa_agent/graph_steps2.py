@@ -7,6 +7,14 @@ from langchain.callbacks import get_openai_callback
 from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 
 from qa_agent.agent import OpenAIAssistantExecuters
+from .rate_limiter import rate_limiter
+from .response_cache import response_cache
+from .usage_tracker import UsageTracker
+from .message_window import windowed_messages, message_archive
+from .checkpoint_store import checkpoint_store, checkpoint_store_path
+from .tracing import tracer
+from .model_routing import routing_policy, REFLECTION
+from .output_validator import FINE, NEEDS_LLM, local_validation, validate_scenarios
 from platform_ia.generate_scenarios import run_ia_prompt_processing
 
 import requests
@@ -41,9 +49,9 @@ from .prompts.graph_steps2_prompts import get_qa_reflection_prompt_stage1_system
 
 LOG_LEVEL = "Info"
 
-qa_reflection_model = "gpt-4-turbo"
+qa_reflection_model = routing_policy.route(REFLECTION).primary
 
-llm = ChatOpenAI(temperature=0.0, model_name=qa_reflection_model)
+llm = routing_policy.chat_model(qa_reflection_model)
 
 
 class Reflection(BaseModel):
@@ -94,19 +102,10 @@ qa_reflect_stage3 = qa_reflection_prompt_stage3 | llm.bind_tools(tools=[Reflecti
 qa_validator_stage3 = PydanticToolsParser(tools=[Reflection])
 
 converse_mode = True
-stage1_thread_id = None
-stage2_thread_id = None
-stage3_thread_id = None
 max_revisions = 3
 usage_limit = 10.0
-
-# storage for connector metadata with levels resources, endpoints and endpoint content
-test_metadata = {}
-
-
-# define method to add testcase content to test metadata
-def add_testcase_content(test_type: str, test_case_details: list[dict]):
-    test_metadata.setdefault(test_type, []).extend(test_case_details)
+# messages kept in message_history, the nodes only look at the last few
+message_window = 20
 
 
 # user_journey = "As an IO user, I want to extract and utilize webhook request query parameters and headers in transformations, so that I can leverage the values for enhanced data processing"
@@ -116,7 +115,7 @@ def add_testcase_content(test_type: str, test_case_details: list[dict]):
 class AutoconState(TypedDict):
     input: str
     target_app: str
-    message_history: Annotated[list[BaseMessage], operator.add]
+    message_history: Annotated[list[BaseMessage], windowed_messages(message_window, "graph_steps2", message_archive)]
     test_list: list[str]  # list of test scenarios
     is_test_list_processed: bool
     test_types: list[tuple[int, str]]
@@ -144,137 +143,27 @@ class AutoconState(TypedDict):
     aggregated_test_list: list[str]  # combined test scenarios from both flows
 
 
-class UsageStatistics(TypedDict):
-    completion_tokens: int
-    prompt_tokens: int
-    total_tokens: int
-    model_cost: float
-    completion_cost: float
-    prompt_cost: float
-    total_cost: float
-
-
 class QAGraph():
 
-    def __init__(self,checkpoint_path:str):
+    def __init__(self,checkpoint_path:str = checkpoint_store_path):
         
         self.conn = None
         self.checkpointer = None
-        self.checkpointer_cm = None
         self.checkpoint_path = checkpoint_path
+        self.usage_tracker = UsageTracker()
+        # connector metadata with levels resources, endpoints and endpoint content, per graph instance
+        self.test_metadata = {}
 
-        # Cumulative usage statistics for Genrerator
-        self.cumulative_usage = {
-            'completion_tokens': 0,
-            'prompt_tokens': 0,
-            'total_tokens': 0,
-            'model_cost': 0.0,
-            'completion_cost': 0.0,
-            'prompt_cost': 0.0,
-            'total_cost': 0.0
-        }
-
-        # Cumulative usage statistics for reflection 
-        self.cumulative_usage_reflection = {
-            'completion_tokens': 0,
-            'prompt_tokens': 0,
-            'total_tokens': 0,
-            'total_cost': 0.0
-        }
-
-    def _get_run_data(self, thread_id: str, run_id: str):
-        """
-        Retrieve OpenAI run data using thread_id and run_id.
-        """
-        client = OpenAI()
-        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
-        return run
+    def add_testcase_content(self, test_type: str, test_case_details: list[dict]):
+        self.test_metadata.setdefault(test_type, []).extend(test_case_details)
 
     def _check_limits(self) -> bool:
         """
         Check if the usage limits have been exceeded.
         """
-        usage = self.cumulative_usage.get('total_cost', 0.0)
+        usage = self.usage_tracker.assistant['total_cost']
         return usage > usage_limit
 
-    def _get_model_cost(self, model_name):
-        model_costs = {
-            'gpt-4.1': 0.0020,
-            'gpt-4o': 0.0050,
-            'gpt-4-turbo-2024-04-09': 0.01,
-            'gpt-4-turbo': 0.01,
-            'gpt-4-turbo-preview': 0.01,
-            'gpt-4-0125-preview': 0.01,
-            'gpt-4-1106-preview': 0.01,
-            'gpt-4-0613': 0.03,
-            'gpt-4-32k-0613': 0.03,
-            'gpt-3.5-turbo-0125': 0.0005,
-            'gpt-3.5-turbo': 0.0005,
-            'gpt-3.5-turbo-1106': 0.0010,
-            'gpt-3.5-turbo-16k-0613': 0.0030,
-            'gpt-3.5-turbo-0613': 0.0015,
-
-        }
-        return model_costs.get(model_name, 0.0)
-
-    # Define method to calculate usage statistics
-    def _calculate_usage(self, out) -> Optional[UsageStatistics]:
-        if (out['agent_output']['thread_id'] and out['agent_output']['run_id']):
-
-            thread_id = out['agent_output']['thread_id']
-            run_id = out['agent_output']['run_id']
-
-            run_data = self._get_run_data(thread_id, run_id)
-            run_completion_tokens = run_data.usage.completion_tokens
-            run_prompt_tokens = run_data.usage.prompt_tokens
-            run_total_tokens = run_data.usage.total_tokens
-            model_cost = self._get_model_cost(run_data.model)
-            completion_cost = (run_completion_tokens / 1000) * model_cost
-            prompt_cost = (run_prompt_tokens / 1000) * model_cost
-            total_cost = (run_total_tokens / 1000) * model_cost
-
-            print(
-                f"Current usage: Completion tokens: {run_completion_tokens}, Prompt tokens: {run_prompt_tokens}, Total tokens: {run_total_tokens}, Model cost: {model_cost}, Completion cost: {completion_cost}, Prompt cost: {prompt_cost}, Total cost: {total_cost}")
-
-            return UsageStatistics(
-                completion_tokens=run_completion_tokens,
-                prompt_tokens=run_prompt_tokens,
-                total_tokens=run_total_tokens,
-                model_cost=model_cost,
-                completion_cost=completion_cost,
-                prompt_cost=prompt_cost,
-                total_cost=total_cost
-            )
-        else:
-            raise ValueError("Missing thread_id or run_id in output data")
-
-    # Define method to caluculate cumulative usage statistics
-    def _calculate_cumulative_usage(self, out, usage) -> Optional[UsageStatistics]:
-        # calculate cumulative usage statistics using calculate_usage method
-        usage_stats = self._calculate_usage(out)
-        if usage_stats:
-            usage['completion_tokens'] += usage_stats['completion_tokens']
-            usage['prompt_tokens'] += usage_stats['prompt_tokens']
-            usage['total_tokens'] += usage_stats['total_tokens']
-            usage['completion_cost'] += usage_stats['completion_cost']
-            usage['prompt_cost'] += usage_stats['prompt_cost']
-            usage['total_cost'] += usage_stats['total_cost']
-            print(
-                f"Cumulative Usage: Completion tokens: {usage['completion_tokens']}, Prompt tokens: {usage['prompt_tokens']}, Total tokens: {usage['total_tokens']}, Model cost: {usage['model_cost']}, Completion cost: {usage['completion_cost']}, Prompt cost: {usage['prompt_cost']}, Total cost: {usage['total_cost']}")
-        return usage
-
-    # Define method to calculate cumulative usage statistics for reflection
-    def _calculate_cumulative_usage_reflection(self, cb, usage) -> Optional[UsageStatistics]:
-
-        if cb:
-            usage['completion_tokens'] += cb.completion_tokens
-            usage['prompt_tokens'] += cb.prompt_tokens
-            usage['total_tokens'] += cb.total_tokens
-            usage['total_cost'] += cb.total_cost
-            print(
-                f"Cumulative Usage Reflection: Completion tokens: {usage['completion_tokens']}, Prompt tokens: {usage['prompt_tokens']}, Total tokens: {usage['total_tokens']}, Total cost: {usage['total_cost']}")
-        return usage
-
     def _sim_assist_stage1_node(self, state: AutoconState):
         print("assist state:", type(state), state)
         content = 'Based on the information extracted from the documentation provided, here is the complete list of Salesforce B2B and D2C Commerce Resources formatted as requested:\n\n```json\n{\n  "resources": [\n    "Commerce Extension Mapping",\n    "Commerce Extension Mappings",\n    "Commerce Extension Provider",\n    "Commerce Extension Providers",\n    "Commerce Extensions",\n    "Commerce Import Category Job Create",\n    "Commerce Import Category Job Manage",\n    "Commerce Import Product Job Create",\n    "Commerce Import Product Job Manage",\n    "Commerce Product Import Resource",\n    "Commerce Webstore Account Addresses",\n    "Commerce Webstore Account Address",\n    "Commerce Webstore Application Context",\n    "Commerce Webstore Calculate Taxes",\n    "Commerce Webstore Carts",\n    "Commerce Webstore Cart",\n    "Commerce Webstore Cart Add to Wishlist",\n    "Commerce Webstore Cart Arrange Items",\n    "Commerce Webstore Cart Clone",\n    "Commerce Webstore Cart Make Primary",\n    "Commerce Webstore Cart Preserve",\n    "Commerce Webstore Cart Coupons",\n    "Commerce Webstore Cart Coupon",\n    "Commerce Webstore Cart Delivery Group",\n    "Commerce Webstore Cart Delivery Groups",\n    "Commerce Webstore Cart Inventory Reservations (Pilot)",\n    "Commerce Webstore Cart Messages Set Visibility",\n    "Commerce Webstore Cart Promotions",\n    "Commerce Webstore Cart Items",\n    "Commerce Webstore Cart Items Batch",\n    "Commerce Webstore Cart Item",\n    "Commerce Webstore Cart Items Promotions",\n    "Commerce Webstore Cart Product",\n    "Commerce Webstore Cart Products",\n    "Commerce Webstore Checkout",\n    "Commerce Webstore Checkout Payments",\n    "Commerce Webstore Checkout Orders",\n    "Commerce Webstore Checkouts",\n    "Commerce Webstore Externally Managed Accounts",\n    "Commerce Webstore Order Summaries",\n    "Commerce Webstore Order Summary",\n    "Commerce Webstore Order Summary Adjustments",\n    "Commerce Webstore Order Summary Lookup (Developer Preview)",\n    "Commerce Webstore Order Delivery Groups",\n    "Commerce Webstore Order Items",\n    "Commerce Webstore Order Items Adjustments",\n    "Commerce Webstore Order Summaries Add Order to Cart",\n    "Commerce Webstore Order Summaries Adjustment Aggregates",\n    "Commerce Webstore Order Shipments",\n    "Commerce Webstore Shipment Items",\n    "Commerce Webstore Payments Token"\n  ]\n}\n```\n\nThis list represents the Salesforce B2B and D2C Commerce Resources mentioned in the provided document【9†source】. Note that any URI formatting was omitted as per your request.'
@@ -303,7 +192,8 @@ class QAGraph():
         # if state['resources']:
         #     print("resources already cached")
         #     return {"message_history":[HumanMessage(content="Resources already cached")],"resources": state['resources'],"stage2_revisions":0}
-        global stage1_thread_id
+        # assistant thread is carried in state so that concurrent runs never share it
+        stage1_thread_id = state.get('stage1_thread_id')
         user_journey = state['user_journey']
         special_instructions = state.get('special_instructions')
 
@@ -401,8 +291,6 @@ class QAGraph():
             print(json_data)
             print('-' * 100)
 
-        time.sleep(3)
-
         # response = requests.post(
         #             "http://localhost:8000/connector/query/invoke",
         #             json = json_data
@@ -417,7 +305,7 @@ class QAGraph():
             ]
 
             assist = OpenAIAssistantExecuters(agent_id=agent_id)
-            out = asyncio.run(assist.get_query_chain(json_data['input']))
+            out = asyncio.run(response_cache.aget_query_chain(assist, agent_id, json_data['input']))
             if LOG_LEVEL == 'DEBUG':
                 print('+' * 100)
                 print(out)
@@ -436,7 +324,7 @@ class QAGraph():
                     test_list = out['query']['test_list']
 
             # Log usage
-            self.cumulative_usage = self._calculate_cumulative_usage(out, self.cumulative_usage)
+            self.usage_tracker.record(out, "assist_stage1")
 
             # else:
             #     print(response.text)
@@ -446,7 +334,7 @@ class QAGraph():
             out_message = AIMessage(content="Server error occurred while generating the answer. Prompt to try again.")
 
         return {"message_history": [query_message, out_message], "test_list": test_list,
-                "current_test_type": current_test_type}
+                "current_test_type": current_test_type, "stage1_thread_id": stage1_thread_id}
 
     # assistant for stage2, identify endpoints from resources
     def _assist_stage2_node(self, state: AutoconState):
@@ -459,11 +347,9 @@ class QAGraph():
         if LOG_LEVEL == 'DEBUG':
             print("assist stage2:", type(state), state)
             print(type(state), state)
-        global stage2_thread_id
-        global stage1_thread_id
         special_instructions = state.get('special_instructions')
         # stich with stage1
-        stage2_thread_id = stage1_thread_id
+        stage2_thread_id = state.get('stage1_thread_id')
         total_platform_features = len(state['platform_features'])
         current_platform_feature = state['current_platform_feature']
         is_finished_stage2 = state.get('is_finished_stage2')
@@ -516,8 +402,6 @@ class QAGraph():
             print(json_data)
             print('-' * 100)
 
-        time.sleep(1)
-
         try:
 
             test_list = [
@@ -528,7 +412,7 @@ class QAGraph():
             ]
 
             assist = OpenAIAssistantExecuters(agent_id="asst_V8DhPI6pYJNS5rMptP4SSr4o")
-            out = asyncio.run(assist.get_query_chain(json_data['input']))
+            out = asyncio.run(response_cache.aget_query_chain(assist, "asst_V8DhPI6pYJNS5rMptP4SSr4o", json_data['input']))
 
             if (out['agent_output'] and out['agent_output']['thread_id']):
                 # save json to state
@@ -542,7 +426,7 @@ class QAGraph():
                                 out['agent_output']['output'])
 
             # Log usage
-            self.cumulative_usage = self._calculate_cumulative_usage(out, self.cumulative_usage)
+            self.usage_tracker.record(out, "assist_stage2")
 
             # else:
             #     print(response.text)
@@ -568,8 +452,7 @@ class QAGraph():
             print(json_data)
             print('+' * 100)
 
-        time.sleep(3)
-
+        rate_limiter.acquire()
         response = requests.post(
             "http://localhost:8000/connector/query/invoke",
             json=json_data
@@ -596,28 +479,38 @@ class QAGraph():
         # Filter last two messages from the history
         messages = messages[-2:]
 
-        with get_openai_callback() as cb:
-            res = qa_reflect_stage1.invoke({"messages": messages})
+        validation = None
+        if local_validation:
+            validation = validate_scenarios(messages[-1].content, state.get('test_list'),
+                                            state.get('stage1_revisions', 0) > 0)
+            self.usage_tracker.record_validation(validation, "qa_reflection_stage1")
 
-        # Log usage
-        self.cumulative_usage_reflection = self._calculate_cumulative_usage_reflection(cb,
-                                                                                       self.cumulative_usage_reflection)
+        if validation is not None and validation.verdict != NEEDS_LLM:
+            # decided locally, no reflection call
+            is_finished = validation.verdict == FINE
+            followup_question = validation.follow_up
+        else:
+            with get_openai_callback() as cb:
+                res = routing_policy.reflect(qa_reflection_prompt_stage1, Reflection, messages)
 
-        # We treat the output of this as human feedback for the generator
-        parser = JsonOutputToolsParser(return_id=True)
+            # Log usage
+            self.usage_tracker.record_reflection(cb, "qa_reflection_stage1")
 
-        tool_invocation: AIMessage = res
-        parsed_tool_calls = parser.invoke(tool_invocation)
-        print('+' * 100)
-        print("parsed reflection:", type(parsed_tool_calls))
-        pprint(parsed_tool_calls)
-        print('+' * 100)
+            # We treat the output of this as human feedback for the generator
+            parser = JsonOutputToolsParser(return_id=True)
 
-        is_finished = parsed_tool_calls[0]['args']['Finished']
-        followup_question = parsed_tool_calls[0]['args'].get(
-            'follow_up_question',
-            "PLEASE RETRY THE TASK. "
-        )
+            tool_invocation: AIMessage = res
+            parsed_tool_calls = parser.invoke(tool_invocation)
+            print('+' * 100)
+            print("parsed reflection:", type(parsed_tool_calls))
+            pprint(parsed_tool_calls)
+            print('+' * 100)
+
+            is_finished = parsed_tool_calls[0]['args']['Finished']
+            followup_question = parsed_tool_calls[0]['args'].get(
+                'follow_up_question',
+                "PLEASE RETRY THE TASK. "
+            )
 
         # Update revision count
         revisions = state.get('stage1_revisions', 0)
@@ -651,29 +544,39 @@ class QAGraph():
         # Filter last two messages from the history
         messages = messages[-2:]
 
-        with get_openai_callback() as cb:
-            res = qa_reflect_stage1.invoke({"messages": messages})
+        validation = None
+        if local_validation:
+            validation = validate_scenarios(messages[-1].content, state.get('test_list'),
+                                            state.get('stage2_revisions', 0) > 0)
+            self.usage_tracker.record_validation(validation, "qa_reflection_stage2")
+
+        if validation is not None and validation.verdict != NEEDS_LLM:
+            # decided locally, no reflection call
+            is_finished = validation.verdict == FINE
+            followup_question = validation.follow_up
+        else:
+            with get_openai_callback() as cb:
+                res = routing_policy.reflect(qa_reflection_prompt_stage1, Reflection, messages)
 
-        # Log usage
-        self.cumulative_usage_reflection = self._calculate_cumulative_usage_reflection(cb,
-                                                                                       self.cumulative_usage_reflection)
+            # Log usage
+            self.usage_tracker.record_reflection(cb, "qa_reflection_stage2")
 
-        # We treat the output of this as human feedback for the generator
-        parser = JsonOutputToolsParser(return_id=True)
+            # We treat the output of this as human feedback for the generator
+            parser = JsonOutputToolsParser(return_id=True)
 
-        tool_invocation: AIMessage = res
-        parsed_tool_calls = parser.invoke(tool_invocation)
-        print('+' * 100)
-        print("parsed reflection stage2:", type(parsed_tool_calls))
-        pprint(parsed_tool_calls)
-        print('+' * 100)
+            tool_invocation: AIMessage = res
+            parsed_tool_calls = parser.invoke(tool_invocation)
+            print('+' * 100)
+            print("parsed reflection stage2:", type(parsed_tool_calls))
+            pprint(parsed_tool_calls)
+            print('+' * 100)
 
-        is_finished = parsed_tool_calls[0]['args']['Finished']
-        followup_question = parsed_tool_calls[0]['args'].get(
-            'follow_up_question',
-            "PLEASE RETRY THE TASK. "
-        )
-        print("Stage 2 QA ---->", type(parsed_tool_calls[0]), type(is_finished), is_finished)
+            is_finished = parsed_tool_calls[0]['args']['Finished']
+            followup_question = parsed_tool_calls[0]['args'].get(
+                'follow_up_question',
+                "PLEASE RETRY THE TASK. "
+            )
+        print("Stage 2 QA ---->", type(is_finished), is_finished)
 
         # Update revision count
         revisions = state.get('stage2_revisions', 0)
@@ -887,18 +790,18 @@ class QAGraph():
         builder = StateGraph(AutoconState)
 
         # Main flow nodes
-        builder.add_node("assist_stage1", self._assist_stage1_node)
-        builder.add_node("reflect_stage1", self._qa_reflection_stage1_node)
-        builder.add_node("assist_stage2", self._assist_stage2_node)
-        builder.add_node("reflect_stage2", self._qa_reflection_stage2_node)
+        builder.add_node("assist_stage1", tracer.traced_node("assist_stage1", self._assist_stage1_node))
+        builder.add_node("reflect_stage1", tracer.traced_node("reflect_stage1", self._qa_reflection_stage1_node))
+        builder.add_node("assist_stage2", tracer.traced_node("assist_stage2", self._assist_stage2_node))
+        builder.add_node("reflect_stage2", tracer.traced_node("reflect_stage2", self._qa_reflection_stage2_node))
 
         # Parallel flow nodes
-        builder.add_node("parallel_start", self._parallel_start_node)
-        builder.add_node("ia_processing", self._ia_processing_node)
-        builder.add_node("wait_for_ia", self._wait_for_ia_node)
-        builder.add_node("wait_for_main", self._wait_for_main_node)
-        builder.add_node("wait_for_both", self._wait_for_both_node)
-        builder.add_node("aggregate_results", self._aggregate_results_node)
+        builder.add_node("parallel_start", tracer.traced_node("parallel_start", self._parallel_start_node))
+        builder.add_node("ia_processing", tracer.traced_node("ia_processing", self._ia_processing_node))
+        builder.add_node("wait_for_ia", tracer.traced_node("wait_for_ia", self._wait_for_ia_node))
+        builder.add_node("wait_for_main", tracer.traced_node("wait_for_main", self._wait_for_main_node))
+        builder.add_node("wait_for_both", tracer.traced_node("wait_for_both", self._wait_for_both_node))
+        builder.add_node("aggregate_results", tracer.traced_node("aggregate_results", self._aggregate_results_node))
 
         # Set entry point
         builder.set_entry_point("parallel_start")
@@ -946,18 +849,15 @@ class QAGraph():
     async def aget_sqlite_graph(self):
         builder = self.prepare_graph()
 
-        # Store the async context manager explicitly and use it later
-        self.checkpointer_cm = AsyncSqliteSaver.from_conn_string(self.checkpoint_path)  # Stores the context manager
-        self.checkpointer = await self.checkpointer_cm.__aenter__()  # Manually enter the async context
+        # shared long lived checkpointer, checkpoints outlive the run so it can be resumed
+        self.checkpointer = await checkpoint_store.saver(self.checkpoint_path)
         lc_graph_with_memory = builder.compile(checkpointer=self.checkpointer)
 
-        return lc_graph_with_memory  # Ensures checkpointer remains available
+        return lc_graph_with_memory
 
     def cleanup(self):
-
-        if os.path.exists(self.checkpoint_path):
-            os.remove(self.checkpoint_path)
-            print(f"Database '{self.checkpoint_path}' has been deleted.")
+        # the checkpoint database is shared and kept for resume, only this graph's reference is dropped
+        self.checkpointer = None
 
     def __enter__(self):
         return self
@@ -966,11 +866,9 @@ class QAGraph():
         self.cleanup()
 
     async def acleanup(self):
-        if hasattr(self, "checkpointer"):
-            await self.checkpointer_cm.__aexit__(None, None, None)  # Properly close the async resource
-        if os.path.exists(self.checkpoint_path):
-            os.remove(self.checkpoint_path)
-            print(f"Database '{self.checkpoint_path}' has been deleted.")
+        # checkpoints are kept for resume, runs past the retention are removed instead
+        await checkpoint_store.expire(self.checkpoint_path)
+        self.checkpointer = None
 
     async def __aenter__(self):
         return self
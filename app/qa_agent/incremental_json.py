@@ -0,0 +1,148 @@
+"""
+Incremental parsing of streamed assistant answers: the objects of one array (e.g. "test_list") are returned as
+soon as their closing brace arrives, and a truncated answer still gives the objects which were complete.
+"""
+import json
+import re
+from typing import Optional
+
+# a markdown code block, the answer is often prose around one
+_fenced_block = re.compile(r"```(?:json|JSON)?\s*\n?(.*?)```", re.DOTALL)
+
+
+def _loads(text: str):
+    try:
+        return json.loads(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_answer(text: str):
+    """
+    The JSON of a complete answer: the whole text, else the first fenced block which is valid JSON, else the
+    text from the first { or [ to the last } or ] (prose around unfenced JSON). None when there is none.
+    """
+    if not isinstance(text, str):
+        return None
+    parsed = _loads(text)
+    if parsed is not None:
+        return parsed
+    for block in _fenced_block.findall(text):
+        parsed = _loads(block)
+        if parsed is not None:
+            return parsed
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    end = max(text.rfind("}"), text.rfind("]"))
+    if starts and end > min(starts):
+        return _loads(text[min(starts):end + 1])
+    return None
+
+
+class ArrayItemParser:
+    """
+    Fed chunks of a JSON text, returns the objects of the array under key (of the outermost object, or the
+    outermost array itself for key None) as they are closed. Text before the first { or [ is skipped.
+
+    Only the bracket structure is tracked while scanning, every chunk is scanned once and only the pieces of the
+    object (or key) still open are kept aside, an object is decoded once, when it closes.
+    """
+
+    def __init__(self, key: Optional[str] = "test_list"):
+        self.key = key
+        self.items = []
+        self._chunks = []
+        # per open container: [kind, is the target array, last key (objects)]
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._expect_key = False
+        # text of the open item / key string from earlier chunks, None when there is none
+        self._item_parts = None
+        self._key_parts = None
+        self._started = False
+
+    def feed(self, chunk: str) -> list:
+        """
+        Add chunk, returns the objects it completed.
+        """
+        self._chunks.append(chunk)
+        completed = []
+        # where the open item / key string continues in this chunk
+        item_from = 0 if self._item_parts is not None else None
+        key_from = 0 if self._key_parts is not None else None
+        for i, char in enumerate(chunk):
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._key_parts is not None:
+                        self._stack[-1][2] = "".join(self._key_parts) + chunk[key_from:i]
+                        self._key_parts = key_from = None
+                continue
+            if not self._started:
+                if char not in "{[":
+                    continue
+                self._started = True
+            if char == '"':
+                self._in_string = True
+                if self._expect_key and self._stack and self._stack[-1][0] == "object":
+                    self._key_parts, key_from = [], i + 1
+            elif char in "{[":
+                parent = self._stack[-1] if self._stack else None
+                if char == "{" and parent is not None and parent[1]:
+                    self._item_parts, item_from = [], i
+                self._stack.append(["object" if char == "{" else "array", char == "[" and self._is_target(parent),
+                                    None])
+                self._expect_key = char == "{"
+            elif char in "}]":
+                if not self._stack:
+                    continue
+                self._stack.pop()
+                parent = self._stack[-1] if self._stack else None
+                if char == "}" and parent is not None and parent[1] and self._item_parts is not None:
+                    try:
+                        item = json.loads("".join(self._item_parts) + chunk[item_from:i + 1])
+                    except ValueError:
+                        item = None
+                    if item is not None:
+                        self.items.append(item)
+                        completed.append(item)
+                    self._item_parts = item_from = None
+                self._expect_key = False
+            elif char == ",":
+                self._expect_key = bool(self._stack) and self._stack[-1][0] == "object"
+            elif char == ":":
+                self._expect_key = False
+        if self._item_parts is not None:
+            self._item_parts.append(chunk[item_from:])
+        if self._key_parts is not None:
+            self._key_parts.append(chunk[key_from:])
+        return completed
+
+    def _is_target(self, parent) -> bool:
+        if self.key is None:
+            return parent is None
+        return parent is not None and len(self._stack) == 1 and parent[0] == "object" and parent[2] == self.key
+
+    @property
+    def text(self) -> str:
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+    def result(self):
+        """
+        The whole answer when it is valid JSON, otherwise what can be salvaged from its valid prefix:
+        {key: completed objects, "truncated": True}, or None when no object was completed.
+        """
+        parsed = parse_answer(self.text)
+        if parsed is not None:
+            return parsed
+        if not self.items:
+            return None
+        if self.key is None:
+            return list(self.items)
+        return {self.key: list(self.items), "truncated": True}
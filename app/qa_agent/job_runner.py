@@ -0,0 +1,431 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .checkpoint_store import checkpoint_store, run_config, DEFAULT_RUN_RETENTION
+from .document_store import document_store
+from .message_window import archive_run
+from .metrics import metrics
+from .run_registry import run_registry, pid_alive
+from .progress import ProgressChannel, with_progress, ScenarioStarted, ScenarioFinished, ScenarioFailed, TokensUsed
+
+job_store_path = os.getenv("QA_JOB_STORE_PATH", "qa_jobs.sqlite")
+# generation runs executing at the same time, every one in its own worker process
+max_job_workers = int(os.getenv("QA_JOB_WORKERS", "2"))
+# queued and running jobs accepted in total and per user, further submissions are turned away
+max_pending_jobs = int(os.getenv("QA_MAX_PENDING_JOBS", "8"))
+max_jobs_per_owner = int(os.getenv("QA_MAX_JOBS_PER_OWNER", "2"))
+# a job whose worker process died is started again (from its checkpoint) up to this many times in total
+max_job_attempts = 2
+JOB_POLL_INTERVAL = 1.0
+
+active_states = ("queued", "running")
+# a finished job some of whose scenarios failed, the results of the others are kept
+partial_state = "partial"
+
+
+class JobRejected(RuntimeError):
+    """
+    Raised by JobRunner.submit when the admission limits are reached.
+    """
+
+
+def _json_default(value):
+    # numpy scalars from the scenario sheet
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def job_inputs(inputs: dict) -> dict:
+    """
+    Graph inputs back from their JSON form, scenarios are tuples in the graph state.
+    """
+    inputs = dict(inputs)
+    inputs['scenario_list'] = [(scenario_id, tuple(scenario)) for scenario_id, scenario in inputs['scenario_list']]
+    inputs['current_scenario'] = inputs['scenario_list'][0]
+    return inputs
+
+
+class JobStore:
+    """
+    SQLite record of generation jobs, their progress events and per scenario results.
+
+    Shared by the server process, which submits and reads jobs, and the worker processes, which run them.
+    """
+
+    def __init__(self, path: str = job_store_path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, owner TEXT, status TEXT, inputs TEXT, "
+                "options TEXT, label TEXT, cost REAL, error TEXT, runner_pid INTEGER, worker_pid INTEGER, attempts INTEGER, "
+                "created_at REAL, started_at REAL, finished_at REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_events (id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT, kind TEXT, "
+                "scenario_id INTEGER, label TEXT, created_at REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS job_events_job ON job_events (job_id, id)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_results (job_id TEXT, scenario_id INTEGER, scenario TEXT, "
+                "test_cases TEXT, elapsed REAL, error TEXT, PRIMARY KEY (job_id, scenario_id))"
+            )
+            # stores created before results carried their run time and error
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(job_results)")}
+            for column, kind in (("elapsed", "REAL"), ("error", "TEXT")):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE job_results ADD COLUMN {column} {kind}")
+        return self._conn
+
+    def _execute(self, sql: str, params=()):
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def admit(self, inputs: dict, options: dict, owner: str, runner_pid: int, max_pending: int,
+              max_per_owner: int) -> str:
+        """
+        Record a queued job unless the limits are reached, checked and inserted in one write transaction so
+        concurrent submissions (also from other server processes) cannot overshoot them.
+        """
+        job_id = str(uuid.uuid4())
+        placeholders = ", ".join("?" * len(active_states))
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                pending = conn.execute(f"SELECT COUNT(*) FROM jobs WHERE status IN ({placeholders})",
+                                       active_states).fetchone()[0]
+                if pending >= max_pending:
+                    raise JobRejected(f"{pending} generation jobs are already waiting, please try again later")
+                if owner is not None:
+                    owned = conn.execute(f"SELECT COUNT(*) FROM jobs WHERE owner = ? AND status IN ({placeholders})",
+                                         (owner, *active_states)).fetchone()[0]
+                    if owned >= max_per_owner:
+                        raise JobRejected(f"You already have {owned} generation jobs running, wait for one to finish")
+                conn.execute(
+                    "INSERT INTO jobs (job_id, owner, status, inputs, options, label, cost, runner_pid, attempts, "
+                    "created_at) VALUES (?, ?, 'queued', ?, ?, 'Queued', 0.0, ?, 0, ?)",
+                    (job_id, owner, json.dumps(inputs, default=_json_default), json.dumps(options), runner_pid,
+                     time.time()),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return job_id
+
+    def get(self, job_id: str) -> dict:
+        with self._lock:
+            cursor = self._connect().execute("SELECT * FROM jobs WHERE job_id = ?", (str(job_id),))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            job = dict(zip([column[0] for column in cursor.description], row))
+        job['inputs'] = json.loads(job['inputs'])
+        job['options'] = json.loads(job['options'])
+        return job
+
+    def start(self, job_id: str, worker_pid: int):
+        self._execute("UPDATE jobs SET status = 'running', worker_pid = ?, attempts = attempts + 1, "
+                      "started_at = COALESCE(started_at, ?) WHERE job_id = ?", (worker_pid, time.time(), job_id))
+
+    def requeue(self, job_id: str):
+        self._execute("UPDATE jobs SET status = 'queued', label = 'Restarting' WHERE job_id = ?", (job_id,))
+
+    def finish(self, job_id: str, status: str, error: str = None):
+        self._execute("UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE job_id = ?",
+                      (status, error, time.time(), job_id))
+
+    def add_event(self, job_id: str, event):
+        if isinstance(event, TokensUsed):
+            # too frequent to keep, only the running cost of the job
+            self._execute("UPDATE jobs SET cost = ? WHERE job_id = ?", (event.run_cost, job_id))
+            return
+        label = event.describe()
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT INTO job_events (job_id, kind, scenario_id, label, created_at) VALUES (?, ?, ?, ?, ?)",
+                         (job_id, type(event).__name__, event.scenario_id, label, now))
+            conn.execute("UPDATE jobs SET label = ? WHERE job_id = ?", (label, job_id))
+
+    def events(self, job_id: str, after: int = 0) -> list[dict]:
+        """
+        Events of the job with an id above after, pass the last id seen to read only new ones.
+        """
+        rows = self._execute("SELECT id, kind, scenario_id, label, created_at FROM job_events "
+                             "WHERE job_id = ? AND id > ? ORDER BY id", (job_id, after))
+        return [dict(id=row[0], kind=row[1], scenario_id=row[2], label=row[3], created_at=row[4]) for row in rows]
+
+    def add_result(self, job_id: str, scenario_id: int, scenario: str, test_cases: list, elapsed: float = None,
+                   error: str = None):
+        """
+        Result of a scenario: its test cases and run time in seconds, or the error it failed with. A scenario run
+        again after a restart replaces its earlier result.
+        """
+        self._execute("INSERT OR REPLACE INTO job_results (job_id, scenario_id, scenario, test_cases, elapsed, error) "
+                      "VALUES (?, ?, ?, ?, ?, ?)",
+                      (job_id, scenario_id, str(scenario), json.dumps(test_cases or [], default=_json_default),
+                       elapsed, error))
+
+    def results(self, job_id: str) -> list[tuple[str, list]]:
+        """
+        (scenario, test cases) of the finished scenarios in scenario order.
+        """
+        rows = self._execute("SELECT scenario, test_cases FROM job_results WHERE job_id = ? AND error IS NULL "
+                             "ORDER BY scenario_id", (job_id,))
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def failures(self, job_id: str) -> list[tuple[int, str, str]]:
+        """
+        (scenario id, scenario, error) of the failed scenarios in scenario order.
+        """
+        return self._execute("SELECT scenario_id, scenario, error FROM job_results WHERE job_id = ? AND error IS NOT NULL "
+                             "ORDER BY scenario_id", (job_id,))
+
+    def timing(self, job_id: str) -> dict:
+        """
+        Wall time of the job so far and the summed run time of its finished scenarios, which is what running them
+        one after the other would have taken.
+        """
+        rows = self._execute("SELECT j.started_at, j.finished_at, COUNT(r.scenario_id), COALESCE(SUM(r.elapsed), 0) "
+                             "FROM jobs j LEFT JOIN job_results r ON r.job_id = j.job_id AND r.error IS NULL "
+                             "WHERE j.job_id = ? GROUP BY j.job_id", (job_id,))
+        if not rows or rows[0][0] is None:
+            return {"scenarios": 0, "wall_seconds": 0.0, "scenario_seconds": 0.0, "speedup": 1.0}
+        started_at, finished_at, scenarios, scenario_seconds = rows[0]
+        wall_seconds = (finished_at or time.time()) - started_at
+        return {"scenarios": scenarios, "wall_seconds": wall_seconds, "scenario_seconds": scenario_seconds,
+                "speedup": scenario_seconds / wall_seconds if wall_seconds > 0 and scenarios else 1.0}
+
+    def position(self, job_id: str) -> int:
+        """
+        Number of queued jobs submitted before job_id.
+        """
+        rows = self._execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at < "
+                             "(SELECT created_at FROM jobs WHERE job_id = ?)", (job_id,))
+        return rows[0][0]
+
+    def counts(self) -> dict:
+        """
+        Number of jobs per active state.
+        """
+        placeholders = ", ".join("?" * len(active_states))
+        rows = self._execute(f"SELECT status, COUNT(*) FROM jobs WHERE status IN ({placeholders}) GROUP BY status",
+                             active_states)
+        return {state: 0 for state in active_states} | dict(rows)
+
+    def active(self, owner: str) -> list[str]:
+        placeholders = ", ".join("?" * len(active_states))
+        rows = self._execute(f"SELECT job_id FROM jobs WHERE owner = ? AND status IN ({placeholders}) "
+                             "ORDER BY created_at DESC", (owner, *active_states))
+        return [row[0] for row in rows]
+
+    def expire(self, retention: float = DEFAULT_RUN_RETENTION) -> int:
+        """
+        Remove finished jobs older than the retention with their events and results.
+        """
+        placeholders = ", ".join("?" * len(active_states))
+        rows = self._execute(f"SELECT job_id FROM jobs WHERE status NOT IN ({placeholders}) AND created_at < ?",
+                             (*active_states, time.time() - retention))
+        for (job_id,) in rows:
+            for table in ("job_events", "job_results", "jobs"):
+                self._execute(f"DELETE FROM {table} WHERE job_id = ?", (job_id,))
+        return len(rows)
+
+    def orphaned(self, runner_pid: int) -> list[str]:
+        """
+        Claim the unfinished jobs of server processes which are gone, they are continued by runner_pid.
+        """
+        placeholders = ", ".join("?" * len(active_states))
+        rows = self._execute(f"SELECT job_id, runner_pid FROM jobs WHERE status IN ({placeholders}) "
+                             "ORDER BY created_at", active_states)
+        claimed = []
+        for job_id, pid in rows:
+            if pid != runner_pid and not pid_alive(pid):
+                self._execute("UPDATE jobs SET status = 'queued', runner_pid = ? WHERE job_id = ?", (runner_pid, job_id))
+                claimed.append(job_id)
+        return claimed
+
+
+async def _run_job(store: JobStore, job_id: str):
+    from .tc_graph import QAGraph
+
+    job = store.get(job_id)
+    store.start(job_id, os.getpid())
+    inputs = job_inputs(job['inputs'])
+    workers = job['options'].get('workers', 1)
+    file_ids = [attachment['file_id'] for attachment in inputs.get('attachments') or []]
+    # the job id is the checkpoint thread, a job picked up again after a crash continues where it stopped
+    config = run_config(job_id, {"recursion_limit": 10000})
+    channel = ProgressChannel()
+    tc_graph = QAGraph()
+    status, error = "done", None
+    # start of the scenarios in progress of a sequential run, by scenario id
+    started = {}
+    try:
+        async with tc_graph:
+            graph = await tc_graph.aget_sqlite_graph()
+
+            async def run_parallel():
+                async for result in tc_graph.astream_scenarios(graph, inputs, with_progress(config, channel), workers):
+                    if result['error'] is None:
+                        store.add_result(job_id, result['scenario_id'], result['scenario'][0],
+                                         result['test_details_list'], result['elapsed'])
+                    else:
+                        store.add_result(job_id, result['scenario_id'], result['scenario'][0], [],
+                                         result['elapsed'], result['error'])
+                        channel.put(ScenarioFailed(result['scenario_id'], result['scenario'][0], result['error']))
+
+            async def run_sequential():
+                snapshot = await graph.aget_state(config)
+                if snapshot.values and not snapshot.next:
+                    return
+                await graph.ainvoke(None if snapshot.values else inputs, with_progress(config, channel))
+
+            parallel = workers > 1 and len(inputs['scenario_list']) > 1
+            # scenarios finished before a restart are not reported again
+            run_registry.register(job_id, "job", job['owner'], len(inputs['scenario_list']),
+                                  scenarios_done=len(store.results(job_id)))
+            with archive_run(job_id):
+                async for event in channel.stream(run_parallel() if parallel else run_sequential()):
+                    if isinstance(event, ScenarioStarted):
+                        run_registry.scenario_started(job_id, event.scenario_id)
+                        started[event.scenario_id] = time.perf_counter()
+                    elif isinstance(event, ScenarioFinished):
+                        run_registry.scenario_finished(job_id, len(event.test_cases or []))
+                        if not parallel:
+                            elapsed = time.perf_counter() - started.pop(event.scenario_id, time.perf_counter())
+                            store.add_result(job_id, event.scenario_id, event.scenario, event.test_cases, elapsed)
+                    store.add_event(job_id, event)
+            await checkpoint_store.prune(job_id, tc_graph.checkpoint_path, finished=True)
+            failures = store.failures(job_id)
+            if failures:
+                status = "failed" if len(failures) == len(inputs['scenario_list']) else partial_state
+                error = f"{len(failures)} of {len(inputs['scenario_list'])} scenarios failed: " + "; ".join(
+                    f"scenario {scenario_id}: {scenario_error}" for scenario_id, _, scenario_error in failures)
+    except Exception as e:
+        print(f"Job {job_id} failed: {e}")
+        # e.g. the usage limit stopped a sequential run, the scenarios it finished are kept
+        status, error = partial_state if store.results(job_id) else "failed", str(e)
+    finally:
+        store.finish(job_id, status, error)
+        run_registry.unregister(job_id)
+        # the submitting session handed its document references over to the job
+        document_store.release(file_ids)
+        await checkpoint_store.aclose()
+        # worker processes end without running atexit handlers
+        metrics.flush()
+
+
+def run_job(job_id: str, path: str = job_store_path):
+    """
+    Worker process entry point, runs one job to completion with progress and results written to the store.
+    """
+    asyncio.run(_run_job(JobStore(path), job_id))
+
+
+def describe_timing(timing: dict, total_scenarios: int) -> str:
+    return (f"Finished {timing['scenarios']}/{total_scenarios} scenarios in {timing['wall_seconds']:.0f}s "
+            f"(sequential estimate {timing['scenario_seconds']:.0f}s, speedup {timing['speedup']:.1f}x)")
+
+
+class JobRunner:
+    """
+    Runs generation jobs in a pool of worker processes, decoupled from the Streamlit script thread.
+
+    submit() records the job and returns its id at once. Progress events and per scenario results are written
+    to the job store by the worker, so a page reloaded at any time can re-attach with the job id. Unfinished
+    jobs of a server process which went away are picked up again and continue from their checkpoints.
+    """
+
+    def __init__(self, path: str = job_store_path, max_workers: int = max_job_workers,
+                 max_pending: int = max_pending_jobs, max_per_owner: int = max_jobs_per_owner):
+        self.store = JobStore(path)
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_per_owner = max_per_owner
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn, the server process has threads and event loops which must not be forked
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+                self.store.expire()
+                for job_id in self.store.orphaned(os.getpid()):
+                    print(f"Resuming job {job_id} left unfinished by a previous server process")
+                    self._dispatch(job_id, self._executor)
+            return self._executor
+
+    def _dispatch(self, job_id: str, pool: ProcessPoolExecutor):
+        future = pool.submit(run_job, job_id, self.store.path)
+        future.add_done_callback(lambda f: self._done(job_id, pool, f))
+
+    def _done(self, job_id: str, pool: ProcessPoolExecutor, future):
+        if future.cancelled() or future.exception() is None:
+            return
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool):
+            # a worker died (killed, out of memory), which fails every job of the pool; the jobs are started again
+            # on a new pool and continue from their checkpoints
+            with self._lock:
+                if self._executor is pool:
+                    self._executor = None
+            job = self.store.get(job_id)
+            if job is not None and job['status'] in active_states and job['attempts'] < max_job_attempts:
+                print(f"Job {job_id} lost its worker, starting it again")
+                self.store.requeue(job_id)
+                self._dispatch(job_id, self._pool())
+                return
+        print(f"Job {job_id} worker failed: {error}")
+        job = self.store.get(job_id)
+        self.store.finish(job_id, "failed", str(error))
+        if job is not None and job['status'] in active_states:
+            # the worker never got to its own release, the documents of the job would stay referenced
+            inputs = job_inputs(job['inputs'])
+            document_store.release([attachment['file_id'] for attachment in inputs.get('attachments') or []])
+
+    def submit(self, inputs: dict, owner: str = None, workers: int = 1) -> str:
+        """
+        Queue a generation run for inputs and return its job id, raises JobRejected when over the limits.
+        """
+        pool = self._pool()
+        job_id = self.store.admit(inputs, {'workers': workers}, owner, os.getpid(), self.max_pending,
+                                  self.max_per_owner)
+        try:
+            self._dispatch(job_id, pool)
+        except BrokenProcessPool:
+            with self._lock:
+                if self._executor is pool:
+                    self._executor = None
+            self._dispatch(job_id, self._pool())
+        return job_id
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+# one pool of worker processes per server process
+job_runner = JobRunner()
@@ -0,0 +1,95 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from langchain_core.messages import BaseMessage, messages_from_dict, messages_to_dict
+
+# messages kept in message_history when a graph does not choose its own window
+DEFAULT_MESSAGE_WINDOW = 20
+
+# run the archived messages belong to, reducers do not see the graph config so callers set it around a run
+message_archive_run: ContextVar[Optional[str]] = ContextVar("message_archive_run", default=None)
+
+
+@contextmanager
+def archive_run(run_id: str):
+    """
+    Archive messages dropped from the window during this block under run_id.
+    """
+    token = message_archive_run.set(str(run_id))
+    try:
+        yield
+    finally:
+        message_archive_run.reset(token)
+
+
+class MessageArchive:
+    """
+    Side table for messages which fell out of a graph's message_history window.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS archived_messages (id INTEGER PRIMARY KEY AUTOINCREMENT, run_id TEXT, "
+                "graph TEXT, message TEXT, archived_at REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS archived_messages_run ON archived_messages (run_id, graph)")
+        return self._conn
+
+    def archive(self, graph: str, messages: list[BaseMessage]):
+        run_id = message_archive_run.get() or "unscoped"
+        now = time.time()
+        rows = [(run_id, graph, json.dumps(message, default=str), now) for message in messages_to_dict(messages)]
+        with self._lock:
+            self._connect().executemany(
+                "INSERT INTO archived_messages (run_id, graph, message, archived_at) VALUES (?, ?, ?, ?)", rows
+            )
+
+    def load(self, run_id: str, graph: str = None) -> list[BaseMessage]:
+        """
+        Archived messages of a run in the order they were dropped.
+        """
+        sql = "SELECT message FROM archived_messages WHERE run_id = ?"
+        params = [str(run_id)]
+        if graph is not None:
+            sql += " AND graph = ?"
+            params.append(graph)
+        with self._lock:
+            rows = self._connect().execute(sql + " ORDER BY id", params).fetchall()
+        return messages_from_dict([json.loads(row[0]) for row in rows])
+
+
+def windowed_messages(window: int = DEFAULT_MESSAGE_WINDOW, graph: str = "graph", archive: MessageArchive = None):
+    """
+    message_history reducer which appends like operator.add but keeps only the last window messages,
+    so checkpoints stay the same size for the whole run. Dropped messages go to archive when given.
+    """
+    if window < 1:
+        raise ValueError("message window must keep at least one message")
+
+    def reducer(left: list, right: list) -> list:
+        merged = (left or []) + (right or [])
+        if len(merged) <= window:
+            return merged
+        if archive is not None:
+            archive.archive(graph, merged[:-window])
+        return merged[-window:]
+
+    return reducer
+
+
+# shared archive, only enabled when QA_MESSAGE_ARCHIVE_PATH is set
+message_archive = MessageArchive(os.environ["QA_MESSAGE_ARCHIVE_PATH"]) if os.getenv("QA_MESSAGE_ARCHIVE_PATH") else None
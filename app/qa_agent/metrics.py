@@ -0,0 +1,230 @@
+"""
+Counters and histograms of the generation runs, shared by the Streamlit apps, the job worker processes and the
+batch CLI through one SQLite database (QA_METRICS_PATH) and exposed in the Prometheus text format by apis.py.
+
+Recording only updates in-process totals, they are added to the database every METRICS_FLUSH_INTERVAL
+seconds and when a job ends. Rates (tokens or cost per minute) come from the counters, e.g.
+rate(qa_tokens_total[1m]) * 60.
+"""
+import atexit
+import bisect
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+metrics_path = os.getenv("QA_METRICS_PATH", "qa_metrics.sqlite")
+METRICS_FLUSH_INTERVAL = 5.0
+busy_timeout_ms = 5000
+
+# upper bounds of the histogram buckets, +Inf is implied
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+checkpoint_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+revision_buckets = (0, 1, 2, 3, 5, 8, 13, 20)
+histogram_buckets = {
+    "qa_llm_latency_seconds": latency_buckets,
+    "qa_reflection_latency_seconds": latency_buckets,
+    "qa_checkpoint_write_seconds": checkpoint_buckets,
+    "qa_scenario_revisions": revision_buckets,
+    "qa_stage_latency_seconds": latency_buckets,
+}
+
+descriptions = {
+    "qa_llm_latency_seconds": ("histogram", "Assistant run latency per assistant id and model"),
+    "qa_reflection_latency_seconds": ("histogram", "Reflection call latency per model"),
+    "qa_checkpoint_write_seconds": ("histogram", "Checkpoint write latency"),
+    "qa_scenario_revisions": ("histogram", "Revisions (stage 1 and 2) needed per finished scenario"),
+    "qa_stage_latency_seconds": ("histogram", "Call latency per pipeline stage and routed assistant / model"),
+    "qa_stage_calls_total": ("counter", "Calls per pipeline stage and routed assistant / model, escalated or not"),
+    "qa_stage_cost_dollars_total": ("counter", "Cost in dollars per pipeline stage and routed assistant / model"),
+    "qa_revisions_total": ("counter", "Revisions asked for by the reflections"),
+    "qa_scenarios_total": ("counter", "Scenarios finished"),
+    "qa_test_cases_total": ("counter", "Test cases finished, result gave_up after max revisions"),
+    "qa_node_errors_total": ("counter", "Failed graph node attempts"),
+    "qa_tokens_total": ("counter", "Tokens used per node"),
+    "qa_cost_dollars_total": ("counter", "Cost in dollars per node"),
+    "qa_cache_requests_total": ("counter", "Response cache lookups per kind and result"),
+    "qa_validations_total": ("counter", "Local answer validations per node and verdict, needs_llm went to reflection"),
+    "qa_speculative_runs_total": ("counter", "Speculative stage 2 runs per outcome, see speculation"),
+    "qa_speculation_hidden_seconds_total": ("counter", "Stage 2 run time hidden behind reflection by speculation"),
+    "qa_runs": ("gauge", "Generation jobs per state"),
+}
+
+
+def _labels(labels: dict) -> str:
+    return ",".join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items()))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metrics:
+    """
+    Process wide recorder: counters and histograms keyed by (name, labels), flushed to SQLite by a background
+    thread so recording never waits on the database.
+    """
+
+    def __init__(self, path: str = metrics_path, flush_interval: float = METRICS_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        # revisions of the scenarios in progress, by (run, scenario id)
+        self._scenario_revisions = defaultdict(int)
+        self._flusher = None
+        self._pid = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=busy_timeout_ms / 1000, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT, labels TEXT, value REAL, "
+                     "PRIMARY KEY (name, labels))")
+        conn.execute("CREATE TABLE IF NOT EXISTS histograms (name TEXT, labels TEXT, bucket INTEGER, "
+                     "count INTEGER, PRIMARY KEY (name, labels, bucket))")
+        return conn
+
+    def _start_flusher(self):
+        # also restarts it in a forked worker, the thread of the parent is not copied
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+            self._flusher.start()
+            atexit.register(self.flush)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        with self._lock:
+            self._counters[(name, _labels(labels))] += amount
+            self._start_flusher()
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        Add value to the histogram name (one of histogram_buckets).
+        """
+        buckets = histogram_buckets[name]
+        key = (name, _labels(labels))
+        with self._lock:
+            counts = self._histograms.get(key)
+            if counts is None:
+                counts = self._histograms[key] = [0] * (len(buckets) + 1)
+            counts[bisect.bisect_left(buckets, value)] += 1
+            self._counters[(name + "_sum", key[1])] += value
+            self._counters[(name + "_count", key[1])] += 1
+            self._start_flusher()
+
+    def flush(self):
+        """
+        Add the totals recorded since the last flush to the database.
+        """
+        with self._lock:
+            counters, self._counters = self._counters, defaultdict(float)
+            histograms, self._histograms = self._histograms, {}
+        if not counters and not histograms:
+            return
+        try:
+            conn = self._connect()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany(
+                    "INSERT INTO counters (name, labels, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT(name, labels) DO UPDATE SET value = value + excluded.value",
+                    [(name, labels, value) for (name, labels), value in counters.items()])
+                conn.executemany(
+                    "INSERT INTO histograms (name, labels, bucket, count) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(name, labels, bucket) DO UPDATE SET count = count + excluded.count",
+                    [(name, labels, bucket, count) for (name, labels), counts in histograms.items()
+                     for bucket, count in enumerate(counts) if count])
+                conn.execute("COMMIT")
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"Metrics flush failed: {e}")
+
+    def record_event(self, event, run_id=None):
+        """
+        Count a progress event (see progress.py) of the run.
+        """
+        from .progress import Revision, ScenarioFinished, TestCaseDone, NodeError, TokensUsed
+
+        if isinstance(event, TokensUsed):
+            self.inc("qa_tokens_total", event.total_tokens, node=event.node)
+            self.inc("qa_cost_dollars_total", event.total_cost, node=event.node)
+        elif isinstance(event, Revision):
+            self.inc("qa_revisions_total", stage=event.stage)
+            with self._lock:
+                self._scenario_revisions[(run_id, event.scenario_id)] += 1
+        elif isinstance(event, TestCaseDone):
+            self.inc("qa_test_cases_total", result="done" if event.ok else "gave_up")
+        elif isinstance(event, NodeError):
+            self.inc("qa_node_errors_total", node=event.node)
+        elif isinstance(event, ScenarioFinished):
+            with self._lock:
+                revisions = self._scenario_revisions.pop((run_id, event.scenario_id), 0)
+            self.inc("qa_scenarios_total")
+            self.observe("qa_scenario_revisions", revisions)
+
+
+def render(path: str = metrics_path, gauges: dict = None) -> str:
+    """
+    All metrics of the database in the Prometheus text exposition format. gauges maps (name, labels) to the
+    value of gauges read at scrape time, labels as a tuple of (label, value) pairs.
+    """
+    counters, histograms = [], []
+    if os.path.exists(path):
+        conn = sqlite3.connect(path, timeout=busy_timeout_ms / 1000)
+        try:
+            counters = conn.execute("SELECT name, labels, value FROM counters ORDER BY name, labels").fetchall()
+            histograms = conn.execute("SELECT name, labels, bucket, count FROM histograms "
+                                      "ORDER BY name, labels, bucket").fetchall()
+        except sqlite3.OperationalError:
+            # nothing flushed yet
+            pass
+        finally:
+            conn.close()
+
+    samples = defaultdict(list)
+    histogram_totals = {}
+    for name, labels, value in counters:
+        family, _, suffix = name.rpartition("_")
+        if family in histogram_buckets and suffix in ("sum", "count"):
+            histogram_totals[(name, labels)] = value
+        else:
+            samples[name].append((name, labels, value))
+    bucket_counts = defaultdict(dict)
+    for name, labels, bucket, count in histograms:
+        bucket_counts[(name, labels)][bucket] = count
+    for (name, labels), counts in bucket_counts.items():
+        cumulative = 0
+        for bucket, le in enumerate([*map(_format_value, histogram_buckets[name]), "+Inf"]):
+            cumulative += counts.get(bucket, 0)
+            samples[name].append((name + "_bucket", ",".join(filter(None, [labels, f'le="{le}"'])), cumulative))
+        for suffix in ("_sum", "_count"):
+            samples[name].append((name + suffix, labels, histogram_totals.get((name + suffix, labels), 0)))
+    for (name, labels), value in (gauges or {}).items():
+        samples[name].append((name, _labels(dict(labels)), value))
+
+    lines = []
+    for name in sorted(samples):
+        kind, help_text = descriptions.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sample, labels, value in samples[name]:
+            lines.append(f"{sample}{{{labels}}} {_format_value(value)}" if labels
+                         else f"{sample} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# shared recorder of the process
+metrics = Metrics()
@@ -0,0 +1,200 @@
+"""
+Routing policy of the pipeline stages: the assistant (stage 1 test case lists, test type classification,
+stage 2 details) or chat model (reflection) every stage runs on first, and the one it escalates to.
+
+Assistant stages escalate for revisions, i.e. after a failed local validation or a negative reflection.
+Reflection runs on the cheap model first and only a negative verdict (or an answer without a verdict) is
+checked again on the escalation model, so the strong model decides every revision but never has to
+confirm a good answer.
+
+Override the routes with QA_MODEL_ROUTES, a JSON file or JSON text such as
+{"reflection": {"primary": "gpt-4o-mini", "escalation": "gpt-4-turbo"}, "stage2": {"escalation": "asst_..."}}
+"""
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass, replace
+from typing import Optional
+
+from langchain_openai import ChatOpenAI
+
+from .metrics import metrics
+from .rate_limiter import rate_limiter
+from .response_cache import response_cache
+from .tracing import current_span
+from .usage_tracker import usage_statistics
+
+STAGE1 = "stage1"
+CLASSIFICATION = "classification"
+STAGE2 = "stage2"
+REFLECTION = "reflection"
+
+
+@dataclass(frozen=True)
+class Route:
+    # assistant id for the assistant stages, model name for reflection
+    primary: str
+    escalation: Optional[str] = None
+
+    def target(self, escalate: bool = False) -> str:
+        return self.escalation if escalate and self.escalation else self.primary
+
+
+default_routes = {
+    STAGE1: Route("asst_QCXmcIT4rhtSmHpyjBIWmLsc"),
+    CLASSIFICATION: Route("asst_lYJEAxz8st4RMEWC7Na5fuwM"),
+    STAGE2: Route("asst_u8bbBW8lsqzKUtmCtl1bCWZp"),
+    REFLECTION: Route("gpt-4o-mini", "gpt-4-turbo"),
+}
+
+
+def load_routes(value: Optional[str]) -> dict:
+    """
+    Routes of QA_MODEL_ROUTES (file path or JSON text) merged over default_routes.
+    """
+    routes = dict(default_routes)
+    if not value:
+        return routes
+    if os.path.exists(value):
+        with open(value, encoding="utf-8") as f:
+            value = f.read()
+    for stage, route in json.loads(value).items():
+        if isinstance(route, str):
+            route = {"primary": route}
+        routes[stage] = replace(routes[stage], **route) if stage in routes else Route(**route)
+    return routes
+
+
+def _is_finished(res) -> bool:
+    tool_calls = getattr(res, "tool_calls", None) or []
+    return bool(tool_calls and tool_calls[0].get("args", {}).get("Finished"))
+
+
+class RoutingPolicy:
+    """
+    Picks the assistant / model of every call and records per stage latency, cost and escalation rate,
+    in the process (summary) and as qa_stage_* metrics.
+    """
+
+    def __init__(self, routes: dict = None):
+        self.routes = dict(routes or default_routes)
+        self._lock = threading.Lock()
+        self._models = {}
+        self._chains = {}
+        self.reset_stats()
+
+    @classmethod
+    def from_env(cls) -> "RoutingPolicy":
+        return cls(load_routes(os.getenv("QA_MODEL_ROUTES")))
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = defaultdict(lambda: {"calls": 0, "escalated": 0, "seconds": 0.0, "cost": 0.0,
+                                              "models": defaultdict(int)})
+
+    def route(self, stage: str) -> Route:
+        return self.routes[stage]
+
+    def assistant_id(self, stage: str, escalate: bool = False) -> str:
+        return self.route(stage).target(escalate)
+
+    def chat_model(self, model: str) -> ChatOpenAI:
+        with self._lock:
+            if model not in self._models:
+                self._models[model] = ChatOpenAI(temperature=0.0, model_name=model,
+                                                 http_client=rate_limiter.http_client(),
+                                                 http_async_client=rate_limiter.async_http_client())
+            return self._models[model]
+
+    def reflection_chain(self, prompt, tool, model: str):
+        """
+        prompt | model bound to the reflection tool, built once per prompt, tool and model.
+        """
+        key = (id(prompt), tool, model)
+        chain = self._chains.get(key)
+        if chain is None:
+            chain = prompt | self.chat_model(model).bind_tools(tools=[tool], tool_choice=tool.__name__)
+            self._chains[key] = chain
+        return chain
+
+    def record(self, stage: str, target: str, seconds: float, usage=None):
+        """
+        Count one call of stage on target (assistant id or model), usage as returned by the usage tracker.
+        """
+        escalated = target != self.route(stage).primary
+        cost = usage['total_cost'] if usage else 0.0
+        with self._lock:
+            stats = self.stats[stage]
+            stats["calls"] += 1
+            stats["escalated"] += escalated
+            stats["seconds"] += seconds
+            stats["cost"] += cost
+            stats["models"][target] += 1
+        metrics.observe("qa_stage_latency_seconds", seconds, stage=stage, target=target)
+        metrics.inc("qa_stage_calls_total", stage=stage, target=target, escalated=str(escalated).lower())
+        metrics.inc("qa_stage_cost_dollars_total", cost, stage=stage, target=target)
+        current_span().set(route_target=target, escalated=escalated)
+
+    def record_output(self, stage: str, target: str, seconds: float, out):
+        """
+        record for an assistant output, with the usage the run carries (nothing is looked up for it).
+        """
+        out = out or {}
+        agent_output = out.get('agent_output') or {}
+        usage = None
+        if not out.get('cached') and agent_output.get('usage') is not None:
+            usage = usage_statistics(agent_output['usage'], agent_output.get('model'))
+        self.record(stage, target, seconds, usage)
+
+    def _record_reflection(self, model: str, started: float, res):
+        metadata = getattr(res, "response_metadata", None) or {}
+        # cached answers cost nothing
+        token_usage = None if metadata.get("cached") else metadata.get("token_usage")
+        usage = usage_statistics(token_usage, model) if token_usage else None
+        self.record(REFLECTION, model, time.perf_counter() - started, usage)
+
+    async def areflect(self, prompt, tool, messages):
+        """
+        Reflection on the primary model, rechecked on the escalation model unless it finished the task.
+        """
+        route = self.route(REFLECTION)
+        started = time.perf_counter()
+        res = await response_cache.ainvoke_reflection(self.reflection_chain(prompt, tool, route.primary),
+                                                      route.primary, messages)
+        self._record_reflection(route.primary, started, res)
+        if route.escalation and not _is_finished(res):
+            started = time.perf_counter()
+            res = await response_cache.ainvoke_reflection(self.reflection_chain(prompt, tool, route.escalation),
+                                                          route.escalation, messages)
+            self._record_reflection(route.escalation, started, res)
+        return res
+
+    def reflect(self, prompt, tool, messages):
+        route = self.route(REFLECTION)
+        started = time.perf_counter()
+        res = response_cache.invoke_reflection(self.reflection_chain(prompt, tool, route.primary),
+                                               route.primary, messages)
+        self._record_reflection(route.primary, started, res)
+        if route.escalation and not _is_finished(res):
+            started = time.perf_counter()
+            res = response_cache.invoke_reflection(self.reflection_chain(prompt, tool, route.escalation),
+                                                   route.escalation, messages)
+            self._record_reflection(route.escalation, started, res)
+        return res
+
+    def summary(self) -> dict:
+        """
+        Per stage: calls, escalation rate, mean latency, cost and calls per assistant / model.
+        """
+        with self._lock:
+            return {stage: {"calls": stats["calls"], "escalated": stats["escalated"],
+                            "escalation_rate": stats["escalated"] / stats["calls"] if stats["calls"] else 0.0,
+                            "mean_seconds": stats["seconds"] / stats["calls"] if stats["calls"] else 0.0,
+                            "cost": stats["cost"], "models": dict(stats["models"])}
+                    for stage, stats in self.stats.items()}
+
+
+# shared policy of the process, tc_graph, sub_tc_graph and graph_steps2 route through it
+routing_policy = RoutingPolicy.from_env()
@@ -0,0 +1,259 @@
+"""
+Local checks of the assistant answers, run by the reflection nodes before they call the reflection model.
+
+An answer which is well formed and complete is accepted (FINE), an error placeholder or an answer missing the
+required fields is sent back with a follow-up question (RETRY), and only answers the checks can not decide
+(too few or too many entries, duplicates, partly broken lists, revisions) go to the reflection model (NEEDS_LLM).
+An answer which was cut off (the "truncated" marker of a salvaged streamed answer) is always sent back, and the
+stage 1 test case list always goes to the reflection model, which judges whether it covers the scenario.
+Set QA_LOCAL_VALIDATION=0 to send every answer to the reflection model again.
+"""
+import os
+from dataclasses import dataclass
+from typing import Optional, Union
+
+from langchain_core.pydantic_v1 import BaseModel, ValidationError, constr
+
+FINE = "fine"
+RETRY = "retry"
+NEEDS_LLM = "needs_llm"
+
+local_validation = os.getenv("QA_LOCAL_VALIDATION", "1") != "0"
+# whether a well formed stage 1 list still goes to the reflection model for its coverage of the scenario
+coverage_reflection = os.getenv("QA_COVERAGE_REFLECTION", "1") != "0"
+
+# test cases of a stage 1 list which are accepted without reflection
+MIN_TEST_CASES = 3
+MAX_TEST_CASES = 40
+# detail entries expected for one test case in stage 2
+MAX_DETAIL_ENTRIES = 3
+# share of broken entries above which a list is sent back instead of reviewed
+MAX_INVALID_SHARE = 0.5
+
+# contents the assist nodes put in place of an answer when the run failed or returned no JSON
+error_prefixes = ("Server error occurred", "**ERROR parsing JSON:**", "Failed to process output",
+                  "Failed to generate")
+# value of every field of the get_test_schema placeholder
+placeholder_value = "error"
+
+Text = constr(strip_whitespace=True, min_length=1)
+
+
+class TestCase(BaseModel):
+    Title: Text
+    Type: Text
+    Pre_Conditions: Union[Text, list[Text]]
+
+    class Config:
+        extra = "allow"
+
+
+class BackEndDetails(BaseModel):
+    Expected_Result: Text
+    Request_Body: Union[dict, list, Text]
+    Response: Union[dict, list, Text]
+
+    class Config:
+        extra = "allow"
+
+
+class FrontEndDetails(BaseModel):
+    Test_Steps: Union[list[Text], Text]
+    Expected_Result: Text
+
+    class Config:
+        extra = "allow"
+
+
+class TestScenario(BaseModel):
+    scenarioDescription: Text
+    expectedResults: Text
+
+    class Config:
+        extra = "allow"
+
+
+class TestTypeAnswer(BaseModel):
+    Test_Type: Text
+    Reason: Text
+
+
+@dataclass(frozen=True)
+class Validation:
+    verdict: str
+    reason: str
+    # question sent back to the assistant for RETRY
+    follow_up: Optional[str] = None
+
+
+def is_error_answer(content) -> bool:
+    return isinstance(content, str) and content.startswith(error_prefixes)
+
+
+def is_truncated(answer) -> bool:
+    """
+    Whether an answer (message or parsed content) was cut off and only its complete entries were kept.
+    """
+    if isinstance(answer, dict):
+        return bool(answer.get("truncated"))
+    return bool((getattr(answer, "response_metadata", None) or {}).get("truncated"))
+
+
+def _truncated_retry(entries: list, what: str, expected: str) -> Validation:
+    return Validation(RETRY, f"answer cut off after {len(entries)} {what}",
+                      f"Your previous answer was cut off after {len(entries)} complete {what}. Answer again with "
+                      f"the complete JSON object {expected}.")
+
+
+def _error_retry(content: str, expected: str) -> Validation:
+    if content.startswith("**ERROR parsing JSON:**") or content.startswith("Failed to process output"):
+        return Validation(RETRY, "answer is not valid JSON",
+                          f"Your previous answer could not be parsed. Answer again with only the JSON object "
+                          f"{expected}, without any other text.")
+    return Validation(RETRY, "assistant run failed", "PLEASE RETRY THE TASK. ")
+
+
+def _normalize(entry) -> Optional[dict]:
+    if isinstance(entry, tuple) and len(entry) == 2:
+        entry = entry[1]
+    if not isinstance(entry, dict):
+        return None
+    # the prompt examples use both spellings
+    if "Pre_Conditions" not in entry and "Pre_Condition" in entry:
+        entry = {**entry, "Pre_Conditions": entry["Pre_Condition"]}
+    return entry
+
+
+def _is_placeholder(entry: dict, fields) -> bool:
+    return all(entry.get(name) == placeholder_value for name in fields)
+
+
+def _check_entries(entries: list, model, fields) -> list[str]:
+    """
+    Problems of the entries, one line per broken entry.
+    """
+    problems = []
+    for i, entry in enumerate(entries):
+        entry = _normalize(entry)
+        if entry is None:
+            problems.append(f"entry {i + 1} is not an object")
+            continue
+        if _is_placeholder(entry, fields):
+            problems.append(f"entry {i + 1} is empty")
+            continue
+        try:
+            model.parse_obj(entry)
+        except ValidationError as e:
+            missing = sorted({str(error['loc'][0]) for error in e.errors()})
+            problems.append(f"entry {i + 1} is missing or has an empty {', '.join(missing)}")
+    return problems
+
+
+def _judge(entries: list, problems: list[str], what: str, expected: str) -> Optional[Validation]:
+    """
+    RETRY when most entries are broken, NEEDS_LLM when some are, None when all of them are valid.
+    """
+    if not entries:
+        return Validation(RETRY, f"no {what}", f"Your previous answer contained no {what}. Answer again with "
+                                               f"the JSON object {expected}.")
+    if len(problems) > len(entries) * MAX_INVALID_SHARE:
+        return Validation(RETRY, f"{len(problems)} of {len(entries)} {what} are incomplete",
+                          f"Your previous answer is incomplete: {'; '.join(problems)}. Answer again with the "
+                          f"complete JSON object {expected}.")
+    if problems:
+        return Validation(NEEDS_LLM, f"{len(problems)} of {len(entries)} {what} are incomplete")
+    return None
+
+
+def validate_test_list(content, test_list: list, revision: bool = False, truncated: bool = False) -> Validation:
+    """
+    Stage 1 answer: the test case list (Title, Type, Pre_Conditions) of a scenario.
+    """
+    expected = "with the key 'test_list' and a list of test cases with Title, Type and Pre_Conditions"
+    if is_error_answer(content):
+        return _error_retry(content, expected)
+    entries = list(test_list or [])
+    if truncated or is_truncated(content):
+        # the test cases after the cut are lost, ask for the whole list again
+        return _truncated_retry(entries, "test cases", expected)
+    problems = _check_entries(entries, TestCase, ("Title", "Type", "Pre_Conditions"))
+    verdict = _judge(entries, problems, "test cases", expected)
+    if verdict is not None:
+        return verdict
+    titles = [str(_normalize(entry)["Title"]).strip().lower() for entry in entries]
+    if len(set(titles)) < len(titles):
+        return Validation(NEEDS_LLM, "duplicate test case titles")
+    if not MIN_TEST_CASES <= len(entries) <= MAX_TEST_CASES:
+        return Validation(NEEDS_LLM, f"{len(entries)} test cases")
+    if revision:
+        # whether the follow-up question was answered is for the reflection model to judge
+        return Validation(NEEDS_LLM, "revised answer")
+    if coverage_reflection:
+        return Validation(NEEDS_LLM, f"{len(entries)} complete test cases, coverage of the scenario to be judged")
+    return Validation(FINE, f"{len(entries)} complete test cases")
+
+
+def validate_test_details(content, details: list, tech_stack: str, revision: bool = False,
+                          truncated: bool = False) -> Validation:
+    """
+    Stage 2 answer: the details of one test case, Back End or Front End fields.
+    """
+    if tech_stack == "Back End":
+        model, fields = BackEndDetails, ("Expected_Result", "Request_Body", "Response")
+    else:
+        model, fields = FrontEndDetails, ("Test_Steps", "Expected_Result")
+    expected = f"with the key 'test_list' and the test case details with {', '.join(fields)}"
+    if is_error_answer(content):
+        return _error_retry(content, expected)
+    entries = list(details or [])
+    if truncated or is_truncated(content):
+        return _truncated_retry(entries, "test case details", expected)
+    verdict = _judge(entries, _check_entries(entries, model, fields), "test case details", expected)
+    if verdict is not None:
+        return verdict
+    if len(entries) > MAX_DETAIL_ENTRIES:
+        return Validation(NEEDS_LLM, f"{len(entries)} detail entries for one test case")
+    if revision:
+        return Validation(NEEDS_LLM, "revised answer")
+    return Validation(FINE, "complete test case details")
+
+
+def validate_scenarios(content, test_list: list, revision: bool = False) -> Validation:
+    """
+    graph_steps2 answer: test scenarios (scenarioDescription, expectedResults) of a test type or feature.
+    """
+    expected = "with the key 'test_list' and a list of scenarios with scenarioDescription and expectedResults"
+    if is_error_answer(content):
+        return _error_retry(content, expected)
+    entries = list(test_list or [])
+    problems = _check_entries(entries, TestScenario, ("scenarioDescription", "expectedResults"))
+    verdict = _judge(entries, problems, "test scenarios", expected)
+    if verdict is not None:
+        return verdict
+    descriptions = [str(entry["scenarioDescription"]).strip().lower() for entry in entries]
+    if len(set(descriptions)) < len(descriptions):
+        return Validation(NEEDS_LLM, "duplicate test scenarios")
+    if not MIN_TEST_CASES <= len(entries) <= MAX_TEST_CASES:
+        return Validation(NEEDS_LLM, f"{len(entries)} test scenarios")
+    if revision:
+        return Validation(NEEDS_LLM, "revised answer")
+    return Validation(FINE, f"{len(entries)} complete test scenarios")
+
+
+def validate_test_types(content, answers: list[tuple], revision: bool = False) -> Validation:
+    """
+    sub_tc_graph answer: (test type, reason) per classified test case, the test type already normalized to
+    Component / End-to-End or None.
+    """
+    expected = "with Test_Type (Component or End-to-End) and Reason"
+    if is_error_answer(content):
+        return _error_retry(content, expected)
+    entries = [{"Test_Type": test_type or "", "Reason": reason if isinstance(reason, str) else ""}
+               for test_type, reason in answers]
+    verdict = _judge(entries, _check_entries(entries, TestTypeAnswer, ("Test_Type", "Reason")),
+                     "test type classifications", expected)
+    if verdict is not None:
+        return verdict
+    if revision:
+        return Validation(NEEDS_LLM, "revised answer")
+    return Validation(FINE, f"{len(entries)} test types classified")
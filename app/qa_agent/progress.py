@@ -0,0 +1,177 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Optional
+
+from langgraph.config import get_config
+
+from .metrics import metrics
+
+
+@dataclass(frozen=True)
+class ScenarioStarted:
+    scenario_id: Optional[int]
+    scenario: str
+    # None for scenario workers, which only know their own scenario
+    total_scenarios: Optional[int]
+
+    def describe(self) -> str:
+        position = f"{self.scenario_id} of {self.total_scenarios}" if self.total_scenarios else f"{self.scenario_id}"
+        return f'Generating test cases for scenario {position}: "{self.scenario}"...'
+
+
+@dataclass(frozen=True)
+class TestCaseDone:
+    scenario_id: Optional[int]
+    index: int
+    total: int
+    title: str
+    ok: bool = True
+
+    def describe(self) -> str:
+        state = "done" if self.ok else "gave up after max revisions"
+        return f'Test case {self.index} of {self.total} {state}: "{self.title}"'
+
+
+@dataclass(frozen=True)
+class PartialResult:
+    """
+    A test case (stage 1) or test case details entry (stage 2) completed in the answer still being streamed.
+    """
+    scenario_id: Optional[int]
+    stage: int
+    index: int
+    title: str
+
+    def describe(self) -> str:
+        if self.stage == 1:
+            return f'Drafted test case {self.index} of scenario {self.scenario_id}: "{self.title}"'
+        return f'Drafting details of "{self.title}" ({self.index} received)'
+
+
+@dataclass(frozen=True)
+class Revision:
+    scenario_id: Optional[int]
+    stage: int
+    revision: int
+
+    def describe(self) -> str:
+        return f"Revising stage {self.stage} output of scenario {self.scenario_id} (revision {self.revision})..."
+
+
+@dataclass(frozen=True)
+class NodeError:
+    scenario_id: Optional[int]
+    node: str
+    error: str
+
+    def describe(self) -> str:
+        return f"Error in {self.node} for scenario {self.scenario_id}: {self.error}, retrying..."
+
+
+@dataclass(frozen=True)
+class TokensUsed:
+    scenario_id: Optional[int]
+    node: str
+    total_tokens: int
+    total_cost: float
+    run_cost: float
+
+    def describe(self) -> str:
+        return f"{self.node} used {self.total_tokens} tokens, run cost so far ${self.run_cost:.4f}"
+
+
+@dataclass(frozen=True)
+class ScenarioFinished:
+    scenario_id: Optional[int]
+    scenario: str
+    # the list held in graph state, passed by reference and never copied or serialized by the channel
+    test_cases: Any
+
+    def describe(self) -> str:
+        return f'Finished scenario {self.scenario_id}: "{self.scenario}" with {len(self.test_cases or [])} test cases'
+
+
+@dataclass(frozen=True)
+class ScenarioFailed:
+    """
+    A scenario of a parallel run which failed for good, its test cases are missing from the results.
+    """
+    scenario_id: Optional[int]
+    scenario: str
+    error: str
+
+    def describe(self) -> str:
+        return f'Scenario {self.scenario_id} failed: "{self.scenario}": {self.error}'
+
+
+class ProgressChannel:
+    """
+    Progress events of one run, handed to the graph as config['configurable']['progress'].
+
+    Nodes put small typed events (also from worker threads), the caller reads them with stream() while the run
+    is going instead of reading the whole checkpoint after every step.
+    """
+
+    def __init__(self):
+        self._events = deque()
+        self._loop = None
+        self._wakeup = None
+        self.result = None
+
+    def put(self, event):
+        self._events.append(event)
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError:
+                # consumer loop already closed
+                pass
+
+    def drain(self) -> list:
+        events = []
+        while self._events:
+            events.append(self._events.popleft())
+        return events
+
+    async def stream(self, run: Awaitable) -> AsyncIterator:
+        """
+        Run the awaitable (e.g. graph.ainvoke) and yield its events as they arrive, its return value is left
+        in self.result once the stream ends.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        task = asyncio.ensure_future(run)
+        try:
+            while True:
+                waiter = asyncio.ensure_future(self._wakeup.wait())
+                await asyncio.wait({task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                self._wakeup.clear()
+                for event in self.drain():
+                    yield event
+                if task.done():
+                    break
+            self.result = task.result()
+        finally:
+            if not task.done():
+                task.cancel()
+            self._loop = None
+
+
+def with_progress(config: dict, channel: ProgressChannel) -> dict:
+    return {**config, 'configurable': {**config.get('configurable', {}), 'progress': channel}}
+
+
+def emit_progress(event):
+    """
+    Count event in the metrics and put it on the progress channel of the running graph (if it has one).
+    """
+    try:
+        config = get_config()
+    except RuntimeError:
+        config = {}
+    metrics.record_event(event, config.get('configurable', {}).get('thread_id'))
+    channel = config.get('configurable', {}).get('progress')
+    if channel is not None:
+        channel.put(event)
@@ -152,6 +152,59 @@ def get_test_case_type_prompt_hard(test_case:dict):
     return prompt
 
 
+def get_test_case_type_batch_prompt(test_cases:list[tuple[int, dict]]):
+    test_case_blocks = "\n".join(
+        f"""
+    ## Test Case {index}:
+    {test_case.get('Title')}
+    Pre Conditions: {test_case.get('Pre_Conditions')}
+    """
+        for index, test_case in test_cases
+    )
+    prompt = f"""
+    You are tasked with deciding whether each of the following backend test cases should be tested at Component level or End-to-End level for Celigo's Integrator.IO.
+
+    # Guideline to classify a testcase:
+    Test cases are segregated into component tests or end-end tests based on how they can be automated
+    For a test case to be a component test -
+    i) The functionality that we are trying to test must be handled within the service. It shouldn’t need any upstream or downstream services.
+    ii) We would then see if there is any API available, either the REST API or WebSocket to test it within the service.
+    For a test case to be a functional test -
+    i) Anything that needs to be validated with flow runs
+    ii) Functionality related to mapping, transformations, user level settings, integration of multiple services
+
+    # Instructions:
+    - Use the TD and FRD documents attached to understand the test cases
+    - Use Celigo Product KB, Microservices Documentation and the GitHub repositories impacted by the technical design document where needed
+    - Classify every test case independently and keep its index as given below
+
+    # Test Cases:
+    {test_case_blocks}
+
+    # Output Format:
+    Return your answer as JSON with exactly one entry per test case:
+
+    ```json
+    {{
+    "test_types": [
+        {{
+        "index": 1,
+        "Test_Type": "Component" | "End-to-End",
+        "Reason": "Detailed reasoning citing tool findings."
+        }}
+    ]
+    }}
+    ```
+    # Important Notes:
+    - Ensure the JSON output is valid and strictly adheres to JSON standards.
+    - Do NOT include any code comments (`//` or `/* */`) inside the JSON output.
+    - Every line in the output must be valid JSON—no inline comments, explanations, or additional text outside of the JSON structure.
+    - Do NOT use ellipsis (`...`) as a placeholder, every test case listed above must have its own entry.
+
+    """
+    return prompt
+
+
 def get_general_test_case_generation_prompt(scenario):
     prompt = f"""Generate a comprehensive list of test cases based on the test scenario {scenario} by utilizing detailed information from technical design documents and the Feature requirements document. 
                 Refer to the product Knowledge base when additional clarification is needed.
@@ -0,0 +1,235 @@
+import asyncio
+import re
+import threading
+import time
+import weakref
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import httpx
+from openai import AsyncOpenAI, RateLimitError
+
+from .tracing import current_span
+
+# Requests per minute assumed until the API tells us the real limit
+DEFAULT_REQUESTS_PER_MINUTE = 500
+# Back off used for a 429 which does not carry a retry-after header
+DEFAULT_RETRY_AFTER = 2.0
+MAX_RETRY_AFTER = 60.0
+MAX_RETRIES = 5
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset_duration(value) -> Optional[float]:
+    """
+    Parse OpenAI reset values such as "20ms", "1s" or "6m0.5s" (or plain seconds) into seconds.
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """
+    Read retry-after-ms / retry-after (seconds or HTTP date) from response headers.
+    """
+    if not headers:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket shared by every graph node of the process.
+
+    Calls go out immediately while the bucket has budget. The bucket size and refill rate follow the
+    x-ratelimit-* headers of OpenAI responses, and a 429 (or an exhausted remaining budget) blocks all
+    callers until the reset / retry-after time given by the API.
+    """
+
+    def __init__(self, requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE):
+        self._lock = threading.Lock()
+        self.capacity = float(requests_per_minute)
+        self.refill_rate = requests_per_minute / 60.0
+        self.tokens = self.capacity
+        self.blocked_until = 0.0
+        self.updated_at = time.monotonic()
+        self.throttled = 0
+        self.rate_limited = 0
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_rate)
+        self.updated_at = now
+
+    def _reserve(self) -> float:
+        """
+        Take one request from the bucket and return how long the caller has to wait before sending it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0.0, self.blocked_until - now)
+            if self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) / self.refill_rate)
+            # going negative keeps the reservations in arrival order
+            self.tokens -= 1
+            if wait > 0:
+                self.throttled += 1
+            return wait
+
+    def acquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def aacquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def backoff(self, seconds: float, rate_limited: bool = False):
+        """
+        Block every caller for the given number of seconds, rate_limited counts it as a 429 of the API.
+        """
+        seconds = min(max(seconds, 0.0), MAX_RETRY_AFTER)
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            if rate_limited:
+                self.rate_limited += 1
+
+    def update_from_headers(self, headers):
+        """
+        Adjust the bucket from the x-ratelimit-* headers of an OpenAI response.
+        """
+        if not headers:
+            return
+        limit = headers.get("x-ratelimit-limit-requests")
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if limit is not None and limit.isdigit() and int(limit) > 0:
+                self.capacity = float(limit)
+                self.refill_rate = self.capacity / 60.0
+            if remaining is not None and remaining.isdigit():
+                self.tokens = min(self.tokens, float(remaining))
+                if int(remaining) == 0:
+                    reset = parse_reset_duration(headers.get("x-ratelimit-reset-requests"))
+                    if reset:
+                        self.blocked_until = max(self.blocked_until, now + min(reset, MAX_RETRY_AFTER))
+            if remaining_tokens is not None and remaining_tokens.isdigit() and int(remaining_tokens) == 0:
+                reset = parse_reset_duration(headers.get("x-ratelimit-reset-tokens"))
+                if reset:
+                    self.blocked_until = max(self.blocked_until, now + min(reset, MAX_RETRY_AFTER))
+
+    def observe_response(self, response: httpx.Response):
+        """
+        httpx response hook, feeds every OpenAI response (including 429s) into the limiter.
+        """
+        self.update_from_headers(response.headers)
+        if response.status_code == 429:
+            current_span().add("rate_limited")
+            self.backoff(parse_retry_after(response.headers) or DEFAULT_RETRY_AFTER, rate_limited=True)
+
+    async def aobserve_response(self, response: httpx.Response):
+        self.observe_response(response)
+
+    def retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """
+        Seconds to wait before retrying after error, None when the error is not a rate limit.
+        """
+        response = getattr(error, "response", None)
+        if not isinstance(error, RateLimitError) and getattr(response, "status_code", None) != 429:
+            return None
+        headers = getattr(response, "headers", None)
+        self.update_from_headers(headers)
+        delay = parse_retry_after(headers) or DEFAULT_RETRY_AFTER * (2 ** attempt)
+        self.backoff(delay, rate_limited=True)
+        return delay
+
+    def call(self, fn, *args, max_retries: int = MAX_RETRIES, **kwargs):
+        """
+        Run fn once the bucket allows it, retrying on 429 after the retry-after given by the API.
+        """
+        for attempt in range(max_retries + 1):
+            self.acquire()
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if delay is None or attempt == max_retries:
+                    raise
+                current_span().add("retries")
+                print(f"Rate limited, retrying in {delay:.1f}s (attempt {attempt + 1}/{max_retries})")
+
+    async def acall(self, fn, *args, max_retries: int = MAX_RETRIES, **kwargs):
+        """
+        Async counterpart of call, fn must return an awaitable.
+        """
+        for attempt in range(max_retries + 1):
+            await self.aacquire()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if delay is None or attempt == max_retries:
+                    raise
+                current_span().add("retries")
+                print(f"Rate limited, retrying in {delay:.1f}s (attempt {attempt + 1}/{max_retries})")
+
+    def http_client(self) -> httpx.Client:
+        """
+        httpx client for OpenAI / ChatOpenAI whose responses update this limiter.
+        """
+        return httpx.Client(event_hooks={"response": [self.observe_response]})
+
+    def async_http_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(event_hooks={"response": [self.aobserve_response]})
+
+
+# shared limiter used by tc_graph, sub_tc_graph, graph_steps2, graph, graph_fe and tc_graph_agent
+rate_limiter = AdaptiveRateLimiter()
+
+# AsyncOpenAI per event loop, see shared_async_client
+_async_clients = weakref.WeakKeyDictionary()
+_async_clients_lock = threading.Lock()
+
+
+def shared_async_client() -> AsyncOpenAI:
+    """
+    AsyncOpenAI of the running event loop, created on first use and kept for every later request of the loop.
+    httpx connections belong to the loop which opened them, so each loop (asyncio.run) gets a client of its own.
+    """
+    loop = asyncio.get_running_loop()
+    with _async_clients_lock:
+        client = _async_clients.get(loop)
+        if client is None:
+            client = _async_clients[loop] = AsyncOpenAI(http_client=rate_limiter.async_http_client())
+    return client
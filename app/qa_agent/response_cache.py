@@ -0,0 +1,293 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from langchain_core.messages import messages_from_dict, messages_to_dict
+
+from .rate_limiter import rate_limiter, shared_async_client
+from .tracing import tracer, payload_size
+from .metrics import metrics
+
+response_cache_path = os.getenv("QA_RESPONSE_CACHE_PATH", "qa_response_cache.sqlite")
+# entries older than this are never served
+DEFAULT_CACHE_TTL = 7 * 24 * 3600
+# least recently used entries are evicted once the stored responses exceed this size
+DEFAULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _messages_size(messages) -> int:
+    return sum(payload_size(getattr(message, "content", message)) for message in messages)
+
+
+def _cached_message(cached):
+    message = messages_from_dict(cached)[0]
+    message.response_metadata["cached"] = True
+    return message
+
+
+class ResponseCache:
+    """
+    Persistent cache of assistant (get_query_chain) and reflection responses.
+
+    Entries are keyed by sha256 of (kind, assistant id / model, prompt text, assistant thread,
+    attachment content hashes), so re-running the same scenarios against the same documents
+    reuses earlier answers even though the documents were uploaded under new file ids.
+
+    A cached assistant answer is never handed out with the thread of the run which produced it: the runs of
+    a later job would otherwise share that thread ("thread already has an active run"). The answer is
+    replayed onto a thread of the caller instead, a new thread for a new-thread answer and the caller's own
+    thread for a follow-up, and the new thread is keyed as an alias of the cached one so the follow-ups
+    still hit. Cut off (truncated) answers are not stored.
+    """
+
+    def __init__(self, path: str = response_cache_path, ttl: float = DEFAULT_CACHE_TTL,
+                 max_bytes: int = DEFAULT_CACHE_MAX_BYTES, enabled: bool = True):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, kind TEXT, value TEXT, "
+                "size INTEGER, created_at REAL, accessed_at REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS file_hashes (file_id TEXT PRIMARY KEY, sha256 TEXT, created_at REAL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS thread_aliases (thread_id TEXT PRIMARY KEY, cache_thread_id TEXT, "
+                "created_at REAL)"
+            )
+        return self._conn
+
+    def register_file(self, file_id: str, content: bytes = None, sha256: str = None):
+        """
+        Remember the content hash of an uploaded file so attachments are keyed by content, not file id.
+        """
+        if sha256 is None:
+            if content is None:
+                return
+            sha256 = hash_bytes(content)
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO file_hashes (file_id, sha256, created_at) VALUES (?, ?, ?)",
+                (file_id, sha256, time.time()),
+            )
+
+    def attachment_hashes(self, attachments) -> list[str]:
+        """
+        Content hashes of the attachments, the file id is used for files which were never registered.
+        """
+        file_ids = [a.get("file_id") for a in attachments or [] if isinstance(a, dict) and a.get("file_id")]
+        if not file_ids:
+            return []
+        with self._lock:
+            rows = self._connect().execute(
+                f"SELECT file_id, sha256 FROM file_hashes WHERE file_id IN ({','.join('?' * len(file_ids))})",
+                file_ids,
+            ).fetchall()
+        known = dict(rows)
+        return sorted(known.get(file_id, file_id) for file_id in file_ids)
+
+    def cache_thread(self, thread_id: Optional[str]) -> Optional[str]:
+        """
+        Thread the cache entries of thread_id are keyed by, the cached thread a replayed answer was forked from.
+        """
+        if not thread_id:
+            return thread_id
+        with self._lock:
+            row = self._connect().execute("SELECT cache_thread_id FROM thread_aliases WHERE thread_id = ?",
+                                          (thread_id,)).fetchone()
+        return row[0] if row else thread_id
+
+    def _alias_thread(self, thread_id: str, cache_thread_id: str):
+        # the cached answer may itself have been produced on a replayed thread
+        cache_thread_id = self.cache_thread(cache_thread_id)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO thread_aliases (thread_id, cache_thread_id, created_at) "
+                         "VALUES (?, ?, ?)", (thread_id, cache_thread_id, now))
+            conn.execute("DELETE FROM thread_aliases WHERE created_at < ?", (now - self.ttl,))
+
+    def make_key(self, kind: str, identity: str, prompt: str, thread_id: Optional[str] = None,
+                 attachments=None) -> str:
+        payload = json.dumps(
+            [kind, identity, prompt, self.cache_thread(thread_id), self.attachment_hashes(attachments)],
+            ensure_ascii=False,
+        )
+        return hash_bytes(payload.encode("utf-8"))
+
+    def get(self, key: str):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, kind: str, value):
+        if not self.enabled:
+            return
+        data = json.dumps(value, default=str)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, kind, value, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, kind, data, len(data), now, now),
+            )
+            self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def clear(self):
+        with self._lock:
+            self._connect().execute("DELETE FROM responses")
+
+    def summary(self) -> str:
+        return f"Cache hits: {self.hits}, Cache misses: {self.misses}"
+
+    def _count(self, kind: str, hit: bool):
+        if self.enabled:
+            metrics.inc("qa_cache_requests_total", kind=kind, result="hit" if hit else "miss")
+
+    async def aget_query_chain(self, assist, assistant_id: str, query_input: dict):
+        """
+        Cached assist.get_query_chain, only answers with a thread and parsed JSON are stored.
+        Cached outputs carry 'cached': True so callers can skip the run usage lookup.
+        """
+        prompt = query_input.get("promptInput", {}).get("query", "")
+        with tracer.span("assistant_run", assistant_id=assistant_id, prompt_bytes=payload_size(prompt),
+                         new_thread=not query_input.get("threadID")) as span:
+            key = self.make_key("assistant", assistant_id, prompt, query_input.get("threadID"),
+                                query_input.get("attachments"))
+            out = self.get(key)
+            span.set(cached=out is not None)
+            self._count("assistant", out is not None)
+            if out is not None:
+                out = await self._replay(out, prompt, query_input)
+            if out is not None:
+                out["cached"] = True
+                return out
+            started = time.perf_counter()
+            out = await rate_limiter.acall(assist.get_query_chain, query_input)
+            agent_output = out.get("agent_output") if isinstance(out, dict) else None
+            metrics.observe("qa_llm_latency_seconds", time.perf_counter() - started, assistant_id=assistant_id,
+                            model=(agent_output or {}).get("model") or "unknown")
+            if agent_output:
+                span.set(output_bytes=payload_size(agent_output.get("output")),
+                         tokens=(agent_output.get("usage") or {}).get("total_tokens", 0))
+            query = out.get("query") if isinstance(out, dict) else None
+            # a cut off answer replayed from the cache would lose the same entries on every run
+            truncated = isinstance(query, dict) and query.get("truncated")
+            if agent_output and agent_output.get("thread_id") and query and not truncated:
+                self.put(key, "assistant", out)
+            return out
+
+    async def _replay(self, out: dict, prompt: str, query_input: dict) -> Optional[dict]:
+        """
+        Cached out moved onto a thread of the caller: the question and the cached answer are added to the
+        caller's thread, or to a new thread for a new-thread answer. None when that failed, the question is
+        then run for real.
+        """
+        agent_output = out.get("agent_output") or {}
+        user_message = {"role": "user", "content": prompt}
+        if query_input.get("attachments"):
+            user_message["attachments"] = query_input["attachments"]
+        messages = [user_message, {"role": "assistant", "content": agent_output.get("output") or ""}]
+        try:
+            client = shared_async_client()
+            thread_id = query_input.get("threadID")
+            if thread_id:
+                for message in messages:
+                    await client.beta.threads.messages.create(thread_id=thread_id, **message)
+            else:
+                thread_id = (await client.beta.threads.create(messages=messages)).id
+                self._alias_thread(thread_id, agent_output.get("thread_id"))
+        except Exception as e:
+            print(f"Could not replay the cached answer onto a thread, running it again: {e}")
+            return None
+        return {**out, "agent_output": {**agent_output, "thread_id": thread_id}}
+
+    def _reflection_key(self, chain, model: str, messages) -> str:
+        try:
+            # the prompt of the chain formatted with the messages, i.e. exactly what is sent to the model
+            prompt = chain.first.invoke({"messages": messages}).to_messages()
+        except Exception:
+            prompt = messages
+        return self.make_key("reflection", model, json.dumps(messages_to_dict(prompt), default=str))
+
+    def _store_reflection(self, key: str, res):
+        if getattr(res, "tool_calls", None):
+            self.put(key, "reflection", messages_to_dict([res]))
+
+    async def ainvoke_reflection(self, chain, model: str, messages):
+        """
+        Cached chain.ainvoke({"messages": messages}) for the reflection chains.
+        """
+        with tracer.span("reflection_invoke", model=model, prompt_bytes=_messages_size(messages)) as span:
+            key = self._reflection_key(chain, model, messages)
+            cached = self.get(key)
+            span.set(cached=cached is not None)
+            self._count("reflection", cached is not None)
+            if cached is not None:
+                return _cached_message(cached)
+            started = time.perf_counter()
+            res = await rate_limiter.acall(chain.ainvoke, {"messages": messages})
+            metrics.observe("qa_reflection_latency_seconds", time.perf_counter() - started, model=model)
+            self._store_reflection(key, res)
+            return res
+
+    def invoke_reflection(self, chain, model: str, messages):
+        with tracer.span("reflection_invoke", model=model, prompt_bytes=_messages_size(messages)) as span:
+            key = self._reflection_key(chain, model, messages)
+            cached = self.get(key)
+            span.set(cached=cached is not None)
+            self._count("reflection", cached is not None)
+            if cached is not None:
+                return _cached_message(cached)
+            started = time.perf_counter()
+            res = rate_limiter.call(chain.invoke, {"messages": messages})
+            metrics.observe("qa_reflection_latency_seconds", time.perf_counter() - started, model=model)
+            self._store_reflection(key, res)
+            return res
+
+
+# shared cache used by tc_graph, sub_tc_graph, graph_steps2 and tc_graph_agent
+response_cache = ResponseCache(enabled=os.getenv("QA_RESPONSE_CACHE", "1") != "0")
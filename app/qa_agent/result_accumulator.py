@@ -0,0 +1,220 @@
+import csv
+import math
+import os
+import tempfile
+import threading
+import uuid
+
+import pandas as pd
+import xlsxwriter
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    parquet_available = True
+except ImportError:
+    parquet_available = False
+
+result_labels = ['Adopt', 'New Addition', 'Not Used(Basic)', 'Not Used(Irrelevant)', 'Not Used(Other)']
+export_dir = os.getenv("QA_EXPORT_DIR", os.path.join(tempfile.gettempdir(), "qa_exports"))
+export_formats = {
+    "xlsx": ("test_scenarios.xlsx", "application/vnd.ms-excel"),
+    "csv": ("test_scenarios.csv", "text/csv"),
+    "parquet": ("test_scenarios.parquet", "application/octet-stream"),
+}
+
+
+def cell_value(value):
+    """
+    Value as written to a spreadsheet cell, non scalar values are written as text like pandas does.
+    """
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+class ParquetRowGroupWriter:
+    """
+    Parquet file written one row group per append(), so the rows are never all held in memory.
+
+    The columns are fixed by the first append: the leading columns, then the fields of its rows in order of first
+    appearance, all fields stored as text. Fields which only later rows have are left out (and reported once).
+    Parquet files are only readable once their footer is written, the row groups go to path + '.tmp' which
+    close() moves to path; abort() removes it.
+    """
+
+    def __init__(self, path: str, leading: dict):
+        """
+        leading maps the columns written before the fields of the rows to their pyarrow type.
+        """
+        self.path = path
+        self.leading = leading
+        self.schema = None
+        self.rows = 0
+        self._writer = None
+        self._ignored = set()
+
+    def append(self, leading_values: dict, rows: list[dict]):
+        if not rows:
+            return
+        if self._writer is None:
+            fields = list(dict.fromkeys(name for row in rows for name in row if name not in self.leading))
+            self.schema = pyarrow.schema([*self.leading.items(), *((name, pyarrow.string()) for name in fields)])
+            self._writer = pyarrow.parquet.ParquetWriter(self.path + ".tmp", self.schema)
+        ignored = {name for row in rows for name in row} - set(self.schema.names) - self._ignored
+        if ignored:
+            print(f"{os.path.basename(self.path)}: fields {', '.join(sorted(ignored))} are not written to Parquet")
+            self._ignored |= ignored
+        columns = {}
+        for name in self.schema.names:
+            if name in self.leading:
+                columns[name] = [leading_values.get(name)] * len(rows)
+            else:
+                values = (cell_value(row.get(name)) for row in rows)
+                columns[name] = [None if value is None else str(value) for value in values]
+        self._writer.write_table(pyarrow.table(columns, schema=self.schema))
+        self.rows += len(rows)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            os.replace(self.path + ".tmp", self.path)
+            self._writer = None
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+            os.remove(self.path + ".tmp")
+            self._writer = None
+
+
+class ResultAccumulator:
+    """
+    Append-only columnar store of the generated test cases of a session.
+
+    append() adds the test cases of a finished scenario in O(rows added); columns are kept in order of first
+    appearance with a trailing 'scenario' column, like the pd.concat the downloaders used to run. export() writes
+    a file for the current contents once and serves it from disk until more results are appended.
+    """
+
+    def __init__(self, directory: str = export_dir):
+        self.directory = directory
+        self.key = uuid.uuid4().hex
+        self.columns: dict[str, list] = {}
+        self.rows = 0
+        self.version = 0
+        self.unique_cases = None
+        self._exports = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.rows
+
+    def _add_column(self, name: str):
+        if name not in self.columns:
+            self.columns[name] = [None] * self.rows
+
+    def append(self, scenario, test_cases: list[dict]):
+        with self._lock:
+            # the columns of all the scenario's test cases come before 'scenario', as in its DataFrame
+            for test_case in test_cases:
+                for name in test_case:
+                    self._add_column(name)
+            if test_cases:
+                self._add_column('scenario')
+            for test_case in test_cases:
+                for name, values in self.columns.items():
+                    values.append(scenario if name == 'scenario' else test_case.get(name))
+                self.rows += 1
+            self.version += 1
+
+    def set_unique_cases(self, unique_cases: pd.DataFrame):
+        """
+        Deduplicated test cases exported as the 'unique_cases' sheet.
+        """
+        with self._lock:
+            self.unique_cases = unique_cases
+            self.version += 1
+
+    def clear(self):
+        with self._lock:
+            self.columns, self.rows, self.unique_cases = {}, 0, None
+            self.version += 1
+
+    def header(self) -> list[str]:
+        return list(self.columns) + ['Result']
+
+    def iter_rows(self):
+        values = list(self.columns.values())
+        for i in range(self.rows):
+            yield [cell_value(column[i]) for column in values] + [result_labels[i % len(result_labels)]]
+
+    def to_dataframe(self) -> pd.DataFrame:
+        df = pd.DataFrame({name: [cell_value(value) for value in values] for name, values in self.columns.items()})
+        df['Result'] = [result_labels[i % len(result_labels)] for i in range(self.rows)]
+        return df
+
+    def _write_sheet(self, worksheet, header: list, rows, header_format):
+        for col, name in enumerate(header):
+            worksheet.write(0, col, name, header_format)
+        for row, values in enumerate(rows, start=1):
+            for col, value in enumerate(values):
+                if value is not None:
+                    worksheet.write(row, col, value)
+
+    def _write_xlsx(self, path: str):
+        # constant_memory flushes every row to disk once written, memory stays flat for any number of test cases
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'strings_to_urls': False,
+                                              'strings_to_formulas': False})
+        header_format = workbook.add_format({'bold': True, 'border': 1})
+        self._write_sheet(workbook.add_worksheet('Sheet1'), self.header(), self.iter_rows(), header_format)
+        if self.unique_cases is not None and not self.unique_cases.empty:
+            unique_cases = self.unique_cases
+            header = [str(name) for name in unique_cases.columns] + ['Result']
+            rows = ([cell_value(value) for value in values] + [result_labels[i % len(result_labels)]]
+                    for i, values in enumerate(unique_cases.itertuples(index=False, name=None)))
+            self._write_sheet(workbook.add_worksheet('unique_cases'), header, rows, header_format)
+        workbook.close()
+
+    def _write_csv(self, path: str):
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.header())
+            writer.writerows(self.iter_rows())
+
+    def _write_parquet(self, path: str):
+        self.to_dataframe().to_parquet(path, index=False)
+
+    def formats(self) -> list[str]:
+        return [fmt for fmt in export_formats if fmt != "parquet" or parquet_available]
+
+    def export(self, fmt: str = "xlsx") -> str:
+        """
+        Path of the fmt export of the current contents, built only when results changed since the last export.
+        """
+        if fmt not in self.formats():
+            raise ValueError(f"Unsupported export format: {fmt}")
+        with self._lock:
+            cached = self._exports.get(fmt)
+            if cached and cached[0] == self.version and os.path.exists(cached[1]):
+                return cached[1]
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{self.key}_{self.version}.{fmt}")
+            {"xlsx": self._write_xlsx, "csv": self._write_csv, "parquet": self._write_parquet}[fmt](path)
+            if cached and cached[1] != path and os.path.exists(cached[1]):
+                os.remove(cached[1])
+            self._exports[fmt] = (self.version, path)
+            return path
+
+    def export_bytes(self, fmt: str = "xlsx") -> bytes:
+        with open(self.export(fmt), 'rb') as f:
+            return f.read()
+
+    def remove_exports(self):
+        with self._lock:
+            for _, path in self._exports.values():
+                if os.path.exists(path):
+                    os.remove(path)
+            self._exports = {}
@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+run_registry_path = os.getenv("QA_RUN_REGISTRY_PATH", "qa_runs.sqlite")
+
+
+def pid_alive(pid) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class RunRegistry:
+    """
+    Open page requests and active generation runs of every process on the host, for the health server.
+
+    Every request and run is one row written with a single statement, so concurrent processes never lose an
+    update the way rewriting a counter file does. Rows of processes which died without unregistering are
+    ignored and removed on read.
+    """
+
+    def __init__(self, path: str = run_registry_path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # a connection must not be carried over into a forked process
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            self._pid = os.getpid()
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, kind TEXT, owner TEXT, pid INTEGER, "
+                "started_at REAL, updated_at REAL, scenarios_total INTEGER, scenarios_done INTEGER, "
+                "current_scenario INTEGER, test_cases INTEGER)"
+            )
+        return self._conn
+
+    def _execute(self, sql: str, params=()):
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def register(self, run_id: str, kind: str, owner: str = None, scenarios_total: int = None,
+                 scenarios_done: int = 0):
+        now = time.time()
+        self._execute(
+            "INSERT OR REPLACE INTO runs (run_id, kind, owner, pid, started_at, updated_at, scenarios_total, "
+            "scenarios_done, current_scenario, test_cases) VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL, 0)",
+            (str(run_id), kind, owner, os.getpid(), now, now, scenarios_total, scenarios_done),
+        )
+
+    def scenario_started(self, run_id: str, scenario_id):
+        self._execute("UPDATE runs SET current_scenario = ?, updated_at = ? WHERE run_id = ?",
+                      (scenario_id, time.time(), str(run_id)))
+
+    def scenario_finished(self, run_id: str, test_cases: int):
+        self._execute("UPDATE runs SET scenarios_done = scenarios_done + 1, test_cases = test_cases + ?, "
+                      "updated_at = ? WHERE run_id = ?", (test_cases, time.time(), str(run_id)))
+
+    def unregister(self, run_id: str):
+        self._execute("DELETE FROM runs WHERE run_id = ?", (str(run_id),))
+
+    @contextmanager
+    def tracked(self, kind: str, owner: str = None, run_id: str = None, scenarios_total: int = None):
+        """
+        Registered for the duration of the with block, yields the run id.
+        """
+        run_id = run_id or str(uuid.uuid4())
+        self.register(run_id, kind, owner, scenarios_total)
+        try:
+            yield run_id
+        finally:
+            self.unregister(run_id)
+
+    def active(self, kind: str = None) -> list[dict]:
+        """
+        Registered requests / runs of live processes, oldest first.
+        """
+        sql = "SELECT * FROM runs" + (" WHERE kind = ?" if kind else "") + " ORDER BY started_at"
+        with self._lock:
+            cursor = self._connect().execute(sql, (kind,) if kind else ())
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        dead = [row['run_id'] for row in rows if not pid_alive(row['pid'])]
+        for run_id in dead:
+            self.unregister(run_id)
+        return [row for row in rows if row['run_id'] not in dead]
+
+    def count(self, kind: str) -> int:
+        return len(self.active(kind))
+
+
+# shared registry of the process, the Streamlit apps, job workers and apis.py all open the same database
+run_registry = RunRegistry()
@@ -0,0 +1,96 @@
+"""
+Speculative stage 2 runs: while reflect_stage2 checks the details of test case i, the details of test case i + 1
+are already being generated, so the reflection round trip is hidden behind generation. Most reflections finish
+the test case and the next assist_stage2 only waits for what is left of the speculative run. When the reflection
+asks for a revision the revision runs first, the speculative answer is kept and taken by the next test case.
+
+Speculative runs are tasks of the process, they are not checkpointed: a resumed graph run generates the next
+test case again. Set QA_PIPELINE_STAGE2=1 (or QAGraph(pipeline_stage2=True)) to turn it on.
+"""
+import asyncio
+import os
+import time
+import traceback
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from .metrics import metrics
+
+pipeline_stage2 = os.getenv("QA_PIPELINE_STAGE2", "0") == "1"
+
+
+class SpeculativeRuns:
+    """
+    Runs started ahead of the graph node which needs them, keyed by what they were started for and taken by
+    that node only when it asks the same query.
+    """
+
+    def __init__(self):
+        self._runs = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {"started": 0, "used": 0, "discarded": 0, "failed": 0, "waited_seconds": 0.0,
+                      "hidden_seconds": 0.0}
+
+    def _count(self, outcome: str):
+        self.stats[outcome] += 1
+        metrics.inc("qa_speculative_runs_total", outcome=outcome)
+
+    def pending(self, key: Hashable) -> bool:
+        return key in self._runs
+
+    def start(self, key: Hashable, query: str, run: Callable[[], Awaitable[Any]]):
+        """
+        Start run() in the background for key, unless one is already pending for it.
+        """
+        if key in self._runs:
+            return
+
+        async def timed():
+            started = time.perf_counter()
+            result = await run()
+            return result, time.perf_counter() - started
+
+        self._runs[key] = (query, asyncio.ensure_future(timed()))
+        self._count("started")
+
+    async def take(self, key: Hashable, query: str) -> Optional[Any]:
+        """
+        Result of the run started for key, awaited. None when there is none, it was started for another query
+        or it failed, the caller runs the query itself then.
+        """
+        entry = self._runs.pop(key, None)
+        if entry is None:
+            return None
+        speculated_query, task = entry
+        if speculated_query != query:
+            task.cancel()
+            self._count("discarded")
+            return None
+        started = time.perf_counter()
+        try:
+            result, run_seconds = await task
+        except Exception:
+            print(f"Speculative run {key} failed, running it again")
+            traceback.print_exc()
+            self._count("failed")
+            return None
+        waited = time.perf_counter() - started
+        hidden = max(0.0, run_seconds - waited)
+        self.stats["waited_seconds"] += waited
+        self.stats["hidden_seconds"] += hidden
+        self._count("used")
+        metrics.inc("qa_speculation_hidden_seconds_total", hidden)
+        return result
+
+    def cancel(self):
+        """
+        Cancel the runs nobody took, e.g. of a graph run which failed or was interrupted.
+        """
+        for _, task in self._runs.values():
+            task.cancel()
+            self._count("discarded")
+        self._runs.clear()
+
+    def summary(self) -> dict:
+        return {**self.stats, "pending": len(self._runs)}
@@ -0,0 +1,98 @@
+"""
+Assistant executor which streams the run instead of polling it until it completes. It takes the same input as
+OpenAIAssistantExecuters.get_query_chain ({"promptInput": {"query"}, "threadID", "attachments"}) and returns the
+same output ({"agent_output": {...}, "query": parsed answer}).
+
+The objects of the answer's array (test_list by default) are handed to on_item as soon as they are complete,
+and an answer which is cut off (max tokens, a stream ending early) keeps its complete objects instead of
+failing to parse. Set QA_STREAM_ANSWERS=0 to use the polling executor again.
+"""
+import os
+import traceback
+from typing import Callable, Optional
+
+from .incremental_json import ArrayItemParser
+from .rate_limiter import shared_async_client
+
+stream_answers = os.getenv("QA_STREAM_ANSWERS", "1") != "0"
+# run states after which the stream has nothing more to say
+failed_run_states = ("failed", "cancelled", "expired", "requires_action")
+# run states of an answer which was cut off (max tokens), kept but marked truncated
+incomplete_run_states = ("incomplete",)
+
+
+class StreamingAssistantExecutor:
+
+    def __init__(self, agent_id: str, key: Optional[str] = "test_list",
+                 on_item: Callable[[int, dict], None] = None):
+        self.agent_id = agent_id
+        self.key = key
+        self.on_item = on_item
+
+    def _emit(self, index: int, item):
+        if self.on_item is None:
+            return
+        try:
+            self.on_item(index, item)
+        except Exception:
+            # a failing progress update must not fail the run
+            traceback.print_exc()
+
+    async def get_query_chain(self, query_input: dict) -> dict:
+        message = {"role": "user", "content": query_input.get("promptInput", {}).get("query", "")}
+        if query_input.get("attachments"):
+            message["attachments"] = query_input["attachments"]
+        parser = ArrayItemParser(self.key)
+        run = None
+        client = shared_async_client()
+        if query_input.get("threadID"):
+            stream = await client.beta.threads.runs.create(thread_id=query_input["threadID"],
+                                                           assistant_id=self.agent_id,
+                                                           additional_messages=[message], stream=True)
+        else:
+            stream = await client.beta.threads.create_and_run(assistant_id=self.agent_id,
+                                                              thread={"messages": [message]}, stream=True)
+        # the stream holds a connection of the shared client until it is closed
+        async with stream:
+            async for event in stream:
+                if event.event == "thread.message.delta":
+                    for part in event.data.delta.content or []:
+                        if part.type == "text" and part.text and part.text.value:
+                            for item in parser.feed(part.text.value):
+                                self._emit(len(parser.items), item)
+                elif event.event.startswith("thread.run.") and not event.event.startswith("thread.run.step"):
+                    run = event.data
+                elif event.event == "error":
+                    raise RuntimeError(f"Assistant stream error: {event.data}")
+
+        if run is None:
+            raise RuntimeError("Assistant stream ended before the run was created")
+        if run.status in failed_run_states:
+            raise RuntimeError(f"Assistant run {run.id} {run.status}: {run.last_error}")
+        query = parser.result()
+        if run.status in incomplete_run_states and isinstance(query, dict):
+            # even when what arrived parses, the answer stopped early, leave it to the validation
+            query = {**query, "truncated": True}
+        if isinstance(query, dict) and query.get("truncated"):
+            print(f"Assistant run {run.id} ({run.status}) returned truncated JSON, kept {len(parser.items)} "
+                  f"complete entries")
+        return {
+            "agent_output": {
+                "thread_id": run.thread_id,
+                "run_id": run.id,
+                "output": parser.text,
+                "usage": run.usage.model_dump() if run.usage else None,
+                "model": run.model,
+            },
+            "query": query,
+        }
+
+
+def assistant_executor(agent_id: str, fallback, key: Optional[str] = "test_list",
+                       on_item: Callable[[int, dict], None] = None):
+    """
+    StreamingAssistantExecutor for agent_id, fallback(agent_id=agent_id) when streaming is turned off.
+    """
+    if stream_answers:
+        return StreamingAssistantExecutor(agent_id, key, on_item)
+    return fallback(agent_id=agent_id)
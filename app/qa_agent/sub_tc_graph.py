@@ -9,6 +9,14 @@ from langchain.callbacks import get_openai_callback
 from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 
 from qa_agent.cl_agent import OpenAIAssistantExecuters
+from .rate_limiter import rate_limiter
+from .response_cache import response_cache
+from .usage_tracker import UsageTracker
+from .message_window import windowed_messages, message_archive
+from .tracing import tracer
+from .streaming_executor import assistant_executor
+from .model_routing import routing_policy, CLASSIFICATION, REFLECTION
+from .output_validator import FINE, NEEDS_LLM, local_validation, validate_test_types
 
 import requests
 
@@ -42,28 +50,89 @@ from .prompts.tc_graph_prompts import (
     get_front_end_test_case_generation_prompt,
     get_test_case_type_prompt_soft,
     get_test_case_type_prompt_hard,
+    get_test_case_type_batch_prompt,
     get_qa_sub_reflection_stage1_prompt
 )
 
 import traceback  # Import traceback for detailed error logging
 
 MAX_REVISION = 3  # Define maximum revisions globally
-
-# Add a global variable for thread_id at the top (similar to tc_graph.py)
-stage1_thread_id = None
+# messages kept in message_history, reflection reads the last 2 * (revisions + 1) of them
+message_window = 20
+
+test_type_assistant_id = routing_policy.assistant_id(CLASSIFICATION)
+# test cases classified per assistant request, 1 keeps the one request per test case behaviour
+DEFAULT_CLASSIFICATION_BATCH_SIZE = 1
+# prompt budget of one batch, leaves room in the context window for file search results and the answer
+MAX_BATCH_PROMPT_TOKENS = 6000
+test_types = {"component": "Component", "end-to-end": "End-to-End", "endtoend": "End-to-End"}
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:  # tiktoken missing or its encoding can not be downloaded
+    _encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Token count of text, approximated with 4 characters per token when tiktoken is not available.
+    """
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def get_test_details(test):
+    if isinstance(test, tuple) and len(test) == 2 and isinstance(test[1], dict) and 'Title' in test[1]:
+        return test[1]
+    return None
+
+
+def normalize_test_type(test_type) -> Optional[str]:
+    if not isinstance(test_type, str):
+        return None
+    return test_types.get(test_type.strip().lower().replace(" ", ""))
+
+
+def validate_batch_output(output, batch_indices: list[int]):
+    """
+    Split a batch answer into {index: (test_type, reason)} for the valid entries and the list of indices
+    which are missing, duplicated or invalid.
+    """
+    items = output.get('test_types') if isinstance(output, dict) else output
+    results = {}
+    if isinstance(items, list):
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            try:
+                index = int(item.get('index'))
+            except (TypeError, ValueError):
+                continue
+            test_type = normalize_test_type(item.get('Test_Type'))
+            reason = item.get('Reason')
+            if index not in batch_indices or index in results or not test_type or not isinstance(reason, str) or not reason.strip():
+                continue
+            results[index] = (test_type, reason)
+    failed = [index for index in batch_indices if index not in results]
+    return results, failed
 
 class SubAutoconState(TypedDict):
     test_list: list[dict]  # list of test cases with test_type included
     current_test_index: int  # index of the current test case
-    message_history: Annotated[list[BaseMessage], operator.add]
+    message_history: Annotated[list[BaseMessage], windowed_messages(message_window, "sub_tc_graph", message_archive)]
     is_finished: bool
     revisions: int
     is_test_list_processed: bool  # Flag to track if test_list processing is finished
     attachments: Optional[list[dict]]  # Add attachments as an optional list of dictionaries
+    thread_id: Optional[str]  # assistant thread of the current test case, reused for revisions
+    batch_indices: Optional[list[int]]  # 1-based indices of the test cases in the current batch
+    scenario_id: Optional[int]  # scenario of the test list, usage is recorded per scenario
 
 # Define the reflection model and prompt
-qa_reflection_model = "gpt-4-turbo"
-llm = ChatOpenAI(temperature=0.0, model_name=qa_reflection_model)
+qa_reflection_model = routing_policy.route(REFLECTION).primary
+llm = routing_policy.chat_model(qa_reflection_model)
 
 class Reflection(BaseModel):
     """Reflection and Followup"""
@@ -83,30 +152,17 @@ qa_reflection_prompt_stage1 = ChatPromptTemplate.from_messages(
 qa_reflect_stage1 = qa_reflection_prompt_stage1 | llm.bind_tools(tools=[Reflection], tool_choice="Reflection")
 
 class SubQAGraph:
-    def __init__(self, max_revisions: int = 3):
+    def __init__(self, max_revisions: int = 3, batch_size: int = DEFAULT_CLASSIFICATION_BATCH_SIZE,
+                 max_batch_tokens: int = MAX_BATCH_PROMPT_TOKENS, usage_tracker: UsageTracker = None):
+        if 2 * (max_revisions + 1) + 1 > message_window:
+            raise ValueError(f"max_revisions={max_revisions} needs a message_window of at least {2 * (max_revisions + 1) + 1}")
         self.max_revisions = max_revisions
-        self.cumulative_usage_reflection = {
-            "completion_tokens": 0,
-            "prompt_tokens": 0,
-            "total_tokens": 0,
-            "total_cost": 0.0,
-        }
-
-    def _calculate_cumulative_usage_reflection(self, cb, usage):
-        if cb:
-            usage["completion_tokens"] += cb.completion_tokens
-            usage["prompt_tokens"] += cb.prompt_tokens
-            usage["total_tokens"] += cb.total_tokens
-            usage["total_cost"] += cb.total_cost
-            print(
-                f"Cumulative Usage Reflection: Completion tokens: {usage['completion_tokens']}, "
-                f"Prompt tokens: {usage['prompt_tokens']}, Total tokens: {usage['total_tokens']}, "
-                f"Total cost: {usage['total_cost']}"
-            )
-        return usage
+        self.batch_size = max(1, batch_size)
+        self.max_batch_tokens = max_batch_tokens
+        self.usage_tracker = usage_tracker or UsageTracker()
 
-    def _sub_assist_stage1_node(self, state: SubAutoconState):
-        global stage1_thread_id  # Use the global variable
+    async def _sub_assist_stage1_node(self, state: SubAutoconState):
+        stage1_thread_id = state.get('thread_id')
 
         # Ensure 'attachments' key exists in the state
         if "attachments" not in state:
@@ -141,12 +197,8 @@ class SubQAGraph:
 
         query_message = HumanMessage(content=query)
 
-        assist = OpenAIAssistantExecuters(agent_id="asst_lYJEAxz8st4RMEWC7Na5fuwM")  # Replace with actual assistant ID
-        try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
+        assistant_id = routing_policy.assistant_id(CLASSIFICATION, is_revision)
+        assist = assistant_executor(assistant_id, OpenAIAssistantExecuters, key=None)
 
         try:
             # Include attachments in the query if available
@@ -158,11 +210,15 @@ class SubQAGraph:
             if is_revision and stage1_thread_id is not None:
                 query_input["threadID"] = stage1_thread_id
 
-            out = loop.run_until_complete(assist.get_query_chain(query_input))
+            started = time.perf_counter()
+            out = await response_cache.aget_query_chain(assist, assistant_id, query_input)
+            elapsed = time.perf_counter() - started
+            usage = await self.usage_tracker.arecord(out, "sub_assist_stage1", state.get('scenario_id'))
+            routing_policy.record(CLASSIFICATION, assistant_id, elapsed, usage)
             test_list_copy = state['test_list'][:]  # Initialize test_list_copy with a shallow copy
             print(f"Assistant output: {out}")
             if out['agent_output'] and out['agent_output']['thread_id']:
-                # Capture thread_id in the global variable
+                # Capture thread_id for the follow-up revisions
                 stage1_thread_id = out['agent_output']['thread_id']
                 # Handle output with 'query' key
                 if out['query'] and isinstance(out['query'], dict):
@@ -204,13 +260,149 @@ class SubQAGraph:
         return {
             "message_history": [query_message, out_message],  # Directly return the messages
             "test_list": test_list_copy,
+            "thread_id": stage1_thread_id,
         }
 
-    def _sub_qa_reflection_stage1_node(self, state: SubAutoconState):
+    def _next_batch(self, state: SubAutoconState) -> list[int]:
+        """
+        Indices of the test cases for the next batch, packed from current_test_index until batch_size
+        test cases or max_batch_tokens prompt tokens are reached. Always holds at least one test case.
+        """
+        test_list = state['test_list']
+        batch = []
+        index = state['current_test_index']
+        while index <= len(test_list) and len(batch) < self.batch_size:
+            details = get_test_details(test_list[index - 1])
+            if details is None and batch:
+                break  # invalid entries are classified on their own
+            candidate = batch + [(index, details)]
+            if batch and count_tokens(get_test_case_type_batch_prompt(candidate)) > self.max_batch_tokens:
+                break
+            batch = candidate
+            index += 1
+            if details is None:
+                break
+        return [i for i, _ in batch]
+
+    def _next_test_index(self, state: SubAutoconState) -> int:
+        batch_indices = state.get('batch_indices')
+        if batch_indices:
+            return batch_indices[-1] + 1
+        return state.get('current_test_index', 1) + 1
+
+    async def _classify_single(self, test_details: dict, attachments, scenario_id=None):
+        """
+        Classify one test case of a failed batch entry with the single test prompt, without reflection.
+        The entry failed validation, so it runs on the escalation assistant of the stage.
+        """
+        query_input = {"promptInput": {"query": get_test_case_type_prompt_hard(test_details)}}
+        if attachments:
+            query_input["attachments"] = attachments
+        assistant_id = routing_policy.assistant_id(CLASSIFICATION, escalate=True)
+        assist = assistant_executor(assistant_id, OpenAIAssistantExecuters, key=None)
+        try:
+            started = time.perf_counter()
+            out = await response_cache.aget_query_chain(assist, assistant_id, query_input)
+            elapsed = time.perf_counter() - started
+            usage = await self.usage_tracker.arecord(out, "sub_assist_stage1", scenario_id)
+            routing_policy.record(CLASSIFICATION, assistant_id, elapsed, usage)
+            output = out['query'] if out.get('agent_output') else None
+            if isinstance(output, dict):
+                test_type = normalize_test_type(output.get('Test_Type'))
+                if test_type:
+                    return test_type, output.get('Reason', "No reason provided.")
+            print(f"Single test retry returned invalid output: {output}")
+            return "Error", "Invalid query format."
+        except Exception as e:
+            print(f"Error in _classify_single: {e}")
+            return "Error", "OpenAI server error"
+
+    async def _sub_assist_batch_node(self, state: SubAutoconState):
+        """
+        Classify a batch of test cases with one assistant request, entries missing or invalid in the
+        answer are retried one by one.
+        """
+        thread_id = state.get('thread_id')
+        attachments = state.get("attachments") or []
+        is_revision = state.get('revisions', 0) > 0
+
+        if is_revision and state.get('batch_indices'):
+            batch_indices = state['batch_indices']
+            # For revision, use the follow_up_question as the query
+            query = state['message_history'][-1].content
+        else:
+            batch_indices = self._next_batch(state)
+            batch = [(i, get_test_details(state['test_list'][i - 1])) for i in batch_indices]
+            if batch[0][1] is None:
+                query = "Invalid test details provided."
+            else:
+                query = get_test_case_type_batch_prompt(batch)
+        print(f"Processing test cases {batch_indices} in one batch")
+
+        query_message = HumanMessage(content=query)
+        assistant_id = routing_policy.assistant_id(CLASSIFICATION, is_revision)
+        # a truncated batch answer keeps its complete entries, only the rest is retried one by one
+        assist = assistant_executor(assistant_id, OpenAIAssistantExecuters, key="test_types")
+        results = {}
+        failed = list(batch_indices)
+        try:
+            query_input = {"promptInput": {"query": query}}
+            if attachments:
+                query_input["attachments"] = attachments
+            if is_revision and thread_id is not None:
+                query_input["threadID"] = thread_id
+
+            started = time.perf_counter()
+            out = await response_cache.aget_query_chain(assist, assistant_id, query_input)
+            elapsed = time.perf_counter() - started
+            usage = await self.usage_tracker.arecord(out, "sub_assist_stage1", state.get('scenario_id'))
+            routing_policy.record(CLASSIFICATION, assistant_id, elapsed, usage)
+            print(f"Assistant output: {out}")
+            if out['agent_output'] and out['agent_output']['thread_id']:
+                thread_id = out['agent_output']['thread_id']
+                results, failed = validate_batch_output(out['query'], batch_indices)
+                if results:
+                    out_message = AIMessage(content=json.dumps(out['query']))
+                else:
+                    out_message = AIMessage(content="**ERROR parsing JSON:** Failed to process output as proper JSON list of 'index', 'Test_Type' and 'Reason', Received following output response, probably with incorrect JSON.\n" +
+                                out['agent_output']['output'])
+            else:
+                out_message = AIMessage(content="Failed to generate test type and reason.")
+        except Exception as e:
+            print(f"Error in _sub_assist_batch_node: {e}")
+            traceback.print_exc()
+            out_message = AIMessage(content="Server error occurred while generating the answer. Please try again.")
+
+        # retry only the entries the batch answer did not cover
+        retry_indices = [i for i in failed if get_test_details(state['test_list'][i - 1]) is not None]
+        if retry_indices:
+            print(f"Retrying test cases {retry_indices} one by one")
+            retried = await asyncio.gather(*[
+                self._classify_single(get_test_details(state['test_list'][i - 1]), attachments, state.get('scenario_id'))
+                for i in retry_indices
+            ])
+            results.update(zip(retry_indices, retried))
+
+        test_list_copy = state['test_list'][:]
+        for i in batch_indices:
+            test_type, reason = results.get(i, ("Error", "Invalid test details provided."))
+            index, test_details = test_list_copy[i - 1]
+            test_details['test_type'] = test_type
+            test_details['Reason'] = reason
+            test_list_copy[i - 1] = (index, test_details)
+
+        return {
+            "message_history": [query_message, out_message],
+            "test_list": test_list_copy,
+            "thread_id": thread_id,
+            "batch_indices": batch_indices,
+        }
+
+    async def _sub_qa_reflection_stage1_node(self, state: SubAutoconState):
         # skip message and reset revisions if max revisions reached
         revisions = state.get('revisions', 0)
         if revisions >= self.max_revisions:
-            next_test_index = state.get('current_test_index', 1) + 1
+            next_test_index = self._next_test_index(state)
             is_test_list_processed = next_test_index > len(state['test_list'])
             return {
                 "revisions": 0,
@@ -222,39 +414,52 @@ class SubQAGraph:
         # Extract the last two messages from the history
         messages = state['message_history'][-2 * (revisions + 1):]
 
-        # Invoke the reflection stage with the extracted messages
-        with get_openai_callback() as cb:
-            try:
-                res = qa_reflect_stage1.invoke({"messages": messages})
-            except Exception as e:
-                print(f"Error in _sub_qa_reflection_stage1_node: {e}")
-                return {
-                    "message_history": [AIMessage(content="Reflection failed.")],  # Directly return the message
-                    "revisions": state.get('revisions', 0),
-                    "is_finished": False
-                }
-
-        # Log usage statistics for reflection
-        self.cumulative_usage_reflection = self._calculate_cumulative_usage_reflection(cb, self.cumulative_usage_reflection)
-
-        # Parse the reflection output
-        parser = JsonOutputToolsParser(return_id=True)
-        tool_invocation: AIMessage = res
-        parsed_tool_calls = parser.invoke(tool_invocation)
-
-        # Extract reflection results
-        is_finished = parsed_tool_calls[0]['args'].get('Finished', False)
-        followup_question = parsed_tool_calls[0]['args'].get(
-            'follow_up_question', 
-            "PLEASE RETRY THE TASK. "
-        )
+        validation = None
+        if local_validation:
+            indices = state.get('batch_indices') or [state['current_test_index']]
+            answers = [(normalize_test_type(details.get('test_type')), details.get('Reason'))
+                       for details in (get_test_details(state['test_list'][i - 1]) or {} for i in indices)]
+            validation = validate_test_types(messages[-1].content, answers, revisions > 0)
+            self.usage_tracker.record_validation(validation, "sub_qa_reflection_stage1", state.get('scenario_id'))
+
+        if validation is not None and validation.verdict != NEEDS_LLM:
+            # decided locally, no reflection call
+            is_finished = validation.verdict == FINE
+            followup_question = validation.follow_up
+        else:
+            # Invoke the reflection stage with the extracted messages
+            with get_openai_callback() as cb:
+                try:
+                    res = await routing_policy.areflect(qa_reflection_prompt_stage1, Reflection, messages)
+                except Exception as e:
+                    print(f"Error in _sub_qa_reflection_stage1_node: {e}")
+                    return {
+                        "message_history": [AIMessage(content="Reflection failed.")],  # Directly return the message
+                        "revisions": state.get('revisions', 0),
+                        "is_finished": False
+                    }
+
+            # Log usage statistics for reflection
+            self.usage_tracker.record_reflection(cb, "sub_qa_reflection_stage1", state.get('scenario_id'))
+
+            # Parse the reflection output
+            parser = JsonOutputToolsParser(return_id=True)
+            tool_invocation: AIMessage = res
+            parsed_tool_calls = parser.invoke(tool_invocation)
+
+            # Extract reflection results
+            is_finished = parsed_tool_calls[0]['args'].get('Finished', False)
+            followup_question = parsed_tool_calls[0]['args'].get(
+                'follow_up_question', 
+                "PLEASE RETRY THE TASK. "
+            )
 
         # Update revision count and prepare the next question
        
         if is_finished:
             revisions = 0
             question = AIMessage(content="Finished processing the test case.")
-            next_test_index = state.get('current_test_index', 1) + 1
+            next_test_index = self._next_test_index(state)
             is_test_list_processed = next_test_index > len(state['test_list'])
             return {
                 "message_history": [question],
@@ -280,8 +485,12 @@ class SubQAGraph:
 
     def prepare_graph(self) -> StateGraph:
         builder = StateGraph(SubAutoconState)
-        builder.add_node("sub_assist_stage1", self._sub_assist_stage1_node)
-        builder.add_node("sub_reflect_stage1", self._sub_qa_reflection_stage1_node)
+        if self.batch_size > 1:
+            builder.add_node("sub_assist_stage1", tracer.traced_node("sub_assist_stage1", self._sub_assist_batch_node))
+        else:
+            builder.add_node("sub_assist_stage1", tracer.traced_node("sub_assist_stage1", self._sub_assist_stage1_node))
+        builder.add_node("sub_reflect_stage1",
+                         tracer.traced_node("sub_reflect_stage1", self._sub_qa_reflection_stage1_node))
 
         builder.set_entry_point("sub_assist_stage1")
         builder.add_edge("sub_assist_stage1", "sub_reflect_stage1")
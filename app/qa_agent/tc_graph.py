@@ -7,6 +7,19 @@ from langchain.callbacks import get_openai_callback
 from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 
 from qa_agent.cl_agent import OpenAIAssistantExecuters
+from .rate_limiter import rate_limiter
+from .response_cache import response_cache
+from .usage_tracker import UsageTracker
+from .message_window import windowed_messages, message_archive, archive_run
+from .checkpoint_store import checkpoint_store, checkpoint_store_path, run_config
+from .progress import ScenarioStarted, TestCaseDone, Revision, NodeError, ScenarioFinished, PartialResult, \
+    emit_progress
+from .tracing import tracer
+from .streaming_executor import assistant_executor
+from .model_routing import routing_policy, STAGE1, STAGE2, REFLECTION
+from .output_validator import FINE, NEEDS_LLM, local_validation, is_truncated, validate_test_list, \
+    validate_test_details
+from .speculation import SpeculativeRuns, pipeline_stage2
 
 import requests
 
@@ -22,8 +35,9 @@ from typing import List, Sequence, TypedDict, Annotated, Optional, Literal, Unio
 import operator
 
 from langgraph.graph import END, MessageGraph, StateGraph
+from langgraph.types import Send
 from langgraph.checkpoint.memory import MemorySaver
-from .sub_tc_graph import SubQAGraph  # Import SubQAGraph from the appropriate module
+from .sub_tc_graph import SubQAGraph, DEFAULT_CLASSIFICATION_BATCH_SIZE, get_test_details  # Import SubQAGraph from the appropriate module
 
 from openai import OpenAI
 
@@ -39,9 +53,10 @@ LOG_LEVEL = "Info"
 
 # This graph is focusing to generate Test Scenarios for individual test types and platform features.
 
-qa_reflection_model = "gpt-4-turbo"
+# reflection models and assistants of the stages come from the routing policy, see model_routing
+qa_reflection_model = routing_policy.route(REFLECTION).primary
 
-llm = ChatOpenAI(temperature=0.0, model_name=qa_reflection_model)
+llm = routing_policy.chat_model(qa_reflection_model)
 
 
 class Reflection(BaseModel):
@@ -93,23 +108,19 @@ qa_reflect_stage3 = qa_reflection_prompt_stage3 | llm.bind_tools(tools=[Reflecti
 qa_validator_stage3 = PydanticToolsParser(tools=[Reflection])
 
 converse_mode = True
-stage1_thread_id = None
-stage2_thread_id = None
-stage3_thread_id = None
 max_revisions = 3
 usage_limit = 25.0
+# messages kept in message_history, the nodes only look at the last few
+message_window = 20
 
-stage1_assistant_id = "asst_QCXmcIT4rhtSmHpyjBIWmLsc"
-stage2_assistant_id = "asst_u8bbBW8lsqzKUtmCtl1bCWZp"
-
-# storage for connector metadata with levels resources, endpoints and endpoint content
-test_metadata = {}
-
-
-# define method to add testcase content to test metadata
-def add_testcase_content(test_type: str, test_case_details: list[dict]):
-    test_metadata.setdefault(test_type, []).extend(test_case_details)
+# upper bound of scenarios processed concurrently by QAGraph.astream_scenarios
+max_scenario_workers = 8
+# test cases whose details are generated at the same time by expand_test (map-reduce stage 2), across the
+# scenario workers of a graph; 0 keeps the sequential assist_stage2 / reflect_stage2 loop
+stage2_concurrency = int(os.getenv("QA_STAGE2_CONCURRENCY", "0"))
 
+stage1_assistant_id = routing_policy.assistant_id(STAGE1)
+stage2_assistant_id = routing_policy.assistant_id(STAGE2)
 
 user_journey = "Access response header for pagination"
 special_instructions = "- Please only include specific and relevant test scenarios for the given product feature."
@@ -129,16 +140,31 @@ def update_testlist(
     return existing + updates
 
 
+def update_testmap(
+        existing: Optional[dict] = None,
+        updates: Optional[Union[dict, Literal["clear"]]] = None,
+) -> dict:
+    if existing is None:
+        existing = {}
+    if updates is None:
+        return existing
+    if updates == "clear":
+        return {}
+    # parallel expand_test branches each add their own test ids
+    return {**existing, **updates}
+
+
 # Define the state for the graph
 class AutoconState(TypedDict):
     input: str
     target_app: str
-    message_history: Annotated[list[BaseMessage], operator.add]
+    message_history: Annotated[list[BaseMessage], windowed_messages(message_window, "tc_graph", message_archive)]
     tech_stack: str
     test_list: list[tuple[int, dict]]  # list of test cases
     is_scenario_list_processed: bool
     scenario_list: list[tuple[int, (str, str)]]  # list of scenarios
     current_scenario: tuple[int, (str, str)]  # current scenario
+    scenario_id: Optional[int]  # id of the scenario in the uploaded sheet, set by astream_scenarios
     current_test: tuple[int, (str)]  # current test
     current_test_details: list[dict]
     test_details_list: Annotated[List[dict], update_testlist]  # list of test details
@@ -153,140 +179,89 @@ class AutoconState(TypedDict):
     stage3_thread_id: str
     stage3_revisions: int
     is_finished_stage3: bool
+    # map-reduce stage 2, per test id (str): details of the finished test case and revisions it took
+    stage2_results: Annotated[dict, update_testmap]
+    stage2_test_revisions: Annotated[dict, update_testmap]
 
 
-class UsageStatistics(TypedDict):
-    completion_tokens: int
-    prompt_tokens: int
-    total_tokens: int
-    model_cost: float
-    completion_cost: float
-    prompt_cost: float
-    total_cost: float
+class Stage2Task(TypedDict):
+    """
+    Input of one expand_test branch, the part of the scenario's state a single test case needs.
+    """
+    tech_stack: str
+    test_list: list[tuple[int, dict]]
+    current_scenario: tuple[int, (str, str)]
+    scenario_id: Optional[int]
+    current_test: tuple[int, (str)]
+    attachments: dict
+
+
+class UsageLimitExceeded(RuntimeError):
+    """
+    Raised by a graph run once the assistant cost of its QAGraph passed usage_limit, the run can not ask anyone
+    whether to go on: it runs in a job worker or the batch CLI.
+    """
+
+
+class ScenarioResult(TypedDict):
+    scenario_id: int
+    scenario: tuple[str, str]
+    test_details_list: List[dict]
+    elapsed: float
+    error: Optional[str]
 
 
 class QAGraph():
 
-    def __init__(self, checkpoint_path: str):
+    def __init__(self, checkpoint_path: str = checkpoint_store_path,
+                 classification_batch_size: int = DEFAULT_CLASSIFICATION_BATCH_SIZE,
+                 pipeline_stage2: bool = pipeline_stage2, stage2_concurrency: int = stage2_concurrency):
 
         self.conn = None
         self.checkpointer = None
-        self.checkpointer_cm = None
         self.checkpoint_path = checkpoint_path
 
-        # Cumulative usage statistics for Genrerator
-        self.cumulative_usage = {
-            'completion_tokens': 0,
-            'prompt_tokens': 0,
-            'total_tokens': 0,
-            'model_cost': 0.0,
-            'completion_cost': 0.0,
-            'prompt_cost': 0.0,
-            'total_cost': 0.0
-        }
-
-        # Cumulative usage statistics for reflection 
-        self.cumulative_usage_reflection = {
-            'completion_tokens': 0,
-            'prompt_tokens': 0,
-            'total_tokens': 0,
-            'total_cost': 0.0
-        }
-
-    def _get_run_data(self, thread_id: str, run_id: str):
-        """
-        Retrieve OpenAI run data using thread_id and run_id.
-        """
-        client = OpenAI()
-        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
-        return run
+        # compiled SubQAGraph, rebuilt only when the checkpointer changes
+        self.subgraph = None
+        self.subgraph_checkpointer = None
+        # test cases classified per SubQAGraph assistant request
+        self.classification_batch_size = classification_batch_size
+        # token and cost accounting of this session, shared with the subgraph
+        self.usage_tracker = UsageTracker()
+        # connector metadata with levels resources, endpoints and endpoint content, per graph instance
+        self.test_metadata = {}
+        # generate the next test case's details while the current one is reflected on, see speculation
+        self.pipeline_stage2 = pipeline_stage2
+        self.speculative_runs = SpeculativeRuns()
+        # > 0 expands all test cases of a scenario concurrently instead, see _fan_out_stage2
+        self.stage2_concurrency = stage2_concurrency
+        # (event loop, semaphore) limiting the expand_test branches to stage2_concurrency
+        self._stage2_slots = None
+
+    def _scenario_id(self, state: AutoconState):
+        if state.get('scenario_id') is not None:
+            return state['scenario_id']
+        current_scenario = state.get('current_scenario')
+        return current_scenario[0] if current_scenario else None
+
+    def _test_title(self, state: AutoconState) -> str:
+        details = get_test_details(state.get('current_test'))
+        return details['Title'] if details else str(state['current_test'][1])
+
+    def add_testcase_content(self, test_type: str, test_case_details: list[dict]):
+        self.test_metadata.setdefault(test_type, []).extend(test_case_details)
 
     def _check_limits(self) -> bool:
         """
         Check if the usage limits have been exceeded.
         """
-        usage = self.cumulative_usage.get('total_cost', 0.0)
+        usage = self.usage_tracker.assistant['total_cost']
         return usage > usage_limit
 
-    def _get_model_cost(self, model_name):
-        model_costs = {
-            'gpt-4.1': 0.0020,
-            'gpt-4o': 0.0050,
-            'gpt-4-turbo-2024-04-09': 0.01,
-            'gpt-4-turbo': 0.01,
-            'gpt-4-turbo-preview': 0.01,
-            'gpt-4-0125-preview': 0.01,
-            'gpt-4-1106-preview': 0.01,
-            'gpt-4-0613': 0.03,
-            'gpt-4-32k-0613': 0.03,
-            'gpt-3.5-turbo-0125': 0.0005,
-            'gpt-3.5-turbo': 0.0005,
-            'gpt-3.5-turbo-1106': 0.0010,
-            'gpt-3.5-turbo-16k-0613': 0.0030,
-            'gpt-3.5-turbo-0613': 0.0015,
-
-        }
-        return model_costs.get(model_name, 0.0)
-
-    # Define method to calculate usage statistics
-    def _calculate_usage(self, out) -> Optional[UsageStatistics]:
-        if (out['agent_output']['thread_id'] and out['agent_output']['run_id']):
-
-            thread_id = out['agent_output']['thread_id']
-            run_id = out['agent_output']['run_id']
-
-            run_data = self._get_run_data(thread_id, run_id)
-            run_completion_tokens = run_data.usage.completion_tokens
-            run_prompt_tokens = run_data.usage.prompt_tokens
-            run_total_tokens = run_data.usage.total_tokens
-            model_cost = self._get_model_cost(run_data.model)
-            completion_cost = (run_completion_tokens / 1000) * model_cost
-            prompt_cost = (run_prompt_tokens / 1000) * model_cost
-            total_cost = (run_total_tokens / 1000) * model_cost
-
-            print(
-                f"Current usage: Completion tokens: {run_completion_tokens}, Prompt tokens: {run_prompt_tokens}, Total tokens: {run_total_tokens}, Model cost: {model_cost}, Completion cost: {completion_cost}, Prompt cost: {prompt_cost}, Total cost: {total_cost}")
-
-            return UsageStatistics(
-                completion_tokens=run_completion_tokens,
-                prompt_tokens=run_prompt_tokens,
-                total_tokens=run_total_tokens,
-                model_cost=model_cost,
-                completion_cost=completion_cost,
-                prompt_cost=prompt_cost,
-                total_cost=total_cost
-            )
-        else:
-            raise ValueError("Missing thread_id or run_id in output data")
-
-    # Define method to caluculate cumulative usage statistics
-    def _calculate_cumulative_usage(self, out, usage) -> Optional[UsageStatistics]:
-        # calculate cumulative usage statistics using calculate_usage method
-        usage_stats = self._calculate_usage(out)
-        if usage_stats:
-            usage['completion_tokens'] += usage_stats['completion_tokens']
-            usage['prompt_tokens'] += usage_stats['prompt_tokens']
-            usage['total_tokens'] += usage_stats['total_tokens']
-            usage['completion_cost'] += usage_stats['completion_cost']
-            usage['prompt_cost'] += usage_stats['prompt_cost']
-            usage['total_cost'] += usage_stats['total_cost']
-            print(
-                f"Cumulative Usage: Completion tokens: {usage['completion_tokens']}, Prompt tokens: {usage['prompt_tokens']}, Total tokens: {usage['total_tokens']}, Model cost: {usage['model_cost']}, Completion cost: {usage['completion_cost']}, Prompt cost: {usage['prompt_cost']}, Total cost: {usage['total_cost']}")
-        return usage
-
-    # Define method to calculate cumulative usage statistics for reflection
-    def _calculate_cumulative_usage_reflection(self, cb, usage) -> Optional[UsageStatistics]:
-
-        if cb:
-            usage['completion_tokens'] += cb.completion_tokens
-            usage['prompt_tokens'] += cb.prompt_tokens
-            usage['total_tokens'] += cb.total_tokens
-            usage['total_cost'] += cb.total_cost
-            print(
-                f"Cumulative Usage Reflection: Completion tokens: {usage['completion_tokens']}, Prompt tokens: {usage['prompt_tokens']}, Total tokens: {usage['total_tokens']}, Total cost: {usage['total_cost']}")
-        return usage
+    def _usage_limit_error(self) -> UsageLimitExceeded:
+        return UsageLimitExceeded(f"Usage limit exceeded: ${self.usage_tracker.assistant['total_cost']:.2f} spent "
+                                  f"on assistant runs, the limit is ${usage_limit:.2f}")
 
-    
     def _sim_assist_stage1_node(self, state: AutoconState):
         print("assist state:", type(state), state)
         content = 'Based on the information extracted from the documentation provided, here is the complete list of Salesforce B2B and D2C Commerce Resources formatted as requested:\n\n```json\n{\n  "resources": [\n    "Commerce Extension Mapping",\n    "Commerce Extension Mappings",\n    "Commerce Extension Provider",\n    "Commerce Extension Providers",\n    "Commerce Extensions",\n    "Commerce Import Category Job Create",\n    "Commerce Import Category Job Manage",\n    "Commerce Import Product Job Create",\n    "Commerce Import Product Job Manage",\n    "Commerce Product Import Resource",\n    "Commerce Webstore Account Addresses",\n    "Commerce Webstore Account Address",\n    "Commerce Webstore Application Context",\n    "Commerce Webstore Calculate Taxes",\n    "Commerce Webstore Carts",\n    "Commerce Webstore Cart",\n    "Commerce Webstore Cart Add to Wishlist",\n    "Commerce Webstore Cart Arrange Items",\n    "Commerce Webstore Cart Clone",\n    "Commerce Webstore Cart Make Primary",\n    "Commerce Webstore Cart Preserve",\n    "Commerce Webstore Cart Coupons",\n    "Commerce Webstore Cart Coupon",\n    "Commerce Webstore Cart Delivery Group",\n    "Commerce Webstore Cart Delivery Groups",\n    "Commerce Webstore Cart Inventory Reservations (Pilot)",\n    "Commerce Webstore Cart Messages Set Visibility",\n    "Commerce Webstore Cart Promotions",\n    "Commerce Webstore Cart Items",\n    "Commerce Webstore Cart Items Batch",\n    "Commerce Webstore Cart Item",\n    "Commerce Webstore Cart Items Promotions",\n    "Commerce Webstore Cart Product",\n    "Commerce Webstore Cart Products",\n    "Commerce Webstore Checkout",\n    "Commerce Webstore Checkout Payments",\n    "Commerce Webstore Checkout Orders",\n    "Commerce Webstore Checkouts",\n    "Commerce Webstore Externally Managed Accounts",\n    "Commerce Webstore Order Summaries",\n    "Commerce Webstore Order Summary",\n    "Commerce Webstore Order Summary Adjustments",\n    "Commerce Webstore Order Summary Lookup (Developer Preview)",\n    "Commerce Webstore Order Delivery Groups",\n    "Commerce Webstore Order Items",\n    "Commerce Webstore Order Items Adjustments",\n    "Commerce Webstore Order Summaries Add Order to Cart",\n    "Commerce Webstore Order Summaries Adjustment Aggregates",\n    "Commerce Webstore Order Shipments",\n    "Commerce Webstore Shipment Items",\n    "Commerce Webstore Payments Token"\n  ]\n}\n```\n\nThis list represents the Salesforce B2B and D2C Commerce Resources mentioned in the provided document【9†source】. Note that any URI formatting was omitted as per your request.'
@@ -329,7 +304,7 @@ class QAGraph():
                 }
             ]
 
-    def _assist_stage1_node(self, state: AutoconState):
+    async def _assist_stage1_node(self, state: AutoconState):
         if LOG_LEVEL == "Debug":
             print("assist stage1:", type(state), state)
             print(type(state), state)
@@ -338,9 +313,9 @@ class QAGraph():
         # if state['resources']:
         #     print("resources already cached")
         #     return {"message_history":[HumanMessage(content="Resources already cached")],"resources": state['resources'],"stage2_revisions":0}
-        global stage1_thread_id
-        global user_journey
 
+        # assistant thread is carried in state so that concurrent scenario workers never share it
+        stage1_thread_id = state.get('stage1_thread_id')
         current_scenario = state['current_scenario']
         total_scenarios = len(state['scenario_list'])
 
@@ -387,6 +362,10 @@ class QAGraph():
                     # REFRESH THREAD ID FOR NEW TEST TYPE, ONLY CHAIN LAST TEST TYPE TO PLATFORM FOCUS
                     if state['current_scenario'][0] != (total_scenarios):
                         stage1_thread_id = None
+                # scenario workers run a single re-indexed scenario, their position in the run is not known here
+                is_worker = state.get('scenario_id') is not None
+                emit_progress(ScenarioStarted(state['scenario_id'] if is_worker else current_scenario[0],
+                                              current_scenario[1][0], None if is_worker else total_scenarios))
 
             # query = f"I have uploaded tech design document with details for a back end requirement in PDF format. Can you identify and list down all {current_test_type[1]} cases, based on the uploaded technical document? Please consider all positive, negative and edge cases.  You just need to list down the test case scenarios. Make sure You have the full coverage as per the attached design document. Format the output as JSON, where the key is 'test_list' and the value is a list of dict with Test Name-Details pairs without additional key names. \nInstructions: \n1.  Make sure you generate all the test cases covering all the possible scenarios. \n2. Carefully study the attached document and other Domain information available to you, to generate the test cases. \n3. Be as comprehensive as possible. \n4. Generate 10 or more test cases in each category whenever possible."
             # query = f"I have uploaded tech design document with details for a back end requirement in PDF format. Can you go through it to identify and list down all the {current_test_type[1]} cases, based on the uploaded technical document? Please consider all positive, negative and edge cases.  You just need to list down the test case scenarios. Make sure You have the full coverage as per the attached design document. Format the output as JSON, where the key is 'test_list' and the value is a list of dict with Test Name-Details pairs without additional key names. \nInstructions: \n1. Make sure you generate all the test cases covering all the possible scenarios. \n2. Carefully study and think through the attached document and other Domain information available to you to generate the test cases. \n3. Be as comprehensive as possible. \n4. Generate extensive list of test cases in each category."
@@ -411,8 +390,6 @@ class QAGraph():
             print(json_data)
             print('-' * 100)
 
-        time.sleep(3)
-
         # response = requests.post(
         #             "http://localhost:8000/connector/query/invoke",
         #             json = json_data
@@ -421,15 +398,16 @@ class QAGraph():
         try:
 
             test_list = self.get_test_schema(state)
-            assist = OpenAIAssistantExecuters(agent_id=stage1_assistant_id)
-            # out = asyncio.run(assist.get_query_chain(json_data['input']))
-            try:
-                loop = asyncio.get_event_loop()
-            except RuntimeError:  # No event loop in this thread
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-
-            out = loop.run_until_complete(assist.get_query_chain(json_data['input']))  # Run async function
+            # revisions escalate to the stronger assistant of the stage, if the policy has one
+            assistant_id = routing_policy.assistant_id(STAGE1, is_revision)
+            scenario_id = self._scenario_id(state)
+            # test cases are shown while the answer is still streaming
+            assist = assistant_executor(assistant_id, OpenAIAssistantExecuters,
+                                        on_item=lambda index, test: emit_progress(
+                                            PartialResult(scenario_id, 1, index, str(test.get('Title', '')))))
+            started = time.perf_counter()
+            out = await response_cache.aget_query_chain(assist, assistant_id, json_data['input'])
+            elapsed = time.perf_counter() - started
 
             if LOG_LEVEL == "Debug":
                 print('+' * 100)
@@ -449,7 +427,9 @@ class QAGraph():
                     test_list = out['query']['test_list']
                     # prepend index to each test case
                     test_list = [(i + 1, test) for i, test in enumerate(test_list)]
-                    out_message = AIMessage(content=str(out['query']))
+                    # a cut off answer is marked for the reflection, see output_validator.is_truncated
+                    out_message = AIMessage(content=str(out['query']),
+                                            response_metadata={"truncated": bool(out['query'].get('truncated'))})
                 else:
                     test_list = [(i + 1, test) for i, test in enumerate(test_list)]
                     out_message = AIMessage(
@@ -457,7 +437,8 @@ class QAGraph():
                                 out['agent_output']['output'])
 
             # Log usage
-            self.cumulative_usage = self._calculate_cumulative_usage(out, self.cumulative_usage)
+            usage = await self.usage_tracker.arecord(out, "assist_stage1", self._scenario_id(state))
+            routing_policy.record(STAGE1, assistant_id, elapsed, usage)
 
             # else:
             #     print(response.text)
@@ -465,57 +446,70 @@ class QAGraph():
 
         except Exception as e:
             print("Error assist1: ", e)
+            emit_progress(NodeError(self._scenario_id(state), "assist_stage1", str(e)))
             test_list = [(i + 1, test) for i, test in enumerate(test_list)]
             out_message = AIMessage(content="Server error occurred while generating the answer. Prompt to try again.")
 
         return {"message_history": [query_message, out_message], "test_list": test_list,
-                "current_scenario": current_scenario, "current_test": test_list[0]}
+                "current_scenario": current_scenario, "current_test": test_list[0],
+                "stage1_thread_id": stage1_thread_id}
     
+    def _get_subgraph(self):
+        """
+        Compiled SubQAGraph for the current checkpointer, compiled once and reused by every subgraph_node call.
+        """
+        if self.subgraph is None or self.subgraph_checkpointer is not self.checkpointer:
+            builder = SubQAGraph(batch_size=self.classification_batch_size,
+                                 usage_tracker=self.usage_tracker).prepare_graph()
+            self.subgraph = builder.compile(checkpointer=self.checkpointer)
+            self.subgraph_checkpointer = self.checkpointer
+        return self.subgraph
+
     # add node which uses subgrph to populate test_types
-    def _subgraph_node(self, state: AutoconState):
+    async def _subgraph_node(self, state: AutoconState):
         # use node from sub_tc_graph.py
-        subgraph = SubQAGraph()   
-        # prepare graph
-        builder = subgraph.prepare_graph()
-        subgraph = builder.compile(checkpointer=self.checkpointer)
-        
+        subgraph = self._get_subgraph()
+
         # Extract the integer index and test details from the tuple
         current_test_index, current_test_details = state['current_test']  # Unpack the tuple
-        res = subgraph.invoke({
+        res = await subgraph.ainvoke({
             "test_list": state['test_list'], 
             "current_test_index": current_test_index, 
             "test_details": current_test_details,
-            "attachments": state.get('attachments')  # Pass attachments to the subgraph
+            "attachments": state.get('attachments'),  # Pass attachments to the subgraph
+            "scenario_id": self._scenario_id(state),
         })
         # update state with test_types
         test_list = res['test_list']
         return {"test_list": test_list}
 
     # assistant for stage2, identify endpoints from resources
-    def _assist_stage2_node(self, state: AutoconState):
+    async def _assist_stage2_node(self, state: AutoconState):
         if LOG_LEVEL == "Debug":
             print("assist stage2:", type(state), state)
             print(type(state), state)
-        global stage2_thread_id
-        global stage1_thread_id
-        global special_instructions
-        # stich with stage1
-        stage2_thread_id = stage1_thread_id
         total_tests = len(state['test_list'])
         current_test = state['current_test']
         is_finished_stage2 = state.get('is_finished_stage2')
         is_test_list_processed = state.get('is_test_list_processed')
         print("current_test", current_test[0], current_test, total_tests)
-        global user_journey
 
         # check whether we are revising or processing new resources
         stage2_revisions = state.get('stage2_revisions')
         is_revision = stage2_revisions is not None and stage2_revisions > 0
 
+        # stich with stage1
+        stage2_thread_id = state.get('stage1_thread_id')
+        if is_revision and state.get('stage2_thread_id'):
+            # the answer under revision came from a speculative run, which has a thread of its own
+            stage2_thread_id = state['stage2_thread_id']
+
         if not is_revision:
             # process next available platform feature
             if state['current_test'][0] >= (total_tests) and is_finished_stage2:
                 print("finishing all test cases stage 2.....")
+                emit_progress(ScenarioFinished(self._scenario_id(state), state['current_scenario'][1][0],
+                                               state.get('test_details_list')))
                 return {"message_history": [HumanMessage(content="Finished")], "is_test_list_processed": True,
                         "current_test": None}
             else:
@@ -525,10 +519,7 @@ class QAGraph():
 
         # query = f'Could you capture details for following list of test scenarios in JSON as per below format according to the tech design doc I have uploaded? Please do not be leasy and attend to full list of tests along with complete details. Format the output as JSON, where the key is "test_list" and the value is a list of dict with  Test Details JSON without additional key names. \n Note: You have to prepare the complete list for all the test cases, dont leave it incomplete. \nFormat:\nTest Case ID: (give it a logical short name), Title/Description, Preconditions, Test Steps, Test Data, Expected Result, Actual Result, Status, Postconditions, Tags/Labels, Test Type.\nTest List:\n{state["test_list"]}'
         # query = f'I have generated test scenarios for the backend development item. I am attaching tech design document of the same. Could you look at Celigo Product Knoledge, Tech Design and other information in order to generate details for these test scenarios as per given format? Format the output as JSON, where the key is "test_list" and the value is a list of dict with Test Details JSON without additional key names.\nFormat: Test Case ID: (give it a logical short name), Title/Description, Preconditions, Test Steps, Test Data, Expected Result, Actual Result, Status, Postconditions, Tags/Labels, Test Type.\nNote:\n- You have to prepare the complete list for all the test cases, dont leave it incomplete.\n- Just generate requested JSON without any other details, observations or instructions.\nDo not include any additional commentary.\nTest Scenario List:\n{state["test_list"]}'
-        if state['tech_stack'] == "Back End":
-            query = get_backend_test_case_generation_prompt(current_test[1])
-        else:
-            query = get_front_end_test_case_generation_prompt(current_test[1])
+        query = self._stage2_query(state, current_test)
 
         if is_revision:
             # Followup question for revision
@@ -552,38 +543,23 @@ class QAGraph():
             print(json_data)
             print('-' * 100)
 
-        time.sleep(1)
-
-        assist = OpenAIAssistantExecuters(agent_id=stage2_assistant_id)  # "asst_V8DhPI6pYJNS5rMptP4SSr4o")
+        assistant_id = routing_policy.assistant_id(STAGE2, is_revision)
+        # thread of a speculative answer, kept for its revisions
+        speculative_thread_id = state.get('stage2_thread_id') if is_revision else None
         try:
 
             test_list = self.get_test_schema(state)
 
-            # out = asyncio.run(assist.get_query_chain(json_data['input']))
-            try:
-                loop = asyncio.get_event_loop()
-            except RuntimeError:  # No event loop in this thread
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-
-            out = loop.run_until_complete(assist.get_query_chain(json_data['input']))  # Run async function
-
-            if (out['agent_output'] and out['agent_output']['thread_id']):
-                # save json to state
-                if out['query'] and out['query'].get('test_list'):
-                    print('query')  # ,out['query'])
-                    test_list = out['query']['test_list']
-                    # concatenate curent test keys with test details
-                    test_list = [({"id": str(current_test[0]), **current_test[1], **test}) for test in test_list]
-                    out_message = AIMessage(content=str(out['query']))
-                else:
-                    test_list = [({"id": str(current_test[0]), **current_test[1], **test}) for test in test_list]
-                    out_message = AIMessage(
-                        content="**ERROR parsing JSON:** Failed to process output as proper JSON 'test_list' key not found, Received following output response, probably with incorrect JSON.\n" +
-                                out['agent_output']['output'])
+            out = None
+            if not is_revision:
+                out = await self.speculative_runs.take(self._speculation_key(state, current_test), query)
+                if out is not None and out['agent_output']:
+                    speculative_thread_id = out['agent_output']['thread_id']
+            if out is None:
+                out = await self._generate_test_details(assistant_id, json_data['input'], self._scenario_id(state),
+                                                        current_test)
 
-            # Log usage
-            self.cumulative_usage = self._calculate_cumulative_usage(out, self.cumulative_usage)
+            test_list, out_message = self._test_details_from_output(current_test, out, test_list)
 
             # else:
             #     print(response.text)
@@ -591,10 +567,79 @@ class QAGraph():
 
         except Exception as e:
             print("Error assist2: ", e)
+            emit_progress(NodeError(self._scenario_id(state), "assist_stage2", str(e)))
             test_list = [({"id": str(current_test[0]), **current_test[1], **test}) for test in test_list]
             out_message = AIMessage(content="Server error occurred while generating the answer. Prompt to try again.")
+
+        if self.pipeline_stage2:
+            self._speculate_next_test(state, current_test)
         return {"message_history": [query_message, out_message], "current_test_details": test_list,
-                "current_test": current_test}
+                "current_test": current_test, "stage2_thread_id": speculative_thread_id}
+
+    def _test_details_from_output(self, test: tuple, out: dict, test_list: list[dict]):
+        """
+        (test details, answer message) of a stage 2 output, test_list (the test schema) when it has no details.
+        """
+        out_message = None
+        if (out['agent_output'] and out['agent_output']['thread_id']):
+            # save json to state
+            if out['query'] and out['query'].get('test_list'):
+                print('query')  # ,out['query'])
+                test_list = out['query']['test_list']
+                # concatenate curent test keys with test details
+                test_list = [({"id": str(test[0]), **test[1], **details}) for details in test_list]
+                out_message = AIMessage(content=str(out['query']),
+                                        response_metadata={"truncated": bool(out['query'].get('truncated'))})
+            else:
+                test_list = [({"id": str(test[0]), **test[1], **details}) for details in test_list]
+                out_message = AIMessage(
+                    content="**ERROR parsing JSON:** Failed to process output as proper JSON 'test_list' key not found, Received following output response, probably with incorrect JSON.\n" +
+                            out['agent_output']['output'])
+        return test_list, out_message
+
+    def _stage2_query(self, state: AutoconState, test: tuple) -> str:
+        if state['tech_stack'] == "Back End":
+            return get_backend_test_case_generation_prompt(test[1])
+        return get_front_end_test_case_generation_prompt(test[1])
+
+    def _speculation_key(self, state: AutoconState, test: tuple) -> tuple:
+        # the stage 1 thread tells the runs of one scenario apart, also across workers of astream_scenarios
+        return self._scenario_id(state), state.get('stage1_thread_id'), test[0]
+
+    async def _generate_test_details(self, assistant_id: str, query_input: dict, scenario_id, test: tuple):
+        """
+        One stage 2 assistant run for the details of test, usage recorded.
+        """
+        title = str(test[1].get('Title', ''))
+        assist = assistant_executor(assistant_id, OpenAIAssistantExecuters, on_item=lambda index, item: emit_progress(
+            PartialResult(scenario_id, 2, index, title)))  # "asst_V8DhPI6pYJNS5rMptP4SSr4o")
+        started = time.perf_counter()
+        out = await response_cache.aget_query_chain(assist, assistant_id, query_input)
+        elapsed = time.perf_counter() - started
+
+        # Log usage
+        usage = await self.usage_tracker.arecord(out, "assist_stage2", scenario_id)
+        routing_policy.record(STAGE2, assistant_id, elapsed, usage)
+        return out
+
+    def _speculate_next_test(self, state: AutoconState, current_test: tuple):
+        """
+        Start generating the details of the test after current_test while reflect_stage2 runs. It can not share
+        the stage 1 thread, a thread runs one run at a time, so it runs on a new thread with the same prompt.
+        """
+        if current_test[0] >= len(state['test_list']) or self._check_limits():
+            return
+        next_test = state['test_list'][current_test[0]]
+        key = self._speculation_key(state, next_test)
+        if self.speculative_runs.pending(key):
+            return
+        query = self._stage2_query(state, next_test)
+        query_input = {'promptInput': {'query': query}}
+        if state.get('attachments'):
+            query_input['attachments'] = state['attachments']
+        assistant_id = routing_policy.assistant_id(STAGE2)
+        self.speculative_runs.start(key, query, lambda: self._generate_test_details(
+            assistant_id, query_input, self._scenario_id(state), next_test))
 
     def _qa_agent_reflect_node(self, state: Sequence[BaseMessage]):
 
@@ -614,8 +659,7 @@ class QAGraph():
             print(json_data)
             print('+' * 100)
 
-        time.sleep(3)
-
+        rate_limiter.acquire()
         response = requests.post(
             "http://localhost:8000/connector/query/invoke",
             json=json_data
@@ -634,36 +678,51 @@ class QAGraph():
 
         return out_message
 
-    def _qa_reflection_stage1_node(self, state: AutoconState):
+    async def _qa_reflection_stage1_node(self, state: AutoconState):
         # print("Reflection_stage1",type(state),state)
 
+        # Nothing to reflect on once all the scenarios are processed
+        if state.get('is_scenario_list_processed'):
+            print("finishing scenarios reflection stage 1.....")
+            return {"message_history": [HumanMessage(content="Finished")]}
+
         messages = state['message_history']
         print("reflection stage1 messages:", messages)
         # Filter last two messages from the history
         messages = messages[-2:]
 
-        with get_openai_callback() as cb:
-            res = qa_reflect_stage1.invoke({"messages": messages})
+        validation = None
+        if local_validation:
+            validation = validate_test_list(messages[-1].content, state.get('test_list'),
+                                            state.get('stage1_revisions', 0) > 0, is_truncated(messages[-1]))
+            self.usage_tracker.record_validation(validation, "qa_reflection_stage1", self._scenario_id(state))
 
-        # Log usage
-        self.cumulative_usage_reflection = self._calculate_cumulative_usage_reflection(cb,
-                                                                                       self.cumulative_usage_reflection)
+        if validation is not None and validation.verdict != NEEDS_LLM:
+            # decided locally, no reflection call
+            is_finished = validation.verdict == FINE
+            followup_question = validation.follow_up
+        else:
+            with get_openai_callback() as cb:
+                res = await routing_policy.areflect(qa_reflection_prompt_stage1, Reflection, messages)
 
-        # We treat the output of this as human feedback for the generator
-        parser = JsonOutputToolsParser(return_id=True)
+            # Log usage
+            self.usage_tracker.record_reflection(cb, "qa_reflection_stage1", self._scenario_id(state))
 
-        tool_invocation: AIMessage = res
-        parsed_tool_calls = parser.invoke(tool_invocation)
-        print('+' * 100)
-        print("parsed reflection:", type(parsed_tool_calls))
-        pprint(parsed_tool_calls)
-        print('+' * 100)
+            # We treat the output of this as human feedback for the generator
+            parser = JsonOutputToolsParser(return_id=True)
 
-        is_finished = parsed_tool_calls[0]['args']['Finished']
-        followup_question = parsed_tool_calls[0]['args'].get(
-            'follow_up_question', 
-            "PLEASE RETRY THE TASK. "
-        )
+            tool_invocation: AIMessage = res
+            parsed_tool_calls = parser.invoke(tool_invocation)
+            print('+' * 100)
+            print("parsed reflection:", type(parsed_tool_calls))
+            pprint(parsed_tool_calls)
+            print('+' * 100)
+
+            is_finished = parsed_tool_calls[0]['args']['Finished']
+            followup_question = parsed_tool_calls[0]['args'].get(
+                'follow_up_question', 
+                "PLEASE RETRY THE TASK. "
+            )
 
         # Update revision count
         revisions = state.get('stage1_revisions', 0)
@@ -673,6 +732,7 @@ class QAGraph():
         is_finished_stage2 = None
         current_test_details = None
         test_details_list = None
+        stage2_results = None
         if is_finished:
             # Reset revision count
             revisions = 0
@@ -683,21 +743,24 @@ class QAGraph():
             is_finished_stage2 = False
             current_test_details = None
             test_details_list = "clear"
+            stage2_results = "clear"
 
         else:
             # revise answer with followup question
             revisions = revisions + 1
             question = HumanMessage(content=followup_question)
+            emit_progress(Revision(self._scenario_id(state), 1, revisions))
 
         # prepare outputs
         # out_state = {"message_history":[question] if question else None,"stage1_revisions":revisions,"is_finished_stage1":[is_finished] if is_finished else None,"is_resources_processed":[is_resources_processed] if is_resources_processed else None}
         out_state = {"message_history": [question], "stage1_revisions": revisions, "is_finished_stage1": is_finished,
                      "is_test_list_processed": is_test_list_processed, "is_finished_stage2": is_finished_stage2,
-                     "current_test_details": current_test_details, "test_details_list": test_details_list}
+                     "current_test_details": current_test_details, "test_details_list": test_details_list,
+                     "stage2_results": stage2_results, "stage2_test_revisions": stage2_results}
         filtered_state = {k: v for k, v in out_state.items() if v is not None}
         return filtered_state
 
-    def _qa_reflection_stage2_node(self, state: AutoconState):
+    async def _qa_reflection_stage2_node(self, state: AutoconState):
         # print("Reflection_stage2",type(state),state)
 
         # Check if we have processed all the test cases
@@ -715,29 +778,10 @@ class QAGraph():
         # Filter last two messages from the history
         messages = messages[-2:]
 
-        with get_openai_callback() as cb:
-            res = qa_reflect_stage1.invoke({"messages": messages})
-
-        # Log usage
-        self.cumulative_usage_reflection = self._calculate_cumulative_usage_reflection(cb,
-                                                                                       self.cumulative_usage_reflection)
-
-        # We treat the output of this as human feedback for the generator
-        parser = JsonOutputToolsParser(return_id=True)
-
-        tool_invocation: AIMessage = res
-        parsed_tool_calls = parser.invoke(tool_invocation)
-        print('+' * 100)
-        print("parsed reflection stage2:", type(parsed_tool_calls))
-        pprint(parsed_tool_calls)
-        print('+' * 100)
-
-        is_finished = parsed_tool_calls[0]['args']['Finished']
-        followup_question = parsed_tool_calls[0]['args'].get(
-            'follow_up_question', 
-            "PLEASE RETRY THE TASK. "
-        )
-        print("Stage 2 QA ---->", type(parsed_tool_calls[0]), type(is_finished), is_finished)
+        is_finished, followup_question = await self._reflect_test_details(
+            messages, state.get('current_test_details'), state['tech_stack'], state.get('stage2_revisions', 0) > 0,
+            self._scenario_id(state))
+        print("Stage 2 QA ---->", type(is_finished), is_finished)
 
         # Update revision count
         revisions = state.get('stage2_revisions', 0)
@@ -765,12 +809,131 @@ class QAGraph():
             revisions = 0
             question = AIMessage(
                 content="Could not generate test case details after max attempts allowed. Moving on to next test case.")
+            emit_progress(TestCaseDone(self._scenario_id(state), state['current_test'][0], len(state['test_list']),
+                                       self._test_title(state), ok=False))
+        elif is_finished:
+            emit_progress(TestCaseDone(self._scenario_id(state), state['current_test'][0], len(state['test_list']),
+                                       self._test_title(state)))
+        else:
+            emit_progress(Revision(self._scenario_id(state), 2, revisions))
 
         out_state = {"message_history": [question], "stage2_revisions": revisions, "is_finished_stage2": is_finished,
                      "test_details_list": current_test_details}
         filtered_state = {k: v for k, v in out_state.items() if v is not None}
         return filtered_state
 
+    async def _reflect_test_details(self, messages: list[BaseMessage], test_details: list[dict], tech_stack: str,
+                                    revision: bool, scenario_id, node: str = "qa_reflection_stage2"):
+        """
+        (finished, follow-up question) for a stage 2 answer, messages being the question and the answer.
+        """
+        validation = None
+        if local_validation:
+            validation = validate_test_details(messages[-1].content, test_details, tech_stack, revision,
+                                               is_truncated(messages[-1]))
+            self.usage_tracker.record_validation(validation, node, scenario_id)
+
+        if validation is not None and validation.verdict != NEEDS_LLM:
+            # decided locally, no reflection call
+            return validation.verdict == FINE, validation.follow_up
+
+        with get_openai_callback() as cb:
+            res = await routing_policy.areflect(qa_reflection_prompt_stage1, Reflection, messages)
+
+        # Log usage
+        self.usage_tracker.record_reflection(cb, node, scenario_id)
+
+        # We treat the output of this as human feedback for the generator
+        parser = JsonOutputToolsParser(return_id=True)
+
+        tool_invocation: AIMessage = res
+        parsed_tool_calls = parser.invoke(tool_invocation)
+        print('+' * 100)
+        print("parsed reflection stage2:", type(parsed_tool_calls))
+        pprint(parsed_tool_calls)
+        print('+' * 100)
+
+        return parsed_tool_calls[0]['args']['Finished'], parsed_tool_calls[0]['args'].get(
+            'follow_up_question',
+            "PLEASE RETRY THE TASK. "
+        )
+
+    def _stage2_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._stage2_slots is None or self._stage2_slots[0] is not loop:
+            self._stage2_slots = (loop, asyncio.Semaphore(max(1, self.stage2_concurrency)))
+        return self._stage2_slots[1]
+
+    def _fan_out_stage2(self, state: AutoconState):
+        """
+        Map step of stage 2: one expand_test branch per test case of the scenario, joined by collect_stage2.
+        """
+        task = {key: state.get(key) for key in Stage2Task.__annotations__ if key != 'current_test'}
+        sends = [Send("expand_test", {**task, 'current_test': test}) for test in state['test_list']]
+        return sends or "collect_stage2"
+
+    async def _expand_test_node(self, state: Stage2Task):
+        """
+        Generate and reflect on the details of one test case until they are finished or max_revisions is reached,
+        on an assistant thread of its own. The branches of a scenario run side by side, stage2_concurrency at a time.
+        """
+        current_test = state['current_test']
+        scenario_id = self._scenario_id(state)
+        query = self._stage2_query(state, current_test)
+        thread_id = None
+        revisions = 0
+        async with self._stage2_semaphore():
+            while True:
+                is_revision = revisions > 0
+                query_input = {'promptInput': {'query': query}}
+                if thread_id is not None:
+                    query_input['threadID'] = thread_id
+                if state.get('attachments'):
+                    query_input['attachments'] = state['attachments']
+                test_details = self.get_test_schema(state)
+                try:
+                    out = await self._generate_test_details(routing_policy.assistant_id(STAGE2, is_revision),
+                                                            query_input, scenario_id, current_test)
+                    test_details, out_message = self._test_details_from_output(current_test, out, test_details)
+                    if out['agent_output'] and out['agent_output']['thread_id']:
+                        thread_id = out['agent_output']['thread_id']
+                except Exception as e:
+                    print("Error expand_test: ", e)
+                    emit_progress(NodeError(scenario_id, "expand_test", str(e)))
+                    test_details = [({"id": str(current_test[0]), **current_test[1], **test}) for test in test_details]
+                    out_message = AIMessage(
+                        content="Server error occurred while generating the answer. Prompt to try again.")
+
+                is_finished, followup_question = await self._reflect_test_details(
+                    [HumanMessage(content=query), out_message], test_details, state['tech_stack'], is_revision,
+                    scenario_id, "expand_test")
+                if is_finished:
+                    break
+                revisions = revisions + 1
+                if revisions >= max_revisions:
+                    break
+                emit_progress(Revision(scenario_id, 2, revisions))
+                # revise answer with followup question, on the thread of the answer
+                query = followup_question
+
+        emit_progress(TestCaseDone(scenario_id, current_test[0], len(state['test_list']), self._test_title(state),
+                                   ok=is_finished))
+        # a test case which could not be finished after max attempts is left out, as in reflect_stage2
+        return {"stage2_results": {str(current_test[0]): test_details if is_finished else []},
+                "stage2_test_revisions": {str(current_test[0]): revisions}}
+
+    async def _collect_stage2_node(self, state: AutoconState):
+        """
+        Reduce step of stage 2: the details of all test cases in test id order, the scenario is finished.
+        """
+        results = state.get('stage2_results') or {}
+        test_details_list = [details for test_id in sorted(results, key=int) for details in results[test_id]]
+        print(f"finishing all test cases stage 2, revisions per test case: {state.get('stage2_test_revisions')}")
+        emit_progress(ScenarioFinished(self._scenario_id(state), state['current_scenario'][1][0], test_details_list))
+        return {"message_history": [AIMessage(content="Finished generating test case details.")],
+                "test_details_list": test_details_list, "is_test_list_processed": True, "is_finished_stage2": True,
+                "current_test": None}
+
     def _should_continue_agent(self, state: List[BaseMessage]):
         # If the agent outcome is an AgentFinish, then we return `exit` string
         # This will be used when setting up the graph to define the flow
@@ -806,6 +969,8 @@ class QAGraph():
             # go to subgraph node for backend
             if state['tech_stack'] == "Back End":
                 return "subgraph_node"
+            elif self.stage2_concurrency > 0:
+                return self._fan_out_stage2(state)
             else:   
                 # go to stage2
                 return "assist_stage2"            
@@ -821,9 +986,7 @@ class QAGraph():
 
         if self._check_limits():
             print("Usage limits exceeded for stage 2")
-            user_input = input("Usage limit has exceeded, continue (y/n)?: ")
-            if user_input == 'n':
-                return END
+            raise self._usage_limit_error()
 
         # End if we have processed all the platform feature test types   
         is_test_list_processed = state.get('is_test_list_processed')
@@ -863,11 +1026,11 @@ class QAGraph():
 
     def prepare_graph(self) -> StateGraph:
         builder = StateGraph(AutoconState)
-        builder.add_node("assist_stage1", self._assist_stage1_node)
-        builder.add_node("reflect_stage1", self._qa_reflection_stage1_node)
-        builder.add_node("subgraph_node", self._subgraph_node)
-        builder.add_node("assist_stage2", self._assist_stage2_node)
-        builder.add_node("reflect_stage2", self._qa_reflection_stage2_node)
+        builder.add_node("assist_stage1", tracer.traced_node("assist_stage1", self._assist_stage1_node))
+        builder.add_node("reflect_stage1", tracer.traced_node("reflect_stage1", self._qa_reflection_stage1_node))
+        builder.add_node("subgraph_node", tracer.traced_node("subgraph_node", self._subgraph_node))
+        builder.add_node("assist_stage2", tracer.traced_node("assist_stage2", self._assist_stage2_node))
+        builder.add_node("reflect_stage2", tracer.traced_node("reflect_stage2", self._qa_reflection_stage2_node))
         # builder.add_node("assist_stage3", assist_stage3_node)
         # builder.add_node("reflect_stage3", qa_reflection_stage3_node)
 
@@ -875,9 +1038,16 @@ class QAGraph():
 
         builder.add_edge("assist_stage1", "reflect_stage1")
         builder.add_conditional_edges("reflect_stage1", self._should_continue_stage1_qa)       
-        builder.add_edge("subgraph_node", "assist_stage2")
         builder.add_edge("assist_stage2", "reflect_stage2")
         builder.add_conditional_edges("reflect_stage2", self._should_continue_stage2_qa)
+        if self.stage2_concurrency > 0:
+            builder.add_node("expand_test", tracer.traced_node("expand_test", self._expand_test_node))
+            builder.add_node("collect_stage2", tracer.traced_node("collect_stage2", self._collect_stage2_node))
+            builder.add_conditional_edges("subgraph_node", self._fan_out_stage2)
+            builder.add_edge("expand_test", "collect_stage2")
+            builder.add_edge("collect_stage2", "assist_stage1")
+        else:
+            builder.add_edge("subgraph_node", "assist_stage2")
 
         return builder
 
@@ -901,18 +1071,30 @@ class QAGraph():
     async def aget_sqlite_graph(self):
         builder = self.prepare_graph()
 
-        # Store the async context manager explicitly and use it later
-        self.checkpointer_cm = AsyncSqliteSaver.from_conn_string(self.checkpoint_path)  # Stores the context manager
-        self.checkpointer = await self.checkpointer_cm.__aenter__()  # Manually enter the async context
+        # shared long lived checkpointer, checkpoints outlive the run so it can be resumed
+        self.checkpointer = await checkpoint_store.saver(self.checkpoint_path)
         lc_graph_with_memory = builder.compile(checkpointer=self.checkpointer)
 
-        return lc_graph_with_memory  # Ensures checkpointer remains available
+        return lc_graph_with_memory
 
-    def cleanup(self):
+    async def resume(self, run_id: str, config: dict = None):
+        """
+        Continue run_id from its latest checkpoint, yields the updates like graph.astream.
+        A finished run yields nothing, an unknown run raises ValueError.
+        """
+        graph = await self.aget_sqlite_graph()
+        config = run_config(run_id, config)
+        snapshot = await graph.aget_state(config)
+        if not snapshot.values:
+            raise ValueError(f"No checkpoint found for run {run_id}")
+        print(f"Resuming run {run_id} before {snapshot.next}")
+        with archive_run(run_id):
+            async for output in graph.astream(None, config):
+                yield output
 
-        if os.path.exists(self.checkpoint_path):
-            os.remove(self.checkpoint_path)
-            print(f"Database '{self.checkpoint_path}' has been deleted.")
+    def cleanup(self):
+        # the checkpoint database is shared and kept for resume, only this graph's reference is dropped
+        self.checkpointer = None
 
     def __enter__(self):
         return self
@@ -921,11 +1103,64 @@ class QAGraph():
         self.cleanup()
 
     async def acleanup(self):
-        if hasattr(self, "checkpointer"):
-            await self.checkpointer_cm.__aexit__(None, None, None)  # Properly close the async resource
-        if os.path.exists(self.checkpoint_path):
-            os.remove(self.checkpoint_path)
-            print(f"Database '{self.checkpoint_path}' has been deleted.")
+        self.speculative_runs.cancel()
+        # checkpoints are kept for resume, runs past the retention are removed instead
+        await checkpoint_store.expire(self.checkpoint_path)
+        self.checkpointer = None
+
+    async def astream_scenarios(self, graph, inputs: dict, config: dict, max_workers: int = 4):
+        """
+        Run every scenario of inputs['scenario_list'] as an independent graph run, at most max_workers at a time.
+
+        Each scenario gets its own checkpoint thread (and therefore its own assistant thread), results are yielded
+        as ScenarioResult in completion order; sort them on scenario_id to merge back in scenario order.
+        Calling it again with the same config resumes: finished scenarios are read back from their checkpoint and
+        interrupted ones continue from their latest checkpoint.
+        """
+        scenario_list = inputs['scenario_list']
+        max_workers = max(1, min(max_workers, max_scenario_workers))
+        semaphore = asyncio.Semaphore(max_workers)
+        base_thread_id = config.get('configurable', {}).get('thread_id', 1)
+
+        async def run_scenario(scenario_id, scenario):
+            async with semaphore:
+                started = time.perf_counter()
+                # single scenario run, re-indexed so the stage 1 bookkeeping finishes after this scenario
+                worker_inputs = {**inputs, 'scenario_list': [(1, scenario)], 'current_scenario': (1, scenario),
+                                 'scenario_id': scenario_id}
+                # run_id keeps the traces of the scenario workers together under the run
+                worker_config = {**config,
+                                 'configurable': {'run_id': str(base_thread_id), **config.get('configurable', {}),
+                                                  'thread_id': f"{base_thread_id}-scenario-{scenario_id}"}}
+                try:
+                    if self._check_limits():
+                        # scenarios waiting for a worker are not started once the limit is spent
+                        raise self._usage_limit_error()
+                    snapshot = await graph.aget_state(worker_config)
+                    if snapshot.values and not snapshot.next:
+                        final_state = snapshot.values
+                    else:
+                        with archive_run(worker_config['configurable']['thread_id']):
+                            final_state = await graph.ainvoke(None if snapshot.values else worker_inputs, worker_config)
+                        await checkpoint_store.prune(worker_config['configurable']['thread_id'], self.checkpoint_path,
+                                                     finished=True)
+                    test_details_list = final_state.get('test_details_list') or []
+                    error = None
+                except Exception as e:
+                    print(f"Error processing scenario {scenario_id}: {e}")
+                    test_details_list = []
+                    error = str(e)
+
+                return ScenarioResult(scenario_id=scenario_id, scenario=scenario, test_details_list=test_details_list,
+                                      elapsed=time.perf_counter() - started, error=error)
+
+        tasks = [asyncio.ensure_future(run_scenario(scenario_id, scenario)) for scenario_id, scenario in scenario_list]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
 
     async def __aenter__(self):
         return self
@@ -0,0 +1,307 @@
+"""
+Spans for graph nodes and the operations inside them (assistant runs, usage lookups, reflection calls,
+checkpoint writes, UI updates), written as OTLP JSON lines to QA_TRACE_PATH. Tracing is off when it is not set.
+
+Print where the wall time of the traced runs went:  python -m qa_agent.tracing qa_trace.jsonl --run <run id>
+"""
+import argparse
+import atexit
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Optional
+
+from langgraph.config import get_config
+
+trace_path = os.getenv("QA_TRACE_PATH")
+# spans buffered before they are appended to the file, a finished root span always flushes
+EXPORT_BATCH_SIZE = 100
+service_name = "qa_agent"
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    start_ns: int = field(default_factory=time.time_ns)
+    end_ns: Optional[int] = None
+    attributes: dict = field(default_factory=dict)
+    error: Optional[str] = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, key: str, amount=1):
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def to_otlp(self) -> dict:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+
+
+class _NoopSpan:
+    def set(self, **attributes):
+        pass
+
+    def add(self, key: str, amount=1):
+        pass
+
+
+noop_span = _NoopSpan()
+_current_span: ContextVar[Optional[Span]] = ContextVar("qa_current_span", default=None)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _from_otlp_value(value: dict):
+    if "intValue" in value:
+        return int(value["intValue"])
+    if "doubleValue" in value:
+        return value["doubleValue"]
+    if "boolValue" in value:
+        return value["boolValue"]
+    return value.get("stringValue")
+
+
+def payload_size(value) -> int:
+    """
+    Approximate size in bytes of a prompt, answer or message list.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return len(str(value))
+
+
+class JsonlSpanExporter:
+    """
+    Appends finished spans to a file in the OTLP JSON file format (one ExportTraceServiceRequest per line),
+    which the OpenTelemetry collector's otlpjsonfile receiver reads. Every line is a single append so graph
+    worker processes can share the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._spans = []
+        atexit.register(self.flush)
+
+    def export(self, span: Span):
+        with self._lock:
+            self._spans.append(span.to_otlp())
+            if span.parent_id is not None and len(self._spans) < EXPORT_BATCH_SIZE:
+                return
+            spans, self._spans = self._spans, []
+        self._write(spans)
+
+    def flush(self):
+        with self._lock:
+            spans, self._spans = self._spans, []
+        self._write(spans)
+
+    def _write(self, spans: list):
+        if not spans:
+            return
+        request = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}},
+                                        {"key": "process.pid", "value": {"intValue": str(os.getpid())}}]},
+            "scopeSpans": [{"scope": {"name": "qa_agent.tracing"}, "spans": spans}],
+        }]}
+        line = json.dumps(request, default=str) + "\n"
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+def _run_id() -> Optional[str]:
+    """
+    Run of the graph executing in this context: its configurable run_id (scenario workers share the run id of
+    their run) or its checkpoint thread id.
+    """
+    try:
+        configurable = get_config().get("configurable", {})
+    except RuntimeError:
+        return None
+    run_id = configurable.get("run_id", configurable.get("thread_id"))
+    return None if run_id is None else str(run_id)
+
+
+class Tracer:
+    """
+    Creates spans nested after the context they are opened in: across awaits, asyncio tasks and the executor
+    threads LangGraph runs sync nodes in. Without an exporter every call is a no-op.
+    """
+
+    def __init__(self, exporter: JsonlSpanExporter = None):
+        self.exporter = exporter
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    @contextmanager
+    def span(self, name: str, run_id: str = None, **attributes):
+        """
+        Span around the with block, yields it so attributes (tokens, sizes, ...) can be set on the way.
+        A span without a parent starts the trace of its run.
+        """
+        if self.exporter is None:
+            yield noop_span
+            return
+        parent = _current_span.get()
+        if parent is None:
+            run_id = run_id or _run_id()
+            trace_id = uuid.uuid5(uuid.NAMESPACE_URL, run_id).hex if run_id else uuid.uuid4().hex
+            attributes = {"qa.run_id": run_id or "", **attributes}
+        else:
+            trace_id = parent.trace_id
+        span = Span(name, trace_id, uuid.uuid4().hex[:16], parent.span_id if parent else None,
+                    attributes=attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            _current_span.reset(token)
+            self.exporter.export(span)
+
+    def traced_node(self, name: str, node):
+        """
+        Graph node wrapped in a span of its name, the node itself when tracing is off. The signature is kept so
+        LangGraph still passes config etc. to nodes asking for it.
+        """
+        if self.exporter is None:
+            return node
+        if inspect.iscoroutinefunction(node):
+            @functools.wraps(node)
+            async def traced(*args, **kwargs):
+                with self.span(name, node=name):
+                    return await node(*args, **kwargs)
+        else:
+            @functools.wraps(node)
+            def traced(*args, **kwargs):
+                with self.span(name, node=name):
+                    return node(*args, **kwargs)
+        return traced
+
+
+def current_span():
+    """
+    The innermost open span of this context, a no-op span when there is none.
+    """
+    return _current_span.get() or noop_span
+
+
+# shared tracer of the process, graph worker processes pick up the same QA_TRACE_PATH
+tracer = Tracer(JsonlSpanExporter(trace_path) if trace_path else None)
+
+
+def read_spans(path: str) -> list[dict]:
+    spans = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            for resource_spans in json.loads(line).get("resourceSpans", []):
+                for scope_spans in resource_spans.get("scopeSpans", []):
+                    for span in scope_spans.get("spans", []):
+                        span["attributes"] = {item["key"]: _from_otlp_value(item["value"])
+                                              for item in span.get("attributes", [])}
+                        span["duration"] = (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])) / 1e9
+                        spans.append(span)
+    return spans
+
+
+def summarize(spans: list[dict]) -> dict:
+    """
+    Per run: wall time, and per span name count, total and self time (without child spans), tokens, retries
+    and 429 responses.
+    """
+    children = defaultdict(float)
+    for span in spans:
+        if span["parentSpanId"]:
+            children[span["parentSpanId"]] += span["duration"]
+    trace_runs = {span["traceId"]: span["attributes"].get("qa.run_id") or span["traceId"]
+                  for span in spans if not span["parentSpanId"]}
+
+    runs = {}
+    for span in spans:
+        run_id = trace_runs.get(span["traceId"], span["traceId"])
+        run = runs.setdefault(run_id, {"start": None, "end": None, "errors": 0, "names": {}})
+        start, end = int(span["startTimeUnixNano"]), int(span["endTimeUnixNano"])
+        run["start"] = start if run["start"] is None else min(run["start"], start)
+        run["end"] = end if run["end"] is None else max(run["end"], end)
+        run["errors"] += span["status"].get("code") == 2
+        stats = run["names"].setdefault(span["name"], {"count": 0, "total": 0.0, "self": 0.0, "tokens": 0,
+                                                       "retries": 0, "rate_limited": 0})
+        stats["count"] += 1
+        stats["total"] += span["duration"]
+        stats["self"] += max(0.0, span["duration"] - children[span["spanId"]])
+        stats["tokens"] += span["attributes"].get("tokens", 0)
+        stats["retries"] += span["attributes"].get("retries", 0)
+        stats["rate_limited"] += span["attributes"].get("rate_limited", 0)
+    for run in runs.values():
+        run["wall_time"] = (run["end"] - run["start"]) / 1e9
+    return runs
+
+
+def print_summary(runs: dict):
+    for run_id, run in sorted(runs.items(), key=lambda item: item[1]["start"]):
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(run["start"] / 1e9))
+        print(f"\nRun {run_id} ({started}): {run['wall_time']:.1f}s wall time, {run['errors']} failed spans")
+        print(f"  {'span':<28} {'count':>6} {'total s':>9} {'self s':>9} {'self %':>7} {'tokens':>9} {'retries':>8} {'429s':>6}")
+        for name, stats in sorted(run["names"].items(), key=lambda item: -item[1]["self"]):
+            share = stats["self"] / run["wall_time"] if run["wall_time"] else 0.0
+            print(f"  {name:<28} {stats['count']:6d} {stats['total']:9.2f} {stats['self']:9.2f} {share:7.1%} "
+                  f"{stats['tokens']:9d} {stats['retries']:8d} {stats['rate_limited']:6d}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", nargs="?", default=trace_path or "qa_trace.jsonl", help="trace file")
+    parser.add_argument("--run", help="only runs whose id starts with this")
+    args = parser.parse_args()
+    runs = summarize(read_spans(args.path))
+    if args.run:
+        runs = {run_id: run for run_id, run in runs.items() if str(run_id).startswith(args.run)}
+    if not runs:
+        print(f"No traced runs in {args.path}")
+        return
+    print_summary(runs)
+
+
+if __name__ == "__main__":
+    main()
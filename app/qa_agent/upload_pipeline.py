@@ -0,0 +1,90 @@
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import yaml
+
+from .document_store import document_store, max_upload_workers
+
+try:
+    # libyaml backed loader, an order of magnitude faster on large OpenAPI specs
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+
+def is_yaml(filename: str) -> bool:
+    return filename.lower().endswith((".yml", ".yaml"))
+
+
+def yaml_to_json(filename: str, content: bytes) -> tuple[str, bytes]:
+    """
+    Convert a YAML document to compact JSON, e.g. openapi.yaml -> openapi.json.
+    """
+    data = yaml.load(content, Loader=YamlLoader)
+    json_bytes = json.dumps(data, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8")
+    return filename.rsplit(".", 1)[0] + ".json", json_bytes
+
+
+class UploadPipeline:
+    """
+    Converts and uploads documents on a worker pool so the Streamlit script thread only submits them.
+
+    Every submitted document is converted (if needed), hashed and acquired from the document store
+    concurrently. file_ids() waits for all of them and keeps the submission order.
+    """
+
+    def __init__(self, store=document_store, max_workers: int = max_upload_workers):
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+        self.collected = False
+
+    def _upload(self, filename: str, content: bytes, convert=None) -> str:
+        if convert is not None:
+            filename, content = convert(filename, content)
+        return self.store.acquire(filename, content)
+
+    def submit(self, filename: str, content: bytes, convert=None):
+        self.futures.append(self.executor.submit(self._upload, filename, content, convert))
+
+    def submit_openapi_spec(self, filename: str, content: bytes):
+        self.submit(filename, content, convert=yaml_to_json if is_yaml(filename) else None)
+
+    def progress(self):
+        """
+        Yield (finished, total) every time a document is ready.
+        """
+        for finished, _ in enumerate(as_completed(self.futures), start=1):
+            yield finished, len(self.futures)
+
+    def file_ids(self) -> list[str]:
+        """
+        File ids in submission order. When any document fails, the ones already acquired are released
+        and the error is raised.
+        """
+        file_ids, error = [], None
+        for future in self.futures:
+            try:
+                file_ids.append(future.result())
+            except Exception as e:
+                error = error or e
+        self.collected = True
+        if error is not None:
+            self.store.release(file_ids)
+            raise error
+        return file_ids
+
+    def close(self):
+        """
+        Wait for the workers, documents never handed out through file_ids() are released.
+        """
+        self.executor.shutdown(wait=True)
+        if not self.collected:
+            self.collected = True
+            self.store.release([f.result() for f in self.futures if f.exception() is None])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,221 @@
+import asyncio
+import threading
+from collections import defaultdict
+from typing import Optional, TypedDict
+
+from openai import OpenAI
+
+from .metrics import metrics
+from .output_validator import NEEDS_LLM
+from .progress import TokensUsed, emit_progress
+from .rate_limiter import rate_limiter
+from .response_cache import response_cache
+from .tracing import tracer, current_span
+
+# cost per 1000 tokens
+model_costs = {
+    'gpt-4.1': 0.0020,
+    'gpt-4o': 0.0050,
+    'gpt-4o-mini': 0.00015,
+    'gpt-4-turbo-2024-04-09': 0.01,
+    'gpt-4-turbo': 0.01,
+    'gpt-4-turbo-preview': 0.01,
+    'gpt-4-0125-preview': 0.01,
+    'gpt-4-1106-preview': 0.01,
+    'gpt-4-0613': 0.03,
+    'gpt-4-32k-0613': 0.03,
+    'gpt-3.5-turbo-0125': 0.0005,
+    'gpt-3.5-turbo': 0.0005,
+    'gpt-3.5-turbo-1106': 0.0010,
+    'gpt-3.5-turbo-16k-0613': 0.0030,
+    'gpt-3.5-turbo-0613': 0.0015,
+}
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class UsageStatistics(TypedDict):
+    completion_tokens: int
+    prompt_tokens: int
+    total_tokens: int
+    model_cost: float
+    completion_cost: float
+    prompt_cost: float
+    total_cost: float
+
+
+def get_model_cost(model_name: str) -> float:
+    return model_costs.get(model_name, 0.0)
+
+
+def empty_usage() -> UsageStatistics:
+    return UsageStatistics(completion_tokens=0, prompt_tokens=0, total_tokens=0, model_cost=0.0,
+                           completion_cost=0.0, prompt_cost=0.0, total_cost=0.0)
+
+
+def _shared_client() -> OpenAI:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OpenAI(http_client=rate_limiter.http_client())
+    return _client
+
+
+def _read(usage, key: str) -> int:
+    if isinstance(usage, dict):
+        return usage.get(key) or 0
+    return getattr(usage, key, 0) or 0
+
+
+def usage_statistics(usage, model: str) -> UsageStatistics:
+    """
+    UsageStatistics from a run / completion usage object (or dict) and the model which produced it.
+    """
+    completion_tokens = _read(usage, 'completion_tokens')
+    prompt_tokens = _read(usage, 'prompt_tokens')
+    total_tokens = _read(usage, 'total_tokens') or completion_tokens + prompt_tokens
+    model_cost = get_model_cost(model)
+    return UsageStatistics(
+        completion_tokens=completion_tokens,
+        prompt_tokens=prompt_tokens,
+        total_tokens=total_tokens,
+        model_cost=model_cost,
+        completion_cost=(completion_tokens / 1000) * model_cost,
+        prompt_cost=(prompt_tokens / 1000) * model_cost,
+        total_cost=(total_tokens / 1000) * model_cost,
+    )
+
+
+def _add(total: UsageStatistics, usage: UsageStatistics):
+    for key in ('completion_tokens', 'prompt_tokens', 'total_tokens', 'completion_cost', 'prompt_cost', 'total_cost'):
+        total[key] += usage[key]
+
+
+class UsageTracker:
+    """
+    Token and cost accounting of one graph (session), aggregated per node and per scenario.
+
+    Assistant usage is read from the run the executor returns in out['agent_output'] ('usage' and
+    'model'); only outputs without it fall back to a runs.retrieve on one shared client.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new run, the graph keeps its tracker (and the subgraph's reference to it) across runs.
+        """
+        with self._lock:
+            self.assistant = empty_usage()
+            self.reflection = empty_usage()
+            self.by_node = defaultdict(empty_usage)
+            self.by_scenario = defaultdict(empty_usage)
+            self.retrieved = 0
+            # local validations of answers by verdict, see output_validator
+            self.validations = defaultdict(int)
+
+    def _needs_retrieve(self, out) -> bool:
+        agent_output = out.get('agent_output') or {}
+        return not out.get('cached') and agent_output.get('usage') is None
+
+    def run_usage(self, out) -> Optional[UsageStatistics]:
+        """
+        Usage of the assistant run behind out, None for cached outputs.
+        """
+        if out.get('cached'):
+            return None
+        agent_output = out.get('agent_output') or {}
+        if agent_output.get('usage') is not None:
+            return usage_statistics(agent_output['usage'], agent_output.get('model'))
+        if not (agent_output.get('thread_id') and agent_output.get('run_id')):
+            raise ValueError("Missing thread_id or run_id in output data")
+        with tracer.span("usage_retrieve", run=agent_output['run_id']):
+            run = _shared_client().beta.threads.runs.retrieve(thread_id=agent_output['thread_id'],
+                                                              run_id=agent_output['run_id'])
+        self.retrieved += 1
+        return usage_statistics(run.usage, run.model)
+
+    def _record(self, usage: Optional[UsageStatistics], total: UsageStatistics, node: str, scenario, label: str):
+        if usage is None:
+            print(f"Current usage: served from cache. {response_cache.summary()}")
+            return None
+        with self._lock:
+            _add(total, usage)
+            _add(self.by_node[node], usage)
+            if scenario is not None:
+                _add(self.by_scenario[scenario], usage)
+            run_cost = self.total_cost()
+        current_span().add("tokens", usage['total_tokens'])
+        emit_progress(TokensUsed(scenario, node, usage['total_tokens'], usage['total_cost'], run_cost))
+        print(
+            f"Current usage ({node}): Completion tokens: {usage['completion_tokens']}, Prompt tokens: {usage['prompt_tokens']}, "
+            f"Total tokens: {usage['total_tokens']}, Total cost: {usage['total_cost']}")
+        print(
+            f"Cumulative Usage{label}: Completion tokens: {total['completion_tokens']}, Prompt tokens: {total['prompt_tokens']}, "
+            f"Total tokens: {total['total_tokens']}, Total cost: {total['total_cost']}, {response_cache.summary()}")
+        return usage
+
+    def record(self, out, node: str, scenario=None) -> Optional[UsageStatistics]:
+        """
+        Add the usage of an assistant output to the session, node and scenario totals.
+        """
+        return self._record(self.run_usage(out), self.assistant, node, scenario, "")
+
+    async def arecord(self, out, node: str, scenario=None) -> Optional[UsageStatistics]:
+        if self._needs_retrieve(out):
+            # the fallback lookup is a blocking call, keep it off the event loop
+            usage = await asyncio.to_thread(self.run_usage, out)
+        else:
+            usage = self.run_usage(out)
+        return self._record(usage, self.assistant, node, scenario, "")
+
+    def record_reflection(self, cb, node: str, scenario=None) -> Optional[UsageStatistics]:
+        """
+        Add the usage collected by get_openai_callback for a reflection call.
+        """
+        if not cb or not cb.total_tokens:
+            return None
+        usage = UsageStatistics(
+            completion_tokens=cb.completion_tokens,
+            prompt_tokens=cb.prompt_tokens,
+            total_tokens=cb.total_tokens,
+            model_cost=0.0,
+            completion_cost=0.0,
+            prompt_cost=0.0,
+            total_cost=cb.total_cost,
+        )
+        return self._record(usage, self.reflection, node, scenario, " Reflection")
+
+    def record_validation(self, validation, node: str, scenario=None):
+        """
+        Count a local validation of an answer, every verdict but NEEDS_LLM replaced a reflection call.
+        """
+        with self._lock:
+            self.validations[validation.verdict] += 1
+            saved = self.reflections_saved()
+        metrics.inc("qa_validations_total", node=node, verdict=validation.verdict)
+        current_span().set(validation=validation.verdict)
+        print(f"Local validation ({node}, scenario {scenario}): {validation.verdict}, {validation.reason}. "
+              f"Reflection calls saved: {saved}")
+
+    def reflections_saved(self) -> int:
+        return sum(count for verdict, count in self.validations.items() if verdict != NEEDS_LLM)
+
+    def total_cost(self) -> float:
+        return self.assistant['total_cost'] + self.reflection['total_cost']
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                'assistant': dict(self.assistant),
+                'reflection': dict(self.reflection),
+                'total_cost': self.total_cost(),
+                'by_node': {node: dict(usage) for node, usage in self.by_node.items()},
+                'by_scenario': {scenario: dict(usage) for scenario, usage in self.by_scenario.items()},
+                'runs_retrieved': self.retrieved,
+                'validations': dict(self.validations),
+                'reflections_saved': self.reflections_saved(),
+            }
@@ -1,6 +1,8 @@
 import streamlit as st
 
 from qa_agent.tc_graph_agent import QAGraph
+from qa_agent.document_store import document_store, file_search_attachments
+from qa_agent.message_window import archive_run
 
 from pprint import pprint
 import json
@@ -11,6 +13,7 @@ import pandas as pd
 import io
 
 import time
+import uuid
 
 st.set_page_config(layout="wide")
 
@@ -201,13 +204,10 @@ def query_input():
         placeholder = st.empty()
         placeholder.write('Processing query...')    
 
+        uploaded_file_ids = []
         try:
-            # Create file and attachment (Uploads the user provided file to OpenAI)        
-            client = OpenAI()
-            file_attachments = []
-            td_file = None
-            frd_file = None
-            figma_file = None
+            # Upload the user provided files to OpenAI, documents uploaded before are reused
+            documents = []
             scenario_list = []
 
             # read scenario document
@@ -224,42 +224,21 @@ def query_input():
             # Add schema_file if uploaded
             if st.session_state.schema_doc is not None:
                 schema_doc = st.session_state.schema_doc
-                schema_file = client.files.create(
-                    file=schema_doc, purpose="assistants"
-                    )
-
-                file_attachments.append({
-                    "file_id": schema_file.id,
-                    "tools": [{"type": "file_search"}]
-                })
+                documents.append((schema_doc.name, schema_doc.getvalue()))
 
             # Add tech_design_file if uploaded
             if st.session_state.tech_design is not None:
                 tech_design_doc = st.session_state.tech_design
-                td_file = client.files.create(
-                    file=tech_design_doc, purpose="assistants"
-                    )
-
-                # add td and frd files to attachments if present
-                file_attachments.append(
-                    {
-                        "file_id": td_file.id,
-                        "tools": [{"type": "file_search"}]
-                    }
-                )
+                documents.append((tech_design_doc.name, tech_design_doc.getvalue()))
 
             # Add frd_document_file if uploaded
             if st.session_state.frd_document is not None:
                 frd_doc = st.session_state.frd_document
+                documents.append((frd_doc.name, frd_doc.getvalue()))
 
-                frd_file = client.files.create(
-                    file=frd_doc, purpose="assistants"
-                    )
-
-                file_attachments.append({
-                    "file_id": frd_file.id,
-                    "tools": [{"type": "file_search"}]
-                })
+            # all documents are uploaded in parallel
+            uploaded_file_ids = document_store.acquire_many(documents)
+            file_attachments = file_search_attachments(uploaded_file_ids)
 
             attachment_input = {"attachments": file_attachments}
             st.session_state['uploaded_td_file'] = attachment_input
@@ -283,24 +262,21 @@ def query_input():
             placeholder.write('Error processing files...')
 
         finally:
-            # cleanup files
-            if td_file:
-                client.files.delete(td_file.id)
-            if frd_file:
-                client.files.delete(frd_file.id)
-            if figma_file:
-                client.files.delete(figma_file.id)
+            # release the uploaded files, they stay available for the next run
+            document_store.release(uploaded_file_ids)
     
 
 
 #---------------------------------------- Stage Handling  -----------------------------------------------------
 #thread_config = {"configurable": {"thread_id": 1,"recursion_limit": 10000}}
-thread_config = {
-    "recursion_limit": 10000,
-    "configurable": {
-        "thread_id": 1
+def new_thread_config() -> dict:
+    # a checkpoint thread per request, concurrent sessions never share checkpoints
+    return {
+        "recursion_limit": 10000,
+        "configurable": {
+            "thread_id": str(uuid.uuid4())
+        }
     }
-}
 
 def get_required_values(data, required_keys):
     """Recursively searches for required keys in a nested dictionary and returns their values.
@@ -435,9 +411,10 @@ def get_progress_data(node_state:dict,global_state:dict):
 
 def run_qa_graph(inputs,placeholder):
     graph_with_memory = st.session_state['graph_with_memory']
+    thread_config = new_thread_config()
     print("Running stage 1 graph id ~~~~~~~~~~~~~~~~~~: ",graph_with_memory)
     
-    with st.status("Generating Test Cases .. ") as status:
+    with archive_run(thread_config['configurable']['thread_id']), st.status("Generating Test Cases .. ") as status:
         #status.update(label="Processing Files.. ",expanded=True)
         # update staus as per first test type
         #id,current_scenario = inputs.get('current_scenario')
@@ -479,13 +456,10 @@ def process_button():
             placeholder = st.empty()
             placeholder.write('Processing files...')          
             
+            uploaded_file_ids = []
             try:
-                # Create file and attachment (Uploads the user provided file to OpenAI)        
-                client = OpenAI()
-                file_attachments = []
-                td_file = None
-                frd_file = None
-                figma_file = None
+                # Upload the user provided files to OpenAI, documents uploaded before are reused
+                documents = []
                 scenario_list = []
 
                 # read scenario document
@@ -502,42 +476,21 @@ def process_button():
                 # Add schema_file if uploaded
                 if st.session_state.schema_doc is not None:
                     schema_doc = st.session_state.schema_doc
-                    schema_file = client.files.create(
-                        file=schema_doc, purpose="assistants"
-                        )
-
-                    file_attachments.append({
-                        "file_id": schema_file.id,
-                        "tools": [{"type": "file_search"}]
-                    })
+                    documents.append((schema_doc.name, schema_doc.getvalue()))
 
                 # Add tech_design_file if uploaded
                 if st.session_state.tech_design is not None:
                     tech_design_doc = st.session_state.tech_design
-                    td_file = client.files.create(
-                        file=tech_design_doc, purpose="assistants"
-                        )
-
-                    # add td and frd files to attachments if present
-                    file_attachments.append(
-                        {
-                            "file_id": td_file.id,
-                            "tools": [{"type": "file_search"}]
-                        }
-                    )
+                    documents.append((tech_design_doc.name, tech_design_doc.getvalue()))
 
                 # Add frd_document_file if uploaded
                 if st.session_state.frd_document is not None:
                     frd_doc = st.session_state.frd_document
+                    documents.append((frd_doc.name, frd_doc.getvalue()))
 
-                    frd_file = client.files.create(
-                        file=frd_doc, purpose="assistants"
-                        )
-
-                    file_attachments.append({
-                        "file_id": frd_file.id,
-                        "tools": [{"type": "file_search"}]
-                    })
+                # all documents are uploaded in parallel
+                uploaded_file_ids = document_store.acquire_many(documents)
+                file_attachments = file_search_attachments(uploaded_file_ids)
 
                 attachment_input = {"attachments": file_attachments}
                 st.session_state['uploaded_td_file'] = attachment_input
@@ -562,13 +515,8 @@ def process_button():
                 placeholder.write('Error processing files...')
 
             finally:
-                # cleanup files
-                if td_file:
-                    client.files.delete(td_file.id)
-                if frd_file:
-                    client.files.delete(frd_file.id)
-                if figma_file:
-                    client.files.delete(figma_file.id)
+                # release the uploaded files, they stay available for the next run
+                document_store.release(uploaded_file_ids)
 
 
 # Function to create a bordered container with a given title and content
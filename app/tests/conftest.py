@@ -0,0 +1,116 @@
+import asyncio
+import json
+import os
+import re
+import sys
+import tempfile
+import types
+
+import pytest
+from langchain_core.messages import AIMessage
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+# the shared stores of qa_agent are created at import time, keep them out of the working directory
+_store_dir = tempfile.mkdtemp(prefix="qa_agent_tests_")
+for name in ("QA_CHECKPOINT_PATH", "QA_DOCUMENT_STORE_PATH", "QA_JOB_STORE_PATH",
+             "QA_METRICS_PATH", "QA_RESPONSE_CACHE_PATH", "QA_RUN_REGISTRY_PATH"):
+    os.environ.setdefault(name, os.path.join(_store_dir, name.lower()[3:].replace("_path", ".sqlite")))
+os.environ.setdefault("QA_EXPORT_DIR", os.path.join(_store_dir, "exports"))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+try:
+    import qa_agent.cl_agent  # noqa: F401
+except ImportError:
+    # the assistant executors are not part of this repository, the tests use their own stub assistants
+    cl_agent = types.ModuleType("qa_agent.cl_agent")
+    cl_agent.OpenAIAssistantExecuters = None
+    sys.modules["qa_agent.cl_agent"] = cl_agent
+
+
+class StubAssistant:
+    """
+    response_cache.aget_query_chain answering like the assistants, shaped after the prompt. Every prompt of a
+    scenario carries its name "scenario-<n>": stage 1 puts it into the titles of the test cases.
+    delays are keyed by scenario or by (scenario, kind of answer).
+    """
+    tests_per_scenario = 3
+
+    def __init__(self, delays: dict = None):
+        self.delays = delays or {}
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @staticmethod
+    def kind(prompt: str) -> str:
+        if re.search(r"## Test Case \d+:", prompt):
+            return "batch"
+        if "Component level or End-to-End" in prompt:
+            return "classification"
+        if "Generate comprehensive test case details" in prompt or "Generate UI test case details" in prompt:
+            return "details"
+        return "test_list"
+
+    def answer(self, prompt: str, kind: str, scenario: int) -> dict:
+        if kind == "batch":
+            return {"test_types": [{"index": int(index), "Test_Type": "Component", "Reason": "one service"}
+                                   for index in re.findall(r"## Test Case (\d+):", prompt)]}
+        if kind == "classification":
+            return {"Test_Type": "Component", "Reason": "one service"}
+        if kind == "details":
+            return {"test_list": [{"Test_Steps": "Call the endpoint", "Request_Body": {"name": "x"},
+                                   "Response": {"status": 200}, "Expected_Result": "It is saved"}]}
+        return {"test_list": [{"Title": f"scenario-{scenario} test {i}", "Type": "Functional",
+                               "Pre_Conditions": "The user is logged in"}
+                              for i in range(1, self.tests_per_scenario + 1)]}
+
+    @staticmethod
+    def inputs(count: int) -> dict:
+        """
+        Graph inputs with count scenarios named for the stub.
+        """
+        scenario_list = [(i, (f"scenario-{i} works", f"scenario-{i} is saved")) for i in range(1, count + 1)]
+        return {"scenario_list": scenario_list, "current_scenario": scenario_list[0], "tech_stack": "Back End",
+                "attachments": []}
+
+    async def aget_query_chain(self, assist, assistant_id, query_input):
+        prompt = query_input["promptInput"]["query"]
+        scenario = int(re.search(r"scenario-(\d+)", prompt).group(1))
+        kind = self.kind(prompt)
+        self.calls.append((scenario, kind))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delays.get((scenario, kind), self.delays.get(scenario, 0.001)))
+            answer = self.answer(prompt, kind, scenario)
+        finally:
+            self.in_flight -= 1
+        thread_id = query_input.get("threadID") or f"thread_{scenario}_{len(self.calls)}"
+        return {"agent_output": {"thread_id": thread_id, "run_id": f"run_{len(self.calls)}",
+                                 "output": json.dumps(answer), "model": "gpt-4o",
+                                 "usage": {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20}},
+                "query": answer}
+
+
+async def finished_reflection(prompt, tool, messages):
+    return AIMessage(content="", tool_calls=[{"name": "Reflection", "args": {"Finished": True}, "id": "call_1"}])
+
+
+@pytest.fixture
+def assistant(monkeypatch):
+    """
+    StubAssistant in place of the assistants, reflections finish at once.
+    """
+    from qa_agent import output_validator
+    from qa_agent.model_routing import routing_policy
+    from qa_agent.response_cache import response_cache
+
+    assistant = StubAssistant()
+    monkeypatch.setattr(response_cache, "aget_query_chain", assistant.aget_query_chain)
+    monkeypatch.setattr(routing_policy, "areflect", finished_reflection)
+    monkeypatch.setattr(output_validator, "coverage_reflection", False)
+    return assistant
+
@@ -0,0 +1,109 @@
+import asyncio
+import operator
+from typing import Annotated, TypedDict
+
+import pytest
+from langgraph.graph import END, StateGraph
+
+from qa_agent.checkpoint_store import CheckpointStore, run_config
+
+
+class CountState(TypedDict):
+    steps: Annotated[list, operator.add]
+    fail_at: int
+
+
+def counting_graph(checkpointer):
+    builder = StateGraph(CountState)
+
+    def step(state: CountState):
+        if len(state["steps"]) == state.get("fail_at"):
+            raise RuntimeError("worker died")
+        return {"steps": [len(state["steps"])]}
+
+    builder.add_node("step", step)
+    builder.set_entry_point("step")
+    builder.add_conditional_edges("step", lambda state: END if len(state["steps"]) >= 4 else "step")
+    return builder.compile(checkpointer=checkpointer)
+
+
+def run(coroutine_function, tmp_path):
+    """
+    coroutine_function(store, path) on a fresh store, its connections closed afterwards.
+    """
+    async def main():
+        store = CheckpointStore()
+        try:
+            return await coroutine_function(store, str(tmp_path / "checkpoints.sqlite"))
+        finally:
+            await store.aclose()
+
+    return asyncio.run(main())
+
+
+async def count_checkpoints(saver, thread_id: str) -> int:
+    async with saver.conn.execute("SELECT COUNT(*) FROM checkpoints WHERE thread_id = ?", (thread_id,)) as cursor:
+        return (await cursor.fetchone())[0]
+
+
+def test_run_config_points_at_the_run_thread():
+    config = run_config(7, {"recursion_limit": 100, "configurable": {"run_id": "batch"}})
+    assert config == {"recursion_limit": 100, "configurable": {"run_id": "batch", "thread_id": "7"}}
+
+
+def test_one_saver_per_database_and_loop(tmp_path):
+    async def check(store, path):
+        first, second = await asyncio.gather(store.saver(path), store.saver(path))
+        assert first is second
+        async with first.conn.execute("PRAGMA journal_mode") as cursor:
+            assert (await cursor.fetchone())[0] == "wal"
+
+    run(check, tmp_path)
+
+
+def test_interrupted_runs_continue_from_their_latest_checkpoint(tmp_path):
+    async def check(store, path):
+        graph = counting_graph(await store.saver(path))
+        config = run_config("run-1")
+        with pytest.raises(RuntimeError):
+            await graph.ainvoke({"steps": [], "fail_at": 2}, config)
+        assert (await graph.aget_state(config)).values["steps"] == [0, 1]
+
+        await graph.aupdate_state(config, {"fail_at": -1})
+        final = await graph.ainvoke(None, config)
+        assert final["steps"] == [0, 1, 2, 3]
+
+    run(check, tmp_path)
+
+
+def test_prune_keeps_the_latest_checkpoint(tmp_path):
+    async def check(store, path):
+        saver = await store.saver(path)
+        graph = counting_graph(saver)
+        config = run_config("run-1")
+        await graph.ainvoke({"steps": [], "fail_at": -1}, config)
+        assert await count_checkpoints(saver, "run-1") > 1
+
+        await store.prune("run-1", path, finished=True)
+        assert await count_checkpoints(saver, "run-1") == 1
+        assert (await graph.aget_state(config)).values["steps"] == [0, 1, 2, 3]
+
+    run(check, tmp_path)
+
+
+def test_runs_past_the_retention_expire(tmp_path):
+    async def check(store, path):
+        saver = await store.saver(path)
+        graph = counting_graph(saver)
+        for run_id in ("run-1", "run-1-scenario-1", "run-2"):
+            await graph.ainvoke({"steps": [], "fail_at": -1}, run_config(run_id))
+        assert [thread_id for thread_id, _ in await store.runs(path, prefix="run-1")] == ["run-1-scenario-1", "run-1"]
+
+        # at most once per EXPIRE_INTERVAL unless forced
+        store.retention = 0
+        assert await store.expire(path) == 3
+        assert await store.expire(path) == 0
+        assert await store.runs(path) == []
+        assert await count_checkpoints(saver, "run-2") == 0
+
+    run(check, tmp_path)
@@ -0,0 +1,129 @@
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from openai import NotFoundError
+
+from qa_agent.document_store import DocumentStore
+
+
+class FakeFiles:
+    """
+    OpenAI files endpoint keeping the uploaded file ids in memory.
+    """
+
+    def __init__(self):
+        self.live = set()
+        self.created = 0
+        self.fail_delete = False
+
+    def create(self, file, purpose):
+        self.created += 1
+        file_id = f"file_{self.created}"
+        self.live.add(file_id)
+        return SimpleNamespace(id=file_id)
+
+    def retrieve(self, file_id):
+        if file_id not in self.live:
+            response = httpx.Response(404, request=httpx.Request("GET", f"http://openai.test/v1/files/{file_id}"))
+            raise NotFoundError("file not found", response=response, body=None)
+        return SimpleNamespace(id=file_id)
+
+    def delete(self, file_id):
+        if self.fail_delete:
+            raise RuntimeError("server error")
+        self.live.discard(file_id)
+
+
+@pytest.fixture
+def files():
+    return FakeFiles()
+
+
+@pytest.fixture
+def store(tmp_path, files):
+    store = DocumentStore(str(tmp_path / "documents.sqlite"), ttl=0, lease_ttl=3600,
+                          client=SimpleNamespace(files=files))
+    # release collects only where a test calls collect_garbage
+    store._last_gc = time.time()
+    return store
+
+
+def refcount(store, file_id):
+    return store._execute("SELECT refcount FROM documents WHERE file_id = ?", (file_id,))[0][0]
+
+
+def test_identical_bytes_are_uploaded_once(store, files):
+    first = store.acquire("design.pdf", b"design")
+    second = store.acquire("copy of design.pdf", b"design")
+    other = store.acquire("frd.pdf", b"frd")
+    assert first == second != other
+    assert files.created == 2 and (store.uploaded, store.reused) == (2, 1)
+    assert refcount(store, first) == 2
+
+
+def test_acquire_many_keeps_the_order(store):
+    file_ids = store.acquire_many([(f"doc{i}.pdf", f"doc {i}".encode()) for i in range(8)])
+    assert len(set(file_ids)) == 8
+    assert [store.acquire(f"doc{i}.pdf", f"doc {i}".encode()) for i in range(8)] == file_ids
+
+
+def test_referenced_files_are_never_collected(store, files):
+    file_id = store.acquire("design.pdf", b"design")
+    time.sleep(0.01)
+    store.collect_garbage()
+    assert file_id in files.live
+
+    store.release([file_id])
+    time.sleep(0.01)
+    store.collect_garbage()
+    assert file_id not in files.live
+    assert store._execute("SELECT * FROM documents") == []
+
+
+def test_leaked_references_only_delay_collection(store, files):
+    store.lease_ttl = 0
+    store.ttl = 3600
+    file_id = store.acquire("design.pdf", b"design")
+    time.sleep(0.01)
+    store.collect_garbage()
+    # the lease expired, the file is kept unused for another TTL
+    assert file_id in files.live and refcount(store, file_id) == 0
+
+
+def test_release_does_not_go_below_zero(store):
+    file_id = store.acquire("design.pdf", b"design")
+    store.release([file_id, file_id])
+    assert refcount(store, file_id) == 0
+
+
+def test_files_being_collected_are_uploaded_again(store, files):
+    file_id = store.acquire("design.pdf", b"design")
+    store.release([file_id])
+    # collect_garbage claimed the row and is deleting the file
+    store._execute("UPDATE documents SET refcount = -1 WHERE file_id = ?", (file_id,))
+    new_file_id = store.acquire("design.pdf", b"design")
+    assert new_file_id != file_id and refcount(store, new_file_id) == 1
+    # the collection which claimed the old file does not remove the new row
+    store._execute("DELETE FROM documents WHERE file_id = ?", (file_id,))
+    assert refcount(store, new_file_id) == 1
+
+
+def test_failed_deletes_are_tried_again(store, files):
+    file_id = store.acquire("design.pdf", b"design")
+    store.release([file_id])
+    files.fail_delete = True
+    time.sleep(0.01)
+    store.collect_garbage()
+    assert refcount(store, file_id) == 0
+
+    files.fail_delete = False
+    store.collect_garbage()
+    assert file_id not in files.live
+
+
+def test_files_deleted_elsewhere_are_uploaded_again(store, files):
+    file_id = store.acquire("design.pdf", b"design")
+    files.live.discard(file_id)
+    assert store.acquire("design.pdf", b"design") != file_id
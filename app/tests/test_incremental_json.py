@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+from qa_agent.incremental_json import ArrayItemParser, parse_answer
+
+test_list = [
+    {"Title": "Saves an order", "Request_Body": {"items": [{"id": 1}], "note": "a \"quoted\" } brace"}},
+    {"Title": "Rejects [an] empty order", "Response": {"status": 400}},
+    {"Title": "Escaped backslash \\", "Tags": []},
+]
+answer = json.dumps({"summary": {"test_list": [{"Title": "not the target"}]}, "test_list": test_list}, indent=2)
+
+
+def feed_in_chunks(parser: ArrayItemParser, text: str, size: int) -> list:
+    completed = []
+    for i in range(0, len(text), size):
+        completed.extend(parser.feed(text[i:i + size]))
+    return completed
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 64, len(answer)])
+def test_items_are_returned_as_they_close_whatever_the_chunks(size):
+    parser = ArrayItemParser()
+    assert feed_in_chunks(parser, answer, size) == test_list
+    assert parser.items == test_list
+    assert parser.text == answer
+    assert parser.result() == json.loads(answer)
+
+
+def test_each_item_is_returned_by_the_chunk_which_closes_it():
+    parser = ArrayItemParser()
+    first = json.dumps(test_list[0])
+    assert parser.feed('Here you go:\n```json\n{"test_list": [' + first[:-1]) == []
+    assert parser.feed(first[-1] + ", ") == [test_list[0]]
+    assert parser.feed(json.dumps(test_list[1]) + "]}\n```") == [test_list[1]]
+
+
+def test_the_outermost_array_for_key_none():
+    parser = ArrayItemParser(key=None)
+    assert feed_in_chunks(parser, json.dumps(test_list), 3) == test_list
+    assert parser.result() == test_list
+
+
+def test_a_truncated_answer_keeps_the_complete_items():
+    text = json.dumps({"test_list": test_list})
+    parser = ArrayItemParser()
+    feed_in_chunks(parser, text[:text.index("Escaped")], 5)
+    assert parser.result() == {"test_list": test_list[:2], "truncated": True}
+    assert ArrayItemParser().result() is None
+    parser = ArrayItemParser(key=None)
+    parser.feed(json.dumps(test_list)[:-10])
+    assert parser.result() == test_list[:2]
+
+
+def test_invalid_items_are_skipped():
+    parser = ArrayItemParser()
+    parser.feed('{"test_list": [{"Title": 01}, {"Title": "valid"}')
+    assert parser.items == [{"Title": "valid"}]
+
+
+def test_only_the_open_item_is_kept_aside():
+    parser = ArrayItemParser()
+    feed_in_chunks(parser, '{"test_list": [' + json.dumps(test_list[0]) + ', {"Title": "op', 4)
+    assert "".join(parser._item_parts) == '{"Title": "op'
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"test_list": []}', {"test_list": []}),
+    ('Sure!\n```json\n{"a": 1}\n```\nAnything else?', {"a": 1}),
+    ('```\nnot json\n```\n```JSON\n[1, 2]\n```', [1, 2]),
+    ('The answer is {"a": [1, 2]} as requested.', {"a": [1, 2]}),
+    ("no JSON here", None),
+    ('{"a": ', None),
+    (None, None),
+])
+def test_parse_answer(text, expected):
+    assert parse_answer(text) == expected
@@ -0,0 +1,222 @@
+import asyncio
+import os
+import sqlite3
+import subprocess
+import sys
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from qa_agent import job_runner as job_runner_module
+from qa_agent.job_runner import (JobRejected, JobRunner, JobStore, _run_job, describe_timing, max_job_attempts,
+                                 partial_state)
+from qa_agent.progress import ScenarioStarted, TokensUsed
+
+
+def generation_inputs(count: int = 2, file_ids=()) -> dict:
+    scenario_list = [(i, (f"scenario-{i} works", f"scenario-{i} is saved")) for i in range(1, count + 1)]
+    return {"scenario_list": scenario_list, "current_scenario": scenario_list[0], "tech_stack": "Back End",
+            "attachments": [{"file_id": file_id, "tools": [{"type": "file_search"}]} for file_id in file_ids]}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.sqlite"))
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def test_admission_limits(store):
+    store.admit(generation_inputs(), {}, "ann", os.getpid(), max_pending=3, max_per_owner=2)
+    store.admit(generation_inputs(), {}, "ann", os.getpid(), max_pending=3, max_per_owner=2)
+    with pytest.raises(JobRejected, match="You already have 2"):
+        store.admit(generation_inputs(), {}, "ann", os.getpid(), max_pending=3, max_per_owner=2)
+    store.admit(generation_inputs(), {}, "bob", os.getpid(), max_pending=3, max_per_owner=2)
+    with pytest.raises(JobRejected, match="3 generation jobs are already waiting"):
+        store.admit(generation_inputs(), {}, "cat", os.getpid(), max_pending=3, max_per_owner=2)
+    assert store.counts() == {"queued": 3, "running": 0}
+
+
+def test_events_results_and_queue_position(store):
+    first = store.admit(generation_inputs(), {}, "ann", os.getpid(), 8, 8)
+    second = store.admit(generation_inputs(), {}, "ann", os.getpid(), 8, 8)
+    assert (store.position(first), store.position(second)) == (0, 1)
+    assert store.active("ann") == [second, first]
+
+    store.add_event(first, ScenarioStarted(1, "Login works", 2))
+    store.add_event(first, TokensUsed(1, "assist_stage1", 20, 0.01, 0.25))
+    events = store.events(first)
+    assert [event["kind"] for event in events] == ["ScenarioStarted"]
+    assert store.events(first, after=events[-1]["id"]) == []
+    job = store.get(first)
+    assert job["label"] == events[0]["label"] and job["cost"] == 0.25
+
+    store.add_result(first, 2, ("b", "c"), [{"Title": "later"}])
+    store.add_result(first, 1, ("a", "b"), [{"Title": "first"}])
+    assert [test_cases[0]["Title"] for _, test_cases in store.results(first)] == ["first", "later"]
+
+    store.add_result(first, 3, "c", [], 2.5, "assistant down")
+    assert len(store.results(first)) == 2
+    assert store.failures(first) == [(3, "c", "assistant down")]
+    # a scenario which succeeds on a restart replaces its failure
+    store.add_result(first, 3, "c", [{"Title": "third"}], 1.0)
+    assert store.failures(first) == [] and len(store.results(first)) == 3
+
+
+def test_results_of_an_older_store_get_the_new_columns(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE job_results (job_id TEXT, scenario_id INTEGER, scenario TEXT, test_cases TEXT, "
+                 "PRIMARY KEY (job_id, scenario_id))")
+    conn.execute("INSERT INTO job_results VALUES ('job', 1, 'a', '[]')")
+    conn.commit()
+    conn.close()
+    store = JobStore(path)
+    store.add_result("job", 2, "b", [], 1.5, "boom")
+    assert store.results("job") == [("a", [])] and store.failures("job") == [(2, "b", "boom")]
+
+
+def test_finished_jobs_expire(store):
+    job_id = store.admit(generation_inputs(), {}, "ann", os.getpid(), 8, 8)
+    store.add_result(job_id, 1, "scenario", [])
+    store.finish(job_id, "done")
+    assert store.expire(retention=-1) == 1
+    assert store.get(job_id) is None and store.results(job_id) == []
+
+
+def test_jobs_of_a_dead_server_process_are_claimed(store):
+    orphan = store.admit(generation_inputs(), {}, "ann", dead_pid(), 8, 8)
+    mine = store.admit(generation_inputs(), {}, "ann", os.getpid(), 8, 8)
+    assert store.orphaned(os.getpid()) == [orphan]
+    assert store.get(orphan)["runner_pid"] == os.getpid() and store.get(mine)["status"] == "queued"
+
+
+@pytest.fixture
+def runner(store, monkeypatch):
+    """
+    JobRunner on the test store which records dispatches and released documents instead of running workers.
+    """
+    runner = JobRunner(store.path)
+    runner.dispatched = []
+    runner.released = []
+    monkeypatch.setattr(runner, "_dispatch", lambda job_id, pool: runner.dispatched.append(job_id))
+    monkeypatch.setattr(runner, "_pool", lambda: "new pool")
+    monkeypatch.setattr(job_runner_module.document_store, "release", runner.released.extend)
+    return runner
+
+
+def failed_future(error: BaseException) -> Future:
+    future = Future()
+    future.set_exception(error)
+    return future
+
+
+def test_a_job_which_lost_its_worker_is_started_again(runner):
+    job_id = runner.store.admit(generation_inputs(file_ids=["file_1"]), {}, "ann", os.getpid(), 8, 8)
+    runner.store.start(job_id, 123)
+    runner._done(job_id, "pool", failed_future(BrokenProcessPool("worker killed")))
+
+    assert runner.dispatched == [job_id]
+    assert runner.store.get(job_id)["status"] == "queued" and runner.released == []
+
+
+def test_a_job_out_of_attempts_fails_and_releases_its_documents(runner):
+    job_id = runner.store.admit(generation_inputs(file_ids=["file_1", "file_2"]), {}, "ann", os.getpid(), 8, 8)
+    for _ in range(max_job_attempts):
+        runner.store.start(job_id, 123)
+    runner._done(job_id, "pool", failed_future(BrokenProcessPool("worker killed")))
+
+    job = runner.store.get(job_id)
+    assert (job["status"], job["error"]) == ("failed", "worker killed")
+    assert runner.dispatched == [] and runner.released == ["file_1", "file_2"]
+
+
+def test_documents_of_a_finished_job_are_not_released_twice(runner):
+    job_id = runner.store.admit(generation_inputs(file_ids=["file_1"]), {}, "ann", os.getpid(), 8, 8)
+    # the worker released them itself when it finished
+    runner.store.finish(job_id, "failed", "assistant down")
+    runner._done(job_id, "pool", failed_future(RuntimeError("pickling error")))
+    assert runner.released == []
+
+
+def test_a_worker_runs_the_job_to_completion(store, assistant, monkeypatch):
+    released = []
+    monkeypatch.setattr(job_runner_module.document_store, "release", released.extend)
+    job_id = store.admit(generation_inputs(2, file_ids=["file_1"]), {"workers": 2}, "ann", os.getpid(), 8, 8)
+    asyncio.run(_run_job(store, job_id))
+
+    job = store.get(job_id)
+    assert job["status"] == "done" and job["error"] is None and job["attempts"] == 1
+    results = store.results(job_id)
+    assert [len(test_cases) for _, test_cases in results] == [assistant.tests_per_scenario] * 2
+    kinds = [event["kind"] for event in store.events(job_id)]
+    assert kinds.count("ScenarioStarted") == 2 and kinds.count("ScenarioFinished") == 2
+    assert released == ["file_1"]
+    timing = store.timing(job_id)
+    assert timing["scenarios"] == 2 and 0 < timing["scenario_seconds"]
+    assert timing["wall_seconds"] > 0 and timing["speedup"] == timing["scenario_seconds"] / timing["wall_seconds"]
+
+
+def test_timing_describes_the_speedup(store):
+    job_id = store.admit(generation_inputs(3), {}, "ann", os.getpid(), 8, 8)
+    assert store.timing(job_id)["scenarios"] == 0
+    store.start(job_id, os.getpid())
+    store.add_result(job_id, 1, "a", [], 30.0)
+    store.add_result(job_id, 2, "b", [], 30.0)
+    store.add_result(job_id, 3, "c", [], 5.0, "assistant down")
+    store.finish(job_id, "partial")
+    store._execute("UPDATE jobs SET started_at = finished_at - 20 WHERE job_id = ?", (job_id,))
+    timing = store.timing(job_id)
+    assert timing == pytest.approx({"scenarios": 2, "wall_seconds": 20.0, "scenario_seconds": 60.0, "speedup": 3.0})
+    assert describe_timing(timing, 3) == "Finished 2/3 scenarios in 20s (sequential estimate 60s, speedup 3.0x)"
+
+
+def failing_scenario(monkeypatch, failing: set):
+    """
+    Graphs of QAGraph whose runs of the failing scenario ids raise.
+    """
+    from qa_agent.tc_graph import QAGraph
+
+    original = QAGraph.aget_sqlite_graph
+
+    async def aget_sqlite_graph(self):
+        graph = await original(self)
+        ainvoke = graph.ainvoke
+
+        async def failing_ainvoke(inputs, config, **kwargs):
+            if any(config["configurable"]["thread_id"].endswith(f"-scenario-{i}") for i in failing):
+                raise RuntimeError("assistant down")
+            return await ainvoke(inputs, config, **kwargs)
+
+        graph.ainvoke = failing_ainvoke
+        return graph
+
+    monkeypatch.setattr(QAGraph, "aget_sqlite_graph", aget_sqlite_graph)
+
+
+def test_failed_scenarios_are_recorded_and_the_job_is_partial(store, assistant, monkeypatch):
+    monkeypatch.setattr(job_runner_module.document_store, "release", lambda file_ids: None)
+    failing_scenario(monkeypatch, {2})
+    job_id = store.admit(generation_inputs(3), {"workers": 2}, "ann", os.getpid(), 8, 8)
+    asyncio.run(_run_job(store, job_id))
+
+    job = store.get(job_id)
+    assert job["status"] == partial_state
+    assert job["error"] == "1 of 3 scenarios failed: scenario 2: assistant down"
+    assert [scenario for scenario, _ in store.results(job_id)] == ["scenario-1 works", "scenario-3 works"]
+    assert store.failures(job_id) == [(2, "scenario-2 works", "assistant down")]
+    failed = [event for event in store.events(job_id) if event["kind"] == "ScenarioFailed"]
+    assert [event["scenario_id"] for event in failed] == [2]
+
+
+def test_a_job_whose_scenarios_all_failed_fails(store, assistant, monkeypatch):
+    monkeypatch.setattr(job_runner_module.document_store, "release", lambda file_ids: None)
+    failing_scenario(monkeypatch, {1, 2})
+    job_id = store.admit(generation_inputs(2), {"workers": 2}, "ann", os.getpid(), 8, 8)
+    asyncio.run(_run_job(store, job_id))
+    assert store.get(job_id)["status"] == "failed" and store.results(job_id) == []
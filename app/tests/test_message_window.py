@@ -0,0 +1,49 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+from qa_agent.message_window import MessageArchive, archive_run, windowed_messages
+
+
+def conversation(start: int, count: int) -> list:
+    return [HumanMessage(content=f"message {i}") for i in range(start, start + count)]
+
+
+def contents(messages) -> list[str]:
+    return [message.content for message in messages]
+
+
+def test_appends_while_the_window_has_room():
+    reducer = windowed_messages(4)
+    assert contents(reducer(conversation(0, 2), conversation(2, 2))) == [f"message {i}" for i in range(4)]
+    assert reducer(None, None) == []
+
+
+def test_keeps_the_last_messages():
+    reducer = windowed_messages(3)
+    history = []
+    for i in range(0, 10, 2):
+        history = reducer(history, conversation(i, 2))
+        assert len(history) <= 3
+    assert contents(history) == ["message 7", "message 8", "message 9"]
+
+
+def test_window_must_keep_a_message():
+    with pytest.raises(ValueError):
+        windowed_messages(0)
+
+
+def test_dropped_messages_are_archived_per_run(tmp_path):
+    archive = MessageArchive(str(tmp_path / "archive.sqlite"))
+    reducer = windowed_messages(2, "tc_graph", archive)
+    with archive_run("run-1"):
+        history = reducer(conversation(0, 2), [AIMessage(content="answer")])
+    with archive_run("run-2"):
+        reducer(history, conversation(10, 2))
+    reducer(history, conversation(20, 3))
+
+    assert contents(archive.load("run-1")) == ["message 0"]
+    assert contents(archive.load("run-2", "tc_graph")) == ["message 1", "answer"]
+    assert archive.load("run-2", "sub_tc_graph") == []
+    # messages dropped outside a run are kept under "unscoped"
+    assert len(archive.load("unscoped")) == 3
+    assert isinstance(archive.load("run-2")[1], AIMessage)
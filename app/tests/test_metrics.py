@@ -0,0 +1,125 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from qa_agent import progress
+from qa_agent.metrics import Metrics, render
+
+
+@pytest.fixture
+def metrics_file(tmp_path):
+    return str(tmp_path / "metrics.sqlite")
+
+
+@pytest.fixture
+def metrics(metrics_file):
+    # the background flush never runs during a test, flush() is called explicitly
+    return Metrics(metrics_file, flush_interval=3600)
+
+
+def samples(text: str) -> dict:
+    return dict(line.rsplit(" ", 1) for line in text.splitlines() if line and not line.startswith("#"))
+
+
+def test_nothing_recorded_renders_empty(metrics_file):
+    assert render(metrics_file) == "\n"
+    Metrics(metrics_file).flush()
+    assert not os.path.exists(metrics_file)
+
+
+def test_counters_are_added_to_the_database_on_flush(metrics, metrics_file):
+    metrics.inc("qa_tokens_total", 100, node="assist_stage1")
+    metrics.inc("qa_tokens_total", 50, node="assist_stage1")
+    metrics.inc("qa_cost_dollars_total", 0.25, node="assist_stage1")
+    assert render(metrics_file) == "\n"
+
+    metrics.flush()
+    metrics.inc("qa_tokens_total", 10, node="assist_stage1")
+    metrics.flush()
+    text = render(metrics_file)
+    assert "# TYPE qa_tokens_total counter" in text
+    assert "# HELP qa_tokens_total Tokens used per node" in text
+    assert samples(text) == {'qa_tokens_total{node="assist_stage1"}': "160",
+                             'qa_cost_dollars_total{node="assist_stage1"}': "0.25"}
+
+
+def test_labels_are_sorted_and_escaped(metrics, metrics_file):
+    metrics.inc("qa_cache_requests_total", result="hit", kind='say "hi"\n')
+    metrics.flush()
+    assert samples(render(metrics_file)) == {
+        'qa_cache_requests_total{kind="say \\"hi\\"\\n",result="hit"}': "1"}
+
+
+def test_histograms_render_cumulative_buckets(metrics, metrics_file):
+    for value in (0, 1, 1, 4, 50):
+        metrics.observe("qa_scenario_revisions", value)
+    metrics.flush()
+    text = render(metrics_file)
+    assert "# TYPE qa_scenario_revisions histogram" in text
+    assert samples(text) == {
+        'qa_scenario_revisions_bucket{le="0"}': "1",
+        'qa_scenario_revisions_bucket{le="1"}': "3",
+        'qa_scenario_revisions_bucket{le="2"}': "3",
+        'qa_scenario_revisions_bucket{le="3"}': "3",
+        'qa_scenario_revisions_bucket{le="5"}': "4",
+        'qa_scenario_revisions_bucket{le="8"}': "4",
+        'qa_scenario_revisions_bucket{le="13"}': "4",
+        'qa_scenario_revisions_bucket{le="20"}': "4",
+        'qa_scenario_revisions_bucket{le="+Inf"}': "5",
+        "qa_scenario_revisions_sum": "56",
+        "qa_scenario_revisions_count": "5",
+    }
+
+
+def test_histogram_labels_come_before_le(metrics, metrics_file):
+    metrics.observe("qa_llm_latency_seconds", 0.3, assistant_id="asst_1", model="gpt-4o")
+    metrics.flush()
+    rendered = samples(render(metrics_file))
+    assert rendered['qa_llm_latency_seconds_bucket{assistant_id="asst_1",model="gpt-4o",le="0.25"}'] == "0"
+    assert rendered['qa_llm_latency_seconds_bucket{assistant_id="asst_1",model="gpt-4o",le="0.5"}'] == "1"
+    assert rendered['qa_llm_latency_seconds_sum{assistant_id="asst_1",model="gpt-4o"}'] == "0.3"
+
+
+def test_gauges_are_rendered_at_scrape_time(metrics_file):
+    text = render(metrics_file, {("qa_runs", (("state", "running"),)): 2, ("qa_runs", (("state", "queued"),)): 0})
+    assert "# TYPE qa_runs gauge" in text
+    assert samples(text) == {'qa_runs{state="running"}': "2", 'qa_runs{state="queued"}': "0"}
+
+
+def test_progress_events_are_counted(metrics, metrics_file):
+    for run_id in ("run-1", "run-2"):
+        metrics.record_event(progress.TokensUsed(1, "assist_stage2", 30, 0.5, 0.5), run_id)
+        metrics.record_event(progress.Revision(1, 1, 1), run_id)
+        metrics.record_event(progress.NodeError(1, "assist_stage2", "timeout"), run_id)
+        metrics.record_event(progress.TestCaseDone(1, 1, 2, "saves", ok=True), run_id)
+        metrics.record_event(progress.TestCaseDone(1, 2, 2, "deletes", ok=False), run_id)
+    # revisions are counted per run and scenario until the scenario finishes
+    metrics.record_event(progress.Revision(1, 2, 2), "run-1")
+    metrics.record_event(progress.ScenarioFinished(1, "saves", []), "run-1")
+    metrics.record_event(progress.ScenarioFinished(1, "saves", []), "run-2")
+    metrics.flush()
+    rendered = samples(render(metrics_file))
+    assert rendered['qa_tokens_total{node="assist_stage2"}'] == "60"
+    assert rendered['qa_cost_dollars_total{node="assist_stage2"}'] == "1"
+    assert rendered['qa_revisions_total{stage="1"}'] == "2"
+    assert rendered['qa_revisions_total{stage="2"}'] == "1"
+    assert rendered['qa_node_errors_total{node="assist_stage2"}'] == "2"
+    assert rendered['qa_test_cases_total{result="done"}'] == "2"
+    assert rendered['qa_test_cases_total{result="gave_up"}'] == "2"
+    assert rendered["qa_scenarios_total"] == "2"
+    assert rendered["qa_scenario_revisions_sum"] == "3"
+    assert rendered['qa_scenario_revisions_bucket{le="1"}'] == "1"
+    assert rendered['qa_scenario_revisions_bucket{le="2"}'] == "2"
+
+
+def test_processes_add_to_the_same_totals(metrics, metrics_file):
+    metrics.inc("qa_scenarios_total")
+    metrics.flush()
+    script = ("import sys; from qa_agent.metrics import Metrics; "
+              "m = Metrics(sys.argv[1]); m.inc('qa_scenarios_total', 2)")
+    # the worker never flushes itself, its totals are written when it exits
+    subprocess.run([sys.executable, "-c", script, metrics_file], check=True,
+                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert samples(render(metrics_file)) == {"qa_scenarios_total": "3"}
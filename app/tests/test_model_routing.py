@@ -0,0 +1,122 @@
+import asyncio
+import json
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.pydantic_v1 import BaseModel, Field
+
+from qa_agent import model_routing
+from qa_agent.model_routing import REFLECTION, STAGE1, STAGE2, Route, RoutingPolicy, default_routes, load_routes
+
+
+class Reflection(BaseModel):
+    """Reflection and Followup"""
+    Finished: bool = Field(description="Whether the task is finished.")
+    follow_up_question: str = Field(description="Follow up question when it is not.")
+
+
+prompt = ChatPromptTemplate.from_messages([("system", "Check the answer."), MessagesPlaceholder(variable_name="messages")])
+
+
+def reflection(finished: bool, cached: bool = False) -> AIMessage:
+    metadata = {"cached": True} if cached else {"token_usage": {"prompt_tokens": 1000, "completion_tokens": 1000}}
+    return AIMessage(content="", response_metadata=metadata, tool_calls=[
+        {"name": "Reflection", "args": {"Finished": finished, "follow_up_question": "Add more"}, "id": "call_1"}])
+
+
+@pytest.fixture
+def policy():
+    return RoutingPolicy({**default_routes, REFLECTION: Route("gpt-4o-mini", "gpt-4-turbo")})
+
+
+@pytest.fixture
+def reflections(monkeypatch):
+    """
+    Verdicts answered per model, the models called are recorded in order.
+    """
+    verdicts, called = {}, []
+
+    def invoke_reflection(chain, model, messages):
+        called.append(model)
+        return verdicts[model]
+
+    async def ainvoke_reflection(chain, model, messages):
+        return invoke_reflection(chain, model, messages)
+
+    monkeypatch.setattr(model_routing.response_cache, "ainvoke_reflection", ainvoke_reflection)
+    monkeypatch.setattr(model_routing.response_cache, "invoke_reflection", invoke_reflection)
+    return verdicts, called
+
+
+def test_routes_merge_over_the_defaults(tmp_path):
+    assert load_routes(None) == default_routes
+    routes = load_routes(json.dumps({"reflection": {"primary": "gpt-4o"}, "stage2": {"escalation": "asst_strong"},
+                                     "stage1": "asst_other", "review": {"primary": "gpt-4.1"}}))
+    assert routes[REFLECTION] == Route("gpt-4o", "gpt-4-turbo")
+    assert routes[STAGE2] == Route(default_routes[STAGE2].primary, "asst_strong")
+    assert routes[STAGE1] == Route("asst_other")
+    assert routes["review"] == Route("gpt-4.1")
+    path = tmp_path / "routes.json"
+    path.write_text(json.dumps({"stage1": "asst_file"}))
+    assert load_routes(str(path))[STAGE1] == Route("asst_file")
+
+
+def test_assistant_escalates_only_when_there_is_an_escalation(policy):
+    policy.routes[STAGE2] = Route("asst_cheap", "asst_strong")
+    assert policy.assistant_id(STAGE2) == "asst_cheap"
+    assert policy.assistant_id(STAGE2, escalate=True) == "asst_strong"
+    assert policy.assistant_id(STAGE1, escalate=True) == default_routes[STAGE1].primary
+
+
+def test_reflection_chains_and_models_are_built_once(policy):
+    chain = policy.reflection_chain(prompt, Reflection, "gpt-4o-mini")
+    assert policy.reflection_chain(prompt, Reflection, "gpt-4o-mini") is chain
+    assert policy.reflection_chain(prompt, Reflection, "gpt-4-turbo") is not chain
+    assert policy.chat_model("gpt-4o-mini") is policy.chat_model("gpt-4o-mini")
+
+
+def test_finished_reflection_is_not_escalated(policy, reflections):
+    verdicts, called = reflections
+    verdicts["gpt-4o-mini"] = reflection(True)
+    res = asyncio.run(policy.areflect(prompt, Reflection, [HumanMessage(content="answer")]))
+    assert res is verdicts["gpt-4o-mini"] and called == ["gpt-4o-mini"]
+    stats = policy.summary()[REFLECTION]
+    assert stats["calls"] == 1 and stats["escalated"] == 0
+    # 2000 tokens of gpt-4o-mini
+    assert stats["cost"] == pytest.approx(0.0003)
+
+
+def test_negative_reflection_is_checked_again_on_the_escalation_model(policy, reflections):
+    verdicts, called = reflections
+    verdicts["gpt-4o-mini"] = reflection(False)
+    verdicts["gpt-4-turbo"] = reflection(True, cached=True)
+    res = asyncio.run(policy.areflect(prompt, Reflection, [HumanMessage(content="answer")]))
+    assert res is verdicts["gpt-4-turbo"] and called == ["gpt-4o-mini", "gpt-4-turbo"]
+    assert policy.reflect(prompt, Reflection, [HumanMessage(content="answer")]) is res
+    stats = policy.summary()[REFLECTION]
+    assert (stats["calls"], stats["escalated"], stats["escalation_rate"]) == (4, 2, 0.5)
+    assert stats["models"] == {"gpt-4o-mini": 2, "gpt-4-turbo": 2}
+    # the cached answers of the escalation model cost nothing
+    assert stats["cost"] == pytest.approx(0.0006)
+
+
+def test_without_escalation_the_primary_verdict_stands(reflections):
+    verdicts, called = reflections
+    verdicts["gpt-4o"] = reflection(False)
+    policy = RoutingPolicy({**default_routes, REFLECTION: Route("gpt-4o")})
+    assert asyncio.run(policy.areflect(prompt, Reflection, [])) is verdicts["gpt-4o"]
+    assert called == ["gpt-4o"]
+
+
+def test_record_output_uses_the_usage_of_the_run(policy):
+    policy.routes[STAGE2] = Route("asst_cheap", "asst_strong")
+    out = {"agent_output": {"usage": {"prompt_tokens": 500, "completion_tokens": 500}, "model": "gpt-4o"}}
+    policy.record_output(STAGE2, "asst_strong", 2.0, out)
+    policy.record_output(STAGE2, "asst_cheap", 1.0, {**out, "cached": True})
+    policy.record_output(STAGE2, "asst_cheap", 0.0, None)
+    stats = policy.summary()[STAGE2]
+    assert (stats["calls"], stats["escalated"], stats["mean_seconds"]) == (3, 1, 1.0)
+    assert stats["cost"] == pytest.approx(0.005)
+    policy.reset_stats()
+    assert policy.summary() == {}
@@ -0,0 +1,107 @@
+import pytest
+from langchain_core.messages import AIMessage
+
+from qa_agent import output_validator
+from qa_agent.output_validator import (FINE, NEEDS_LLM, RETRY, is_truncated, validate_scenarios,
+                                       validate_test_details, validate_test_list, validate_test_types)
+
+
+def make_test_case(i: int, **fields) -> dict:
+    return {"Title": f"Saves order {i}", "Type": "Functional", "Pre_Conditions": "The user is logged in", **fields}
+
+
+def make_test_list(count: int) -> list[dict]:
+    return [make_test_case(i) for i in range(1, count + 1)]
+
+
+back_end_details = {"Expected_Result": "The order is saved", "Request_Body": {"id": 1}, "Response": {"status": 200}}
+front_end_details = {"Test_Steps": ["Open the cart", "Click order"], "Expected_Result": "The order is shown"}
+
+
+@pytest.fixture(autouse=True)
+def no_coverage_reflection(monkeypatch):
+    monkeypatch.setattr(output_validator, "coverage_reflection", False)
+
+
+def test_complete_test_list_is_fine():
+    validation = validate_test_list("{}", make_test_list(3))
+    assert validation.verdict == FINE and validation.follow_up is None
+
+
+def test_complete_test_list_goes_to_coverage_reflection(monkeypatch):
+    monkeypatch.setattr(output_validator, "coverage_reflection", True)
+    assert validate_test_list("{}", make_test_list(3)).verdict == NEEDS_LLM
+
+
+def test_pre_condition_spelling_and_tuples_are_accepted():
+    entries = [(i, {"Title": f"Case {i}", "Type": "Negative", "Pre_Condition": ["Logged in"]}) for i in range(3)]
+    assert validate_test_list("{}", entries).verdict == FINE
+
+
+@pytest.mark.parametrize("entries, reason", [
+    (make_test_list(2), "2 test cases"),
+    (make_test_list(41), "41 test cases"),
+    ([make_test_case(1), make_test_case(1), make_test_case(2)], "duplicate test case titles"),
+    (make_test_list(3) + [make_test_case(4, Title=" ")], "1 of 4 test cases are incomplete"),
+])
+def test_undecided_test_lists_need_the_reflection_model(entries, reason):
+    assert validate_test_list("{}", entries) == output_validator.Validation(NEEDS_LLM, reason)
+
+
+def test_revision_always_needs_the_reflection_model():
+    assert validate_test_list("{}", make_test_list(3), revision=True).verdict == NEEDS_LLM
+
+
+def test_mostly_broken_or_empty_lists_are_sent_back():
+    placeholder = {"Title": "error", "Type": "error", "Pre_Conditions": "error"}
+    validation = validate_test_list("{}", [placeholder, {"Title": "Saves"}, make_test_case(1)])
+    assert validation.verdict == RETRY
+    assert "entry 1 is empty" in validation.follow_up
+    assert "entry 2 is missing or has an empty Pre_Conditions, Type" in validation.follow_up
+    assert validate_test_list("{}", []).verdict == RETRY
+    assert validate_test_list("{}", ["not an object"]).follow_up.startswith(
+        "Your previous answer is incomplete: entry 1 is not an object")
+
+
+def test_error_answers_are_sent_back():
+    parse_error = validate_test_list("**ERROR parsing JSON:** Expecting value", [])
+    assert parse_error.verdict == RETRY and "could not be parsed" in parse_error.follow_up
+    failed_run = validate_test_details("Server error occurred: 500", [], "Back End")
+    assert failed_run == output_validator.Validation(RETRY, "assistant run failed", "PLEASE RETRY THE TASK. ")
+
+
+def test_truncated_answers_are_sent_back():
+    validation = validate_test_list({"test_list": make_test_list(5), "truncated": True}, make_test_list(5))
+    assert validation.verdict == RETRY and validation.reason == "answer cut off after 5 test cases"
+    assert validate_test_details("{}", [back_end_details], "Back End", truncated=True).verdict == RETRY
+
+
+def test_is_truncated():
+    assert is_truncated({"truncated": True})
+    assert not is_truncated({"test_list": []})
+    assert is_truncated(AIMessage(content="{}", response_metadata={"truncated": True}))
+    assert not is_truncated(AIMessage(content="{}"))
+    assert not is_truncated("{}")
+
+
+def test_test_details_per_tech_stack():
+    assert validate_test_details("{}", [back_end_details], "Back End").verdict == FINE
+    assert validate_test_details("{}", [front_end_details], "Front End").verdict == FINE
+    # Front End details lack the Back End fields
+    assert validate_test_details("{}", [front_end_details], "Back End").verdict == RETRY
+    assert validate_test_details("{}", [back_end_details] * 4, "Back End").verdict == NEEDS_LLM
+    assert validate_test_details("{}", [back_end_details], "Back End", revision=True).verdict == NEEDS_LLM
+
+
+def test_scenarios():
+    scenarios = [{"scenarioDescription": f"Scenario {i}", "expectedResults": "Works"} for i in range(3)]
+    assert validate_scenarios("{}", scenarios).verdict == FINE
+    assert validate_scenarios("{}", scenarios + scenarios[:1]).reason == "duplicate test scenarios"
+    assert validate_scenarios("{}", [{"scenarioDescription": "Scenario"}]).verdict == RETRY
+
+
+def test_test_types():
+    assert validate_test_types("{}", [("Component", "One service"), ("End-to-End", "Two services")]).verdict == FINE
+    assert validate_test_types("{}", [("Component", "One service"), (None, None)]).verdict == NEEDS_LLM
+    assert validate_test_types("{}", [(None, "Unclear")]).verdict == RETRY
+    assert validate_test_types("Failed to generate", [("Component", "One service")]).verdict == RETRY
@@ -0,0 +1,78 @@
+import asyncio
+from typing import TypedDict
+
+import pytest
+from langgraph.graph import END, StateGraph
+
+from qa_agent import progress
+from qa_agent.progress import NodeError, ProgressChannel, ScenarioFinished, ScenarioStarted, emit_progress, with_progress
+
+# imported under another name, pytest would collect the event class as a test class
+CaseDone = progress.TestCaseDone
+
+
+class StepState(TypedDict):
+    steps: int
+
+
+def reporting_graph(fail: bool = False):
+    builder = StateGraph(StepState)
+
+    async def step(state: StepState):
+        emit_progress(CaseDone(1, state["steps"] + 1, 3, f"test {state['steps'] + 1}"))
+        if fail:
+            raise RuntimeError("assistant down")
+        # events may come from worker threads too, e.g. blocking calls moved off the event loop
+        await asyncio.to_thread(emit_progress, NodeError(1, "step", "from a thread"))
+        return {"steps": state["steps"] + 1}
+
+    builder.add_node("step", step)
+    builder.set_entry_point("step")
+    builder.add_conditional_edges("step", lambda state: END if state["steps"] >= 3 else "step")
+    return builder.compile()
+
+
+async def stream_events(channel: ProgressChannel, run):
+    return [event async for event in channel.stream(run)]
+
+
+def test_events_stream_while_the_graph_runs():
+    channel = ProgressChannel()
+    graph = reporting_graph()
+    events = asyncio.run(stream_events(channel, graph.ainvoke({"steps": 0}, with_progress({}, channel))))
+
+    assert [event.index for event in events if isinstance(event, CaseDone)] == [1, 2, 3]
+    assert sum(isinstance(event, NodeError) for event in events) == 3
+    assert channel.result == {"steps": 3}
+
+
+def test_run_errors_are_raised_after_the_events():
+    channel = ProgressChannel()
+    graph = reporting_graph(fail=True)
+    events = []
+
+    async def consume():
+        async for event in channel.stream(graph.ainvoke({"steps": 0}, with_progress({}, channel))):
+            events.append(event)
+
+    with pytest.raises(RuntimeError, match="assistant down"):
+        asyncio.run(consume())
+    assert [type(event) for event in events] == [CaseDone]
+
+
+def test_events_outside_a_graph_run_are_only_counted():
+    emit_progress(ScenarioStarted(1, "Login works", 2))
+
+
+def test_with_progress_keeps_the_config():
+    channel = ProgressChannel()
+    config = with_progress({"recursion_limit": 10, "configurable": {"thread_id": "run"}}, channel)
+    assert config == {"recursion_limit": 10, "configurable": {"thread_id": "run", "progress": channel}}
+
+
+def test_describe():
+    assert ScenarioStarted(2, "Login works", 5).describe() == 'Generating test cases for scenario 2 of 5: "Login works"...'
+    assert ScenarioStarted(2, "Login works", None).describe() == 'Generating test cases for scenario 2: "Login works"...'
+    assert ScenarioFinished(2, "Login works", [{}, {}]).describe() == \
+        'Finished scenario 2: "Login works" with 2 test cases'
+    assert "gave up" in CaseDone(1, 1, 2, "Login", ok=False).describe()
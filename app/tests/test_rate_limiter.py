@@ -0,0 +1,198 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import httpx
+import pytest
+from openai import OpenAI, RateLimitError
+
+from qa_agent import rate_limiter as rate_limiter_module
+from qa_agent.rate_limiter import (AdaptiveRateLimiter, DEFAULT_RETRY_AFTER, MAX_RETRY_AFTER, parse_reset_duration,
+                                   parse_retry_after)
+
+
+class FakeClock:
+    """
+    time.monotonic / time.sleep of the rate limiter module, sleeping only advances the clock.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter_module.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(rate_limiter_module.time, "sleep", clock.sleep)
+    return clock
+
+
+def openai_client(limiter, handler):
+    http_client = httpx.Client(transport=httpx.MockTransport(handler),
+                               event_hooks={"response": [limiter.observe_response]})
+    return OpenAI(api_key="test", base_url="http://openai.test/v1", http_client=http_client, max_retries=0)
+
+
+def models_response():
+    return httpx.Response(200, json={"object": "list", "data": []},
+                          headers={"x-ratelimit-limit-requests": "120", "x-ratelimit-remaining-requests": "119"})
+
+
+@pytest.mark.parametrize("value, seconds", [("20ms", 0.02), ("1s", 1.0), ("6m0.5s", 360.5), ("1h", 3600.0),
+                                            ("2.5", 2.5)])
+def test_parse_reset_duration(value, seconds):
+    assert parse_reset_duration(value) == pytest.approx(seconds)
+
+
+@pytest.mark.parametrize("value", [None, "", "soon"])
+def test_parse_reset_duration_unknown(value):
+    assert parse_reset_duration(value) is None
+
+
+def test_parse_retry_after_prefers_milliseconds():
+    assert parse_retry_after(httpx.Headers({"retry-after-ms": "250", "retry-after": "9"})) == 0.25
+    assert parse_retry_after(httpx.Headers({"retry-after": "3"})) == 3.0
+    assert parse_retry_after(httpx.Headers({})) is None
+
+
+def test_parse_retry_after_http_date():
+    date = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 < parse_retry_after(httpx.Headers({"retry-after": date})) <= 30
+
+
+def test_bucket_sends_at_once_then_waits_for_refill(clock):
+    limiter = AdaptiveRateLimiter(requests_per_minute=60)
+    for _ in range(60):
+        limiter.acquire()
+    assert clock.sleeps == [] and limiter.throttled == 0
+    limiter.acquire()
+    # one request per second is refilled
+    assert clock.sleeps == [pytest.approx(1.0)]
+    assert limiter.throttled == 1
+
+
+def test_reservations_keep_arrival_order(clock):
+    limiter = AdaptiveRateLimiter(requests_per_minute=60)
+    limiter.tokens = 0
+    waits = [limiter._reserve() for _ in range(3)]
+    assert waits == [pytest.approx(1.0), pytest.approx(2.0), pytest.approx(3.0)]
+
+
+def test_headers_resize_bucket_and_block_on_exhausted_budget(clock):
+    limiter = AdaptiveRateLimiter(requests_per_minute=60)
+    limiter.update_from_headers(httpx.Headers({
+        "x-ratelimit-limit-requests": "600", "x-ratelimit-remaining-requests": "0",
+        "x-ratelimit-reset-requests": "1.5s",
+    }))
+    assert limiter.capacity == 600 and limiter.refill_rate == 10
+    assert limiter.tokens == 0
+    assert limiter.blocked_until == pytest.approx(clock.now + 1.5)
+
+
+def test_exhausted_token_budget_blocks(clock):
+    limiter = AdaptiveRateLimiter()
+    limiter.update_from_headers(httpx.Headers({"x-ratelimit-remaining-tokens": "0",
+                                               "x-ratelimit-reset-tokens": "10m"}))
+    # resets are capped, a wrong header must not stall every caller for long
+    assert limiter.blocked_until == pytest.approx(clock.now + MAX_RETRY_AFTER)
+
+
+def test_429_is_retried_after_retry_after(clock):
+    limiter = AdaptiveRateLimiter()
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if len(requests) == 1:
+            return httpx.Response(429, json={"error": {"message": "slow down"}}, headers={"retry-after-ms": "1500"})
+        return models_response()
+
+    client = openai_client(limiter, handler)
+    limiter.call(client.models.list)
+    assert len(requests) == 2
+    assert clock.sleeps == [pytest.approx(1.5)]
+    # counted by the response hook and by the retry
+    assert limiter.rate_limited == 2
+    assert limiter.capacity == 120
+
+
+def test_429_without_retry_after_backs_off_exponentially(clock):
+    limiter = AdaptiveRateLimiter()
+    client = openai_client(limiter, lambda request: httpx.Response(429, json={"error": {"message": "slow down"}}))
+    with pytest.raises(RateLimitError):
+        limiter.call(client.models.list, max_retries=2)
+    delays = [DEFAULT_RETRY_AFTER * 2 ** attempt for attempt in range(2)]
+    assert clock.sleeps == [pytest.approx(delay) for delay in delays]
+
+
+def test_other_errors_are_not_retried(clock):
+    limiter = AdaptiveRateLimiter()
+    calls = []
+
+    def fail():
+        calls.append(1)
+        raise ValueError("broken")
+
+    with pytest.raises(ValueError):
+        limiter.call(fail)
+    assert len(calls) == 1 and clock.sleeps == []
+
+
+def test_acall_retries_rate_limits(monkeypatch):
+    limiter = AdaptiveRateLimiter()
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+
+    monkeypatch.setattr(rate_limiter_module.asyncio, "sleep", sleep)
+    request = httpx.Request("POST", "http://openai.test/v1/threads")
+    attempts = []
+
+    async def run():
+        attempts.append(1)
+        if len(attempts) == 1:
+            response = httpx.Response(429, headers={"retry-after": "0.5"}, request=request)
+            raise RateLimitError("slow down", response=response, body=None)
+        return "answer"
+
+    assert asyncio.run(limiter.acall(run)) == "answer"
+    assert sleeps == [pytest.approx(0.5, abs=0.01)]
+    assert limiter.rate_limited == 1
+
+
+def test_rate_limited_count_is_exact_across_threads():
+    limiter = AdaptiveRateLimiter()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: limiter.backoff(0.0, rate_limited=True), range(2000)))
+    assert limiter.rate_limited == 2000
+
+
+def test_one_async_client_per_event_loop(monkeypatch):
+    created = []
+
+    def async_http_client():
+        created.append(httpx.AsyncClient())
+        return created[-1]
+
+    monkeypatch.setattr(rate_limiter_module.rate_limiter, "async_http_client", async_http_client)
+
+    async def clients():
+        first = rate_limiter_module.shared_async_client()
+        await asyncio.sleep(0)
+        return first, rate_limiter_module.shared_async_client()
+
+    first, second = asyncio.run(clients())
+    assert first is second and len(created) == 1
+    # a new loop cannot use the connections of the last one
+    assert asyncio.run(clients())[0] is not first and len(created) == 2
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+from qa_agent import response_cache as response_cache_module
+from qa_agent.response_cache import ResponseCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResponseCache(str(tmp_path / "cache.sqlite"))
+
+
+class FakeAssistant:
+    def __init__(self, truncated=False):
+        self.truncated = truncated
+        self.queries = []
+
+    async def get_query_chain(self, query_input):
+        self.queries.append(query_input)
+        query = {"test_list": [{"Title": "Login"}]}
+        if self.truncated:
+            query["truncated"] = True
+        thread_id = query_input.get("threadID") or f"thread_run_{len(self.queries)}"
+        return {"agent_output": {"thread_id": thread_id, "output": json.dumps(query), "model": "gpt-4o",
+                                 "usage": {"total_tokens": 20}},
+                "query": query}
+
+
+@pytest.fixture
+def threads_api(monkeypatch):
+    """
+    Threads endpoints of OpenAI behind httpx.MockTransport, records the requests the cache replays.
+    """
+    requests = []
+
+    def handler(request):
+        body = json.loads(request.content or b"{}")
+        requests.append((request.method, request.url.path, body))
+        if request.url.path.endswith("/messages"):
+            return httpx.Response(200, json={"id": f"msg_{len(requests)}", "object": "thread.message",
+                                             "created_at": 0, "thread_id": request.url.path.split("/")[-2],
+                                             "role": body["role"], "content": [], "status": "completed",
+                                             "attachments": [], "metadata": {}})
+        return httpx.Response(200, json={"id": f"thread_replayed_{len(requests)}", "object": "thread",
+                                         "created_at": 0, "metadata": {}})
+
+    monkeypatch.setattr(response_cache_module.rate_limiter, "async_http_client",
+                        lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return requests
+
+
+def test_keys_follow_attachment_content_not_file_ids(cache):
+    cache.register_file("file_a", b"design document")
+    cache.register_file("file_b", b"design document")
+    cache.register_file("file_c", b"another document")
+    key = cache.make_key("assistant", "asst_1", "prompt", None, [{"file_id": "file_a"}])
+    assert cache.make_key("assistant", "asst_1", "prompt", None, [{"file_id": "file_b"}]) == key
+    assert cache.make_key("assistant", "asst_1", "prompt", None, [{"file_id": "file_c"}]) != key
+    assert cache.make_key("assistant", "asst_2", "prompt", None, [{"file_id": "file_a"}]) != key
+    assert cache.make_key("assistant", "asst_1", "prompt", "thread_1", [{"file_id": "file_a"}]) != key
+
+
+def test_expired_entries_are_not_served(cache):
+    cache.put("key", "assistant", {"answer": 1})
+    assert cache.get("key") == {"answer": 1}
+    cache.ttl = 0
+    time.sleep(0.01)
+    assert cache.get("key") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_entries_are_evicted(cache):
+    cache.max_bytes = 30
+    cache.put("old", "assistant", "x" * 10)
+    cache.put("used", "assistant", "y" * 10)
+    cache.get("used")
+    cache.put("new", "assistant", "z" * 10)
+    assert cache.get("old") is None
+    assert cache.get("used") == "y" * 10 and cache.get("new") == "z" * 10
+
+
+def test_disabled_cache_stores_nothing(cache):
+    cache.enabled = False
+    cache.put("key", "assistant", {"answer": 1})
+    cache.enabled = True
+    assert cache.get("key") is None
+
+
+def test_cached_answers_are_replayed_onto_a_new_thread(cache, threads_api):
+    assistant = FakeAssistant()
+    query_input = {"promptInput": {"query": "List the test cases"}}
+    first = asyncio.run(cache.aget_query_chain(assistant, "asst_1", query_input))
+    second = asyncio.run(cache.aget_query_chain(assistant, "asst_1", query_input))
+
+    assert len(assistant.queries) == 1
+    assert "cached" not in first and second["cached"] is True
+    assert second["query"] == first["query"]
+    # a thread of its own, the cached run's thread may be in use by another run
+    new_thread = second["agent_output"]["thread_id"]
+    assert new_thread.startswith("thread_replayed") and new_thread != first["agent_output"]["thread_id"]
+    method, path, body = threads_api[0]
+    assert (method, path) == ("POST", "/v1/threads")
+    assert [message["role"] for message in body["messages"]] == ["user", "assistant"]
+    # follow-ups on the replayed thread hit the entries of the cached thread
+    assert cache.cache_thread(new_thread) == first["agent_output"]["thread_id"]
+
+
+def test_cached_follow_ups_are_added_to_the_callers_thread(cache, threads_api):
+    assistant = FakeAssistant()
+    follow_up = {"promptInput": {"query": "Add the error cases"}, "threadID": "thread_1"}
+    asyncio.run(cache.aget_query_chain(assistant, "asst_1", follow_up))
+    out = asyncio.run(cache.aget_query_chain(assistant, "asst_1", follow_up))
+
+    assert len(assistant.queries) == 1
+    assert out["agent_output"]["thread_id"] == "thread_1"
+    assert [(method, path) for method, path, _ in threads_api] == [("POST", "/v1/threads/thread_1/messages")] * 2
+
+
+def test_replays_of_a_loop_share_one_client(cache, threads_api, monkeypatch):
+    clients = []
+    http_client = response_cache_module.rate_limiter.async_http_client
+    monkeypatch.setattr(response_cache_module.rate_limiter, "async_http_client",
+                        lambda: clients.append(http_client()) or clients[-1])
+    assistant = FakeAssistant()
+    query_input = {"promptInput": {"query": "List the test cases"}}
+
+    async def replay_twice():
+        await cache.aget_query_chain(assistant, "asst_1", query_input)
+        return [await cache.aget_query_chain(assistant, "asst_1", query_input) for _ in range(2)]
+
+    assert all(out["cached"] for out in asyncio.run(replay_twice()))
+    assert len(threads_api) == 2 and len(clients) == 1
+
+
+def test_failed_replay_runs_the_question_again(cache, monkeypatch):
+    def handler(request):
+        return httpx.Response(400, json={"error": {"message": "thread not found"}})
+
+    monkeypatch.setattr(response_cache_module.rate_limiter, "async_http_client",
+                        lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    assistant = FakeAssistant()
+    query_input = {"promptInput": {"query": "List the test cases"}}
+    asyncio.run(cache.aget_query_chain(assistant, "asst_1", query_input))
+    out = asyncio.run(cache.aget_query_chain(assistant, "asst_1", query_input))
+    assert len(assistant.queries) == 2 and "cached" not in out
+
+
+def test_truncated_answers_are_not_stored(cache):
+    assistant = FakeAssistant(truncated=True)
+    query_input = {"promptInput": {"query": "List the test cases"}}
+    asyncio.run(cache.aget_query_chain(assistant, "asst_1", query_input))
+    asyncio.run(cache.aget_query_chain(assistant, "asst_1", query_input))
+    assert len(assistant.queries) == 2
+
+
+class FakeChain:
+    """
+    Reflection chain: the prompt (first) and the model call, answered with a tool call.
+    """
+
+    class Prompt:
+        def invoke(self, values):
+            return type("PromptValue", (), {"to_messages": lambda self: values["messages"]})()
+
+    def __init__(self):
+        self.first = self.Prompt()
+        self.calls = 0
+
+    async def ainvoke(self, values):
+        self.calls += 1
+        return AIMessage(content="", tool_calls=[{"name": "Reflection", "args": {"Finished": True}, "id": "call_1"}])
+
+    def invoke(self, values):
+        self.calls += 1
+        return AIMessage(content="", tool_calls=[{"name": "Reflection", "args": {"Finished": True}, "id": "call_1"}])
+
+
+def test_reflections_are_cached_per_prompt(cache):
+    chain = FakeChain()
+    messages = [HumanMessage(content="question"), AIMessage(content="answer")]
+    first = asyncio.run(cache.ainvoke_reflection(chain, "gpt-4o", messages))
+    second = cache.invoke_reflection(chain, "gpt-4o", messages)
+    other = cache.invoke_reflection(chain, "gpt-4o", messages + [HumanMessage(content="more")])
+
+    assert chain.calls == 2
+    assert second.tool_calls[0]["args"] == first.tool_calls[0]["args"]
+    assert second.response_metadata["cached"] is True
+    assert not other.response_metadata.get("cached")
@@ -0,0 +1,112 @@
+import csv
+import io
+import os
+import zipfile
+
+import pandas as pd
+import pytest
+
+from qa_agent.result_accumulator import ParquetRowGroupWriter, ResultAccumulator, cell_value, result_labels
+
+
+@pytest.fixture
+def results(tmp_path):
+    return ResultAccumulator(str(tmp_path))
+
+
+def test_columns_follow_the_first_appearance_like_concat(results):
+    first = [{"Title": "Login", "Type": "Functional"}, {"Title": "Logout", "Steps": ["open", "click"]}]
+    second = [{"Type": "Negative", "Title": "Wrong password", "Priority": 1}]
+    results.append(("Login works", "It works"), first)
+    results.append(("Errors", "They are shown"), second)
+
+    expected = pd.concat([pd.DataFrame(first).assign(scenario=[("Login works", "It works")] * 2),
+                          pd.DataFrame(second).assign(scenario=[("Errors", "They are shown")])], ignore_index=True)
+    df = results.to_dataframe()
+    assert list(df.columns) == list(expected.columns) + ["Result"]
+    assert len(results) == 3
+    assert df["Title"].tolist() == expected["Title"].tolist()
+    assert df["Steps"].isna().tolist() == [True, False, True] and df["Steps"][1] == "['open', 'click']"
+    assert df["Result"].tolist() == result_labels[:3]
+
+
+@pytest.mark.parametrize("value, cell", [(None, None), (float("nan"), None), ("x", "x"), (2, 2), ({"a": 1}, "{'a': 1}")])
+def test_cell_value(value, cell):
+    assert cell_value(value) == cell
+
+
+def test_exports_are_built_once_per_version(results):
+    results.append("scenario", [{"Title": "Login"}])
+    path = results.export("csv")
+    assert results.export("csv") == path
+    results.append("scenario", [{"Title": "Logout"}])
+    new_path = results.export("csv")
+    assert new_path != path
+    # the outdated export is removed
+    assert not os.path.exists(path) and os.path.exists(new_path)
+
+
+def test_csv_export(results):
+    results.append("scenario", [{"Title": "Login", "Type": "Functional"}])
+    rows = list(csv.reader(io.StringIO(results.export_bytes("csv").decode("utf-8"))))
+    assert rows == [["Title", "Type", "scenario", "Result"], ["Login", "Functional", "scenario", result_labels[0]]]
+
+
+def test_xlsx_export_has_the_unique_cases_sheet(results):
+    results.append("scenario", [{"Title": "Login"}, {"Title": "Login again"}])
+    results.set_unique_cases(pd.DataFrame({"Title": ["Login"]}))
+    with zipfile.ZipFile(results.export("xlsx")) as workbook:
+        names = workbook.namelist()
+        sheet = workbook.read("xl/worksheets/sheet1.xml").decode("utf-8")
+    assert "xl/worksheets/sheet2.xml" in names
+    assert "Login again" in sheet and result_labels[1] in sheet
+
+
+def test_parquet_export(results):
+    pytest.importorskip("pyarrow")
+    results.append("scenario", [{"Title": "Login"}])
+    assert pd.read_parquet(results.export("parquet"))["Title"].tolist() == ["Login"]
+
+
+def test_parquet_row_groups_are_written_per_append(tmp_path):
+    pyarrow = pytest.importorskip("pyarrow")
+    path = str(tmp_path / "orders.parquet")
+    writer = ParquetRowGroupWriter(path, {"scenario_id": pyarrow.int64(), "scenario": pyarrow.string()})
+    writer.append({"scenario_id": 2, "scenario": "Orders are saved"},
+                  [{"Title": "Save", "Request_Body": {"id": 1}}, {"Title": "Save twice", "Priority": 1}])
+    writer.append({"scenario_id": 1, "scenario": "Orders are listed"}, [])
+    writer.append({"scenario_id": 1, "scenario": "Orders are listed"}, [{"Title": "List", "Extra": "dropped"}])
+    # readable only once closed
+    assert not os.path.exists(path) and os.path.exists(path + ".tmp")
+    writer.close()
+
+    assert pyarrow.parquet.ParquetFile(path).num_row_groups == 2
+    df = pd.read_parquet(path)
+    assert list(df.columns) == ["scenario_id", "scenario", "Title", "Request_Body", "Priority"]
+    assert df["scenario_id"].tolist() == [2, 2, 1]
+    assert df["Request_Body"].tolist()[0] == "{'id': 1}" and df["Priority"].tolist()[1] == "1"
+    assert df["Priority"].isna().tolist() == [True, False, True]
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_aborted_parquet_leaves_no_file(tmp_path):
+    pyarrow = pytest.importorskip("pyarrow")
+    path = str(tmp_path / "orders.parquet")
+    writer = ParquetRowGroupWriter(path, {"scenario_id": pyarrow.int64()})
+    writer.append({"scenario_id": 1}, [{"Title": "Save"}])
+    writer.abort()
+    assert os.listdir(tmp_path) == []
+
+
+def test_unknown_formats_are_rejected(results):
+    with pytest.raises(ValueError):
+        results.export("pdf")
+
+
+def test_clear_and_remove_exports(results):
+    results.append("scenario", [{"Title": "Login"}])
+    path = results.export("csv")
+    results.clear()
+    assert len(results) == 0 and results.header() == ["Result"]
+    results.remove_exports()
+    assert not os.path.exists(path)
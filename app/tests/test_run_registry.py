@@ -0,0 +1,75 @@
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from qa_agent.run_registry import RunRegistry, pid_alive
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return RunRegistry(str(tmp_path / "runs.sqlite"))
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def test_pid_alive():
+    assert pid_alive(os.getpid())
+    assert not pid_alive(None) and not pid_alive(0)
+    assert not pid_alive(dead_pid())
+
+
+def test_runs_are_tracked_with_their_progress(registry):
+    registry.register("request-1", "request", "ann")
+    with registry.tracked("batch", scenarios_total=3) as run_id:
+        registry.scenario_started(run_id, 1)
+        registry.scenario_finished(run_id, 4)
+        registry.scenario_started(run_id, 2)
+        registry.scenario_finished(run_id, 2)
+        runs = registry.active()
+        assert [run["run_id"] for run in runs] == ["request-1", run_id]
+        batch = runs[1]
+        assert batch["kind"] == "batch" and batch["pid"] == os.getpid()
+        assert (batch["scenarios_total"], batch["scenarios_done"], batch["current_scenario"],
+                batch["test_cases"]) == (3, 2, 2, 6)
+        assert registry.count("batch") == 1 and registry.count("job") == 0
+    assert [run["run_id"] for run in registry.active()] == ["request-1"]
+    registry.unregister("request-1")
+    assert registry.active() == []
+
+
+def test_a_failing_run_is_unregistered(registry):
+    with pytest.raises(RuntimeError):
+        with registry.tracked("job", run_id="job-1"):
+            raise RuntimeError("boom")
+    assert registry.active() == []
+
+
+def test_runs_of_dead_processes_are_dropped(registry):
+    registry.register("job-1", "job")
+    registry._execute("UPDATE runs SET pid = ? WHERE run_id = 'job-1'", (dead_pid(),))
+    registry.register("job-2", "job")
+    assert [run["run_id"] for run in registry.active("job")] == ["job-2"]
+    assert registry._execute("SELECT run_id FROM runs") == [("job-2",)]
+
+
+def test_processes_and_threads_share_the_registry(registry):
+    def register(i):
+        registry.register(f"request-{i}", "request")
+
+    threads = [threading.Thread(target=register, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # another process sees every request, each one is its own row
+    script = "import sys; from qa_agent.run_registry import RunRegistry; print(RunRegistry(sys.argv[1]).count('request'))"
+    output = subprocess.check_output([sys.executable, "-c", script, registry.path],
+                                     cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert int(output) == 20
@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+from qa_agent.speculation import SpeculativeRuns
+from qa_agent.tc_graph import QAGraph
+
+
+def run_returning(value, seconds: float = 0.0, error: Exception = None):
+    async def run():
+        await asyncio.sleep(seconds)
+        if error is not None:
+            raise error
+        return value
+    return run
+
+
+def test_a_pending_run_is_taken_by_the_same_query():
+    async def scenario():
+        runs = SpeculativeRuns()
+        runs.start(("scenario-1", 2), "details of test 2", run_returning("answer", 0.05))
+        assert runs.pending(("scenario-1", 2))
+        # started once per key
+        runs.start(("scenario-1", 2), "details of test 2", run_returning("other"))
+        # the reflection of test 1 runs meanwhile
+        await asyncio.sleep(0.05)
+        assert await runs.take(("scenario-1", 2), "details of test 2") == "answer"
+        assert not runs.pending(("scenario-1", 2))
+        return runs
+
+    runs = asyncio.run(scenario())
+    summary = runs.summary()
+    assert (summary["started"], summary["used"], summary["pending"]) == (1, 1, 0)
+    assert summary["hidden_seconds"] > 0.03 and summary["waited_seconds"] < 0.03
+
+
+def test_nothing_is_taken_for_an_unknown_key_or_another_query():
+    async def scenario():
+        runs = SpeculativeRuns()
+        assert await runs.take("unknown", "query") is None
+        runs.start("key", "details of test 2", run_returning("answer", 10))
+        task = runs._runs["key"][1]
+        # a revision changed the query the next test case asks
+        assert await runs.take("key", "revised details of test 2") is None
+        await asyncio.sleep(0)
+        assert task.cancelled()
+        return runs
+
+    runs = asyncio.run(scenario())
+    assert runs.stats["discarded"] == 1 and runs.stats["used"] == 0
+
+
+def test_a_failed_run_is_run_again_by_the_caller():
+    async def scenario():
+        runs = SpeculativeRuns()
+        runs.start("key", "query", run_returning(None, error=RuntimeError("rate limited")))
+        return runs, await runs.take("key", "query")
+
+    runs, result = asyncio.run(scenario())
+    assert result is None and runs.stats["failed"] == 1
+
+
+def test_cancel_discards_the_runs_nobody_took():
+    async def scenario():
+        runs = SpeculativeRuns()
+        runs.start("a", "query a", run_returning("a", 10))
+        runs.start("b", "query b", run_returning("b", 10))
+        tasks = [task for _, task in runs._runs.values()]
+        runs.cancel()
+        await asyncio.sleep(0)
+        assert all(task.cancelled() for task in tasks)
+        return runs
+
+    runs = asyncio.run(scenario())
+    assert runs.summary() == {**runs.stats, "pending": 0}
+    assert runs.stats["discarded"] == 2
+    runs.reset_stats()
+    assert runs.stats["started"] == 0
+
+
+@pytest.mark.parametrize("outcome", ["used", "discarded"])
+def test_outcomes_are_counted_in_the_metrics(monkeypatch, outcome):
+    counted = []
+    monkeypatch.setattr("qa_agent.speculation.metrics.inc", lambda name, amount=1, **labels: counted.append(
+        (name, labels.get("outcome"))))
+
+    async def scenario():
+        runs = SpeculativeRuns()
+        runs.start("key", "query", run_returning("answer"))
+        await runs.take("key", "query" if outcome == "used" else "other query")
+
+    asyncio.run(scenario())
+    assert ("qa_speculative_runs_total", "started") in counted
+    assert ("qa_speculative_runs_total", outcome) in counted
+    assert (("qa_speculation_hidden_seconds_total", None) in counted) == (outcome == "used")
+
+
+def test_pipelined_stage2_takes_the_speculative_details(assistant):
+    graph_runner = QAGraph(pipeline_stage2=True)
+
+    async def run():
+        return [result async for result in graph_runner.astream_scenarios(
+            graph_runner.get_memory_graph(), assistant.inputs(2), {"configurable": {"thread_id": "run"}}, 2)]
+
+    results = asyncio.run(run())
+    for result in results:
+        assert result["error"] is None
+        titles = [details["Title"] for details in result["test_details_list"]]
+        assert titles == [f"scenario-{result['scenario_id']} test {i}" for i in range(1, assistant.tests_per_scenario + 1)]
+    # every test case after the first of a scenario was generated ahead, and each was generated once
+    summary = graph_runner.speculative_runs.summary()
+    assert summary["used"] == 2 * (assistant.tests_per_scenario - 1) and summary["pending"] == 0
+    assert [kind for _, kind in assistant.calls].count("details") == 2 * assistant.tests_per_scenario
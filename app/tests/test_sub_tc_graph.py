@@ -0,0 +1,166 @@
+import asyncio
+
+import pytest
+
+from qa_agent import sub_tc_graph
+from qa_agent.prompts.tc_graph_prompts import get_test_case_type_batch_prompt
+from qa_agent.sub_tc_graph import SubQAGraph, count_tokens, get_test_details, validate_batch_output
+
+
+def make_test_list(count: int, pre_conditions: str = "The user is logged in") -> list:
+    return [(i, {"Title": f"Test {i}", "Pre_Conditions": pre_conditions}) for i in range(1, count + 1)]
+
+
+def state(test_list, current_test_index=1, **values):
+    return {"test_list": test_list, "current_test_index": current_test_index, "message_history": [],
+            "revisions": 0, "attachments": [], **values}
+
+
+def batch_tokens(test_list, indices):
+    return count_tokens(get_test_case_type_batch_prompt([(i, get_test_details(test_list[i - 1])) for i in indices]))
+
+
+def test_validate_batch_output_keeps_valid_entries():
+    output = {"test_types": [
+        {"index": 1, "Test_Type": "component", "Reason": "one screen"},
+        {"index": "2", "Test_Type": "End to End", "Reason": "whole flow"},
+        {"index": 2, "Test_Type": "Component", "Reason": "duplicate"},
+        {"index": 3, "Test_Type": "Unit", "Reason": "unknown type"},
+        {"index": 4, "Test_Type": "Component", "Reason": " "},
+        {"index": 9, "Test_Type": "Component", "Reason": "not in the batch"},
+        "not an entry",
+    ]}
+    results, failed = validate_batch_output(output, [1, 2, 3, 4, 5])
+    assert results == {1: ("Component", "one screen"), 2: ("End-to-End", "whole flow")}
+    assert failed == [3, 4, 5]
+
+
+def test_validate_batch_output_accepts_a_bare_list():
+    results, failed = validate_batch_output([{"index": 1, "Test_Type": "Component", "Reason": "r"}], [1, 2])
+    assert results == {1: ("Component", "r")} and failed == [2]
+
+
+@pytest.mark.parametrize("output", [None, "not json", {"other": []}])
+def test_validate_batch_output_fails_the_whole_batch(output):
+    assert validate_batch_output(output, [1, 2]) == ({}, [1, 2])
+
+
+def test_next_batch_stops_at_batch_size():
+    graph = SubQAGraph(batch_size=3)
+    test_list = make_test_list(7)
+    assert graph._next_batch(state(test_list)) == [1, 2, 3]
+    assert graph._next_batch(state(test_list, current_test_index=6)) == [6, 7]
+
+
+def test_next_batch_packs_up_to_the_token_budget():
+    test_list = make_test_list(6, pre_conditions="A flow with every kind of step exists " * 20)
+    budget = batch_tokens(test_list, [1, 2, 3])
+    assert batch_tokens(test_list, [1, 2, 3, 4]) > budget
+    graph = SubQAGraph(batch_size=10, max_batch_tokens=budget)
+    assert graph._next_batch(state(test_list)) == [1, 2, 3]
+    assert graph._next_batch(state(test_list, current_test_index=4)) == [4, 5, 6]
+
+
+def test_next_batch_uses_the_default_token_budget():
+    test_list = make_test_list(40, pre_conditions="A flow with every kind of step exists " * 40)
+    batch = SubQAGraph(batch_size=40)._next_batch(state(test_list))
+    assert 1 < len(batch) < 40
+    assert batch_tokens(test_list, batch) <= sub_tc_graph.MAX_BATCH_PROMPT_TOKENS
+    assert batch_tokens(test_list, batch + [batch[-1] + 1]) > sub_tc_graph.MAX_BATCH_PROMPT_TOKENS
+
+
+def test_next_batch_always_holds_one_test_case():
+    test_list = make_test_list(2)
+    assert SubQAGraph(batch_size=5, max_batch_tokens=1)._next_batch(state(test_list)) == [1]
+
+
+def test_next_batch_classifies_invalid_entries_alone():
+    test_list = make_test_list(4)
+    test_list[2] = (3, "not a test case")
+    graph = SubQAGraph(batch_size=4)
+    assert graph._next_batch(state(test_list)) == [1, 2]
+    assert graph._next_batch(state(test_list, current_test_index=3)) == [3]
+    assert graph._next_batch(state(test_list, current_test_index=4)) == [4]
+
+
+# every assistant run uses 20 tokens
+usage = {"model": "gpt-4o", "usage": {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20}}
+
+
+class FakeAssistant:
+    """
+    response_cache.aget_query_chain replaced with canned answers: the batch answer for batch prompts and a
+    single classification for the single test prompt.
+    """
+
+    def __init__(self, batch_answer=None, batch_error=None):
+        self.batch_answer = batch_answer
+        self.batch_error = batch_error
+        self.single_queries = []
+
+    async def aget_query_chain(self, assist, assistant_id, query_input):
+        query = query_input["promptInput"]["query"]
+        if "whether a backend test case" in query:
+            self.single_queries.append(query)
+            return {"agent_output": {"thread_id": f"thread_{len(self.single_queries)}", "output": "{}", **usage},
+                    "query": {"Test_Type": "End-to-End", "Reason": "retried alone"}}
+        if self.batch_error is not None:
+            raise self.batch_error
+        return {"agent_output": {"thread_id": "thread_batch", "output": str(self.batch_answer), **usage},
+                "query": self.batch_answer}
+
+
+@pytest.fixture
+def fake_assistant(monkeypatch):
+    def install(**answers):
+        assistant = FakeAssistant(**answers)
+        monkeypatch.setattr(sub_tc_graph.response_cache, "aget_query_chain", assistant.aget_query_chain)
+        return assistant
+    return install
+
+
+def test_batch_node_retries_failed_entries_one_by_one(fake_assistant):
+    assistant = fake_assistant(batch_answer={"test_types": [
+        {"index": 1, "Test_Type": "Component", "Reason": "one screen"},
+        {"index": 3, "Test_Type": "Integration", "Reason": "not a known type"},
+    ]})
+    test_list = make_test_list(3)
+    update = asyncio.run(SubQAGraph(batch_size=3)._sub_assist_batch_node(state(test_list)))
+
+    assert update["batch_indices"] == [1, 2, 3]
+    assert update["thread_id"] == "thread_batch"
+    types = [(details["test_type"], details["Reason"]) for _, details in update["test_list"]]
+    assert types == [("Component", "one screen"), ("End-to-End", "retried alone"), ("End-to-End", "retried alone")]
+    assert len(assistant.single_queries) == 2
+    assert "Test 2" in assistant.single_queries[0] and "Test 3" in assistant.single_queries[1]
+
+
+def test_batch_node_falls_back_to_single_requests_when_the_batch_fails(fake_assistant):
+    assistant = fake_assistant(batch_error=RuntimeError("server error"))
+    test_list = make_test_list(2)
+    update = asyncio.run(SubQAGraph(batch_size=2)._sub_assist_batch_node(state(test_list)))
+
+    assert [details["test_type"] for _, details in update["test_list"]] == ["End-to-End", "End-to-End"]
+    assert len(assistant.single_queries) == 2
+    assert "Server error" in update["message_history"][1].content
+
+
+def test_batch_node_does_not_retry_invalid_entries(fake_assistant):
+    assistant = fake_assistant(batch_answer={"test_types": []})
+    test_list = [(1, {"Reason": "no title"})]
+    update = asyncio.run(SubQAGraph(batch_size=2)._sub_assist_batch_node(state(test_list)))
+
+    assert update["test_list"][0][1]["test_type"] == "Error"
+    assert assistant.single_queries == []
+
+
+def test_classification_usage_is_recorded_per_node_and_scenario(fake_assistant):
+    fake_assistant(batch_answer={"test_types": [{"index": 1, "Test_Type": "Component", "Reason": "one screen"}]})
+    graph = SubQAGraph(batch_size=2)
+    asyncio.run(graph._sub_assist_batch_node(state(make_test_list(2), scenario_id=7)))
+
+    # the batch request and the retry of test 2
+    tracker = graph.usage_tracker
+    assert tracker.assistant["total_tokens"] == 40
+    assert tracker.by_node["sub_assist_stage1"]["total_tokens"] == 40
+    assert tracker.by_scenario[7]["total_tokens"] == 40
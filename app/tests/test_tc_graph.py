@@ -0,0 +1,143 @@
+import asyncio
+
+import pytest
+
+from qa_agent.tc_graph import QAGraph
+
+
+async def collect(graph_runner: QAGraph, graph, inputs: dict, config: dict, max_workers: int, limit: int = None):
+    results = []
+    async for result in graph_runner.astream_scenarios(graph, inputs, config, max_workers):
+        results.append(result)
+        if limit is not None and len(results) == limit:
+            break
+    return results
+
+
+def test_every_scenario_runs_on_its_own_thread(assistant):
+    graph_runner = QAGraph()
+    graph = graph_runner.get_memory_graph()
+    results = asyncio.run(collect(graph_runner, graph, assistant.inputs(3), {"configurable": {"thread_id": "run"}}, 3))
+
+    assert sorted(result["scenario_id"] for result in results) == [1, 2, 3]
+    for result in results:
+        assert result["error"] is None
+        titles = [details["Title"] for details in result["test_details_list"]]
+        assert titles == [f"scenario-{result['scenario_id']} test {i}" for i in range(1, assistant.tests_per_scenario + 1)]
+        state = graph.get_state({"configurable": {"thread_id": f"run-scenario-{result['scenario_id']}"}})
+        assert state.values["scenario_id"] == result["scenario_id"] and not state.next
+
+
+def test_results_come_in_completion_order(assistant):
+    assistant.delays = {1: 0.05}
+    graph_runner = QAGraph()
+    results = asyncio.run(collect(graph_runner, graph_runner.get_memory_graph(), assistant.inputs(3),
+                                  {"configurable": {"thread_id": "run"}}, 3))
+
+    assert [result["scenario_id"] for result in results][-1] == 1
+    ordered = sorted(results, key=lambda result: result["scenario_id"])
+    assert [result["scenario"][0] for result in ordered] == ["scenario-1 works", "scenario-2 works", "scenario-3 works"]
+
+
+def test_at_most_max_workers_scenarios_run_at_once(assistant):
+    graph_runner = QAGraph()
+    results = asyncio.run(collect(graph_runner, graph_runner.get_memory_graph(), assistant.inputs(5),
+                                  {"configurable": {"thread_id": "run"}}, 2))
+
+    assert len(results) == 5
+    # the assistant calls of a scenario are sequential, so in flight calls are running scenarios
+    assert assistant.max_in_flight == 2
+
+
+def test_a_failing_scenario_does_not_stop_the_others(assistant, monkeypatch):
+    graph_runner = QAGraph()
+    graph = graph_runner.get_memory_graph()
+    original = graph.ainvoke
+
+    async def ainvoke(inputs, config, **kwargs):
+        if config["configurable"]["thread_id"].endswith("-scenario-2"):
+            raise RuntimeError("graph failed")
+        return await original(inputs, config, **kwargs)
+
+    monkeypatch.setattr(graph, "ainvoke", ainvoke)
+    results = {result["scenario_id"]: result
+               for result in asyncio.run(collect(graph_runner, graph, assistant.inputs(3),
+                                                 {"configurable": {"thread_id": "run"}}, 3))}
+
+    assert results[2]["error"] == "graph failed" and results[2]["test_details_list"] == []
+    assert results[1]["error"] is None and len(results[3]["test_details_list"]) == assistant.tests_per_scenario
+
+
+def test_a_second_call_resumes_from_the_checkpoints(assistant):
+    # scenarios 2 and 3 are still expanding their test cases when the first one finishes
+    assistant.delays = {(2, "details"): 0.2, (3, "details"): 0.2}
+    graph_runner = QAGraph()
+    graph = graph_runner.get_memory_graph()
+    config = {"configurable": {"thread_id": "run"}}
+
+    async def interrupted_then_resumed():
+        # stops after the first scenario, the other two are cancelled part way
+        first = await collect(graph_runner, graph, assistant.inputs(3), config, 3, limit=1)
+        calls_before = len(assistant.calls)
+        assistant.delays = {}
+        resumed = await collect(graph_runner, graph, assistant.inputs(3), config, 3)
+        return first, calls_before, resumed
+
+    first, calls_before, resumed = asyncio.run(interrupted_then_resumed())
+
+    assert [result["scenario_id"] for result in first] == [1]
+    assert sorted(result["scenario_id"] for result in resumed) == [1, 2, 3]
+    resumed_calls = assistant.calls[calls_before:]
+    # the finished scenario is read back from its checkpoint, no assistant call is repeated for it
+    assert all(scenario != 1 for scenario, _ in resumed_calls)
+    finished = next(result for result in resumed if result["scenario_id"] == 1)
+    assert finished["test_details_list"] == first[0]["test_details_list"]
+    for result in resumed:
+        assert len(result["test_details_list"]) == assistant.tests_per_scenario
+    # the cancelled scenarios continue from their checkpoints instead of starting over
+    assert (2, "test_list") not in resumed_calls and (3, "test_list") not in resumed_calls
+    assert resumed_calls.count((2, "details")) == assistant.tests_per_scenario
+
+
+def test_stage2_expands_the_test_cases_of_a_scenario_side_by_side(assistant):
+    assistant.tests_per_scenario = 5
+    assistant.delays = {(1, "details"): 0.02}
+    graph_runner = QAGraph(stage2_concurrency=2)
+    results = asyncio.run(collect(graph_runner, graph_runner.get_memory_graph(), assistant.inputs(1),
+                                  {"configurable": {"thread_id": "run"}}, 1))
+
+    assert results[0]["error"] is None
+    # collected in the order of the test list, whichever branch finished first
+    titles = [details["Title"] for details in results[0]["test_details_list"]]
+    assert titles == [f"scenario-1 test {i}" for i in range(1, 6)]
+    assert [kind for _, kind in assistant.calls].count("details") == 5
+    assert assistant.max_in_flight == 2
+
+
+def test_classification_usage_counts_in_the_scenario_totals(assistant):
+    graph_runner = QAGraph()
+    asyncio.run(collect(graph_runner, graph_runner.get_memory_graph(), assistant.inputs(2),
+                        {"configurable": {"thread_id": "run"}}, 2))
+
+    tracker = graph_runner.usage_tracker
+    # every stub run uses 20 tokens, one classification per test case
+    assert tracker.by_node["sub_assist_stage1"]["total_tokens"] == 2 * assistant.tests_per_scenario * 20
+    assert tracker.assistant["total_tokens"] == 20 * len(assistant.calls)
+    assert sum(usage["total_tokens"] for usage in tracker.by_scenario.values()) == tracker.assistant["total_tokens"]
+
+
+def test_the_usage_limit_fails_the_remaining_scenarios(assistant, monkeypatch):
+    from qa_agent import tc_graph
+
+    # every assistant run costs more than this
+    monkeypatch.setattr(tc_graph, "usage_limit", 0.0)
+    monkeypatch.setattr("builtins.input", lambda prompt="": pytest.fail("asked for input"))
+    graph_runner = QAGraph()
+    results = asyncio.run(collect(graph_runner, graph_runner.get_memory_graph(), assistant.inputs(3),
+                                  {"configurable": {"thread_id": "run"}}, 1))
+
+    assert sorted(result["scenario_id"] for result in results) == [1, 2, 3]
+    for result in results:
+        assert result["error"].startswith("Usage limit exceeded: $") and result["test_details_list"] == []
+    # the scenarios after the one which passed the limit never ran
+    assert {scenario for scenario, _ in assistant.calls} == {1}
@@ -0,0 +1,122 @@
+import asyncio
+import os
+from typing import TypedDict
+
+import pytest
+from langgraph.graph import END, StateGraph
+
+from qa_agent.tracing import JsonlSpanExporter, Tracer, current_span, noop_span, payload_size, read_spans, summarize
+
+
+@pytest.fixture
+def trace_file(tmp_path):
+    return str(tmp_path / "trace.jsonl")
+
+
+@pytest.fixture
+def tracer(trace_file):
+    return Tracer(JsonlSpanExporter(trace_file))
+
+
+def spans_by_name(trace_file) -> dict:
+    return {span["name"]: span for span in read_spans(trace_file)}
+
+
+def test_without_an_exporter_tracing_is_a_noop():
+    tracer = Tracer()
+
+    def node(state):
+        return state
+
+    assert tracer.traced_node("node", node) is node
+    with tracer.span("assistant_run") as span:
+        assert span is noop_span and current_span() is noop_span
+
+
+def test_spans_nest_across_tasks_and_threads(tracer, trace_file):
+    async def run():
+        with tracer.span("graph", run_id="run-1") as root:
+            root.set(scenarios=2)
+
+            async def node():
+                with tracer.span("assistant_run", tokens=10):
+                    current_span().add("retries")
+                    current_span().add("retries")
+
+            await asyncio.gather(asyncio.ensure_future(node()), asyncio.to_thread(checkpoint))
+
+    def checkpoint():
+        with tracer.span("checkpoint_write"):
+            pass
+
+    asyncio.run(run())
+    spans = spans_by_name(trace_file)
+    root = spans["graph"]
+    assert root["parentSpanId"] == "" and root["attributes"] == {"qa.run_id": "run-1", "scenarios": 2}
+    for name in ("assistant_run", "checkpoint_write"):
+        assert spans[name]["parentSpanId"] == root["spanId"] and spans[name]["traceId"] == root["traceId"]
+    assert spans["assistant_run"]["attributes"] == {"tokens": 10, "retries": 2}
+
+
+def test_runs_keep_one_trace_id(tracer, trace_file):
+    for _ in range(2):
+        with tracer.span("graph", run_id="run-1"):
+            pass
+    assert len({span["traceId"] for span in read_spans(trace_file)}) == 1
+
+
+def test_errors_are_recorded_and_raised(tracer, trace_file):
+    with pytest.raises(ValueError):
+        with tracer.span("assistant_run", run_id="run-1"):
+            raise ValueError("bad answer")
+    span = read_spans(trace_file)[0]
+    assert span["status"] == {"code": 2, "message": "ValueError: bad answer"}
+
+
+class StepState(TypedDict):
+    steps: int
+
+
+def test_traced_nodes_take_the_run_id_of_the_graph(tracer, trace_file):
+    async def step(state: StepState):
+        with tracer.span("assistant_run"):
+            return {"steps": state["steps"] + 1}
+
+    builder = StateGraph(StepState)
+    builder.add_node("step", tracer.traced_node("step", step))
+    builder.set_entry_point("step")
+    builder.add_edge("step", END)
+    asyncio.run(builder.compile().ainvoke({"steps": 0}, {"configurable": {"thread_id": "run-7"}}))
+
+    spans = spans_by_name(trace_file)
+    assert spans["step"]["attributes"] == {"qa.run_id": "run-7", "node": "step"}
+    assert spans["assistant_run"]["parentSpanId"] == spans["step"]["spanId"]
+
+
+def test_child_spans_are_batched_until_the_root_ends(tracer, trace_file):
+    with tracer.span("graph", run_id="run-1"):
+        with tracer.span("assistant_run"):
+            pass
+        # nothing is written while the run is going
+        assert not os.path.exists(trace_file)
+    assert len(read_spans(trace_file)) == 2
+
+
+def test_summarize_splits_self_time():
+    spans = [
+        {"traceId": "t", "spanId": "root", "parentSpanId": "", "name": "graph", "startTimeUnixNano": "0",
+         "endTimeUnixNano": "4000000000", "duration": 4.0, "attributes": {"qa.run_id": "run-1"},
+         "status": {"code": 1}},
+        {"traceId": "t", "spanId": "child", "parentSpanId": "root", "name": "assistant_run",
+         "startTimeUnixNano": "0", "endTimeUnixNano": "3000000000", "duration": 3.0,
+         "attributes": {"tokens": 20, "rate_limited": 1}, "status": {"code": 2}},
+    ]
+    run = summarize(spans)["run-1"]
+    assert run["wall_time"] == 4.0 and run["errors"] == 1
+    assert run["names"]["graph"]["self"] == 1.0 and run["names"]["assistant_run"]["self"] == 3.0
+    assert run["names"]["assistant_run"]["tokens"] == 20 and run["names"]["assistant_run"]["rate_limited"] == 1
+
+
+@pytest.mark.parametrize("value, size", [(None, 0), ("abc", 3), (b"ab", 2), ({"a": 1}, 8)])
+def test_payload_size(value, size):
+    assert payload_size(value) == size